@@ -0,0 +1,149 @@
+"""
+エラーハンドリングミドルウェアのベンチマーク
+
+BaseHTTPMiddleware 版（旧実装）と ASGI ミドルウェア版（現行実装）で、
+/health と /license/confirm の1リクエストあたりの処理時間を比較する。
+Stripe・Firestore への問い合わせと流量制限（同じデバイスへの連続した要求で429になる）は
+モックに差し替え、ミドルウェアの差だけを測る。
+
+実行方法（backend ディレクトリで実行）:
+    python benchmarks/bench_error_middleware.py --requests 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import traceback
+import uuid
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import Request, HTTPException  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from starlette.middleware import Middleware  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware  # noqa: E402
+from entitlements import MutationResult  # noqa: E402
+from middleware import ErrorHandlingMiddleware, logger  # noqa: E402
+from validation import ValidationError  # noqa: E402
+import main  # noqa: E402
+
+
+class LegacyErrorHandlingMiddleware(BaseHTTPMiddleware):
+    """比較用: BaseHTTPMiddleware を使用していた旧実装"""
+
+    async def dispatch(self, request: Request, call_next):
+        try:
+            response = await call_next(request)
+            return response
+        except ValidationError as e:
+            logger.warning(f"Validation error: {e.error_code} - {e.message}")
+            return JSONResponse(status_code=e.status_code,
+                                content={"error": e.error_code, "message": e.message})
+        except HTTPException as e:
+            logger.warning(f"HTTP exception: {e.status_code} - {e.detail}")
+            if isinstance(e.detail, dict):
+                content = e.detail
+            else:
+                content = {"error": "http_error", "message": str(e.detail)}
+            return JSONResponse(status_code=e.status_code, content=content)
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            return JSONResponse(status_code=500, content={
+                "error": "internal_server_error",
+                "message": "予期しないエラーが発生しました"
+            })
+
+
+def use_middleware(middleware_class) -> None:
+    """アプリのエラーハンドリングミドルウェアを差し替え、次のリクエストでスタックを再構築させる"""
+    main.app.user_middleware = [
+        Middleware(middleware_class)
+        if m.cls in (ErrorHandlingMiddleware, LegacyErrorHandlingMiddleware) else m
+        for m in main.app.user_middleware
+    ]
+    main.app.middleware_stack = None
+
+
+async def call(app, method: str, path: str, body: bytes = b'') -> int:
+    """ASGIアプリを直接呼び出し、ステータスコードを返す（HTTPクライアントの処理時間を含めない）"""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'root_path': '', 'query_string': b'', 'server': ('bench', 80), 'client': ('bench', 1),
+        'headers': [(b'host', b'bench'), (b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode())],
+    }
+    request_sent = False
+    status = 0
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await asyncio.sleep(3600)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(scope, receive, send)
+    return status
+
+
+async def measure(method: str, path: str, body: bytes, requests: int) -> float:
+    """1リクエストあたりの平均処理時間（マイクロ秒）を測定"""
+    for _ in range(min(200, requests)):
+        await call(main.app, method, path, body)
+    samples = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(requests):
+            status = await call(main.app, method, path, body)
+        samples.append((time.perf_counter() - start) / requests * 1e6)
+        assert status == 200, f"{path} returned {status}"
+    return statistics.median(samples)
+
+
+def main_benchmark(requests: int) -> None:
+    body = json.dumps({'device_id': str(uuid.uuid4()), 'purchase_token': 'cs_test_benchmark'}).encode()
+    targets = [('GET', '/health', b''), ('POST', '/license/confirm', body)]
+    variants = [('BaseHTTPMiddleware', LegacyErrorHandlingMiddleware),
+                ('ASGI middleware', ErrorHandlingMiddleware)]
+
+    # エンドポイントの成功時のログ出力（構造化ログ）はどちらの実装でも同じため、測定中は抑止する
+    # （ASGI ミドルウェアのアクセスログは現行実装の処理に含まれるため抑止しない）
+    with patch.object(main.logger, 'disabled', True), \
+         patch('main.stripe_config.is_initialized', return_value=True), \
+         patch('main.firestore_config.is_initialized', return_value=True), \
+         patch('main.admission_controller.check', return_value=0.0), \
+         patch('main.firestore_config.get_client', return_value=MagicMock()), \
+         patch('main.device_cache.find_processed', return_value=None), \
+         patch('main.device_cache.record_mutation'), \
+         patch('main._get_session_payment_status', return_value='paid'), \
+         patch('main.EntitlementMutator.apply_license_purchase', return_value=MutationResult(applied=True)):
+        results = {}
+        for name, middleware_class in variants:
+            use_middleware(middleware_class)
+            for method, path, payload in targets:
+                results[(name, path)] = asyncio.run(measure(method, path, payload, requests))
+    use_middleware(ErrorHandlingMiddleware)
+
+    print(f"{'endpoint':<20}{'BaseHTTPMiddleware':>22}{'ASGI middleware':>20}{'speedup':>10}")
+    for _, path, _ in targets:
+        before = results[('BaseHTTPMiddleware', path)]
+        after = results[('ASGI middleware', path)]
+        print(f"{path:<20}{before:>19.1f} us{after:>17.1f} us{before / after:>9.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000, help='1回の測定でのリクエスト数')
+    main_benchmark(parser.parse_args().requests)
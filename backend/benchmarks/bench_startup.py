@@ -0,0 +1,101 @@
+"""
+起動時間のベンチマーク
+
+新しいプロセスで main:app を起動し、次の2つを測定する。
+- import time: main モジュールのインポートにかかる時間
+- time-to-first-response: プロセス起動から /health が最初に200を返すまでの時間（lifespan の起動処理を含む）
+
+--compare-eager を指定すると、Stripe・Firebase Admin SDKを main より先に読み込んだ場合
+（遅延インポート導入前と同じ読み込み順）とも比較する。
+サービスアカウントファイルがない環境ではFirestoreの初期化・ウォームアップは失敗扱いで即座に終わるため、
+本番の起動時間にはFirestoreへの接続確立の時間が加わる。
+
+実行方法（backend ディレクトリで実行）:
+    python benchmarks/bench_startup.py --runs 5 --compare-eager
+"""
+import argparse
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 遅延インポート導入前と同じく、SDKを先に読み込むための前処理
+EAGER_PRELUDE = "import stripe, firebase_admin, firebase_admin.firestore\n"
+
+
+def measure_import(prelude: str) -> float:
+    """新しいプロセスで main のインポート時間（秒）を測定"""
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        f"{prelude}"
+        "import main\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', code], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    """空いているTCPポートを取得"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_response(prelude: str, timeout: float = 60.0) -> float:
+    """プロセス起動から /health が200を返すまでの時間（秒）を測定"""
+    port = free_port()
+    code = (
+        f"{prelude}"
+        "import uvicorn\n"
+        f"uvicorn.run('main:app', host='127.0.0.1', port={port}, log_level='warning', access_log=False)\n"
+    )
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-c', code], cwd=BACKEND_DIR,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+                conn.request('GET', '/health')
+                if conn.getresponse().status == 200:
+                    return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.005)
+        raise TimeoutError(f"/health did not respond within {timeout} seconds")
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def report(label: str, prelude: str, runs: int) -> None:
+    """インポート時間と初回応答までの時間の中央値を出力"""
+    imports = [measure_import(prelude) for _ in range(runs)]
+    first_responses = [measure_first_response(prelude) for _ in range(runs)]
+    print(f"{label:<10}{statistics.median(imports) * 1000:>14.0f} ms"
+          f"{statistics.median(first_responses) * 1000:>24.0f} ms")
+
+
+def main(runs: int, compare_eager: bool) -> None:
+    print(f"{'mode':<10}{'import time':>17}{'time-to-first-response':>27}")
+    report('lazy', '', runs)
+    if compare_eager:
+        report('eager', EAGER_PRELUDE, runs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='測定回数（中央値を出力）')
+    parser.add_argument('--compare-eager', action='store_true', help='SDKを先に読み込んだ場合と比較する')
+    args = parser.parse_args()
+    main(args.runs, args.compare_eager)
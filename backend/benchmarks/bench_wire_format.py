@@ -0,0 +1,80 @@
+"""
+ハートビートのアップロード形式のベンチマーク
+
+1日分（1440件、1分間隔・数秒のずれあり）のハートビートとアプリごとの利用時間について、
+JSON（無圧縮・gzip）とバイナリ形式（heartbeat_codec、無圧縮・zlib）のサイズと、
+サーバー側の解析（gzip の展開・JSON の解析またはバイナリのデコード）の処理時間を比較する。
+
+実行方法（backend ディレクトリで実行）:
+    python benchmarks/bench_wire_format.py --iterations 2000 --packages 30
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from heartbeat_codec import decode_payload, encode_payload  # noqa: E402
+from heartbeats import decode_body  # noqa: E402
+
+MINUTE = 60 * 1000
+
+
+def sample_upload(packages: int, seed: int = 0):
+    """1日分のハートビートと利用時間"""
+    rng = random.Random(seed)
+    start = 1_772_409_600_000
+    timestamps = [start + i * MINUTE + rng.randint(0, 3000) for i in range(1440)]
+    usage = {f"com.example.app{i:03d}": rng.randint(0, 240) for i in range(packages)}
+    return timestamps, usage
+
+
+def decode_json(body: bytes, encoding):
+    payload = json.loads(decode_body(body, encoding))
+    return payload['timestamps'], payload['usage']
+
+
+def decode_binary(body: bytes, encoding):
+    payload = decode_payload(decode_body(body, encoding))
+    return payload.timestamps, payload.usage
+
+
+def measure(fn, body: bytes, encoding, iterations: int) -> float:
+    """1回あたりの処理時間（マイクロ秒）"""
+    fn(body, encoding)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(body, encoding)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main_benchmark(iterations: int, packages: int) -> None:
+    timestamps, usage = sample_upload(packages)
+    raw_json = json.dumps({'timestamps': timestamps, 'usage': usage}).encode()
+    variants = [
+        ('JSON', decode_json, raw_json, None),
+        ('JSON + gzip', decode_json, gzip.compress(raw_json), 'gzip'),
+        ('binary', decode_binary, encode_payload(timestamps, usage), None),
+        ('binary + zlib', decode_binary, encode_payload(timestamps, usage, compress=True), None),
+    ]
+
+    for _, fn, body, encoding in variants:
+        assert fn(body, encoding) == (timestamps, usage)
+
+    print(f"{'format':<16}{'bytes':>10}{'ratio':>8}{'decode':>14}{'heartbeats/s':>16}")
+    for name, fn, body, encoding in variants:
+        elapsed = measure(fn, body, encoding, iterations)
+        print(f"{name:<16}{len(body):>10}{len(body) / len(raw_json):>8.2f}{elapsed:>11.1f} us"
+              f"{len(timestamps) / elapsed * 1e6:>16,.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=2000, help='1形式あたりのデコード回数')
+    parser.add_argument('--packages', type=int, default=30, help='利用時間を送るアプリの数')
+    args = parser.parse_args()
+    main_benchmark(args.iterations, args.packages)
@@ -3,11 +3,35 @@ Timekeeper Backend Configuration
 Firestoreクライアントの設定と初期化を管理
 """
 import os
-from typing import Optional
-import firebase_admin
-from firebase_admin import credentials, firestore
-from google.cloud.firestore import Client
-import stripe # Stripeライブラリをインポート
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Optional
+from lazy_imports import lazy_import
+from metrics import FIRESTORE_OPERATION_DURATION, metrics
+from structured_logging import get_logger
+
+if TYPE_CHECKING:
+    from google.cloud.firestore import Client
+
+logger = get_logger(__name__)
+
+# 起動時間短縮のため、StripeとFirebase Admin SDKは初期化時に読み込む
+stripe = lazy_import('stripe')
+firebase_admin = lazy_import('firebase_admin')
+
+
+def _load_firebase_admin() -> None:
+    """Firebase Admin SDKのサブモジュール（credentials・firestore）を読み込む"""
+    global credentials, firestore
+    from firebase_admin import credentials, firestore
+
+
+def __getattr__(name: str) -> Any:
+    """モジュール外から credentials・firestore を参照された場合に読み込む"""
+    if name in ('credentials', 'firestore'):
+        _load_firebase_admin()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class StripeConfig:
@@ -16,21 +40,28 @@ class StripeConfig:
     def __init__(self):
         self.api_key: Optional[str] = os.getenv('STRIPE_API_KEY')
         self.webhook_secret: Optional[str] = os.getenv('STRIPE_WEBHOOK_SECRET') # 将来的にWebhookで使用する可能性を考慮
+        # 接続先の上書き（負荷試験でStripeのスタンドインに向ける場合のみ設定）
+        self.api_base: Optional[str] = os.getenv('STRIPE_API_BASE')
         self._initialized: bool = False
-        self.initialize_stripe()
+        self._attempted: bool = False
 
     def initialize_stripe(self) -> bool:
-        """Stripe APIキーを設定"""
+        """Stripe APIキーを設定（Stripe SDKの読み込みを含むため、起動処理で呼び出す）"""
+        self._attempted = True
         if self.api_key:
             stripe.api_key = self.api_key
+            if self.api_base:
+                stripe.api_base = self.api_base
             self._initialized = True
-            print("Stripe initialized successfully")
+            logger.info("Stripe initialized successfully")
             return True
-        print("Warning: STRIPE_API_KEY not found in environment variables.")
+        logger.warning("STRIPE_API_KEY not found in environment variables.")
         return False
 
     def is_initialized(self) -> bool:
-        """Stripeが初期化済みかどうかを確認"""
+        """Stripeが初期化済みかどうかを確認（未初期化の場合は初期化を試みる）"""
+        if not self._attempted:
+            self.initialize_stripe()
         return self._initialized
 
 
@@ -43,20 +74,45 @@ class FirestoreConfig:
             'timekee-b5863-firebase-adminsdk-fbsvc-9ad9aa5ac6.json'
         )
         self.environment: str = os.getenv('ENVIRONMENT', 'development')
-        self._client: Optional[Client] = None
+        self._client: Optional['Client'] = None
         self._initialized: bool = False
+        # 初期化に失敗した場合、get_client() は次の再試行時刻まで初期化を試みずにNoneを返す
+        # （再試行の間隔は失敗ごとに倍にし、上限で頭打ちにする）
+        self.init_retry_seconds: float = float(os.getenv('FIRESTORE_INIT_RETRY_SECONDS', '5'))
+        self.init_retry_max_seconds: float = float(os.getenv('FIRESTORE_INIT_RETRY_MAX_SECONDS', '300'))
+        self._init_failures: int = 0
+        self._next_init_attempt: float = 0.0
+        self._init_lock = threading.Lock()
     
     def initialize_firestore(self) -> bool:
         """
         Firestoreクライアントを初期化
         
         Returns:
-            bool: 初期化が成功した場合True、失敗した場合False
+            bool: 初期化が成功した場合True、失敗した場合False（再試行時刻の前の場合は試みずにFalse）
         """
         if self._initialized:
             return True
-            
+
+        with self._init_lock:
+            if self._initialized:
+                return True
+            # ロック待ちの間に他のスレッドが失敗した場合は、同じ障害で初期化を繰り返さない
+            if time.monotonic() < self._next_init_attempt:
+                return False
+            success = self._initialize_locked()
+            if success:
+                self._init_failures = 0
+                self._next_init_attempt = 0.0
+            else:
+                self._record_init_failure()
+            return success
+
+    def _initialize_locked(self) -> bool:
+        """初期化の本体（_init_lock を保持して呼び出す）"""
         try:
+            _load_firebase_admin()
+
             # サービスアカウントファイルのパスを解決
             service_account_file = os.path.join(
                 os.path.dirname(__file__), 
@@ -64,9 +120,12 @@ class FirestoreConfig:
             )
             
             if not os.path.exists(service_account_file):
-                print(f"Error: Service account file not found at {service_account_file}")
-                print(f"Current working directory: {os.getcwd()}")
-                print(f"Files in backend directory: {os.listdir(os.path.dirname(__file__))}")
+                # ディレクトリの一覧は診断用のため、最初の失敗時のみ出力する
+                diagnostics = {} if self._init_failures else {
+                    'cwd': os.getcwd(),
+                    'backend_files': os.listdir(os.path.dirname(__file__))
+                }
+                logger.error(f"Service account file not found at {service_account_file}", extra=diagnostics)
                 return False
             
             # Firebase Admin SDKの初期化（既に初期化されている場合はスキップ）
@@ -78,21 +137,46 @@ class FirestoreConfig:
             self._client = firestore.client()
             self._initialized = True
             
-            print(f"Firestore initialized successfully in {self.environment} environment")
+            logger.info(f"Firestore initialized successfully in {self.environment} environment")
             return True
             
         except Exception as e:
-            print(f"Failed to initialize Firestore: {str(e)}")
+            if self._init_failures:
+                logger.error(f"Failed to initialize Firestore: {str(e)}")
+            else:
+                logger.exception(f"Failed to initialize Firestore: {str(e)}")
             return False
+
+    def _record_init_failure(self) -> None:
+        """初期化の失敗を記録し、次の再試行時刻を決める"""
+        delay = min(self.init_retry_max_seconds, self.init_retry_seconds * (2 ** self._init_failures))
+        self._init_failures += 1
+        self._next_init_attempt = time.monotonic() + delay
+        logger.warning("Firestore initialization failed, backing off", extra={
+            'failures': self._init_failures, 'retry_in_seconds': delay
+        })
+
+    def retry_after(self) -> float:
+        """
+        初期化を再試行するまでの秒数（Retry-After ヘッダーの値に使用）
+
+        Returns:
+            float: 秒数（再試行を待っていない場合は FIRESTORE_INIT_RETRY_SECONDS）
+        """
+        remaining = self._next_init_attempt - time.monotonic()
+        return remaining if remaining > 0 else self.init_retry_seconds
     
-    def get_client(self) -> Optional[Client]:
+    def get_client(self) -> Optional['Client']:
         """
         Firestoreクライアントを取得
+        初期化に失敗した後は、再試行時刻まで初期化を試みずにNoneを返す
         
         Returns:
             Optional[Client]: 初期化済みのFirestoreクライアント、未初期化の場合None
         """
         if not self._initialized:
+            if time.monotonic() < self._next_init_attempt:
+                return None
             if not self.initialize_firestore():
                 return None
         return self._client
@@ -105,6 +189,20 @@ class FirestoreConfig:
             bool: 初期化済みの場合True
         """
         return self._initialized
+
+    def warm_up(self) -> None:
+        """
+        gRPCチャネルの接続と認証トークンの取得を事前に済ませる
+        起動処理（リクエスト受付前）で呼び出し、最初のリクエストが接続確立を待たないようにする
+        FIRESTORE_WARMUP=false で無効化できる
+        """
+        if not self._initialized or os.getenv('FIRESTORE_WARMUP', 'true').lower() == 'false':
+            return
+        try:
+            with metrics.timer(FIRESTORE_OPERATION_DURATION, 'warm_up'):
+                self._client.collection('test_connection').document('warmup').get()
+        except Exception as e:
+            logger.warning(f"Firestore warm-up failed: {str(e)}")
     
     def test_connection(self) -> dict:
         """
@@ -121,6 +219,7 @@ class FirestoreConfig:
             }
         
         try:
+            _load_firebase_admin()
             # テスト用のドキュメントを作成・読み取り
             test_collection = 'test_connection'
             test_doc_id = 'connection_test'
@@ -133,13 +232,16 @@ class FirestoreConfig:
             }
             
             # ドキュメントを書き込み
-            doc_ref.set(test_data)
+            with metrics.timer(FIRESTORE_OPERATION_DURATION, 'set'):
+                doc_ref.set(test_data)
             
             # ドキュメントを読み取り
-            doc = doc_ref.get()
+            with metrics.timer(FIRESTORE_OPERATION_DURATION, 'get'):
+                doc = doc_ref.get()
             if doc.exists:
                 # テスト用ドキュメントを削除
-                doc_ref.delete()
+                with metrics.timer(FIRESTORE_OPERATION_DURATION, 'delete'):
+                    doc_ref.delete()
                 return {
                     "status": "success",
                     "message": "Firestore connection test successful",
@@ -15,6 +15,11 @@ echo "📦 Dockerイメージをビルド中..."
 gcloud builds submit --tag ${IMAGE_NAME}
 
 # 2. Cloud Run にデプロイ
+# Webhookイベントは /tmp（メモリ上）のキューに保存した時点で応答し、バックグラウンドのワーカーが反映する。
+# リクエスト外でもワーカーが動くよう CPU を常時割り当て（--no-cpu-throttling）、
+# スケールインでキューが失われにくいよう最低1インスタンスを維持する。
+# それでも失われたイベントは STRIPE_WEBHOOK_SECRET 設定時に起動する突き合わせ処理
+# （WEBHOOK_RECONCILE_INTERVAL_SECONDS / WEBHOOK_RECONCILE_LOOKBACK_SECONDS）が回収する。
 echo "🌐 Cloud Run にデプロイ中..."
 gcloud run deploy ${SERVICE_NAME} \
   --image ${IMAGE_NAME} \
@@ -24,9 +29,12 @@ gcloud run deploy ${SERVICE_NAME} \
   --port 8080 \
   --memory 512Mi \
   --cpu 1 \
-  --min-instances 0 \
+  --cpu-boost \
+  --no-cpu-throttling \
+  --min-instances 1 \
   --max-instances 10 \
-  --set-env-vars ENVIRONMENT=production \
+  --concurrency 80 \
+  --set-env-vars ENVIRONMENT=production,CONCURRENCY=80 \
   --timeout 300
 
 echo "✅ デプロイ完了！"
@@ -40,4 +48,7 @@ echo "   gcloud run services update ${SERVICE_NAME} --region=${REGION} --set-env
 echo ""
 echo "2. Firebase サービスアカウントキーを設定:"
 echo "   gcloud secrets create firebase-service-account --data-file=timekee-b5863-firebase-adminsdk-fbsvc-9ad9aa5ac6.json"
-echo "   gcloud run services update ${SERVICE_NAME} --region=${REGION} --set-env-vars FIREBASE_SERVICE_ACCOUNT_PATH=/secrets/firebase-service-account" 
\ No newline at end of file
+echo "   gcloud run services update ${SERVICE_NAME} --region=${REGION} --set-env-vars FIREBASE_SERVICE_ACCOUNT_PATH=/secrets/firebase-service-account"
+echo ""
+echo "3. 処理済みセッション（冪等性レコード）のTTLポリシーを設定（初回のみ）:"
+echo "   gcloud firestore fields ttls update expires_at --collection-group=processed_sessions --enable-ttl --project=${PROJECT_ID}"
@@ -0,0 +1,222 @@
+"""
+Timekeeper Backend Device State Cache
+デバイス状態のプロセス内キャッシュ（Firestoreスナップショットリスナーによる無効化付き）
+"""
+import asyncio
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional
+from device_repository import DeviceState, device_repository
+from io_executor import io_executor
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class CachedDevice:
+    """キャッシュされたデバイス状態"""
+
+    __slots__ = ('exists', 'unlock_count', 'last_unlock_date', 'license_purchased', 'recent_sessions')
+
+    def __init__(self, recent_sessions: int):
+        self.exists: bool = False
+        self.unlock_count: int = 0
+        self.last_unlock_date: Optional[str] = None
+        self.license_purchased: bool = False
+        # このデバイスに反映済みであることが確定しているCheckout Session ID（新しい順に上限件数まで）
+        self.recent_sessions: deque = deque(maxlen=recent_sessions)
+
+    def remember_session(self, session_id: Optional[str]) -> None:
+        """反映済みのSession IDを記録"""
+        if session_id and session_id not in self.recent_sessions:
+            self.recent_sessions.appendleft(session_id)
+
+
+class DeviceStateCache:
+    """
+    デバイス状態のサイズ上限付きLRUキャッシュ
+
+    購入反映の結果を書き込み時にそのまま反映し（ライトスルー）、
+    キャッシュ中のデバイスごとにFirestoreのスナップショットリスナーを張って
+    他インスタンスによる変更を取り込む。リスナー数はキャッシュ上限で抑えられ、
+    エントリの破棄時に購読を解除する。
+    リスナー1つにつきSDKのバックグラウンドスレッド1本とgRPCの Listen ストリーム1本を保持するため、
+    上限（DEVICE_CACHE_MAX_ENTRIES）は1 CPU・512Mi のインスタンスを前提に小さく抑えている。
+    リスナーの登録はストリームの開始を伴うため、イベントループを塞がないようスレッドプールで行う。
+    確認APIのリトライや確認API直後に届くWebhookは、反映済みセッションの判定と
+    現在の状態をFirestoreに問い合わせずにメモリから返せる。
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, recent_sessions: int = 8):
+        self.max_entries: int = max_entries if max_entries is not None else int(
+            os.getenv('DEVICE_CACHE_MAX_ENTRIES', '64')
+        )
+        self.recent_sessions = recent_sessions
+        self._entries: "OrderedDict[str, CachedDevice]" = OrderedDict()
+        self._watches: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, device_id: str) -> Optional[CachedDevice]:
+        """
+        デバイス状態を取得
+
+        Args:
+            device_id: デバイスID
+
+        Returns:
+            Optional[CachedDevice]: キャッシュ済みの状態、未登録の場合None
+        """
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None:
+                self._entries.move_to_end(device_id)
+            return entry
+
+    def find_processed(self, device_id: str, session_id: str) -> Optional[CachedDevice]:
+        """
+        セッションがこのデバイスに反映済みであることが分かっている場合に現在の状態を返す
+
+        Args:
+            device_id: デバイスID
+            session_id: Checkout Session ID
+
+        Returns:
+            Optional[CachedDevice]: 反映済みの場合は現在の状態、不明な場合None（Firestoreで判定すること）
+        """
+        entry = self.get(device_id)
+        if entry is not None and entry.exists and session_id in entry.recent_sessions:
+            return entry
+        return None
+
+    def record_mutation(self, db, device_id: str, session_id: str, product_type: str, result: Any) -> None:
+        """
+        購入反映の結果をキャッシュに書き込む（ライトスルー）
+
+        Args:
+            db: Firestoreクライアント（スナップショットリスナーの登録に使用）
+            device_id: デバイスID
+            session_id: 反映（または処理済みと判定）したCheckout Session ID
+            product_type: 商品種別（license / daypass）
+            result: EntitlementMutator の MutationResult
+        """
+        if self.max_entries <= 0 or (not result.device_exists and not result.applied):
+            return
+
+        with self._lock:
+            entry = self._entries.get(device_id)
+            is_new = entry is None
+            if is_new:
+                entry = CachedDevice(self.recent_sessions)
+                self._entries[device_id] = entry
+            self._entries.move_to_end(device_id)
+            entry.exists = True
+            entry.unlock_count = result.unlock_count
+            entry.last_unlock_date = result.last_unlock_date
+            if product_type == 'license':
+                entry.license_purchased = True
+            entry.remember_session(session_id)
+            evicted = self._evict_locked()
+
+        if is_new:
+            io_executor.submit(self._watch, db, device_id)
+        self._unsubscribe(evicted)
+
+    def invalidate(self, device_id: str) -> None:
+        """
+        デバイス状態を破棄し、スナップショットリスナーを解除
+
+        Args:
+            device_id: デバイスID
+        """
+        with self._lock:
+            self._entries.pop(device_id, None)
+            watch = self._watches.pop(device_id, None)
+        self._unsubscribe([watch] if watch is not None else [])
+
+    async def aclose(self, timeout: float = 5.0) -> None:
+        """
+        全エントリを破棄し、全てのスナップショットリスナーをスレッドプールで並行して解除
+        （解除はリスナーのスレッドの終了待ちを伴うため、終了処理でイベントループを塞がない）
+
+        Args:
+            timeout: 解除の完了を待つ最大秒数（超えた分は待たずに終了する）
+        """
+        with self._lock:
+            self._entries.clear()
+            watches = list(self._watches.values())
+            self._watches.clear()
+        if not watches:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(io_executor.run(watch.unsubscribe) for watch in watches), return_exceptions=True),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Timed out unsubscribing device listeners on shutdown", extra={
+                'listener_count': len(watches)
+            })
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _evict_locked(self) -> List[Any]:
+        """上限を超えたエントリを破棄し、解除すべきリスナーを返す（ロック保持中に呼び出す）"""
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            device_id, _ = self._entries.popitem(last=False)
+            watch = self._watches.pop(device_id, None)
+            if watch is not None:
+                evicted.append(watch)
+        return evicted
+
+    def _watch(self, db, device_id: str) -> None:
+        """デバイスドキュメントのスナップショットリスナーを登録（ブロッキング処理のためスレッドプールで実行）"""
+        try:
+            watch = device_repository.reference(db, device_id).on_snapshot(
+                self._make_listener(device_id)
+            )
+        except Exception as e:
+            # リスナーを張れない場合は変更を追跡できないため、キャッシュしない
+            logger.warning(f"Failed to watch device, dropping cache entry: {str(e)}", extra={'device_id': device_id})
+            with self._lock:
+                self._entries.pop(device_id, None)
+            return
+
+        with self._lock:
+            if device_id in self._entries and device_id not in self._watches:
+                self._watches[device_id] = watch
+                return
+        # 登録中にエントリが破棄された場合は即座に解除
+        self._unsubscribe([watch])
+
+    def _make_listener(self, device_id: str) -> Callable:
+        """スナップショットを受け取りキャッシュを更新するコールバックを作成"""
+        def on_snapshot(doc_snapshots, changes, read_time):
+            if not doc_snapshots:
+                return
+            state = DeviceState.from_snapshot(doc_snapshots[-1])
+            with self._lock:
+                entry = self._entries.get(device_id)
+                if entry is None:
+                    return
+                entry.exists = state.exists
+                if not state.exists:
+                    return
+                entry.unlock_count = state.unlock_count
+                entry.last_unlock_date = state.last_unlock_date
+                entry.license_purchased = state.license_purchased
+                entry.remember_session(state.last_session_id)
+        return on_snapshot
+
+    @staticmethod
+    def _unsubscribe(watches: List[Any]) -> None:
+        """リスナーの解除（スレッドの終了待ちを伴うためスレッドプールで実行）"""
+        for watch in watches:
+            io_executor.submit(watch.unsubscribe)
+
+
+# グローバルなデバイス状態キャッシュインスタンス
+device_cache = DeviceStateCache()
@@ -0,0 +1,202 @@
+"""
+Timekeeper Backend Device Repository
+devicesコレクションへのアクセスを一元化するデータアクセス層
+
+読み取りはフィールドマスクで必要なフィールドだけを取得し、辞書ではなく
+__slots__ を持つ DeviceState で返す。確認API・Webhook・キャッシュはすべてこのモジュールの
+get / get_all / put / mutate を経由してデバイスドキュメントを読み書きする。
+"""
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
+from lazy_imports import lazy_import
+from metrics import FIRESTORE_OPERATION_DURATION, metrics
+
+# 起動時間短縮のため、Firestore SDKは初回の書き込み（または起動処理）で読み込む
+firestore = lazy_import('google.cloud.firestore')
+
+DEVICES_COLLECTION = 'devices'
+
+# 書き込みごとにインクリメントするバージョン（ETagなど、変更の有無の判定に使用）
+VERSION_FIELD = 'version'
+# 状態の参照に必要なフィールド
+STATE_FIELDS: Tuple[str, ...] = (
+    'license_purchased', 'unlock_count', 'last_unlock_date', 'last_session_id', VERSION_FIELD
+)
+# 購入反映に必要なフィールド（移行前に処理されたセッションの判定・冪等性レコードへの移行用に processed_purchase_tokens を含む）
+MUTATION_FIELDS: Tuple[str, ...] = STATE_FIELDS + ('processed_purchase_tokens',)
+
+T = TypeVar('T')
+
+
+class DeviceState:
+    """デバイスドキュメントの状態（フィールドマスクで取得したフィールドのみ）"""
+
+    __slots__ = ('reference', 'exists', 'license_purchased', 'unlock_count', 'last_unlock_date',
+                 'last_session_id', 'legacy_session_ids', 'version', 'update_time')
+
+    def __init__(self, reference: Any, exists: bool = False, license_purchased: bool = False,
+                 unlock_count: int = 0, last_unlock_date: Optional[str] = None,
+                 last_session_id: Optional[str] = None, legacy_session_ids: Sequence[str] = (),
+                 version: int = 0, update_time: Any = None):
+        self.reference = reference
+        self.exists = exists
+        self.license_purchased = license_purchased
+        self.unlock_count = unlock_count
+        self.last_unlock_date = last_unlock_date
+        self.last_session_id = last_session_id
+        # 移行前に processed_purchase_tokens へ記録された処理済みセッション（追記は行わず、購入反映の書き込みで冪等性レコードに移す）
+        self.legacy_session_ids = legacy_session_ids
+        # バージョン導入前に作成され、まだ書き込みのないドキュメントは0
+        self.version = version
+        # 書き込みの前提条件に使用する読み取り時点の update_time
+        self.update_time = update_time
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Any) -> 'DeviceState':
+        """
+        スナップショットから状態を作成
+
+        Args:
+            snapshot: デバイスドキュメントのスナップショット
+
+        Returns:
+            DeviceState: デバイスの状態（存在しない場合は exists=False）
+        """
+        if not snapshot.exists:
+            return cls(snapshot.reference)
+        data = snapshot.to_dict() or {}
+        return cls(
+            snapshot.reference,
+            exists=True,
+            license_purchased=bool(data.get('license_purchased', False)),
+            unlock_count=data.get('unlock_count', 0),
+            last_unlock_date=data.get('last_unlock_date'),
+            last_session_id=data.get('last_session_id'),
+            legacy_session_ids=data.get('processed_purchase_tokens') or (),
+            version=data.get(VERSION_FIELD, 0),
+            update_time=snapshot.update_time
+        )
+
+    @property
+    def device_id(self) -> str:
+        return self.reference.id
+
+
+class DeviceRepository:
+    """devicesコレクションの読み書き"""
+
+    def __init__(self, collection: str = DEVICES_COLLECTION):
+        self.collection = collection
+
+    def reference(self, db, device_id: str) -> Any:
+        """
+        デバイスドキュメントの参照を取得
+
+        Args:
+            db: Firestoreクライアント
+            device_id: デバイスID
+
+        Returns:
+            DocumentReference: デバイスドキュメントの参照
+        """
+        return db.collection(self.collection).document(device_id)
+
+    def get(self, db, device_id: str, fields: Iterable[str] = STATE_FIELDS) -> DeviceState:
+        """
+        デバイスの状態を取得
+
+        Args:
+            db: Firestoreクライアント
+            device_id: デバイスID
+            fields: 取得するフィールド
+
+        Returns:
+            DeviceState: デバイスの状態（未登録の場合は exists=False）
+        """
+        with metrics.timer(FIRESTORE_OPERATION_DURATION, 'get'):
+            snapshot = self.reference(db, device_id).get(field_paths=list(fields))
+        return DeviceState.from_snapshot(snapshot)
+
+    def get_all(self, db, device_refs: Sequence[Any], extra_refs: Sequence[Any] = (),
+                fields: Iterable[str] = MUTATION_FIELDS,
+                transaction: Any = None) -> Tuple[List[DeviceState], Dict[str, Any]]:
+        """
+        複数のデバイスと関連ドキュメント（冪等性レコードなど）を1回の読み取りで取得
+
+        フィールドマスクは全ドキュメントに適用されるため、関連ドキュメントは存在の判定にのみ使用すること。
+
+        Args:
+            db: Firestoreクライアント
+            device_refs: デバイスドキュメントの参照
+            extra_refs: 同時に読み取る他のドキュメントの参照
+            fields: デバイスから取得するフィールド
+            transaction: トランザクション内で読み取る場合のトランザクション
+
+        Returns:
+            Tuple: (device_refs と同じ順序の状態, 関連ドキュメントのパス -> スナップショット)
+        """
+        with metrics.timer(FIRESTORE_OPERATION_DURATION, 'get_all'):
+            snapshots = {
+                snapshot.reference.path: snapshot
+                for snapshot in db.get_all(
+                    list(device_refs) + list(extra_refs), field_paths=list(fields), transaction=transaction
+                )
+            }
+        states = [DeviceState.from_snapshot(snapshots[ref.path]) for ref in device_refs]
+        return states, {ref.path: snapshots[ref.path] for ref in extra_refs}
+
+    @staticmethod
+    def put(db, writer: Any, state: DeviceState, data: Dict[str, Any], precondition: bool = False) -> None:
+        """
+        デバイスドキュメントへの書き込みを WriteBatch・トランザクションに追加
+        （バージョンのインクリメントを併せて書き込む）
+
+        Args:
+            db: Firestoreクライアント（前提条件の作成に使用）
+            writer: WriteBatch またはトランザクション
+            state: 読み取り時点の状態
+            data: 書き込む内容
+            precondition: 読み取り後に変更・作成されていないことを前提条件とする場合True
+                （トランザクション外の WriteBatch で使用）
+        """
+        data = {**data, VERSION_FIELD: firestore.Increment(1)}
+        if state.exists:
+            if precondition:
+                writer.update(state.reference, data, option=db.write_option(last_update_time=state.update_time))
+            else:
+                writer.update(state.reference, data)
+        elif precondition:
+            writer.create(state.reference, data)
+        else:
+            writer.set(state.reference, data)
+
+    def mutate(self, db, device_id: str, fn: Callable[[Any, DeviceState, Dict[str, Any]], T],
+               extra_refs: Sequence[Any] = (), fields: Iterable[str] = MUTATION_FIELDS) -> T:
+        """
+        デバイスの状態を読み取り、書き込みを行う関数をトランザクション内で実行
+
+        競合した場合はトランザクションごと再試行されるため、fn は副作用を持たないこと。
+
+        Args:
+            db: Firestoreクライアント
+            device_id: デバイスID
+            fn: (トランザクション, 状態, 関連ドキュメントのスナップショット) を受け取り、
+                put() などで書き込みを追加して結果を返す関数
+            extra_refs: 同時に読み取る他のドキュメントの参照
+            fields: デバイスから取得するフィールド
+
+        Returns:
+            fn の戻り値
+        """
+        device_ref = self.reference(db, device_id)
+
+        def run(transaction):
+            states, extras = self.get_all(db, [device_ref], extra_refs, fields, transaction=transaction)
+            return fn(transaction, states[0], extras)
+
+        with metrics.timer(FIRESTORE_OPERATION_DURATION, 'transaction'):
+            # SDKの読み込みを遅らせるため、transactional デコレータは呼び出し時に適用する
+            return firestore.transactional(run)(db.transaction())
+
+
+# グローバルなデバイスリポジトリインスタンス
+device_repository = DeviceRepository()
@@ -0,0 +1,430 @@
+"""
+Timekeeper Backend Entitlement Mutations
+ライセンス・デイパス購入の反映を原子的に行う
+
+同時に届いた購入反映はフラッシュ間隔の間まとめ、1回の読み取り（get_all）と
+前提条件付きの WriteBatch で書き込む。前提条件が崩れた場合は要求ごとのトランザクションで反映する。
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple, Union
+from device_repository import DeviceState, device_repository
+from lazy_imports import lazy_import
+from metrics import FIRESTORE_OPERATION_DURATION, metrics
+from write_batcher import WriteBatcher
+
+# 起動時間短縮のため、Firestore SDKは初回の購入反映（または起動処理）で読み込む
+firestore = lazy_import('google.cloud.firestore')
+google_exceptions = lazy_import('google.api_core.exceptions')
+
+# 処理済みCheckout Session（冪等性レコード）を保持するコレクション
+# ドキュメントIDはSession ID。expires_at にTTLポリシーを設定して自動削除する
+PROCESSED_SESSIONS_COLLECTION = 'processed_sessions'
+IDEMPOTENCY_TTL_DAYS = int(os.getenv('IDEMPOTENCY_TTL_DAYS', '30'))
+
+# WriteBatch 1回あたりの書き込み上限（Firestoreの制限）
+MAX_BATCH_WRITES = 500
+# 購入反映1回で冪等性レコードに移す processed_purchase_tokens の上限
+# （バッチ上限の要求数の2書き込みと合わせても MAX_BATCH_WRITES に収まる数。残りは次の書き込みで移す）
+LEGACY_MIGRATION_LIMIT = 200
+
+
+class MutationResult:
+    """購入反映の結果"""
+
+    __slots__ = ('applied', 'device_exists', 'unlock_count', 'last_unlock_date')
+
+    def __init__(self, applied: bool, device_exists: bool = True,
+                 unlock_count: int = 0, last_unlock_date: Optional[str] = None):
+        # applied: 今回の呼び出しで書き込みを行った場合True（処理済みトークンの場合False）
+        self.applied = applied
+        self.device_exists = device_exists
+        self.unlock_count = unlock_count
+        self.last_unlock_date = last_unlock_date
+
+
+class PurchaseMutation:
+    """1件の購入反映要求"""
+
+    __slots__ = ('product_type', 'device_id', 'session_id', 'payment_intent')
+
+    def __init__(self, product_type: str, device_id: str, session_id: str,
+                 payment_intent: Optional[str] = None):
+        self.product_type = product_type
+        self.device_id = device_id
+        self.session_id = session_id
+        self.payment_intent = payment_intent
+
+
+def _today_str() -> str:
+    """UTCの今日の日付（YYYY-MM-DD）"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _is_processed(idempotency_snapshot, state: DeviceState, session_id: str) -> bool:
+    """
+    セッションが処理済みかどうかを判定
+
+    冪等性レコードの点検索で判定する。移行前に処理されたセッションは、次の書き込みで
+    冪等性レコードに移されるまでデバイスドキュメントの processed_purchase_tokens にのみ残っているため併せて確認する。
+    """
+    if idempotency_snapshot.exists:
+        return True
+    return session_id in state.legacy_session_ids
+
+
+def within_idempotency_window(created: Optional[int], now: Optional[float] = None) -> bool:
+    """
+    Checkout Sessionが冪等性レコードの保持期間内に作成されたかどうかを判定
+
+    冪等性レコードは反映時（セッション作成以降）から IDEMPOTENCY_TTL_DAYS 日で削除されるため、
+    それより古いセッションは処理済みかどうかを判定できず、再送されると二重に反映されてしまう。
+
+    Args:
+        created: セッションの作成時刻（UNIX時刻。不明な場合None）
+        now: 現在時刻（UNIX時刻、テスト用）
+
+    Returns:
+        bool: 保持期間内、または作成時刻が不明な場合True
+    """
+    if created is None:
+        return True
+    now = datetime.now(timezone.utc).timestamp() if now is None else now
+    return created > now - timedelta(days=IDEMPOTENCY_TTL_DAYS).total_seconds()
+
+
+def _idempotency_record(device_id: str, product_type: str) -> Dict[str, Any]:
+    """冪等性レコードの内容（expires_at はFirestoreのTTLポリシーで削除に使用）"""
+    now = datetime.now(timezone.utc)
+    return {
+        'device_id': device_id,
+        'product_type': product_type,
+        'processed_at': now,
+        'expires_at': now + timedelta(days=IDEMPOTENCY_TTL_DAYS)
+    }
+
+
+def _is_conflict(exc: BaseException) -> bool:
+    """他の書き込みとの競合（前提条件の不一致・作成済み・中断）による失敗かどうか"""
+    return isinstance(exc, (
+        google_exceptions.FailedPrecondition, google_exceptions.Aborted, google_exceptions.AlreadyExists
+    ))
+
+
+def _legacy_migration_count(state: DeviceState) -> int:
+    """購入反映の書き込みで冪等性レコードに移す processed_purchase_tokens の件数"""
+    return min(len(state.legacy_session_ids), LEGACY_MIGRATION_LIMIT)
+
+
+def _migrate_legacy_sessions(db, writer, state: DeviceState, data: Dict[str, Any]) -> None:
+    """
+    移行前の processed_purchase_tokens を冪等性レコードに移す（デバイスへの書き込みに併せて行う）
+
+    レコードは他と同じく IDEMPOTENCY_TTL_DAYS 日で削除され、それより古いセッションは
+    within_idempotency_window で拒否されるため、移した後は配列を参照する必要がない。
+    移しきれなかった分は配列に残し、次の書き込みで移す。
+
+    Args:
+        db: Firestoreクライアント
+        writer: WriteBatch またはトランザクション
+        state: 読み取り時点の状態
+        data: デバイスドキュメントへの書き込み内容（配列の削除・更新を追加する）
+    """
+    count = _legacy_migration_count(state)
+    if not count:
+        return
+    legacy = list(state.legacy_session_ids)
+    for session_id in legacy[:count]:
+        writer.set(db.collection(PROCESSED_SESSIONS_COLLECTION).document(session_id),
+                   _idempotency_record(state.device_id, 'legacy'))
+    data['processed_purchase_tokens'] = legacy[count:] or firestore.DELETE_FIELD
+
+
+def _license_transaction(db, transaction, state: DeviceState, idempotency_snapshot, session_id: str,
+                         payment_intent: Optional[str]) -> MutationResult:
+    """ライセンス購入を反映するトランザクション本体"""
+    # 重複防止: 同じsession_idで既に処理済みかチェック
+    if _is_processed(idempotency_snapshot, state, session_id):
+        return MutationResult(
+            applied=False,
+            device_exists=state.exists,
+            unlock_count=state.unlock_count,
+            last_unlock_date=state.last_unlock_date
+        )
+
+    doc_data = {
+        'license_purchased': True,
+        'license_purchase_date': datetime.now(timezone.utc),
+        # 他インスタンスのデバイス状態キャッシュが反映済みセッションを把握するために記録
+        'last_session_id': session_id
+    }
+    if payment_intent:
+        doc_data['last_successful_payment_intent'] = payment_intent
+
+    _migrate_legacy_sessions(db, transaction, state, doc_data)
+    device_repository.put(db, transaction, state, doc_data)
+    transaction.create(idempotency_snapshot.reference, _idempotency_record(state.device_id, 'license'))
+
+    return MutationResult(
+        applied=True,
+        device_exists=state.exists,
+        unlock_count=state.unlock_count,
+        last_unlock_date=state.last_unlock_date
+    )
+
+
+def _daypass_transaction(db, transaction, state: DeviceState, idempotency_snapshot, session_id: str,
+                         payment_intent: Optional[str]) -> MutationResult:
+    """デイパス購入を反映するトランザクション本体"""
+    if not state.exists:
+        return MutationResult(applied=False, device_exists=False)
+
+    # 重複防止: 同じsession_idで既に処理済みかチェック
+    if _is_processed(idempotency_snapshot, state, session_id):
+        return MutationResult(
+            applied=False,
+            unlock_count=state.unlock_count,
+            last_unlock_date=state.last_unlock_date or _today_str()
+        )
+
+    today_str = _today_str()
+    update_data = {
+        # トランザクション内で読み取った値に対するサーバー側インクリメント
+        'unlock_count': firestore.Increment(1),
+        'last_unlock_date': today_str,
+        'last_session_id': session_id
+    }
+    if payment_intent:
+        update_data['last_successful_payment_intent'] = payment_intent
+    _migrate_legacy_sessions(db, transaction, state, update_data)
+    device_repository.put(db, transaction, state, update_data)
+    transaction.create(idempotency_snapshot.reference, _idempotency_record(state.device_id, 'daypass'))
+
+    return MutationResult(
+        applied=True,
+        unlock_count=state.unlock_count + 1,
+        last_unlock_date=today_str
+    )
+
+
+def _apply_in_transaction(db, mutation: PurchaseMutation) -> MutationResult:
+    """1件の購入反映を個別のトランザクションで行う"""
+    idempotency_ref = db.collection(PROCESSED_SESSIONS_COLLECTION).document(mutation.session_id)
+    transaction_fn = _license_transaction if mutation.product_type == 'license' else _daypass_transaction
+
+    def apply(transaction, state: DeviceState, extras: Dict[str, Any]) -> MutationResult:
+        return transaction_fn(
+            db, transaction, state, extras[idempotency_ref.path], mutation.session_id, mutation.payment_intent
+        )
+
+    return device_repository.mutate(db, mutation.device_id, apply, extra_refs=[idempotency_ref])
+
+
+def _plan_device_write(mutations: List[PurchaseMutation],
+                       state: DeviceState) -> Tuple[Dict[str, Any], List[MutationResult]]:
+    """
+    同じデバイスへの購入反映を1回の書き込みにまとめる
+
+    Returns:
+        Tuple: (デバイスドキュメントへの書き込み内容, 各要求の反映結果)
+    """
+    now = datetime.now(timezone.utc)
+    today_str = _today_str()
+    unlock_count = state.unlock_count
+    last_unlock_date = state.last_unlock_date
+    increments = 0
+    data: Dict[str, Any] = {}
+    results = []
+
+    for mutation in mutations:
+        if mutation.product_type == 'license':
+            data['license_purchased'] = True
+            data['license_purchase_date'] = now
+        else:
+            increments += 1
+            unlock_count += 1
+            last_unlock_date = today_str
+            data['last_unlock_date'] = today_str
+        if mutation.payment_intent:
+            data['last_successful_payment_intent'] = mutation.payment_intent
+        data['last_session_id'] = mutation.session_id
+        results.append(MutationResult(
+            applied=True,
+            device_exists=state.exists,
+            unlock_count=unlock_count,
+            last_unlock_date=last_unlock_date
+        ))
+
+    if increments:
+        data['unlock_count'] = firestore.Increment(increments)
+    return data, results
+
+
+def commit_mutations(db, mutations: List[PurchaseMutation]) -> List[Union[MutationResult, Exception]]:
+    """
+    複数の購入反映をまとめてコミットする（WriteBatcher の commit 関数）
+
+    1回の get_all でデバイスと冪等性レコードを読み取り、処理済み・未登録デバイスを除いた要求を
+    デバイスごとに1件の書き込みにまとめて WriteBatch でコミットする。デバイスへの書き込みは
+    読み取り時点の update_time、冪等性レコードは新規作成を前提条件とするため、
+    他の書き込みと競合した場合はバッチ全体が失敗し、その要求だけを個別のトランザクションで反映し直す。
+    競合以外のエラー（Firestoreの障害など）では反映し直さず、そのバッチの要求すべてにエラーを返す。
+
+    Args:
+        db: Firestoreクライアント
+        mutations: 購入反映要求のリスト
+
+    Returns:
+        List[Union[MutationResult, Exception]]: 要求と同じ順序の反映結果（失敗した要求は例外）
+    """
+    results: List[Union[MutationResult, Exception, None]] = [None] * len(mutations)
+
+    # 同じセッションの要求（確認APIとWebhookの同時到着など）は最初の1件だけを反映する
+    first_index: Dict[str, int] = {}
+    for index, mutation in enumerate(mutations):
+        first_index.setdefault(mutation.session_id, index)
+    unique = sorted(first_index.values())
+
+    device_refs = {
+        mutations[i].device_id: device_repository.reference(db, mutations[i].device_id) for i in unique
+    }
+    idempotency_refs = {
+        mutations[i].session_id: db.collection(PROCESSED_SESSIONS_COLLECTION).document(mutations[i].session_id)
+        for i in unique
+    }
+    device_states, idempotency_snapshots = device_repository.get_all(
+        db, list(device_refs.values()), list(idempotency_refs.values())
+    )
+    states = dict(zip(device_refs, device_states))
+
+    # 処理済み・未登録デバイスの要求を除外し、残りをデバイスごとにまとめる
+    groups: Dict[str, List[int]] = {}
+    for index in unique:
+        mutation = mutations[index]
+        state = states[mutation.device_id]
+        idempotency_snapshot = idempotency_snapshots[idempotency_refs[mutation.session_id].path]
+        if _is_processed(idempotency_snapshot, state, mutation.session_id):
+            results[index] = MutationResult(
+                applied=False,
+                device_exists=state.exists,
+                unlock_count=state.unlock_count,
+                last_unlock_date=state.last_unlock_date or _today_str()
+            )
+        elif mutation.product_type == 'daypass' and not state.exists:
+            results[index] = MutationResult(applied=False, device_exists=False)
+        else:
+            groups.setdefault(mutation.device_id, []).append(index)
+
+    # デバイス単位で分割しないよう、書き込み数の上限ごとにチャンクを作る
+    chunks: List[List[str]] = []
+    chunk: List[str] = []
+    chunk_writes = 0
+    for device_id, indices in groups.items():
+        writes = 1 + len(indices) + _legacy_migration_count(states[device_id])
+        if chunk and chunk_writes + writes > MAX_BATCH_WRITES:
+            chunks.append(chunk)
+            chunk, chunk_writes = [], 0
+        chunk.append(device_id)
+        chunk_writes += writes
+    if chunk:
+        chunks.append(chunk)
+
+    for chunk in chunks:
+        batch = db.batch()
+        planned: Dict[int, MutationResult] = {}
+        for device_id in chunk:
+            indices = groups[device_id]
+            data, device_results = _plan_device_write([mutations[i] for i in indices], states[device_id])
+            _migrate_legacy_sessions(db, batch, states[device_id], data)
+            device_repository.put(db, batch, states[device_id], data, precondition=True)
+            for index, result in zip(indices, device_results):
+                mutation = mutations[index]
+                batch.create(idempotency_refs[mutation.session_id],
+                             _idempotency_record(device_id, mutation.product_type))
+                planned[index] = result
+
+        try:
+            with metrics.timer(FIRESTORE_OPERATION_DURATION, 'batch_commit'):
+                batch.commit()
+            for index, result in planned.items():
+                results[index] = result
+        except Exception as e:
+            if not _is_conflict(e):
+                # Firestoreの障害などは個別のトランザクションでも失敗するため、再試行せずに全要求を失敗させる
+                for index in planned:
+                    results[index] = e
+                continue
+            # 前提条件の不一致（他の書き込みとの競合）でバッチ全体が失敗した場合は個別に反映する
+            for index in planned:
+                try:
+                    results[index] = _apply_in_transaction(db, mutations[index])
+                except Exception as e:
+                    results[index] = e
+
+    # 同じバッチ内で重複していた要求は、最初の要求の結果を処理済みとして返す
+    for index, mutation in enumerate(mutations):
+        if results[index] is None:
+            first = results[first_index[mutation.session_id]]
+            if isinstance(first, Exception):
+                results[index] = first
+            else:
+                results[index] = MutationResult(
+                    applied=False,
+                    device_exists=first.device_exists or first.applied,
+                    unlock_count=first.unlock_count,
+                    last_unlock_date=first.last_unlock_date
+                )
+    return results
+
+
+# 購入反映の書き込みコアレッサー（1件の要求は冪等性レコードとデバイスの2書き込み）
+purchase_write_batcher = WriteBatcher(commit_mutations, max_items=MAX_BATCH_WRITES // 2)
+
+
+class EntitlementMutator:
+    """
+    購入内容をdevicesコレクションに反映する（読み書きは device_repository を経由する）
+
+    冪等性は processed_sessions コレクションのSession ID単位のレコードで判定し、
+    冪等性チェックと更新は原子的に行われるため、
+    確認APIとWebhookが同じセッションで競合しても二重反映やインクリメントの欠落が起きない。
+    同時に届いた要求は purchase_write_batcher でまとめてコミットされる。
+    """
+
+    @staticmethod
+    async def apply_license_purchase(db, device_id: str, session_id: str,
+                                     payment_intent: Optional[str] = None) -> MutationResult:
+        """
+        ライセンス購入を反映（デバイス未登録の場合は新規作成）
+
+        Args:
+            db: Firestoreクライアント
+            device_id: デバイスID
+            session_id: Checkout Session ID（冪等キー）
+            payment_intent: PaymentIntent ID（Webhook経由の場合に記録）
+
+        Returns:
+            MutationResult: 反映結果
+        """
+        return await purchase_write_batcher.submit(
+            db, PurchaseMutation('license', device_id, session_id, payment_intent)
+        )
+
+    @staticmethod
+    async def apply_daypass_unlock(db, device_id: str, session_id: str,
+                                   payment_intent: Optional[str] = None) -> MutationResult:
+        """
+        デイパス購入を反映（unlock_count をインクリメントし last_unlock_date を更新）
+
+        Args:
+            db: Firestoreクライアント
+            device_id: デバイスID
+            session_id: Checkout Session ID（冪等キー）
+            payment_intent: PaymentIntent ID（Webhook経由の場合に記録）
+
+        Returns:
+            MutationResult: 反映結果（デバイス未登録の場合は device_exists=False）
+        """
+        return await purchase_write_batcher.submit(
+            db, PurchaseMutation('daypass', device_id, session_id, payment_intent)
+        )
@@ -0,0 +1,260 @@
+"""
+Timekeeper Backend Gap Analytics
+保存済みハートビートのフリート全体のギャップ分析（バッチジョブ）
+
+heartbeat_buckets をドキュメントID順（= デバイスごと・日付順）にページ単位で読み出し、
+デバイスの境界で区切ったチャンクごとに NumPy 配列へ変換して、ギャップ（np.diff）・閾値判定・
+ヒストグラム・デバイスごとの件数をまとめて計算する。メモリに保持するのは1チャンク分のハートビートと
+固定長のヒストグラムだけで、デバイスごとの集計行はチャンクごとにCSVへ書き出す。
+閾値はアプリの GapDetector（heartbeats モジュール）と同じ。
+
+実行方法（backend ディレクトリで実行）:
+    python gap_analytics.py --output gap_summary.csv --flagged-only
+"""
+import argparse
+import csv
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+import numpy as np
+from heartbeats import HEARTBEAT_BUCKETS_COLLECTION, SECURITY_BREACH_GAP_MS, SUSPICIOUS_GAP_MS
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+MINUTE_MS = 60 * 1000
+
+# ドキュメントIDで並べる場合のフィールドパス（FieldPath.document_id() と同じ値）
+DOCUMENT_ID_FIELD = '__name__'
+
+# ギャップのヒストグラムの区間（ミリ秒、左閉右開。最後の区間は上限なし）
+HISTOGRAM_EDGES_MS = np.array([
+    0, 2 * MINUTE_MS, SUSPICIOUS_GAP_MS, SECURITY_BREACH_GAP_MS, 15 * MINUTE_MS,
+    60 * MINUTE_MS, 6 * 60 * MINUTE_MS, 24 * 60 * MINUTE_MS
+], dtype=np.int64)
+HISTOGRAM_LABELS = ('<2m', '2-3m', '3-5m', '5-15m', '15-60m', '1-6h', '6-24h', '>=24h')
+
+# デバイスごとの集計行
+SUMMARY_DTYPE = np.dtype([
+    ('device_id', 'U64'),
+    ('heartbeats', np.int64),
+    ('first_heartbeat', np.int64),
+    ('last_heartbeat', np.int64),
+    ('suspicious_gaps', np.int64),
+    ('breach_gaps', np.int64),
+    ('max_gap_ms', np.int64),
+    ('flagged_gap_ms', np.int64),
+])
+
+# 1チャンクのハートビート数の目安（デバイスの途中では区切らない）
+DEFAULT_CHUNK_SIZE = 1_000_000
+# Firestoreから1回に読み出すバケット数
+DEFAULT_PAGE_SIZE = 500
+
+
+def stream_buckets(db, collection: str = HEARTBEAT_BUCKETS_COLLECTION,
+                   page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[Tuple[str, List[int]]]:
+    """
+    ハートビートのバケットをドキュメントID順にページ単位で読み出す
+
+    ドキュメントIDは {device_id}_{YYYY-MM-DD} のため、同じデバイスのバケットは連続し、日付順に並ぶ。
+
+    Args:
+        db: Firestoreクライアント
+        collection: バケットのコレクション
+        page_size: 1回に読み出すバケット数
+
+    Returns:
+        Iterator[Tuple[str, List[int]]]: (デバイスID, ハートビート) の列
+    """
+    query = (
+        db.collection(collection)
+        .select(['device_id', 'timestamps'])
+        .order_by(DOCUMENT_ID_FIELD)
+        .limit(page_size)
+    )
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        count = 0
+        for snapshot in page.stream():
+            count += 1
+            last = snapshot
+            data = snapshot.to_dict() or {}
+            yield data.get('device_id') or snapshot.id.rsplit('_', 1)[0], data.get('timestamps') or []
+        if count < page_size:
+            return
+
+
+def iter_device_chunks(buckets: Iterable[Tuple[str, List[int]]],
+                       chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[List[str], np.ndarray, np.ndarray]]:
+    """
+    デバイスごとに連続したバケットの列を、デバイスの境界で区切ったチャンクにまとめる
+
+    Args:
+        buckets: (デバイスID, ハートビート) の列（同じデバイスのバケットが連続していること）
+        chunk_size: 1チャンクのハートビート数の目安
+
+    Returns:
+        Iterator[Tuple[List[str], np.ndarray, np.ndarray]]:
+            (デバイスID, デバイス番号の配列, ハートビートの配列)。デバイス番号はチャンク内のデバイスIDの添字
+    """
+    device_ids: List[str] = []
+    parts: List[List[np.ndarray]] = []
+    size = 0
+    for device_id, timestamps in buckets:
+        values = np.asarray(timestamps, dtype=np.int64)
+        if device_ids and device_ids[-1] == device_id:
+            parts[-1].append(values)
+        else:
+            if size >= chunk_size:
+                yield _to_arrays(device_ids, parts)
+                device_ids, parts, size = [], [], 0
+            device_ids.append(device_id)
+            parts.append([values])
+        size += len(values)
+    if device_ids:
+        yield _to_arrays(device_ids, parts)
+
+
+def _to_arrays(device_ids: List[str], parts: List[List[np.ndarray]]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    per_device = [np.concatenate(device_parts) for device_parts in parts]
+    counts = np.fromiter((len(values) for values in per_device), dtype=np.int64, count=len(per_device))
+    codes = np.repeat(np.arange(len(device_ids), dtype=np.int64), counts)
+    return device_ids, codes, np.concatenate(per_device)
+
+
+def analyze_chunk(device_ids: List[str], codes: np.ndarray,
+                  timestamps: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    1チャンク分のギャップを計算
+
+    Args:
+        device_ids: チャンク内のデバイスID
+        codes: ハートビートごとのデバイス番号
+        timestamps: ハートビート（エポックミリ秒）
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (ハートビートのあるデバイスの集計行（SUMMARY_DTYPE）, ギャップのヒストグラム)
+    """
+    devices = len(device_ids)
+    # デバイスごとに時刻順に並べ、再送による重複を除く
+    order = np.lexsort((timestamps, codes))
+    codes, timestamps = codes[order], timestamps[order]
+    if len(timestamps):
+        keep = np.ones(len(timestamps), dtype=bool)
+        keep[1:] = (codes[1:] != codes[:-1]) | (timestamps[1:] != timestamps[:-1])
+        codes, timestamps = codes[keep], timestamps[keep]
+
+    # 同じデバイス内の連続するハートビートの間隔だけをギャップとする
+    same_device = codes[1:] == codes[:-1]
+    gaps = np.diff(timestamps)[same_device]
+    gap_codes = codes[1:][same_device]
+    breach = gaps >= SECURITY_BREACH_GAP_MS
+    suspicious = (gaps >= SUSPICIOUS_GAP_MS) & ~breach
+    flagged = suspicious | breach
+
+    max_gap = np.zeros(devices, dtype=np.int64)
+    np.maximum.at(max_gap, gap_codes, gaps)
+    flagged_gap = np.bincount(gap_codes[flagged], weights=gaps[flagged], minlength=devices)
+
+    heartbeats = np.bincount(codes, minlength=devices)
+    present = np.flatnonzero(heartbeats)
+    starts = np.concatenate(([0], np.cumsum(heartbeats)[:-1]))
+
+    rows = np.zeros(devices, dtype=SUMMARY_DTYPE)
+    rows['device_id'] = device_ids
+    rows['heartbeats'] = heartbeats
+    rows['first_heartbeat'][present] = timestamps[starts[present]]
+    rows['last_heartbeat'][present] = timestamps[starts[present] + heartbeats[present] - 1]
+    rows['suspicious_gaps'] = np.bincount(gap_codes[suspicious], minlength=devices)
+    rows['breach_gaps'] = np.bincount(gap_codes[breach], minlength=devices)
+    rows['max_gap_ms'] = max_gap
+    rows['flagged_gap_ms'] = flagged_gap.astype(np.int64)
+
+    bins = np.searchsorted(HISTOGRAM_EDGES_MS, gaps, side='right') - 1
+    histogram = np.bincount(bins, minlength=len(HISTOGRAM_EDGES_MS))
+    return rows[present], histogram
+
+
+class GapAnalytics:
+    """フリート全体のギャップ分析（集計行はチャンクごとに書き出し、全体の集計だけを保持する）"""
+
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE, flagged_only: bool = False):
+        self.chunk_size = chunk_size
+        self.flagged_only = flagged_only
+        self.histogram = np.zeros(len(HISTOGRAM_EDGES_MS), dtype=np.int64)
+        self.devices = 0
+        self.flagged_devices = 0
+        self.heartbeats = 0
+        self.suspicious_gaps = 0
+        self.breach_gaps = 0
+
+    def run(self, buckets: Iterable[Tuple[str, List[int]]], output: TextIO) -> Dict[str, Any]:
+        """
+        分析を実行し、デバイスごとの集計表をCSVで書き出す
+
+        Args:
+            buckets: (デバイスID, ハートビート) の列（同じデバイスのバケットが連続していること）
+            output: 集計表の出力先
+
+        Returns:
+            Dict[str, Any]: フリート全体の集計
+        """
+        writer = csv.writer(output)
+        writer.writerow(SUMMARY_DTYPE.names)
+        for chunk in iter_device_chunks(buckets, self.chunk_size):
+            rows, histogram = analyze_chunk(*chunk)
+            self.add(rows, histogram)
+            if self.flagged_only:
+                rows = rows[(rows['suspicious_gaps'] > 0) | (rows['breach_gaps'] > 0)]
+            writer.writerows(rows.tolist())
+        return self.report()
+
+    def add(self, rows: np.ndarray, histogram: np.ndarray) -> None:
+        """1チャンク分の結果を全体の集計に加える"""
+        self.histogram += histogram
+        self.devices += len(rows)
+        self.flagged_devices += int(np.count_nonzero((rows['suspicious_gaps'] > 0) | (rows['breach_gaps'] > 0)))
+        self.heartbeats += int(rows['heartbeats'].sum())
+        self.suspicious_gaps += int(rows['suspicious_gaps'].sum())
+        self.breach_gaps += int(rows['breach_gaps'].sum())
+
+    def report(self) -> Dict[str, Any]:
+        """フリート全体の集計"""
+        return {
+            'devices': self.devices,
+            'flagged_devices': self.flagged_devices,
+            'heartbeats': self.heartbeats,
+            'suspicious_gaps': self.suspicious_gaps,
+            'breach_gaps': self.breach_gaps,
+            'gap_histogram': dict(zip(HISTOGRAM_LABELS, self.histogram.tolist())),
+        }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument('--output', required=True, help='デバイスごとの集計表（CSV）の出力先')
+    parser.add_argument('--flagged-only', action='store_true', help='ギャップ（3分以上）のあるデバイスだけを出力する')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='1チャンクのハートビート数の目安')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help='Firestoreから1回に読み出すバケット数')
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Firestoreのバケットを分析し、全体の集計を返す"""
+    from config import firestore_config
+
+    args = build_parser().parse_args(argv)
+    db = firestore_config.get_client()
+    if db is None:
+        raise SystemExit("Firestore is not initialized")
+
+    analytics = GapAnalytics(args.chunk_size, args.flagged_only)
+    with open(args.output, 'w', newline='') as f:
+        report = analytics.run(stream_buckets(db, page_size=args.page_size), f)
+    logger.info("Gap analytics completed", extra=report)
+    return report
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(), indent=2, ensure_ascii=False))
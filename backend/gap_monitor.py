@@ -0,0 +1,213 @@
+"""
+Timekeeper Backend Gap Monitor
+取り込んだハートビートのオンラインなギャップ検出（改ざんの即時通知）
+
+デバイスごとに固定長の状態（最後のハートビート・間隔の指数移動平均と分散・最大間隔・
+SUSPICIOUS / SECURITY_BREACH の件数）だけをメモリに保持し、ハートビート（または利用イベント）ごとに
+O(1) で更新する。ギャップを検出したらイベントをシンクに渡す。Firestoreは読まない。
+状態はインスタンスごとに保持し、一定時間更新のないデバイスとサイズ上限を超えた分は古い順に破棄する。
+破棄後（または他インスタンスが受けていたデバイス）の最初のバッチは、取り込み時にFirestoreから求めた
+直前のハートビート（previous）を起点に判定するため、アップロードの間隔が破棄までの時間より長くても
+ギャップを見逃さない。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional
+from heartbeats import SECURITY_BREACH, classify_gap
+from metrics import HEARTBEAT_GAP_EVENTS_TOTAL, metrics
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class DeviceGapState:
+    """1デバイス分の状態（固定長）"""
+
+    __slots__ = ('last_seen', 'last_active', 'heartbeats', 'mean_gap', 'var_gap', 'max_gap',
+                 'suspicious', 'breaches')
+
+    def __init__(self, last_seen: int, last_active: float):
+        self.last_seen = last_seen
+        self.last_active = last_active
+        self.heartbeats = 1
+        self.mean_gap = 0.0
+        self.var_gap = 0.0
+        self.max_gap = 0
+        self.suspicious = 0
+        self.breaches = 0
+
+
+class GapEvent:
+    """シンクに渡すギャップのイベント"""
+
+    __slots__ = ('device_id', 'start', 'end', 'gap_ms', 'severity', 'suspicious', 'breaches', 'mean_gap_ms')
+
+    def __init__(self, device_id: str, start: int, end: int, severity: str, state: DeviceGapState):
+        self.device_id = device_id
+        self.start = start
+        self.end = end
+        self.gap_ms = end - start
+        self.severity = severity
+        self.suspicious = state.suspicious
+        self.breaches = state.breaches
+        self.mean_gap_ms = state.mean_gap
+
+
+GapEventSink = Callable[[GapEvent], None]
+
+
+def log_sink(event: GapEvent) -> None:
+    """既定のシンク（構造化ログに警告を出力）"""
+    logger.warning("Heartbeat gap detected", extra={
+        'device_id': event.device_id, 'severity': event.severity, 'gap_ms': event.gap_ms,
+        'gap_start': event.start, 'gap_end': event.end, 'suspicious_count': event.suspicious,
+        'breach_count': event.breaches, 'mean_gap_ms': round(event.mean_gap_ms),
+        'rate_limit_key': f'heartbeat_gap_{event.severity}'
+    })
+
+
+class GapMonitor:
+    """
+    デバイスごとのハートビートの間隔を逐次更新し、ギャップのイベントを発行
+
+    状態は最後に更新した順の OrderedDict で保持し、更新のたびに先頭から期限切れのものを破棄する
+    （破棄の費用は更新1回あたり償却 O(1)）。
+    """
+
+    def __init__(self, sink: Optional[GapEventSink] = None, idle_seconds: Optional[float] = None,
+                 max_devices: Optional[int] = None, alpha: Optional[float] = None):
+        self.sink: GapEventSink = sink or log_sink
+        self.idle_seconds: float = idle_seconds if idle_seconds is not None else float(
+            os.getenv('GAP_MONITOR_IDLE_SECONDS', '3600')
+        )
+        self.max_devices: int = max_devices if max_devices is not None else int(
+            os.getenv('GAP_MONITOR_MAX_DEVICES', '200000')
+        )
+        # 間隔の指数移動平均の重み
+        self.alpha: float = alpha if alpha is not None else float(os.getenv('GAP_MONITOR_EWMA_ALPHA', '0.05'))
+        self._states: "OrderedDict[str, DeviceGapState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, device_id: str, timestamp: int, now: Optional[float] = None) -> Optional[GapEvent]:
+        """
+        ハートビート（または利用イベント）を1件反映
+
+        Args:
+            device_id: デバイスID
+            timestamp: イベントの時刻（エポックミリ秒）
+            now: 現在時刻（time.monotonic()、テスト用）
+
+        Returns:
+            Optional[GapEvent]: ギャップを検出した場合はイベント（シンクにも渡す）
+        """
+        events = self.observe_batch(device_id, (timestamp,), now)
+        return events[0] if events else None
+
+    def observe_batch(self, device_id: str, timestamps: Iterable[int], now: Optional[float] = None,
+                      previous: Optional[int] = None) -> List[GapEvent]:
+        """
+        デバイスのハートビートをまとめて反映（昇順であること。最後に反映した時刻以前のものは無視する）
+
+        Args:
+            device_id: デバイスID
+            timestamps: イベントの時刻（エポックミリ秒、昇順）
+            now: 現在時刻（time.monotonic()、テスト用）
+            previous: バッチより前の最後のハートビート（取り込み時にFirestoreから求めた値。不明な場合None）。
+                状態がない場合はこの時刻を起点にし、状態より新しい場合（他インスタンスが受けていた場合）は
+                その間のギャップを判定せずに起点を進める
+
+        Returns:
+            List[GapEvent]: 検出したギャップのイベント
+        """
+        now = time.monotonic() if now is None else now
+        events = []
+        with self._lock:
+            self._evict(now)
+            state = self._states.get(device_id)
+            if previous is not None:
+                if state is None:
+                    state = DeviceGapState(previous, now)
+                    self._states[device_id] = state
+                elif previous > state.last_seen:
+                    state.last_seen = previous
+            for timestamp in timestamps:
+                if state is None:
+                    state = DeviceGapState(timestamp, now)
+                    self._states[device_id] = state
+                    continue
+                if timestamp <= state.last_seen:
+                    # 再送・順不同で届いた分は反映済み
+                    continue
+                event = self._update(device_id, state, timestamp)
+                if event is not None:
+                    events.append(event)
+            if state is not None:
+                state.last_active = now
+                self._states.move_to_end(device_id)
+                if len(self._states) > self.max_devices:
+                    self._states.popitem(last=False)
+
+        for event in events:
+            metrics.inc(HEARTBEAT_GAP_EVENTS_TOTAL, (event.severity,))
+            try:
+                self.sink(event)
+            except Exception as e:
+                # 通知の失敗で取り込みを失敗させない
+                logger.error(f"Gap event sink failed: {str(e)}", extra={'device_id': device_id})
+        return events
+
+    def state(self, device_id: str) -> Optional[DeviceGapState]:
+        """デバイスの状態を取得（未登録・破棄済みの場合None）"""
+        with self._lock:
+            return self._states.get(device_id)
+
+    def evict_idle(self, now: Optional[float] = None) -> None:
+        """一定時間更新のないデバイスの状態を破棄"""
+        with self._lock:
+            self._evict(time.monotonic() if now is None else now)
+
+    def clear(self) -> None:
+        """全ての状態を破棄（テスト用）"""
+        with self._lock:
+            self._states.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._states)
+
+    def _update(self, device_id: str, state: DeviceGapState, timestamp: int) -> Optional[GapEvent]:
+        gap = timestamp - state.last_seen
+        # 間隔の指数移動平均と分散（West の逐次更新）
+        if state.heartbeats == 1:
+            state.mean_gap = float(gap)
+        else:
+            diff = gap - state.mean_gap
+            increment = self.alpha * diff
+            state.mean_gap += increment
+            state.var_gap = (1 - self.alpha) * (state.var_gap + diff * increment)
+        state.max_gap = max(state.max_gap, gap)
+        state.heartbeats += 1
+        start, state.last_seen = state.last_seen, timestamp
+
+        severity = classify_gap(gap)
+        if severity is None:
+            return None
+        if severity == SECURITY_BREACH:
+            state.breaches += 1
+        else:
+            state.suspicious += 1
+        return GapEvent(device_id, start, timestamp, severity, state)
+
+    def _evict(self, now: float) -> None:
+        deadline = now - self.idle_seconds
+        while self._states:
+            device_id, state = next(iter(self._states.items()))
+            if state.last_active > deadline:
+                break
+            del self._states[device_id]
+
+
+# グローバルなギャップ検出インスタンス
+gap_monitor = GapMonitor()
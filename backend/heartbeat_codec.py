@@ -0,0 +1,210 @@
+"""
+Timekeeper Backend Heartbeat Codec
+ハートビート・利用時間のアップロード用のバイナリ形式（JSON の代替）
+
+1分ごとのハートビートを JSON の数値配列で送ると1件あたり約14バイトになり、解析の負荷も大きい。
+バイナリ形式ではハートビートを昇順に並べて先頭からの差分を varint で、アプリごとの利用時間（分）を
+zigzag 符号化した varint で書き込む（1件あたり3バイト程度）。本文は zlib で圧縮できる。
+デコードは memoryview 上で位置を進めながら行い、本文をコピーしない（zlib 圧縮時の展開を除く）。
+ハートビートの varint の列は np.frombuffer で同じメモリを参照し、終端バイトの位置から一括で復号する。
+
+形式（バージョン1）:
+    [バージョン: 1バイト] [フラグ: 1バイト（bit0: 本文を zlib 圧縮）] [本文]
+    本文: varint ハートビート数
+          varint 先頭のハートビート（エポックミリ秒）、以降は直前との差分の varint（昇順・重複なし）
+          varint 利用時間の件数
+          件数分の [varint パッケージ名のバイト数] [パッケージ名（UTF-8）] [zigzag varint 利用時間（分）]
+"""
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+from heartbeats import MAX_BATCH_SIZE, MAX_DECOMPRESSED_BYTES, MAX_USAGE_PACKAGES
+from lazy_imports import lazy_import
+from validation import ValidationError
+
+# 起動時間短縮のため、NumPyはバイナリ形式の初回のデコードで読み込む
+np = lazy_import('numpy')
+
+# Content-Type（JSON の代わりにこの形式で送る場合）
+BINARY_CONTENT_TYPE = 'application/x-timekeeper-heartbeats'
+
+FORMAT_VERSION = 1
+FLAG_ZLIB = 0x01
+
+# varint の最大バイト数（64ビット）
+_MAX_VARINT_BYTES = 10
+# ハートビートの差分の varint の最大バイト数（2^49ミリ秒。上限件数分を足しても int64 に収まる）
+_MAX_DELTA_BYTES = 7
+# パッケージ名の最大バイト数
+_MAX_PACKAGE_BYTES = 255
+
+
+class HeartbeatPayload:
+    """デコードしたアップロード内容"""
+
+    __slots__ = ('timestamps', 'usage')
+
+    def __init__(self, timestamps: List[int], usage: Dict[str, int]):
+        self.timestamps = timestamps
+        self.usage = usage
+
+
+def zigzag_encode(value: int) -> int:
+    """符号付き整数を符号なし整数に変換（0, -1, 1, -2, ... -> 0, 1, 2, 3, ...）"""
+    return (value << 1) ^ (value >> 63)
+
+
+def zigzag_decode(value: int) -> int:
+    """zigzag_encode の逆変換"""
+    return (value >> 1) ^ -(value & 1)
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_payload(timestamps: Iterable[int], usage: Optional[Dict[str, int]] = None,
+                   compress: bool = False) -> bytes:
+    """
+    アップロード内容をバイナリ形式に変換（アプリ側の実装の参照用・テスト用）
+
+    Args:
+        timestamps: ハートビート（エポックミリ秒、0以上。昇順・重複なしに整えて書き込む）
+        usage: パッケージ名 -> 利用時間（分）
+        compress: 本文を zlib で圧縮するかどうか
+
+    Returns:
+        bytes: バイナリ形式のデータ
+
+    Raises:
+        ValueError: 負の時刻・大きすぎる値が含まれる場合
+    """
+    body = bytearray()
+    values = sorted(set(timestamps))
+    if values and values[0] < 0:
+        raise ValueError("timestamps must be non-negative")
+    _write_varint(body, len(values))
+    previous = 0
+    for value in values:
+        _write_varint(body, value - previous)
+        previous = value
+
+    usage = usage or {}
+    _write_varint(body, len(usage))
+    for package, minutes in usage.items():
+        name = package.encode('utf-8')
+        if len(name) > _MAX_PACKAGE_BYTES:
+            raise ValueError(f"package name too long: {package}")
+        _write_varint(body, len(name))
+        body += name
+        _write_varint(body, zigzag_encode(minutes))
+
+    if compress:
+        return bytes((FORMAT_VERSION, FLAG_ZLIB)) + zlib.compress(bytes(body))
+    return bytes((FORMAT_VERSION, 0)) + bytes(body)
+
+
+def _invalid(message: str) -> ValidationError:
+    return ValidationError("invalid_binary_payload", message)
+
+
+def _read_varint(view: memoryview, pos: int) -> Tuple[int, int]:
+    """varint を1つ読み取り、(値, 次の位置) を返す"""
+    result = 0
+    shift = 0
+    end = min(len(view), pos + _MAX_VARINT_BYTES)
+    while pos < end:
+        byte = view[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+    raise _invalid("varint が途中で終わっているか長すぎます")
+
+
+def _read_timestamps(view: memoryview, pos: int, count: int) -> Tuple[List[int], int]:
+    """差分の varint の列を一括で読み取り、(昇順のハートビート, 次の位置) を返す"""
+    if count == 0:
+        return [], pos
+    data = np.frombuffer(view, dtype=np.uint8, count=min(len(view) - pos, count * _MAX_DELTA_BYTES), offset=pos)
+    # varint の終端（最上位ビットが0）のバイト
+    ends = np.flatnonzero(data < 0x80)[:count]
+    if len(ends) < count:
+        raise _invalid("varint が途中で終わっているか長すぎます")
+    starts = np.empty(count, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    if lengths.max() > _MAX_DELTA_BYTES:
+        raise _invalid("varint が長すぎます")
+
+    used = data[:ends[-1] + 1]
+    # バイトごとの varint 内の位置（0, 1, ...）から桁をずらして、varint ごとに合計する
+    offsets = np.arange(len(used), dtype=np.int64) - np.repeat(starts, lengths)
+    digits = (used & 0x7F).astype(np.int64) << (7 * offsets)
+    deltas = np.add.reduceat(digits, starts)
+    if count > 1 and not deltas[1:].all():
+        raise _invalid("timestamps は昇順・重複なしである必要があります")
+    return np.cumsum(deltas).tolist(), pos + len(used)
+
+
+def decode_payload(data: bytes) -> HeartbeatPayload:
+    """
+    バイナリ形式のアップロード内容をデコード
+
+    Args:
+        data: リクエスト本文
+
+    Returns:
+        HeartbeatPayload: ハートビート（昇順）と利用時間
+
+    Raises:
+        ValidationError: バージョン・形式が不正、または件数・サイズが上限を超える場合
+    """
+    view = memoryview(data)
+    if len(view) < 2:
+        raise _invalid("ヘッダーがありません")
+    version, flags = view[0], view[1]
+    if version != FORMAT_VERSION:
+        raise ValidationError("unsupported_payload_version", f"未対応の形式のバージョンです: {version}")
+    if flags & ~FLAG_ZLIB:
+        raise _invalid(f"未対応のフラグです: {flags:#04x}")
+
+    view = view[2:]
+    if flags & FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(view, MAX_DECOMPRESSED_BYTES + 1)
+        except zlib.error as e:
+            raise _invalid(f"本文を展開できません: {str(e)}")
+        if len(body) > MAX_DECOMPRESSED_BYTES:
+            raise ValidationError("payload_too_large", "本文が大きすぎます", 413)
+        view = memoryview(body)
+
+    count, pos = _read_varint(view, 0)
+    if count > MAX_BATCH_SIZE:
+        raise ValidationError("batch_too_large", f"timestamps は{MAX_BATCH_SIZE}件以下である必要があります", 413)
+    timestamps, pos = _read_timestamps(view, pos, count)
+
+    usage_count, pos = _read_varint(view, pos)
+    if usage_count > MAX_USAGE_PACKAGES:
+        raise ValidationError("too_many_packages", f"usage は{MAX_USAGE_PACKAGES}件以下である必要があります", 413)
+    usage = {}
+    for _ in range(usage_count):
+        length, pos = _read_varint(view, pos)
+        if length > _MAX_PACKAGE_BYTES or pos + length > len(view):
+            raise _invalid("パッケージ名が不正です")
+        try:
+            package = str(view[pos:pos + length], 'utf-8')
+        except UnicodeDecodeError:
+            raise _invalid("パッケージ名が UTF-8 ではありません")
+        pos += length
+        minutes, pos = _read_varint(view, pos)
+        usage[package] = zigzag_decode(minutes)
+
+    if pos != len(view):
+        raise _invalid("余分なデータがあります")
+    return HeartbeatPayload(timestamps, usage)
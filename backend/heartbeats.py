@@ -0,0 +1,325 @@
+"""
+Timekeeper Backend Heartbeats
+デバイスのハートビートの一括取り込みとサーバー側のギャップ判定
+
+アプリは1分ごとにハートビートを記録し、まとめてアップロードする。
+ハートビートはデバイス・日（UTC）ごとの1ドキュメント（heartbeat_buckets/{device_id}_{YYYY-MM-DD}）に
+追記するため、書き込みはバッチが含む日数分だけで済む。ギャップの判定はアプリの GapDetector と同じ閾値で、
+バッチを1回走査して行う。デバイスごとの最後のハートビートは heartbeat_devices/{device_id} に記録し、
+数日間ハートビートが途絶えた後のバッチでも直前のハートビートとのギャップを判定する。
+"""
+import re
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from lazy_imports import lazy_import
+from metrics import FIRESTORE_OPERATION_DURATION, metrics
+from validation import ValidationError
+
+# 起動時間短縮のため、Firestore SDKは初回の書き込み（または起動処理）で読み込む
+firestore = lazy_import('google.cloud.firestore')
+
+HEARTBEAT_BUCKETS_COLLECTION = 'heartbeat_buckets'
+# デバイスごとの最後のハートビート（devices とは別にし、購入反映の前提条件と競合させない）
+HEARTBEAT_DEVICES_COLLECTION = 'heartbeat_devices'
+
+# GapDetector（アプリ）と同じ閾値（ミリ秒）
+HEARTBEAT_INTERVAL_MS = 60 * 1000
+SUSPICIOUS_GAP_MS = 3 * 60 * 1000
+SECURITY_BREACH_GAP_MS = 5 * 60 * 1000
+
+SUSPICIOUS = 'SUSPICIOUS'
+SECURITY_BREACH = 'SECURITY_BREACH'
+
+# 1バッチのハートビート数の上限（2日分）と、展開後の本文サイズの上限
+MAX_BATCH_SIZE = 2 * 24 * 60
+MAX_DECOMPRESSED_BYTES = 1024 * 1024
+# 受け付ける時刻の範囲（端末時計のずれを許容する未来側の幅と、過去側の上限）
+MAX_CLOCK_SKEW_MS = 5 * 60 * 1000
+MAX_AGE_MS = 30 * 24 * 60 * 60 * 1000
+# 1バッチの利用時間（アプリごと）の件数の上限と、Androidのパッケージ名の形式
+MAX_USAGE_PACKAGES = 500
+MAX_USAGE_MINUTES = 24 * 60
+_PACKAGE_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9_]*(\.[A-Za-z0-9_]+)+$')
+
+
+class HeartbeatGap:
+    """連続するハートビート間のギャップ"""
+
+    __slots__ = ('start', 'end', 'gap_ms', 'severity')
+
+    def __init__(self, start: int, end: int, severity: str):
+        self.start = start
+        self.end = end
+        self.gap_ms = end - start
+        self.severity = severity
+
+    @property
+    def gap_minutes(self) -> int:
+        return self.gap_ms // (60 * 1000)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """バケットに保存する形式"""
+        return {'start': self.start, 'end': self.end, 'gap_ms': self.gap_ms, 'severity': self.severity}
+
+
+def classify_gap(gap_ms: int) -> Optional[str]:
+    """
+    ギャップの重大度を判定（GapDetector と同じ閾値）
+
+    Args:
+        gap_ms: ギャップ（ミリ秒）
+
+    Returns:
+        Optional[str]: SECURITY_BREACH / SUSPICIOUS、正常な場合None
+    """
+    if gap_ms >= SECURITY_BREACH_GAP_MS:
+        return SECURITY_BREACH
+    if gap_ms >= SUSPICIOUS_GAP_MS:
+        return SUSPICIOUS
+    return None
+
+
+def detect_gaps(timestamps: Sequence[int], previous: Optional[int] = None) -> List[HeartbeatGap]:
+    """
+    昇順のハートビートを1回走査してギャップを検出
+
+    Args:
+        timestamps: 昇順・重複なしのハートビート（エポックミリ秒）
+        previous: バッチより前の最後のハートビート（不明な場合None）
+
+    Returns:
+        List[HeartbeatGap]: 閾値以上のギャップ（時刻順）
+    """
+    gaps = []
+    prev = previous
+    for timestamp in timestamps:
+        if prev is not None:
+            severity = classify_gap(timestamp - prev)
+            if severity is not None:
+                gaps.append(HeartbeatGap(prev, timestamp, severity))
+        prev = timestamp
+    return gaps
+
+
+def decode_body(body: bytes, content_encoding: Optional[str]) -> bytes:
+    """
+    Content-Encoding（gzip / deflate）に応じて本文を展開（展開後のサイズに上限を設ける）
+
+    Args:
+        body: リクエスト本文
+        content_encoding: Content-Encoding ヘッダーの値
+
+    Returns:
+        bytes: 展開した本文
+
+    Raises:
+        ValidationError: 未対応の圧縮形式・不正なデータ・サイズ超過の場合
+    """
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        data = body
+    elif encoding in ('gzip', 'deflate'):
+        # wbits=47 は gzip・zlib のヘッダーを自動判定する
+        wbits = 47 if encoding == 'gzip' else zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits)
+        try:
+            data = decompressor.decompress(body, MAX_DECOMPRESSED_BYTES + 1)
+        except zlib.error as e:
+            raise ValidationError("invalid_body_encoding", f"本文を展開できません: {str(e)}")
+    else:
+        raise ValidationError("unsupported_content_encoding", f"未対応の Content-Encoding です: {encoding}", 415)
+
+    if len(data) > MAX_DECOMPRESSED_BYTES:
+        raise ValidationError("payload_too_large", "本文が大きすぎます", 413)
+    return data
+
+
+def normalize_timestamps(timestamps: Iterable[Any], now_ms: int) -> List[int]:
+    """
+    ハートビートを検証し、昇順・重複なしに整える
+
+    Args:
+        timestamps: ハートビート（エポックミリ秒）
+        now_ms: 現在時刻（エポックミリ秒）
+
+    Returns:
+        List[int]: 昇順・重複なしのハートビート
+
+    Raises:
+        ValidationError: 件数・型・範囲が不正な場合
+    """
+    values = list(timestamps)
+    if not values:
+        raise ValidationError("empty_batch", "timestamps が空です")
+    if len(values) > MAX_BATCH_SIZE:
+        raise ValidationError("batch_too_large", f"timestamps は{MAX_BATCH_SIZE}件以下である必要があります", 413)
+    oldest = now_ms - MAX_AGE_MS
+    newest = now_ms + MAX_CLOCK_SKEW_MS
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValidationError("invalid_timestamp", "timestamps はエポックミリ秒の整数である必要があります")
+        if not oldest <= value <= newest:
+            raise ValidationError("timestamp_out_of_range", "timestamps に受け付けられない時刻が含まれています")
+    return sorted(set(values))
+
+
+def normalize_usage(usage: Any) -> Dict[str, int]:
+    """
+    アプリごとの当日の利用時間（分）を検証
+
+    Args:
+        usage: パッケージ名 -> 利用時間（分）。省略時None
+
+    Returns:
+        Dict[str, int]: 検証済みの利用時間
+
+    Raises:
+        ValidationError: 形式・件数・範囲が不正な場合
+    """
+    if usage is None:
+        return {}
+    if not isinstance(usage, dict):
+        raise ValidationError("invalid_usage", "usage はパッケージ名と利用時間（分）のオブジェクトである必要があります")
+    if len(usage) > MAX_USAGE_PACKAGES:
+        raise ValidationError("too_many_packages", f"usage は{MAX_USAGE_PACKAGES}件以下である必要があります", 413)
+    for package, minutes in usage.items():
+        if not isinstance(package, str) or len(package) > 255 or not _PACKAGE_NAME.match(package):
+            raise ValidationError("invalid_package_name", "usage のパッケージ名が不正です")
+        if isinstance(minutes, bool) or not isinstance(minutes, int) or not 0 <= minutes <= MAX_USAGE_MINUTES:
+            raise ValidationError("invalid_usage_minutes", f"usage の利用時間は0〜{MAX_USAGE_MINUTES}分の整数である必要があります")
+    return dict(usage)
+
+
+def day_of(timestamp_ms: int) -> str:
+    """ハートビートの日（UTC、YYYY-MM-DD）"""
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def bucket_id(device_id: str, day: str) -> str:
+    """日ごとのバケットのドキュメントID"""
+    return f"{device_id}_{day}"
+
+
+def group_by_day(timestamps: Sequence[int]) -> List[Tuple[str, List[int]]]:
+    """昇順のハートビートを日ごとに分割"""
+    by_day: Dict[str, List[int]] = {}
+    for timestamp in timestamps:
+        by_day.setdefault(day_of(timestamp), []).append(timestamp)
+    return list(by_day.items())
+
+
+class IngestResult:
+    """ハートビートの取り込み結果"""
+
+    __slots__ = ('accepted', 'days', 'gaps', 'previous')
+
+    def __init__(self, accepted: int, days: List[str], gaps: List[HeartbeatGap], previous: Optional[int] = None):
+        self.accepted = accepted
+        self.days = days
+        self.gaps = gaps
+        # バッチより前の最後のハートビート（不明な場合None）
+        self.previous = previous
+
+    @property
+    def max_severity(self) -> Optional[str]:
+        """最も重大なギャップの重大度"""
+        severities = {gap.severity for gap in self.gaps}
+        if SECURITY_BREACH in severities:
+            return SECURITY_BREACH
+        return SUSPICIOUS if severities else None
+
+
+class HeartbeatStore:
+    """日ごとのハートビートバケットの読み書き"""
+
+    def __init__(self, collection: str = HEARTBEAT_BUCKETS_COLLECTION,
+                 devices_collection: str = HEARTBEAT_DEVICES_COLLECTION):
+        self.collection = collection
+        self.devices_collection = devices_collection
+
+    def ingest(self, db, device_id: str, timestamps: Sequence[int],
+               usage: Optional[Dict[str, int]] = None) -> IngestResult:
+        """
+        ハートビートを日ごとのバケットに追記し、ギャップを判定（ブロッキング処理のため io_executor で実行する）
+
+        バッチ直前のハートビートは、デバイスの最後のハートビートと、バッチの日と前日のバケットの
+        last_heartbeat を1回の読み取りで取得して求める。
+        書き込みは ArrayUnion・Maximum・Minimum による追記のため、同じバッチの再送は重複しない。
+        利用時間は当日の累計のため、最後のハートビートの日のバケットにアプリごとの最大値として記録する。
+
+        Args:
+            db: Firestoreクライアント
+            device_id: デバイスID
+            timestamps: 昇順・重複なしのハートビート（エポックミリ秒）
+            usage: パッケージ名 -> 当日の利用時間（分）
+
+        Returns:
+            IngestResult: 取り込み結果
+        """
+        by_day = group_by_day(timestamps)
+        days = [day for day, _ in by_day]
+
+        previous = self._previous_heartbeat(db, device_id, days, timestamps[0])
+        gaps = detect_gaps(timestamps, previous)
+        gaps_by_day: Dict[str, List[HeartbeatGap]] = {}
+        for gap in gaps:
+            gaps_by_day.setdefault(day_of(gap.end), []).append(gap)
+
+        batch = db.batch()
+        for day, day_timestamps in by_day:
+            data = {
+                'device_id': device_id,
+                'day': day,
+                'timestamps': firestore.ArrayUnion(day_timestamps),
+                'first_heartbeat': firestore.Minimum(day_timestamps[0]),
+                'last_heartbeat': firestore.Maximum(day_timestamps[-1]),
+                'updated_at': firestore.SERVER_TIMESTAMP,
+            }
+            if day in gaps_by_day:
+                data['gaps'] = firestore.ArrayUnion([gap.to_dict() for gap in gaps_by_day[day]])
+            if usage and day == days[-1]:
+                data['usage_minutes'] = {package: firestore.Maximum(minutes) for package, minutes in usage.items()}
+            batch.set(self._reference(db, device_id, day), data, merge=True)
+        batch.set(self._device_reference(db, device_id), {
+            'last_heartbeat': firestore.Maximum(timestamps[-1]),
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        with metrics.timer(FIRESTORE_OPERATION_DURATION, 'batch_commit'):
+            batch.commit()
+
+        return IngestResult(len(timestamps), days, gaps, previous)
+
+    def _previous_heartbeat(self, db, device_id: str, days: List[str], first: int) -> Optional[int]:
+        """
+        バッチより前の最後のハートビートを取得（不明な場合None）
+
+        通常はデバイスの最後のハートビートがそのまま直前のハートビートになる。再送・順不同の到着で
+        それがバッチ以降の場合は、バッチの日と前日のバケットから求める。
+        """
+        first_day = datetime.strptime(days[0], "%Y-%m-%d")
+        day_before = (first_day - timedelta(days=1)).strftime("%Y-%m-%d")
+        references = [self._device_reference(db, device_id)]
+        references += [self._reference(db, device_id, day) for day in [day_before] + days]
+        with metrics.timer(FIRESTORE_OPERATION_DURATION, 'get_all'):
+            snapshots = list(db.get_all(references, field_paths=['last_heartbeat']))
+
+        previous = None
+        for snapshot in snapshots:
+            if not snapshot.exists:
+                continue
+            last = (snapshot.to_dict() or {}).get('last_heartbeat')
+            # 再送・順不同の到着でバッチ以降の記録がある場合は、直前のハートビートを特定できない
+            if last is not None and last < first and (previous is None or last > previous):
+                previous = last
+        return previous
+
+    def _reference(self, db, device_id: str, day: str) -> Any:
+        return db.collection(self.collection).document(bucket_id(device_id, day))
+
+    def _device_reference(self, db, device_id: str) -> Any:
+        return db.collection(self.devices_collection).document(device_id)
+
+
+# グローバルなハートビートストアインスタンス
+heartbeat_store = HeartbeatStore()
@@ -0,0 +1,81 @@
+"""
+Timekeeper Backend Blocking I/O Executor
+同期SDK（Firestore / Stripe）の呼び出しをイベントループ外で実行するためのスレッドプール
+"""
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class BlockingIOExecutor:
+    """同期I/O呼び出し用のサイズ固定スレッドプール"""
+
+    def __init__(self):
+        self.max_workers: int = int(os.getenv('IO_THREAD_POOL_SIZE', '32'))
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """
+        スレッドプールを取得（未作成の場合は作成）
+
+        Returns:
+            ThreadPoolExecutor: 同期I/O用のスレッドプール
+        """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='blocking-io'
+                    )
+        return self._executor
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        同期関数をスレッドプール上で実行し、結果を待機する
+
+        Args:
+            func: 実行する同期関数
+            *args: 位置引数
+            **kwargs: キーワード引数
+
+        Returns:
+            Any: 関数の戻り値（例外はそのまま再送出される）
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_executor(),
+            functools.partial(func, *args, **kwargs)
+        )
+
+    def submit(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        """
+        同期関数をスレッドプール上で実行する（結果を待たない）
+        イベントループ外のスレッド（Firestoreのリスナーなど）からも呼び出せる
+
+        Args:
+            func: 実行する同期関数
+            *args: 位置引数
+            **kwargs: キーワード引数
+        """
+        self._get_executor().submit(func, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        スレッドプールを停止する（次回の run() で再作成される）
+
+        Args:
+            wait: 実行中のタスクの完了を待つかどうか
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+# グローバルな同期I/Oエグゼキュータインスタンス
+io_executor = BlockingIOExecutor()
@@ -0,0 +1,57 @@
+"""
+Timekeeper Backend Lazy Imports
+起動時間短縮のための重いSDK（stripe・google.cloud.firestore など）の遅延インポート
+
+lazy_import() が返すモジュールは、属性に初めてアクセスした時点で実際に読み込まれる。
+アプリの読み込み（main:app のインポート）ではSDKを読み込まず、lifespan の起動処理で
+Stripe・Firestoreの初期化と並行して読み込む。
+"""
+import importlib.util
+import sys
+import threading
+from types import ModuleType
+
+_lock = threading.Lock()
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    モジュールを遅延インポート
+
+    既に読み込み済み（または遅延インポート登録済み）の場合は sys.modules のモジュールを返す。
+    サブモジュールを指定した場合、親パッケージは通常どおり読み込まれる。
+
+    Args:
+        name: モジュール名（例: 'stripe', 'google.cloud.firestore'）
+
+    Returns:
+        ModuleType: 属性アクセス時に読み込まれるモジュール
+
+    Raises:
+        ModuleNotFoundError: モジュールが見つからない場合
+    """
+    with _lock:
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+
+        spec = importlib.util.find_spec(name)
+        if spec is None or spec.loader is None:
+            raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+        return module
+
+
+def preload(module: ModuleType) -> None:
+    """
+    遅延インポートしたモジュールを読み込む（起動処理で明示的に読み込む場合に使用）
+
+    Args:
+        module: lazy_import() が返したモジュール
+    """
+    # LazyLoader のモジュールは最初の属性アクセスで読み込まれる
+    getattr(module, '__dict__')
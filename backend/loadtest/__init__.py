@@ -0,0 +1,4 @@
+"""
+Timekeeper Backend Load Test
+Stripe・Firestoreのスタンドインを使用したエンドツーエンド負荷試験
+"""
@@ -0,0 +1,103 @@
+"""
+負荷試験用のアプリケーションサーバー
+
+main:app をインメモリFirestore（FakeFirestoreClient）とStripeのスタンドインに接続して起動する。
+デバイスは device_id_for() で決まるIDで事前に登録しておく（デイパスのアンロックには登録済みデバイスが必要なため）。
+
+実行方法（backend ディレクトリで実行。通常は loadtest.run から起動される）:
+    python -m loadtest.app_server --port 18080 --stripe-api-base http://127.0.0.1:12111
+"""
+import argparse
+import os
+import uuid
+from datetime import datetime, timezone
+
+# 負荷生成側と共有するデバイスIDの名前空間
+DEVICE_NAMESPACE = uuid.UUID('6f1c2a4e-9d0b-4c43-8f57-3b1e2d7a9c10')
+# Webhookの署名に使用するシークレット（負荷生成側と共有）
+WEBHOOK_SECRET = 'whsec_loadtest'
+
+
+def device_id_for(index: int) -> str:
+    """
+    事前登録するデバイスのIDを取得
+
+    Args:
+        index: デバイス番号
+
+    Returns:
+        str: UUID形式のデバイスID
+    """
+    return str(uuid.uuid5(DEVICE_NAMESPACE, f"device-{index}"))
+
+
+def install_fake_firestore(devices: int, latency_ms: float, jitter_ms: float, error_rate: float):
+    """
+    firestore_config にインメモリFirestoreを設定し、デバイスを登録
+
+    Args:
+        devices: 登録するデバイス数
+        latency_ms: 1操作あたりの遅延（ミリ秒）
+        jitter_ms: 遅延のばらつき（ミリ秒）
+        error_rate: エラーを注入する確率
+
+    Returns:
+        FakeFirestoreClient: 設定したクライアント
+    """
+    from config import firestore_config
+    from loadtest.fake_firestore import FakeFirestoreClient
+
+    client = FakeFirestoreClient(latency_ms, jitter_ms, error_rate)
+    created_at = datetime.now(timezone.utc)
+    for i in range(devices):
+        client.seed(f"devices/{device_id_for(i)}", {
+            'license_purchased': False,
+            'unlock_count': 0,
+            'created_at': created_at,
+        })
+    # 初期化済みとして扱わせ、起動処理でFirebase Admin SDKの初期化を行わないようにする
+    firestore_config._client = client
+    firestore_config._initialized = True
+    return client
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--stripe-api-base', required=True)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=80, help='同時リクエスト数の想定（limit_concurrency の算出に使用）')
+    parser.add_argument('--firestore-latency-ms', type=float, default=0.0)
+    parser.add_argument('--firestore-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--firestore-error-rate', type=float, default=0.0)
+    parser.add_argument('--webhook-queue-path', default=None)
+    args = parser.parse_args()
+
+    # config を読み込む前に設定する（StripeConfig は生成時に環境変数を読む）
+    os.environ['STRIPE_API_KEY'] = 'sk_test_loadtest'
+    os.environ['STRIPE_API_BASE'] = args.stripe_api_base
+    os.environ['STRIPE_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    if args.webhook_queue_path:
+        os.environ['WEBHOOK_QUEUE_PATH'] = args.webhook_queue_path
+    # 負荷生成器は全て同じIPから送信するため、IPごとの流量制限は行わない（デバイスごとの制限は有効）
+    os.environ.setdefault('RATE_LIMIT_IP', 'off')
+
+    install_fake_firestore(
+        args.devices, args.firestore_latency_ms, args.firestore_jitter_ms, args.firestore_error_rate
+    )
+
+    import uvicorn
+    from server import build_server_options
+
+    options = build_server_options({
+        'PORT': str(args.port), 'WEB_CONCURRENCY': '1', 'CONCURRENCY': str(args.concurrency), 'LOG_LEVEL': 'warning'
+    })
+    options.update(host='127.0.0.1', workers=1)
+    # インメモリFirestoreを共有するため、インポート文字列ではなくアプリを直接渡す
+    from main import app
+    options['app'] = app
+    uvicorn.run(**options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+"""
+負荷試験用のインメモリFirestore
+
+バックエンドが使用する google.cloud.firestore.Client の機能（ドキュメントの読み書き・get_all・
+WriteBatch と前提条件・トランザクション・スナップショットリスナー・Increment や ArrayUnion などの変換）だけを
+スレッドセーフに再現する。各操作には遅延・ジッター・エラーを注入できる。
+"""
+import copy
+import itertools
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from google.api_core import exceptions
+from google.cloud.firestore_v1.transforms import (
+    DELETE_FIELD, SERVER_TIMESTAMP, ArrayUnion, Increment, Maximum, Minimum
+)
+
+# update_time の基準時刻（書き込みごとに1マイクロ秒ずつ進め、同じ値にならないようにする）
+_EPOCH = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+class FaultInjector:
+    """Firestore操作に遅延・ジッター・エラーを注入する"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def __call__(self, operation: str) -> None:
+        """
+        1回のRPCに相当する遅延を発生させ、確率に応じて ServiceUnavailable を送出
+
+        Args:
+            operation: 操作名（エラーメッセージ用）
+        """
+        delay = self.latency_ms + (random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        if self.error_rate and random.random() < self.error_rate:
+            raise exceptions.ServiceUnavailable(f"Injected failure in {operation}")
+
+
+class FakeDocumentSnapshot:
+    """ドキュメントスナップショット"""
+
+    def __init__(self, reference: 'FakeDocumentReference', data: Optional[Dict[str, Any]],
+                 update_time: Optional[datetime]):
+        self.reference = reference
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str) -> Any:
+        return (self._data or {}).get(field)
+
+
+class FakeWatch:
+    """on_snapshot が返すリスナー登録"""
+
+    def __init__(self, client: 'FakeFirestoreClient', path: str, callback: Callable):
+        self._client = client
+        self._path = path
+        self._callback = callback
+
+    def unsubscribe(self) -> None:
+        self._client._remove_listener(self._path, self._callback)
+
+
+class FakeDocumentReference:
+    """ドキュメント参照"""
+
+    def __init__(self, client: 'FakeFirestoreClient', path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+    def get(self, field_paths: Optional[Iterable[str]] = None, transaction: Any = None) -> FakeDocumentSnapshot:
+        if transaction is not None:
+            return next(iter(self._client.get_all([self], field_paths=field_paths, transaction=transaction)))
+        self._client._inject('get')
+        return self._client._snapshot(self, field_paths)
+
+    def set(self, data: Dict[str, Any], merge: bool = False) -> None:
+        batch = self._client.batch()
+        batch.set(self, data, merge=merge)
+        batch.commit()
+
+    def create(self, data: Dict[str, Any]) -> None:
+        batch = self._client.batch()
+        batch.create(self, data)
+        batch.commit()
+
+    def update(self, data: Dict[str, Any], option: Any = None) -> None:
+        batch = self._client.batch()
+        batch.update(self, data, option=option)
+        batch.commit()
+
+    def delete(self, option: Any = None) -> None:
+        batch = self._client.batch()
+        batch.delete(self, option=option)
+        batch.commit()
+
+    def on_snapshot(self, callback: Callable) -> FakeWatch:
+        return self._client._add_listener(self, callback)
+
+
+class FakeCollectionReference:
+    """コレクション参照"""
+
+    def __init__(self, client: 'FakeFirestoreClient', path: str):
+        self._client = client
+        self.path = path
+
+    def document(self, document_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, f"{self.path}/{document_id}")
+
+
+class FakeWriteOption:
+    """write_option(last_update_time=...) で作成する前提条件"""
+
+    def __init__(self, last_update_time: Optional[datetime] = None, exists: Optional[bool] = None):
+        self.last_update_time = last_update_time
+        self.exists = exists
+
+
+class FakeWriteBatch:
+    """WriteBatch（全ての前提条件を確認してから原子的に書き込む）"""
+
+    def __init__(self, client: 'FakeFirestoreClient'):
+        self._client = client
+        # (種別, 参照, データ, 前提条件)
+        self._writes: List[Tuple[str, FakeDocumentReference, Optional[Dict[str, Any]], Any]] = []
+
+    def create(self, reference: FakeDocumentReference, data: Dict[str, Any]) -> 'FakeWriteBatch':
+        self._writes.append(('create', reference, data, None))
+        return self
+
+    def set(self, reference: FakeDocumentReference, data: Dict[str, Any], merge: bool = False) -> 'FakeWriteBatch':
+        self._writes.append(('merge' if merge else 'set', reference, data, None))
+        return self
+
+    def update(self, reference: FakeDocumentReference, data: Dict[str, Any], option: Any = None) -> 'FakeWriteBatch':
+        self._writes.append(('update', reference, data, option))
+        return self
+
+    def delete(self, reference: FakeDocumentReference, option: Any = None) -> 'FakeWriteBatch':
+        self._writes.append(('delete', reference, None, option))
+        return self
+
+    def commit(self) -> List[datetime]:
+        self._client._inject('commit')
+        return self._client._apply_writes(self._writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    トランザクション（楽観的並行性制御）
+
+    読み取ったドキュメントの update_time をコミット時に確認し、他の書き込みで変わっていれば
+    Aborted を送出する（firestore.transactional が再試行する）。
+    """
+
+    def __init__(self, client: 'FakeFirestoreClient', max_attempts: int = 5):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id: Optional[bytes] = None
+        self._read_versions: Dict[str, Optional[datetime]] = {}
+
+    @property
+    def in_progress(self) -> bool:
+        return self._id is not None
+
+    def _clean_up(self) -> None:
+        self._writes = []
+        self._read_versions = {}
+        self._id = None
+
+    def _begin(self, retry_id: Optional[bytes] = None) -> None:
+        self._client._inject('begin_transaction')
+        self._id = next(self._client._transaction_ids).to_bytes(8, 'big')
+
+    def _rollback(self) -> None:
+        self._clean_up()
+
+    def _commit(self) -> List[datetime]:
+        self._client._inject('commit')
+        try:
+            return self._client._apply_writes(self._writes, self._read_versions)
+        finally:
+            self._clean_up()
+
+    def get_all(self, references: Iterable[FakeDocumentReference], field_paths: Optional[Iterable[str]] = None,
+                **kwargs: Any) -> Iterable[FakeDocumentSnapshot]:
+        self._client._inject('get_all')
+        snapshots = [self._client._snapshot(reference, field_paths) for reference in references]
+        for snapshot in snapshots:
+            self._read_versions.setdefault(snapshot.reference.path, snapshot.update_time)
+        return snapshots
+
+    def get(self, reference: FakeDocumentReference, **kwargs: Any) -> Iterable[FakeDocumentSnapshot]:
+        return self.get_all([reference])
+
+    def commit(self) -> List[datetime]:
+        return self._commit()
+
+
+class FakeFirestoreClient:
+    """インメモリのFirestoreクライアント"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self._inject = FaultInjector(latency_ms, jitter_ms, error_rate)
+        # ドキュメントのパス -> (データ, update_time)
+        self._documents: Dict[str, Tuple[Dict[str, Any], datetime]] = {}
+        self._listeners: Dict[str, List[Callable]] = {}
+        self._lock = threading.Lock()
+        self._clock = itertools.count(1)
+        self._transaction_ids = itertools.count(1)
+        self._events: 'queue.Queue[Tuple[Callable, FakeDocumentSnapshot]]' = queue.Queue()
+        threading.Thread(target=self._dispatch_snapshots, name='fake-firestore-watch', daemon=True).start()
+
+    def collection(self, path: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, path)
+
+    def document(self, path: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, path)
+
+    def get_all(self, references: Iterable[FakeDocumentReference], field_paths: Optional[Iterable[str]] = None,
+                transaction: Optional[FakeTransaction] = None, **kwargs: Any) -> Iterable[FakeDocumentSnapshot]:
+        if transaction is not None:
+            return transaction.get_all(references, field_paths=field_paths)
+        self._inject('get_all')
+        return [self._snapshot(reference, field_paths) for reference in references]
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5, read_only: bool = False) -> FakeTransaction:
+        return FakeTransaction(self, max_attempts=max_attempts)
+
+    def write_option(self, last_update_time: Optional[datetime] = None,
+                     exists: Optional[bool] = None) -> FakeWriteOption:
+        return FakeWriteOption(last_update_time=last_update_time, exists=exists)
+
+    def seed(self, path: str, data: Dict[str, Any]) -> None:
+        """遅延・エラーを注入せずにドキュメントを作成（試験データの投入用）"""
+        with self._lock:
+            self._documents[path] = (copy.deepcopy(data), self._next_time())
+
+    def document_count(self, collection: str) -> int:
+        """コレクション直下のドキュメント数（試験結果の確認用）"""
+        prefix = collection + '/'
+        with self._lock:
+            return sum(1 for path in self._documents if path.startswith(prefix) and '/' not in path[len(prefix):])
+
+    def _next_time(self) -> datetime:
+        return _EPOCH + timedelta(microseconds=next(self._clock))
+
+    def _snapshot(self, reference: FakeDocumentReference,
+                  field_paths: Optional[Iterable[str]] = None) -> FakeDocumentSnapshot:
+        with self._lock:
+            stored = self._documents.get(reference.path)
+        if stored is None:
+            return FakeDocumentSnapshot(reference, None, None)
+        data = stored[0]
+        if field_paths is not None:
+            # フィールドマスク（トップレベルのフィールドのみ対応）
+            data = {field: data[field] for field in field_paths if field in data}
+        return FakeDocumentSnapshot(reference, copy.deepcopy(data), stored[1])
+
+    def _apply_writes(self, writes: List[Tuple[str, FakeDocumentReference, Optional[Dict[str, Any]], Any]],
+                      read_versions: Optional[Dict[str, Optional[datetime]]] = None) -> List[datetime]:
+        """前提条件を全て確認してから書き込みを反映し、リスナーに通知"""
+        with self._lock:
+            for path, version in (read_versions or {}).items():
+                stored = self._documents.get(path)
+                if (stored[1] if stored else None) != version:
+                    raise exceptions.Aborted(f"Transaction conflict on {path}")
+
+            for kind, reference, _, option in writes:
+                stored = self._documents.get(reference.path)
+                if kind == 'create' and stored is not None:
+                    raise exceptions.AlreadyExists(f"Document already exists: {reference.path}")
+                if kind == 'update' and stored is None:
+                    raise exceptions.NotFound(f"No document to update: {reference.path}")
+                if option is not None:
+                    if option.last_update_time is not None and (stored is None or stored[1] != option.last_update_time):
+                        raise exceptions.FailedPrecondition(f"update_time mismatch: {reference.path}")
+                    if option.exists is not None and option.exists != (stored is not None):
+                        raise exceptions.FailedPrecondition(f"exists mismatch: {reference.path}")
+
+            now = self._next_time()
+            changed: List[FakeDocumentReference] = []
+            for kind, reference, data, _ in writes:
+                stored = self._documents.get(reference.path)
+                if kind == 'delete':
+                    self._documents.pop(reference.path, None)
+                else:
+                    base = copy.deepcopy(stored[0]) if stored is not None and kind in ('update', 'merge') else {}
+                    # merge=True の set はネストしたマップもフィールドごとに反映する（update はマップごと置き換える）
+                    self._documents[reference.path] = (_apply_fields(base, data, now, kind != 'update'), now)
+                changed.append(reference)
+
+            notifications = [
+                (callback, reference)
+                for reference in changed
+                for callback in self._listeners.get(reference.path, [])
+            ]
+        for callback, reference in notifications:
+            self._events.put((callback, self._snapshot(reference)))
+        return [now] * len(writes)
+
+    def _add_listener(self, reference: FakeDocumentReference, callback: Callable) -> FakeWatch:
+        with self._lock:
+            self._listeners.setdefault(reference.path, []).append(callback)
+        # 実際のFirestoreと同様に、登録直後に現在のスナップショットを通知する
+        self._events.put((callback, self._snapshot(reference)))
+        return FakeWatch(self, reference.path, callback)
+
+    def _remove_listener(self, path: str, callback: Callable) -> None:
+        with self._lock:
+            callbacks = self._listeners.get(path, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def _dispatch_snapshots(self) -> None:
+        """スナップショットをリスナーに通知する（実際のSDKと同様に別スレッドから呼び出す）"""
+        while True:
+            callback, snapshot = self._events.get()
+            try:
+                callback([snapshot], [], snapshot.update_time)
+            except Exception:
+                pass
+
+
+def _apply_fields(base: Dict[str, Any], data: Optional[Dict[str, Any]], now: datetime,
+                  merge_maps: bool = False) -> Dict[str, Any]:
+    """書き込むフィールドと変換（Increment・Maximum・Minimum・ArrayUnion・SERVER_TIMESTAMP・DELETE_FIELD）を反映"""
+    for field, value in (data or {}).items():
+        if merge_maps and isinstance(value, dict):
+            nested = base.get(field)
+            base[field] = _apply_fields(nested if isinstance(nested, dict) else {}, value, now, True)
+        elif value is DELETE_FIELD:
+            base.pop(field, None)
+        elif value is SERVER_TIMESTAMP:
+            base[field] = now
+        elif isinstance(value, Increment):
+            base[field] = base.get(field, 0) + value.value
+        elif isinstance(value, Maximum):
+            base[field] = value.value if base.get(field) is None else max(base[field], value.value)
+        elif isinstance(value, Minimum):
+            base[field] = value.value if base.get(field) is None else min(base[field], value.value)
+        elif isinstance(value, ArrayUnion):
+            merged = list(base.get(field) or [])
+            for item in value.values:
+                if item not in merged:
+                    merged.append(copy.deepcopy(item))
+            base[field] = merged
+        else:
+            base[field] = copy.deepcopy(value)
+    return base
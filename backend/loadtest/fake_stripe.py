@@ -0,0 +1,174 @@
+"""
+負荷試験用のStripe Checkout APIスタンドイン
+
+stripe ライブラリの接続先（stripe.api_base）をこのサーバーに向けて使用する。
+Checkout Session の作成・取得と Price の検索（lookup_key）・作成だけを実装し、
+各リクエストに遅延・ジッター・エラーを注入できる。
+取得時に未知のセッションIDを指定した場合は支払い済みのセッションとして返す
+（負荷生成側が作成したトークンで確認APIを呼び出せるようにするため）。
+
+実行方法（backend ディレクトリで実行）:
+    python -m loadtest.fake_stripe --port 12111 --latency-ms 80 --jitter-ms 30 --error-rate 0.01
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qsl
+
+
+class FakeStripeState:
+    """作成済みのCheckout Sessionと注入設定"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.sessions: Dict[str, Dict[str, Any]] = {}
+        # lookup_key -> Price
+        self.prices: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def create_session(self, form: Dict[str, str]) -> Dict[str, Any]:
+        """フォームパラメータからCheckout Sessionを作成"""
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        metadata = {
+            key[len('metadata['):-1]: value for key, value in form.items() if key.startswith('metadata[')
+        }
+        session = _session(session_id, 'unpaid', metadata)
+        with self.lock:
+            self.sessions[session_id] = session
+        return session
+
+    def create_price(self, form: Dict[str, str]) -> Dict[str, Any]:
+        """フォームパラメータからPriceを作成（同じ lookup_key のPriceがある場合はそれを返す）"""
+        lookup_key = form.get('lookup_key')
+        with self.lock:
+            if lookup_key and lookup_key in self.prices:
+                return self.prices[lookup_key]
+            price = {
+                'id': f"price_{uuid.uuid4().hex[:24]}",
+                'object': 'price',
+                'active': True,
+                'currency': form.get('currency'),
+                'unit_amount': int(form.get('unit_amount') or 0),
+                'lookup_key': lookup_key,
+                'product': f"prod_{uuid.uuid4().hex[:14]}",
+            }
+            if lookup_key:
+                self.prices[lookup_key] = price
+        return price
+
+    def list_prices(self, query: Dict[str, str]) -> Dict[str, Any]:
+        """lookup_key でPriceを検索"""
+        lookup_keys = [value for key, value in query.items() if key.startswith('lookup_keys[')]
+        with self.lock:
+            data = [self.prices[key] for key in lookup_keys if key in self.prices]
+        return {'object': 'list', 'url': '/v1/prices', 'has_more': False, 'data': data}
+
+    def get_session(self, session_id: str) -> Dict[str, Any]:
+        """Checkout Sessionを取得（未知のIDは支払い済みとして扱う）"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+        return session if session is not None else _session(session_id, 'paid', {})
+
+
+def _session(session_id: str, payment_status: str, metadata: Dict[str, str]) -> Dict[str, Any]:
+    """Checkout SessionのJSON表現"""
+    return {
+        'id': session_id,
+        'object': 'checkout.session',
+        'mode': 'payment',
+        'status': 'complete' if payment_status == 'paid' else 'open',
+        'payment_status': payment_status,
+        'payment_intent': f"pi_{session_id[len('cs_test_'):][:24]}" if payment_status == 'paid' else None,
+        'url': f"https://checkout.stripe.test/c/pay/{session_id}",
+        'metadata': metadata,
+        'created': int(time.time()),
+        'expires_at': int(time.time()) + 24 * 60 * 60,
+    }
+
+
+def make_handler(state: FakeStripeState):
+    """状態を共有するリクエストハンドラーを作成"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def _respond(self, status: int, body: Dict[str, Any]) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.send_header('Request-Id', f"req_{uuid.uuid4().hex[:14]}")
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _inject(self) -> bool:
+            """遅延を発生させ、エラーを注入した場合True"""
+            delay = state.latency_ms + (random.uniform(-state.jitter_ms, state.jitter_ms) if state.jitter_ms else 0.0)
+            if delay > 0:
+                time.sleep(delay / 1000.0)
+            if state.error_rate and random.random() < state.error_rate:
+                self._respond(500, {'error': {'type': 'api_error', 'message': 'Injected failure'}})
+                return True
+            return False
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get('Content-Length') or 0)
+            form = dict(parse_qsl(self.rfile.read(length).decode()))
+            if self._inject():
+                return
+            if self.path == '/v1/checkout/sessions':
+                self._respond(200, state.create_session(form))
+            elif self.path == '/v1/prices':
+                self._respond(200, state.create_price(form))
+            else:
+                self._respond(404, {'error': {'type': 'invalid_request_error', 'message': f'Unrecognized request URL (POST: {self.path})'}})
+
+        def do_GET(self) -> None:
+            if self._inject():
+                return
+            path, _, query = self.path.partition('?')
+            prefix = '/v1/checkout/sessions/'
+            if path.startswith(prefix):
+                self._respond(200, state.get_session(path[len(prefix):]))
+            elif path == '/v1/prices':
+                self._respond(200, state.list_prices(dict(parse_qsl(query))))
+            else:
+                self._respond(404, {'error': {'type': 'invalid_request_error', 'message': f'Unrecognized request URL (GET: {self.path})'}})
+
+    return Handler
+
+
+def serve(port: int, state: Optional[FakeStripeState] = None) -> ThreadingHTTPServer:
+    """
+    スタンドインを起動（呼び出し元で serve_forever() を実行する）
+
+    Args:
+        port: 待ち受けポート（0の場合は空きポート）
+        state: 状態（省略時は遅延・エラーなし）
+
+    Returns:
+        ThreadingHTTPServer: HTTPサーバー
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state or FakeStripeState()))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    serve(args.port, FakeStripeState(args.latency_ms, args.jitter_ms, args.error_rate)).serve_forever()
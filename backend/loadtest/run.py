@@ -0,0 +1,360 @@
+"""
+エンドツーエンド負荷試験
+
+Stripeのスタンドイン（loadtest.fake_stripe）と、インメモリFirestoreに接続した main:app
+（loadtest.app_server）を別プロセスで起動し、仮想ユーザーから次のリクエストを指定した比率で送信する。
+- create:  /create-checkout-session（license・daypass を半数ずつ）
+- license: /license/confirm
+- daypass: /unlock/daypass
+- webhook: /stripe-webhook（署名付きの checkout.session.completed）
+
+確認APIの一部は送信済みのトークンで再送し、クライアントのリトライ（冪等性チェックの経路）を再現する。
+結果はエンドポイントごとのリクエスト数・RPS・p50/p95/p99・エラー率（2xx以外または通信エラー）を
+JSONで出力する。
+
+実行方法（backend ディレクトリで実行）:
+    python -m loadtest.run --duration 30 --users 64 --mix create=2,license=3,daypass=3,webhook=2 \\
+        --stripe-latency-ms 120 --stripe-jitter-ms 40 --firestore-latency-ms 15 --output report.json
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from loadtest.app_server import WEBHOOK_SECRET, device_id_for
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = {
+    'create': '/create-checkout-session',
+    'license': '/license/confirm',
+    'daypass': '/unlock/daypass',
+    'webhook': '/stripe-webhook',
+}
+DEFAULT_MIX = 'create=2,license=3,daypass=3,webhook=2'
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """
+    リクエストの比率（例: "create=2,license=3"）を解析
+
+    Args:
+        mix: 種別=重み をカンマ区切りで並べた文字列
+
+    Returns:
+        Dict[str, float]: 種別ごとの重み
+
+    Raises:
+        ValueError: 未知の種別・不正な重みの場合
+    """
+    weights: Dict[str, float] = {}
+    for item in mix.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown request type '{name}' (expected one of {', '.join(ENDPOINTS)})")
+        weights[name] = float(weight or 1)
+        if weights[name] < 0:
+            raise ValueError(f"Weight for '{name}' must not be negative")
+    if not any(weights.values()):
+        raise ValueError("At least one request type must have a positive weight")
+    return weights
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """
+    ソート済みの値から百分位数を取得（最近傍順位法）
+
+    Args:
+        sorted_values: 昇順にソートした値
+        q: 百分位（0〜100）
+
+    Returns:
+        float: 百分位数（値がない場合0）
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * q // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples: List[Tuple[float, int]], elapsed: float) -> Dict[str, Any]:
+    """
+    (レイテンシ秒, ステータスコード) のリストを集計（通信エラーはステータスコード0）
+
+    Args:
+        samples: 計測結果
+        elapsed: 計測時間（秒）
+
+    Returns:
+        Dict[str, Any]: リクエスト数・RPS・レイテンシ（ミリ秒）・エラー率・ステータスコード別件数
+    """
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    errors = sum(1 for _, status in samples if not 200 <= status < 300)
+    status_codes: Dict[str, int] = {}
+    for _, status in samples:
+        key = str(status) if status else 'transport_error'
+        status_codes[key] = status_codes.get(key, 0) + 1
+    return {
+        'requests': len(samples),
+        'rps': round(len(samples) / elapsed, 2) if elapsed > 0 else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+            'max': round(latencies[-1], 2) if latencies else 0.0,
+            'mean': round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        },
+        'errors': errors,
+        'error_rate': round(errors / len(samples), 4) if samples else 0.0,
+        'status_codes': dict(sorted(status_codes.items())),
+    }
+
+
+def sign_webhook(payload: bytes, secret: str, timestamp: Optional[int] = None) -> str:
+    """
+    Stripe-Signature ヘッダーの値を作成
+
+    Args:
+        payload: リクエストボディ
+        secret: Webhookシークレット
+        timestamp: 署名時刻（省略時は現在時刻）
+
+    Returns:
+        str: "t=<時刻>,v1=<署名>" 形式のヘッダー値
+    """
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signed = f"{timestamp}.".encode() + payload
+    signature = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def new_session_id() -> str:
+    """Checkout Session ID 形式のトークンを作成"""
+    return f"cs_test_{uuid.uuid4().hex}"
+
+
+class LoadGenerator:
+    """仮想ユーザーからリクエストを送信し、結果を記録する"""
+
+    def __init__(self, base_url: str, weights: Dict[str, float], devices: int, retry_rate: float):
+        self.base_url = base_url
+        self.kinds = list(weights)
+        self.weights = [weights[kind] for kind in self.kinds]
+        self.devices = devices
+        self.retry_rate = retry_rate
+        self.samples: Dict[str, List[Tuple[float, int]]] = {kind: [] for kind in ENDPOINTS}
+        # 再送用に保持する送信済み (device_id, トークン)
+        self._sent: Dict[str, List[Tuple[str, str]]] = {'license': [], 'daypass': []}
+
+    def _purchase(self, kind: str) -> Tuple[str, str]:
+        """確認APIに送る (device_id, トークン) を選択（一部は送信済みのものを再送）"""
+        sent = self._sent[kind]
+        if sent and random.random() < self.retry_rate:
+            return random.choice(sent)
+        purchase = (device_id_for(random.randrange(self.devices)), new_session_id())
+        sent.append(purchase)
+        if len(sent) > 1000:
+            del sent[:500]
+        return purchase
+
+    def _build(self, kind: str) -> Tuple[Dict[str, Any], Optional[bytes], Dict[str, str]]:
+        """リクエストの JSON ボディ（またはバイト列）とヘッダーを作成"""
+        device_id = device_id_for(random.randrange(self.devices))
+        if kind == 'create':
+            product_type = random.choice(('license', 'daypass'))
+            body = {'device_id': device_id, 'product_type': product_type}
+            if product_type == 'daypass':
+                body['unlock_count'] = random.randrange(5)
+            return body, None, {}
+        if kind in ('license', 'daypass'):
+            device_id, token = self._purchase(kind)
+            return {'device_id': device_id, 'purchase_token': token}, None, {}
+
+        session_id = new_session_id()
+        event = {
+            'id': f"evt_{uuid.uuid4().hex}",
+            'object': 'event',
+            'type': 'checkout.session.completed',
+            'created': int(time.time()),
+            'data': {'object': {
+                'id': session_id,
+                'object': 'checkout.session',
+                'payment_status': 'paid',
+                'payment_intent': f"pi_{uuid.uuid4().hex[:24]}",
+                'metadata': {'device_id': device_id, 'product_type': random.choice(('license', 'daypass'))},
+            }},
+        }
+        payload = json.dumps(event).encode()
+        headers = {'Content-Type': 'application/json', 'Stripe-Signature': sign_webhook(payload, WEBHOOK_SECRET)}
+        return {}, payload, headers
+
+    async def _user(self, client: httpx.AsyncClient, deadline: float) -> None:
+        """仮想ユーザー1人分の送信ループ"""
+        while time.perf_counter() < deadline:
+            kind = random.choices(self.kinds, self.weights)[0]
+            body, content, headers = self._build(kind)
+            start = time.perf_counter()
+            try:
+                if content is None:
+                    response = await client.post(ENDPOINTS[kind], json=body)
+                else:
+                    response = await client.post(ENDPOINTS[kind], content=content, headers=headers)
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 0
+            self.samples[kind].append((time.perf_counter() - start, status))
+
+    async def run(self, users: int, duration: float, timeout: float) -> float:
+        """
+        仮想ユーザーを起動して指定時間リクエストを送信
+
+        Args:
+            users: 仮想ユーザー数（同時接続数）
+            duration: 送信時間（秒）
+            timeout: 1リクエストのタイムアウト（秒）
+
+        Returns:
+            float: 実際の計測時間（秒）
+        """
+        limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=timeout) as client:
+            start = time.perf_counter()
+            await asyncio.gather(*(self._user(client, start + duration) for _ in range(users)))
+            return time.perf_counter() - start
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        """計測結果のレポートを作成"""
+        all_samples = [sample for samples in self.samples.values() for sample in samples]
+        return {
+            'overall': summarize(all_samples, elapsed),
+            'endpoints': {
+                ENDPOINTS[kind]: summarize(samples, elapsed) for kind, samples in self.samples.items() if samples
+            },
+        }
+
+
+def free_port() -> int:
+    """空いているTCPポートを取得"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    """
+    URLが応答するまで待機
+
+    Raises:
+        RuntimeError: プロセスが終了した・タイムアウトした場合
+    """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode} before {url} became ready")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"{url} did not become ready within {timeout} seconds")
+
+
+def main(args: argparse.Namespace) -> Dict[str, Any]:
+    """スタンドインとアプリを起動して負荷を掛け、レポートを返す"""
+    weights = parse_mix(args.mix)
+    stripe_port, app_port = free_port(), free_port()
+    app_log = open(args.app_log, 'w') if args.app_log else subprocess.DEVNULL
+    queue_path = os.path.join(
+        os.environ.get('TMPDIR', '/tmp'), f"timekeeper_loadtest_{uuid.uuid4().hex}.db"
+    )
+    processes = []
+    try:
+        stripe_process = subprocess.Popen([
+            sys.executable, '-m', 'loadtest.fake_stripe', '--port', str(stripe_port),
+            '--latency-ms', str(args.stripe_latency_ms), '--jitter-ms', str(args.stripe_jitter_ms),
+            '--error-rate', str(args.stripe_error_rate),
+        ], cwd=BACKEND_DIR)
+        processes.append(stripe_process)
+        app_process = subprocess.Popen([
+            sys.executable, '-m', 'loadtest.app_server', '--port', str(app_port),
+            '--stripe-api-base', f"http://127.0.0.1:{stripe_port}", '--devices', str(args.devices),
+            '--concurrency', str(args.users),
+            '--firestore-latency-ms', str(args.firestore_latency_ms),
+            '--firestore-jitter-ms', str(args.firestore_jitter_ms),
+            '--firestore-error-rate', str(args.firestore_error_rate),
+            '--webhook-queue-path', queue_path,
+        ], cwd=BACKEND_DIR, stdout=app_log, stderr=subprocess.STDOUT)
+        processes.append(app_process)
+
+        wait_until_ready(f"http://127.0.0.1:{stripe_port}/", stripe_process)
+        base_url = f"http://127.0.0.1:{app_port}"
+        wait_until_ready(f"{base_url}/health", app_process)
+
+        generator = LoadGenerator(base_url, weights, args.devices, args.retry_rate)
+        elapsed = asyncio.run(generator.run(args.users, args.duration, args.timeout))
+        report = generator.report(elapsed)
+        report['config'] = {
+            'duration_s': round(elapsed, 3),
+            'users': args.users,
+            'mix': weights,
+            'devices': args.devices,
+            'retry_rate': args.retry_rate,
+            'stripe': {'latency_ms': args.stripe_latency_ms, 'jitter_ms': args.stripe_jitter_ms,
+                       'error_rate': args.stripe_error_rate},
+            'firestore': {'latency_ms': args.firestore_latency_ms, 'jitter_ms': args.firestore_jitter_ms,
+                          'error_rate': args.firestore_error_rate},
+        }
+        return report
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if app_log is not subprocess.DEVNULL:
+            app_log.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(queue_path + suffix):
+                os.remove(queue_path + suffix)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=30.0, help='送信時間（秒）')
+    parser.add_argument('--users', type=int, default=32, help='仮想ユーザー数（同時接続数）')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='リクエストの比率（例: create=2,license=3,daypass=3,webhook=2）')
+    parser.add_argument('--devices', type=int, default=1000, help='事前登録するデバイス数')
+    parser.add_argument('--retry-rate', type=float, default=0.1, help='確認APIを送信済みトークンで再送する確率')
+    parser.add_argument('--timeout', type=float, default=30.0, help='1リクエストのタイムアウト（秒）')
+    parser.add_argument('--stripe-latency-ms', type=float, default=0.0)
+    parser.add_argument('--stripe-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--stripe-error-rate', type=float, default=0.0)
+    parser.add_argument('--firestore-latency-ms', type=float, default=0.0)
+    parser.add_argument('--firestore-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--firestore-error-rate', type=float, default=0.0)
+    parser.add_argument('--app-log', default=None, help='アプリのログの出力先（省略時は破棄）')
+    parser.add_argument('--output', default=None, help='レポートの出力先（省略時は標準出力）')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    result = json.dumps(main(args), indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+    else:
+        print(result)
@@ -2,20 +2,44 @@
 Timekeeper Backend API
 FastAPIを使用したバックエンドサーバー
 """
+import asyncio
+import os
 from contextlib import asynccontextmanager
+from typing import List, Optional
 from fastapi import FastAPI, HTTPException, Request as FastAPIRequest
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 from config import firestore_config, stripe_config
+from io_executor import io_executor
+from session_cache import open_session_cache, session_cache
+from entitlements import EntitlementMutator, MutationResult, purchase_write_batcher, within_idempotency_window
+from single_flight import purchase_flights
+from rate_limiter import admission_controller, retry_after_header
+from resilience import DependencyUnavailable, firestore_breaker
+from device_repository import VERSION_FIELD, device_repository
+from pricing import daypass_price, daypass_price_catalog
+from device_cache import device_cache
+from heartbeats import decode_body, heartbeat_store, normalize_timestamps, normalize_usage
+from heartbeat_codec import BINARY_CONTENT_TYPE, decode_payload
+from gap_monitor import gap_monitor
+from webhook_queue import webhook_queue, webhook_reconciler, webhook_worker
 from middleware import ErrorHandlingMiddleware
+from metrics import MetricsMiddleware, STRIPE_API_DURATION, metrics
+from stripe_gateway import stripe_gateway
+from structured_logging import get_logger
+from lazy_imports import lazy_import
 from validation import RequestValidator, ValidationError
 from models import (
     LicenseConfirmRequest, LicenseConfirmResponse,
     UnlockDaypassRequest, UnlockDaypassResponse,
     ErrorResponse,
-    CreateCheckoutSessionRequest, CreateCheckoutSessionResponse
+    CreateCheckoutSessionRequest, CreateCheckoutSessionResponse,
+    DeviceEntitlementsResponse,
+    HeartbeatBatchResponse, HeartbeatGapModel,
+    MAX_DAYPASS_UNLOCK_COUNT
 )
-import stripe
+import uuid
+import json
 from datetime import datetime, timezone
-from google.cloud import firestore
 
 # 定数を定義
 # YOUR_APP_DOMAIN = "https://example.com" # HTTP/HTTPSのダミードメインに変更
@@ -28,18 +52,56 @@ YOUR_PRODUCTION_URL = "https://v0-timekeeper.vercel.app"
 # 開発環境用 - 本番リリース時はコメントアウト
 # YOUR_NGROK_URL = "https://78ac-240b-c020-4b0-ee7b-fc5a-6175-1281-2fe1.ngrok-free.app"
 
+# キューに保存してワーカーで処理するWebhookイベント種別
+HANDLED_WEBHOOK_EVENTS = {'checkout.session.completed'}
+# 受信時に未完了Checkoutセッションのキャッシュから破棄するWebhookイベント種別
+OPEN_SESSION_CLOSING_EVENTS = {'checkout.session.completed', 'checkout.session.expired'}
+
+# 終了時に処理中のWebhookイベントの完了を待つ最大秒数
+# （Cloud Run は SIGTERM から10秒で強制終了するため、リクエストの完了待ちと合わせて収まるようにする）
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', '3'))
+
+logger = get_logger(__name__)
+
+# Stripe SDKは起動処理（stripe_config.initialize_stripe）で読み込む
+stripe = lazy_import('stripe')
+
+
+async def _initialize_firestore() -> bool:
+    """Firestoreを初期化し、リクエスト受付前にgRPCチャネルを接続しておく"""
+    success = await io_executor.run(firestore_config.initialize_firestore)
+    if success:
+        await io_executor.run(firestore_config.warm_up)
+    return success
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """アプリケーションのライフサイクル管理"""
     # 起動時の処理
-    success = firestore_config.initialize_firestore()
+    # Stripe・FirestoreのSDK読み込みと初期化を並行して行い、Firestoreの接続確立（ネットワーク待ち）と
+    # Stripe SDKの読み込みを重ねる
+    success, _ = await asyncio.gather(
+        _initialize_firestore(),
+        io_executor.run(stripe_config.initialize_stripe)
+    )
     if not success:
-        print("Warning: Firestore initialization failed")
+        logger.warning("Firestore initialization failed")
+    webhook_worker.start(process_webhook_event)
+    if stripe_config.webhook_secret:
+        # Webhookを受信する構成では、応答後に失われたイベントをStripeのイベント一覧から回収する
+        webhook_reconciler.start(_list_webhook_events)
     
     yield
     
-    # 終了時の処理（必要に応じて追加）
+    # 終了時の処理
+    await webhook_reconciler.stop()
+    await webhook_worker.stop(timeout=SHUTDOWN_DRAIN_SECONDS)
+    await purchase_write_batcher.flush()
+    await io_executor.run(webhook_queue.close)
+    await stripe_gateway.aclose()
+    await device_cache.aclose(timeout=SHUTDOWN_DRAIN_SECONDS)
+    io_executor.shutdown(wait=True)
 
 
 app = FastAPI(
@@ -49,8 +111,24 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# 共通エラーハンドリングミドルウェアを追加
+# 共通エラーハンドリングミドルウェアを追加（ASGIミドルウェアとして実装）
 app.add_middleware(ErrorHandlingMiddleware)
+# リクエスト数・レイテンシを記録するミドルウェア（エラーレスポンスも含めて計測するため最も外側に追加）
+app.add_middleware(MetricsMiddleware)
+
+
+@app.exception_handler(DependencyUnavailable)
+async def dependency_unavailable_handler(request: FastAPIRequest, exc: DependencyUnavailable):
+    """依存サービスが利用できない場合は外部呼び出しを待たずに503とRetry-Afterを返す"""
+    logger.warning(f"Dependency unavailable: {str(exc)}", extra={
+        'endpoint': request.url.path, 'dependency': exc.dependency, 'reason': exc.reason,
+        'rate_limit_key': f'dependency_unavailable_{exc.dependency}'
+    })
+    return JSONResponse(
+        status_code=503,
+        content={"detail": {"error_code": "dependency_unavailable", "message": f"{exc.dependency} is temporarily unavailable."}},
+        headers={"Retry-After": retry_after_header(exc.retry_after)}
+    )
 
 @app.get("/health")
 async def health_check():
@@ -60,6 +138,12 @@ async def health_check():
         "firestore_initialized": firestore_config.is_initialized()
     }
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """Prometheus形式のメトリクスを返すエンドポイント"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/test_firestore")
 async def test_firestore():
     """Firestore接続テストエンドポイント"""
@@ -69,7 +153,7 @@ async def test_firestore():
             detail="Firestore not initialized"
         )
     
-    result = firestore_config.test_connection()
+    result = await io_executor.run(firestore_config.test_connection)
     
     if result["status"] == "error":
         raise HTTPException(
@@ -87,37 +171,66 @@ async def firestore_status():
         "environment": firestore_config.environment
     }
 
-@app.post("/create-checkout-session", response_model=CreateCheckoutSessionResponse, responses={400: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
-async def create_checkout_session(request: CreateCheckoutSessionRequest):
+def _client_ip(http_request: FastAPIRequest) -> Optional[str]:
+    """クライアントIPを取得（Cloud Run は実際の接続元を X-Forwarded-For の末尾に追加する）"""
+    forwarded = http_request.headers.get('x-forwarded-for')
+    if forwarded:
+        # 先頭側はクライアントが任意に指定できるため、末尾の値を使う
+        return forwarded.rsplit(',', 1)[-1].strip()
+    return http_request.client.host if http_request.client else None
+
+
+def _enforce_rate_limit(route: str, device_id: Optional[str], http_request: FastAPIRequest) -> None:
+    """
+    デバイスID・クライアントIPごとの流量制限（Stripe・Firestoreの呼び出し前に判定する）
+
+    Raises:
+        HTTPException: 上限を超えた場合（429、Retry-After付き）
+    """
+    retry_after = admission_controller.check(route, device_id, _client_ip(http_request))
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=429,
+            detail={"error_code": "rate_limited", "message": "Too many requests. Please retry later."},
+            headers={"Retry-After": retry_after_header(retry_after)}
+        )
+
+
+@app.post("/create-checkout-session", response_model=CreateCheckoutSessionResponse, responses={400: {"model": ErrorResponse}, 429: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
+async def create_checkout_session(request: CreateCheckoutSessionRequest, http_request: FastAPIRequest):
     """
     Stripe Checkoutセッションを作成し、決済ページURLを返却するAPI
     """
+    _enforce_rate_limit("/create-checkout-session", request.device_id, http_request)
+
     if not stripe_config.is_initialized():
         raise HTTPException(
             status_code=503,
             detail={"error_code": "stripe_not_initialized", "message": "Stripe is not initialized. Check API key."}
         )
 
+    # 同じ購入（デバイス・商品・価格段階）の未完了セッションがあれば、新しく作成せずにそのURLを返す
+    unlock_count = request.unlock_count if request.unlock_count is not None and request.unlock_count >= 0 else 0
+    tier = unlock_count if request.product_type == "daypass" else 0
+    open_session = open_session_cache.get(request.device_id, request.product_type, tier)
+    if open_session is not None:
+        logger.info("Reusing open checkout session", extra={
+            'endpoint': '/create-checkout-session', 'device_id': request.device_id,
+            'session_id': open_session.session_id, 'rate_limit_key': 'checkout_session_reused'
+        })
+        return CreateCheckoutSessionResponse(checkout_url=open_session.url)
+
     line_items = []
     if request.product_type == "license":
         if not LICENSE_PRICE_ID:
              raise HTTPException(status_code=500, detail={"error_code": "license_price_id_not_configured", "message": "License Price ID is not configured."})
         line_items.append({"price": LICENSE_PRICE_ID, "quantity": 1})
     elif request.product_type == "daypass":
-        unlock_count = request.unlock_count if request.unlock_count is not None and request.unlock_count >= 0 else 0
-        price_amount = int(200 * (1.2 ** unlock_count))
-        product_name = f"デイパス ({unlock_count + 1}回目)"
-
-        line_items.append({
-            "price_data": {
-                "currency": "jpy",
-                "product_data": {
-                    "name": product_name,
-                },
-                "unit_amount": price_amount,
-            },
-            "quantity": 1,
-        })
+        # 段階ごとに再利用するStripe Priceを参照する（引き当てられない場合は price_data で金額を指定）
+        try:
+            line_items.append(await daypass_price_catalog.line_item(unlock_count))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail={"error_code": "invalid_unlock_count", "message": str(e)})
     else:
         raise HTTPException(status_code=400, detail={"error_code": "invalid_product_type", "message": "Invalid product type provided."})
 
@@ -130,7 +243,8 @@ async def create_checkout_session(request: CreateCheckoutSessionRequest):
         success_url_intermediate = f"{YOUR_HOSTED_DOMAIN}/payment/success?session_id={{CHECKOUT_SESSION_ID}}&deviceId={request.device_id}&product_type={request.product_type}&status=success"
         cancel_url_intermediate = f"{YOUR_HOSTED_DOMAIN}/payment/cancel?deviceId={request.device_id}&product_type={request.product_type}&status=cancel"
 
-        checkout_session = stripe.checkout.Session.create(
+        # 冪等キーはゲートウェイが自動で付与する（再試行しても重複したセッションは作成されない）
+        checkout_session = await stripe_gateway.create_checkout_session(
             payment_method_types=['card'],
             line_items=line_items,
             mode='payment',
@@ -141,30 +255,106 @@ async def create_checkout_session(request: CreateCheckoutSessionRequest):
                 'product_type': request.product_type
             }
         )
+        open_session_cache.put(request.device_id, request.product_type, tier, checkout_session)
         return CreateCheckoutSessionResponse(checkout_url=checkout_session.url)
+    except DependencyUnavailable:
+        raise
     except stripe.error.StripeError as e:
         error_message = str(e)
         if hasattr(e, 'user_message') and e.user_message: # Check if user_message exists
             error_message = e.user_message
-        print(f"Stripe API error: {str(e)}")
+        logger.error(f"Stripe API error: {str(e)}", extra={'endpoint': '/create-checkout-session', 'device_id': request.device_id})
         raise HTTPException(
             status_code=e.http_status or 500,
             detail={"error_code": "stripe_api_error", "message": f"Stripe API error: {error_message}"}
         )
     except Exception as e:
-        print(f"Unexpected error creating checkout session: {str(e)}")
+        logger.exception(f"Unexpected error creating checkout session: {str(e)}", extra={'endpoint': '/create-checkout-session', 'device_id': request.device_id})
         raise HTTPException(
             status_code=500,
             detail={"error_code": "checkout_session_creation_failed", "message": f"An unexpected error occurred while creating the checkout session: {str(e)}"}
         )
 
-@app.post("/license/confirm", response_model=LicenseConfirmResponse, responses={400: {"model": ErrorResponse}, 404: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
-async def license_confirm(request: LicenseConfirmRequest):
+# 冪等性レコードの保持期間より前に作成されたセッションの支払い状態（反映を拒否する）
+SESSION_TOO_OLD = 'session_too_old'
+
+
+async def _get_session_payment_status(purchase_token: str) -> str:
+    """
+    Checkout Sessionの支払い状態を取得
+    支払い済みとしてキャッシュされているセッションはStripeへ問い合わせない
+    同じセッションの同時の問い合わせ（確認APIの再送など）は1回にまとめる
+
+    Args:
+        purchase_token: Checkout Session ID
+
+    Returns:
+        str: 支払い状態（paid / unpaid / no_payment_required）。
+            冪等性レコードの保持期間より前に作成されたセッションは SESSION_TOO_OLD
+
+    Raises:
+        stripe.error.StripeError: Stripe APIエラー
+    """
+    cached = session_cache.get(purchase_token)
+    if cached is not None:
+        return cached.payment_status if within_idempotency_window(cached.created) else SESSION_TOO_OLD
+
+    async def retrieve() -> str:
+        session = await stripe_gateway.retrieve_checkout_session(purchase_token)
+        session_cache.remember(session)
+        if not within_idempotency_window(session.get('created')):
+            return SESSION_TOO_OLD
+        return session.payment_status
+
+    return await purchase_flights.do(('verify', purchase_token), retrieve)
+
+
+async def _apply_purchase(db, product_type: str, device_id: str, session_id: str,
+                          payment_intent: Optional[str] = None) -> MutationResult:
+    """
+    購入内容をFirestoreに反映し、キャッシュを更新
+
+    同じデバイス・セッションの同時の反映（確認API・クライアントの再送・Webhook）は1回にまとめて
+    全員に同じ結果を返し、同じデバイスの異なる購入はプロセス内で直列化して
+    デバイスドキュメントでの競合（前提条件の失敗・トランザクションの再試行）を避ける。
+
+    Args:
+        db: Firestoreクライアント
+        product_type: 商品種別（license / daypass）
+        device_id: デバイスID
+        session_id: Checkout Session ID
+        payment_intent: PaymentIntent ID（Webhookの場合）
+
+    Returns:
+        MutationResult: 反映結果
+
+    Raises:
+        DependencyUnavailable: Firestoreのブレーカーが開いている、または期限を超えた場合
+        Exception: Firestore更新エラー
+    """
+    extra_args = (payment_intent,) if payment_intent else ()
+
+    async def apply() -> MutationResult:
+        if product_type == 'license':
+            mutate = EntitlementMutator.apply_license_purchase
+        else:
+            mutate = EntitlementMutator.apply_daypass_unlock
+        result = await firestore_breaker.call(lambda: mutate(db, device_id, session_id, *extra_args))
+        device_cache.record_mutation(db, device_id, session_id, product_type, result)
+        open_session_cache.invalidate_session(session_id)
+        return result
+
+    return await purchase_flights.do(('apply', product_type, device_id, session_id), apply, lock_key=device_id)
+
+
+@app.post("/license/confirm", response_model=LicenseConfirmResponse, responses={400: {"model": ErrorResponse}, 404: {"model": ErrorResponse}, 429: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
+async def license_confirm(request: LicenseConfirmRequest, http_request: FastAPIRequest):
     """
     ライセンス購入確認API
     
     Args:
         request: ライセンス確認リクエスト
+        http_request: HTTPリクエスト（流量制限のクライアントIPの取得に使用）
         
     Returns:
         LicenseConfirmResponse: 確認結果
@@ -186,31 +376,39 @@ async def license_confirm(request: LicenseConfirmRequest):
             detail={"error_code": e.error_code, "message": e.message}
         )
 
+    _enforce_rate_limit("/license/confirm", device_id, http_request)
+
     if not stripe_config.is_initialized():
         raise HTTPException(
             status_code=503,
             detail={"error_code": "stripe_not_initialized", "message": "Stripe is not initialized. Check API key."}
         )
 
-    db = firestore_config.get_client()
+    db = await io_executor.run(firestore_config.get_client)
     if not db:
         raise HTTPException(
             status_code=503,
-            detail={"error_code": "firestore_not_initialized", "message": "Firestore is not initialized."}
+            detail={"error_code": "firestore_not_initialized", "message": "Firestore is not initialized."},
+            headers={"Retry-After": retry_after_header(firestore_config.retry_after())}
         )
 
-    # Stripe API と連携し purchase_token を検証
+    # 反映済みと分かっているセッション（確認APIのリトライなど）はStripe・Firestoreに問い合わせずに返す
+    if device_cache.find_processed(device_id, purchase_token) is not None:
+        logger.info("License purchase already processed, returning success", extra={
+            'endpoint': '/license/confirm', 'device_id': device_id, 'session_id': purchase_token,
+            'rate_limit_key': 'license_already_processed'
+        })
+        return LicenseConfirmResponse(status="ok")
+
+    # Stripe API と連携し purchase_token を検証（支払い済みセッションはキャッシュから判定）
     try:
         # purchase_tokenはStripeのCheckout Session IDであることを想定
-        session = stripe.checkout.Session.retrieve(purchase_token)
-        if session.payment_status != 'paid':
-            raise HTTPException(
-                status_code=400,
-                detail={"error_code": "payment_not_completed", "message": "Payment not completed or failed."}
-            )
+        payment_status = await _get_session_payment_status(purchase_token)
         # ここで顧客情報や支払い金額を検証することも可能 (session.amount_total, session.currencyなど)
         # 例: session.metadata['device_id'] と device_id が一致するかなど
 
+    except DependencyUnavailable:
+        raise
     except stripe.error.StripeError as e:
         # Stripe APIエラー
         raise HTTPException(
@@ -223,49 +421,42 @@ async def license_confirm(request: LicenseConfirmRequest):
             detail={"error_code": "stripe_validation_failed", "message": f"Stripe purchase_token validation failed: {str(e)}"}
         )
 
+    if payment_status == SESSION_TOO_OLD:
+        # 冪等性レコードが削除されている可能性があり、処理済みかどうかを判定できない
+        raise HTTPException(
+            status_code=400,
+            detail={"error_code": "session_too_old", "message": "Checkout session is too old to be confirmed."}
+        )
+    if payment_status != 'paid':
+        raise HTTPException(
+            status_code=400,
+            detail={"error_code": "payment_not_completed", "message": "Payment not completed or failed."}
+        )
+
     # Firestore の devices コレクションに device_id とライセンス購入情報を記録/更新
+    # 冪等性チェックと更新は原子的に行われ、同時に届いた要求とまとめてコミットされる（デバイス未登録の場合は新規作成）
     try:
-        device_ref = db.collection('devices').document(device_id)
-        device_doc = device_ref.get()
-
-        # TC3: 未登録 device_id でリクエストがあった場合にエラーレスポンスが返却されること
-        # Firestoreにdevice_idが存在しない場合、新規作成するかエラーとするかは仕様による。
-        # ここでは、P01のフローではdevice_idが既に存在している前提とし、
-        # もし存在しなければエラーとする。あるいは、ここで新規作成しても良い。
-        # 今回は、技術仕様書に「認証はUUID (device_id) による匿名識別のみ」とあり、
-        # device_idはクライアントが生成するため、ここでは存在チェックは必須ではないかもしれない。
-        # ただし、不正なdevice_idによる書き込みを防ぐ意図があればチェックは有効。
-        # 今回は「未登録device_id」のテストケースがあるので、ドキュメントが存在しない場合は作成する方針で進める。
-
-        # 重複防止: 同じpurchase_tokenで既に処理済みかチェック
-        if device_doc.exists:
-            device_data = device_doc.to_dict()
-            processed_tokens = device_data.get('processed_purchase_tokens', [])
-            if purchase_token in processed_tokens:
-                print(f"License purchase token {purchase_token} already processed for device {device_id}. Returning success.")
-                return LicenseConfirmResponse(status="ok")
-
-        doc_data = {
-            'license_purchased': True,
-            'license_purchase_date': datetime.now(timezone.utc), # ISO 8601形式で保存
-            'processed_purchase_tokens': firestore.ArrayUnion([purchase_token])
-        }
-        if device_doc.exists:
-            # 既に購入済みの場合の処理も考慮 (例: エラーとするか、上書きするか)
-            # ここでは上書きする
-            device_ref.update(doc_data)
-            print(f"License information updated for device_id: {device_id}")
+        result = await _apply_purchase(db, 'license', device_id, purchase_token)
+        if result.applied:
+            logger.info(f"License information {'updated' if result.device_exists else 'created'}", extra={
+                'endpoint': '/license/confirm', 'device_id': device_id, 'session_id': purchase_token
+            })
         else:
-            # ドキュメントが存在しない場合は新規作成
-            device_ref.set(doc_data)
-            print(f"License information created for device_id: {device_id}")
+            logger.info("License purchase already processed, returning success", extra={
+                'endpoint': '/license/confirm', 'device_id': device_id, 'session_id': purchase_token,
+                'rate_limit_key': 'license_already_processed'
+            })
 
+    except DependencyUnavailable:
+        raise
     except Exception as e:
         # Firestoreエラー
         # P06のケース: 課金は成功したが、Firestore更新に失敗した場合のハンドリング
         # この場合、ユーザーには課金成功・アプリ側処理失敗を通知する必要がある
         # ここでは汎用的な500エラーを返し、クライアント側でP06に誘導する想定
-        print(f"Error updating Firestore for device_id {device_id}: {str(e)}")
+        logger.error(f"Error updating Firestore for license purchase: {str(e)}", extra={
+            'endpoint': '/license/confirm', 'device_id': device_id, 'session_id': purchase_token
+        })
         raise HTTPException(
             status_code=500,
             detail={"error_code": "firestore_update_failed", "message": f"Failed to update license information in Firestore: {str(e)}"}
@@ -275,13 +466,14 @@ async def license_confirm(request: LicenseConfirmRequest):
     return LicenseConfirmResponse(status="ok")
 
 
-@app.post("/unlock/daypass", response_model=UnlockDaypassResponse, responses={400: {"model": ErrorResponse}, 404: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
-async def unlock_daypass(request: UnlockDaypassRequest):
+@app.post("/unlock/daypass", response_model=UnlockDaypassResponse, responses={400: {"model": ErrorResponse}, 404: {"model": ErrorResponse}, 429: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
+async def unlock_daypass(request: UnlockDaypassRequest, http_request: FastAPIRequest):
     """
     デイパスアンロックAPI
     
     Args:
         request: デイパスアンロックリクエスト
+        http_request: HTTPリクエスト（流量制限のクライアントIPの取得に使用）
         
     Returns:
         UnlockDaypassResponse: アンロック結果
@@ -301,28 +493,41 @@ async def unlock_daypass(request: UnlockDaypassRequest):
             detail={"error_code": e.error_code, "message": e.message}
         )
 
+    _enforce_rate_limit("/unlock/daypass", device_id, http_request)
+
     if not stripe_config.is_initialized():
         raise HTTPException(
             status_code=503,
             detail={"error_code": "stripe_not_initialized", "message": "Stripe is not initialized. Check API key."}
         )
 
-    db = firestore_config.get_client()
+    db = await io_executor.run(firestore_config.get_client)
     if not db:
         raise HTTPException(
             status_code=503,
-            detail={"error_code": "firestore_not_initialized", "message": "Firestore is not initialized."}
+            detail={"error_code": "firestore_not_initialized", "message": "Firestore is not initialized."},
+            headers={"Retry-After": retry_after_header(firestore_config.retry_after())}
         )
 
-    # Stripe API と連携し purchase_token を検証
+    # 反映済みと分かっているセッション（確認APIのリトライなど）はStripe・Firestoreに問い合わせずに返す
+    cached_device = device_cache.find_processed(device_id, purchase_token)
+    if cached_device is not None:
+        logger.info("Daypass purchase already processed, returning cached state", extra={
+            'endpoint': '/unlock/daypass', 'device_id': device_id, 'session_id': purchase_token,
+            'rate_limit_key': 'daypass_already_processed'
+        })
+        return UnlockDaypassResponse(
+            status="ok",
+            unlock_count=cached_device.unlock_count,
+            last_unlock_date=cached_device.last_unlock_date or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        )
+
+    # Stripe API と連携し purchase_token を検証（支払い済みセッションはキャッシュから判定）
     try:
-        session = stripe.checkout.Session.retrieve(purchase_token)
-        if session.payment_status != 'paid':
-            raise HTTPException(
-                status_code=400,
-                detail={"error_code": "payment_not_completed", "message": "Payment not completed or failed."}
-            )
+        payment_status = await _get_session_payment_status(purchase_token)
         # ここで顧客情報や支払い金額を検証することも可能
+    except DependencyUnavailable:
+        raise
     except stripe.error.StripeError as e:
         raise HTTPException(
             status_code=e.http_status or 500,
@@ -334,71 +539,277 @@ async def unlock_daypass(request: UnlockDaypassRequest):
             detail={"error_code": "payment_verification_failed", "message": f"Stripe purchase_token validation failed: {str(e)}"}
         )
 
+    if payment_status == SESSION_TOO_OLD:
+        # 冪等性レコードが削除されている可能性があり、処理済みかどうかを判定できない
+        raise HTTPException(
+            status_code=400,
+            detail={"error_code": "session_too_old", "message": "Checkout session is too old to be confirmed."}
+        )
+    if payment_status != 'paid':
+        raise HTTPException(
+            status_code=400,
+            detail={"error_code": "payment_not_completed", "message": "Payment not completed or failed."}
+        )
+
     # Firestore の devices コレクションで unlock_count をインクリメント、last_unlock_date を更新
+    # 冪等性チェックと更新は原子的に行われ、同時に届いた要求とまとめてコミットされる
     try:
-        device_ref = db.collection('devices').document(device_id)
-        device_doc = device_ref.get()
-
-        if not device_doc.exists:
-            # TC6: 未登録 device_id でリクエストがあった場合にエラーレスポンスが返却されること
-            raise HTTPException(
-                status_code=404, # Not Found
-                detail={"error_code": "device_not_found", "message": "device_id が未登録です"}
-            )
-
-        device_data = device_doc.to_dict()
-        
-        # 重複防止: 同じpurchase_tokenで既に処理済みかチェック
-        processed_tokens = device_data.get('processed_purchase_tokens', [])
-        if purchase_token in processed_tokens:
-            print(f"Purchase token {purchase_token} already processed for device {device_id}. Returning current state.")
-            current_unlock_count = device_data.get('unlock_count', 0)
-            current_date = device_data.get('last_unlock_date', datetime.now(timezone.utc).strftime("%Y-%m-%d"))
-            return UnlockDaypassResponse(
-                status="ok",
-                unlock_count=current_unlock_count,
-                last_unlock_date=current_date
-            )
-
-        current_unlock_count = device_data.get('unlock_count', 0)
-        new_unlock_count = current_unlock_count + 1
-        today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-
-        update_data = {
-            'unlock_count': new_unlock_count,
-            'last_unlock_date': today_str,
-            'processed_purchase_tokens': firestore.ArrayUnion([purchase_token])
-        }
-        device_ref.update(update_data)
-        print(f"Daypass unlock information updated for device_id: {device_id}. New unlock_count: {new_unlock_count}")
-
-    except HTTPException as e: # 上でraiseされたHTTPExceptionをそのまま再throw
-        raise e
+        result = await _apply_purchase(db, 'daypass', device_id, purchase_token)
+    except DependencyUnavailable:
+        raise
     except Exception as e:
         # Firestoreエラー (TC9のケースに該当しうる)
         # P06のケース: 課金は成功したが、Firestore更新に失敗した場合のハンドリング
-        print(f"Error updating Firestore for daypass, device_id {device_id}: {str(e)}")
+        logger.error(f"Error updating Firestore for daypass: {str(e)}", extra={
+            'endpoint': '/unlock/daypass', 'device_id': device_id, 'session_id': purchase_token
+        })
         raise HTTPException(
             status_code=500,
             detail={"error_code": "firestore_update_failed", "message": f"Failed to update daypass information in Firestore: {str(e)}"}
         )
 
+    if not result.device_exists:
+        # TC6: 未登録 device_id でリクエストがあった場合にエラーレスポンスが返却されること
+        raise HTTPException(
+            status_code=404, # Not Found
+            detail={"error_code": "device_not_found", "message": "device_id が未登録です"}
+        )
+
+    if result.applied:
+        logger.info("Daypass unlock information updated", extra={
+            'endpoint': '/unlock/daypass', 'device_id': device_id, 'session_id': purchase_token,
+            'unlock_count': result.unlock_count
+        })
+    else:
+        logger.info("Daypass purchase already processed, returning current state", extra={
+            'endpoint': '/unlock/daypass', 'device_id': device_id, 'session_id': purchase_token,
+            'rate_limit_key': 'daypass_already_processed'
+        })
+
     # 成功レスポンス返却 (TC4)
     return UnlockDaypassResponse(
         status="ok",
-        unlock_count=new_unlock_count,
-        last_unlock_date=today_str
+        unlock_count=result.unlock_count,
+        last_unlock_date=result.last_unlock_date
+    )
+
+
+def _entitlements_etag(version: int, today: str) -> str:
+    """
+    購入状態のETag（強いETag）を作成
+
+    購入状態はデバイスドキュメントのバージョンで決まるが、デイパスの有効判定は日付で変わるため日付も含める。
+    """
+    return f'"v{version}-{today}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match ヘッダーがETagに一致するかを判定（弱い比較）"""
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+@app.get("/devices/{device_id}/entitlements", response_model=DeviceEntitlementsResponse, responses={304: {"description": "Not Modified"}, 400: {"model": ErrorResponse}, 404: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
+async def get_device_entitlements(device_id: str, request: FastAPIRequest):
+    """
+    デバイスの購入状態取得API
+
+    ETagを返し、If-None-Match が現在のETagと一致する場合は304を返す。
+    条件付きリクエストではバージョンだけを読み取って判定するため、変更がない場合は
+    状態の読み取りとレスポンスの作成を行わない。
+
+    Args:
+        device_id: デバイスID
+        request: リクエスト（If-None-Match の参照に使用）
+
+    Returns:
+        DeviceEntitlementsResponse: 購入状態（変更がない場合は304）
+
+    Raises:
+        HTTPException: バリデーションエラー・未登録デバイス・Firestoreエラー
+    """
+    try:
+        device_id = RequestValidator.validate_device_id(device_id)
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail={"error_code": e.error_code, "message": e.message}
+        )
+
+    db = await io_executor.run(firestore_config.get_client)
+    if not db:
+        raise HTTPException(
+            status_code=503,
+            detail={"error_code": "firestore_not_initialized", "message": "Firestore is not initialized."},
+            headers={"Retry-After": retry_after_header(firestore_config.retry_after())}
+        )
+
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    if_none_match = request.headers.get('if-none-match')
+    try:
+        if if_none_match:
+            state = await firestore_breaker.call(
+                lambda: io_executor.run(device_repository.get, db, device_id, (VERSION_FIELD,))
+            )
+            etag = _entitlements_etag(state.version, today)
+            if state.exists and _etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': 'private, no-cache'})
+        # 条件なし、またはETagが一致しない場合は状態を読み取る
+        state = await firestore_breaker.call(lambda: io_executor.run(device_repository.get, db, device_id))
+    except DependencyUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Error reading device entitlements: {str(e)}", extra={
+            'endpoint': '/devices/{device_id}/entitlements', 'device_id': device_id
+        })
+        raise HTTPException(
+            status_code=500,
+            detail={"error_code": "firestore_read_failed", "message": f"Failed to read device entitlements: {str(e)}"}
+        )
+
+    if not state.exists:
+        raise HTTPException(
+            status_code=404,
+            detail={"error_code": "device_not_found", "message": "device_id が未登録です"}
+        )
+
+    body = DeviceEntitlementsResponse(
+        device_id=device_id,
+        license_purchased=state.license_purchased,
+        unlock_count=state.unlock_count,
+        last_unlock_date=state.last_unlock_date,
+        daypass_valid_today=state.last_unlock_date == today,
+        next_daypass_price=daypass_price(min(state.unlock_count, MAX_DAYPASS_UNLOCK_COUNT))
+    )
+    return JSONResponse(
+        content=body.model_dump(),
+        headers={'ETag': _entitlements_etag(state.version, today), 'Cache-Control': 'private, no-cache'}
+    )
+
+
+def _parse_heartbeat_upload(body: bytes, content_type: Optional[str]) -> tuple:
+    """
+    ハートビートのアップロード内容を解析（JSON またはバイナリ形式）
+
+    Returns:
+        tuple: (ハートビート, 利用時間)。検証前の値
+
+    Raises:
+        ValidationError: 本文の形式が不正な場合
+    """
+    if (content_type or '').split(';', 1)[0].strip().lower() == BINARY_CONTENT_TYPE:
+        payload = decode_payload(body)
+        return payload.timestamps, payload.usage
+
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise ValidationError("invalid_json", "本文がJSONではありません")
+    if not isinstance(payload, dict) or not isinstance(payload.get('timestamps'), list):
+        raise ValidationError("missing_timestamps", "timestamps（配列）が必須です")
+    return payload['timestamps'], payload.get('usage')
+
+
+@app.post("/devices/{device_id}/heartbeats:batch", response_model=HeartbeatBatchResponse, responses={400: {"model": ErrorResponse}, 413: {"model": ErrorResponse}, 415: {"model": ErrorResponse}, 429: {"model": ErrorResponse}, 500: {"model": ErrorResponse}})
+async def upload_heartbeats(device_id: str, request: FastAPIRequest):
+    """
+    ハートビート一括アップロードAPI
+
+    本文は {"timestamps": [エポックミリ秒, ...], "usage": {パッケージ名: 当日の利用時間（分）}}
+    （usage は省略可。Content-Encoding: gzip / deflate で圧縮可）、または
+    Content-Type: application/x-timekeeper-heartbeats のバイナリ形式（heartbeat_codec）。
+    ハートビートをデバイス・日ごとのバケットに追記し、バッチ直前のハートビートを含めて
+    ギャップ（3分以上: SUSPICIOUS、5分以上: SECURITY_BREACH）を判定して返す。
+    改ざんの通知は gap_monitor（メモリ上のデバイスごとの状態）で判定し、イベントをシンクに渡す。
+
+    Args:
+        device_id: デバイスID
+        request: リクエスト（本文・Content-Encoding の参照に使用）
+
+    Returns:
+        HeartbeatBatchResponse: 取り込み結果と検出したギャップ
+
+    Raises:
+        HTTPException: バリデーションエラー・流量制限・Firestoreエラー
+    """
+    route = '/devices/{device_id}/heartbeats:batch'
+    try:
+        device_id = RequestValidator.validate_device_id(device_id)
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail={"error_code": e.error_code, "message": e.message}
+        )
+
+    _enforce_rate_limit(route, device_id, request)
+
+    try:
+        body = decode_body(await request.body(), request.headers.get('content-encoding'))
+        raw_timestamps, raw_usage = _parse_heartbeat_upload(body, request.headers.get('content-type'))
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        timestamps = normalize_timestamps(raw_timestamps, now_ms)
+        usage = normalize_usage(raw_usage)
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail={"error_code": e.error_code, "message": e.message}
+        )
+
+    result = None
+    try:
+        db = await io_executor.run(firestore_config.get_client)
+        if not db:
+            raise HTTPException(
+                status_code=503,
+                detail={"error_code": "firestore_not_initialized", "message": "Firestore is not initialized."},
+                headers={"Retry-After": retry_after_header(firestore_config.retry_after())}
+            )
+
+        try:
+            result = await firestore_breaker.call(
+                lambda: io_executor.run(heartbeat_store.ingest, db, device_id, timestamps, usage)
+            )
+        except DependencyUnavailable:
+            raise
+        except Exception as e:
+            logger.error(f"Error writing heartbeats: {str(e)}", extra={
+                'endpoint': route, 'device_id': device_id, 'heartbeat_count': len(timestamps)
+            })
+            raise HTTPException(
+                status_code=500,
+                detail={"error_code": "firestore_write_failed", "message": f"Failed to store heartbeats: {str(e)}"}
+            )
+    finally:
+        # 改ざんの通知はFirestoreへの書き込みの成否によらずメモリ上の状態から判定する
+        # （メモリ上に状態がない場合は、取り込み時に求めた直前のハートビートを起点にする）
+        gap_monitor.observe_batch(device_id, timestamps, previous=result.previous if result else None)
+
+    return HeartbeatBatchResponse(
+        device_id=device_id,
+        accepted=result.accepted,
+        buckets=result.days,
+        gaps=[
+            HeartbeatGapModel(start=gap.start, end=gap.end, gap_minutes=gap.gap_minutes, severity=gap.severity)
+            for gap in result.gaps
+        ],
+        max_severity=result.max_severity
     )
 
 
 @app.post("/stripe-webhook", include_in_schema=False) # APIドキュメントには表示しない
 async def stripe_webhook(request: FastAPIRequest):
     """
-    StripeからのWebhookイベントを受信し処理するAPI
+    StripeからのWebhookイベントを受信するAPI
+    署名検証後にイベントを永続キューへ保存して即座に応答し、反映はバックグラウンドのワーカーが行う
     checkout.session.completed イベントを主に処理する
     """
     if not stripe_config.webhook_secret:
-        print("Warning: STRIPE_WEBHOOK_SECRET is not set. Webhook validation will be skipped (unsafe for production).")
+        logger.warning("STRIPE_WEBHOOK_SECRET is not set. Webhook validation will be skipped (unsafe for production).", extra={
+            'endpoint': '/stripe-webhook', 'rate_limit_key': 'webhook_secret_missing'
+        })
 
     payload_body = await request.body()
     sig_header = request.headers.get('stripe-signature')
@@ -406,114 +817,203 @@ async def stripe_webhook(request: FastAPIRequest):
     event = None # イベントオブジェクトを初期化
     try:
         if stripe_config.webhook_secret and sig_header:
-            event = stripe.Webhook.construct_event(
-                payload_body, sig_header, stripe_config.webhook_secret
-            )
+            with metrics.timer(STRIPE_API_DURATION, 'Webhook.construct_event'):
+                event = stripe.Webhook.construct_event(
+                    payload_body, sig_header, stripe_config.webhook_secret
+                )
         elif sig_header: # ヘッダーはあるがシークレットがない場合（設定ミスなど）
-            print("Error: Stripe webhook secret is not configured, but signature header was received. Signature validation failed.")
+            logger.error("Stripe webhook secret is not configured, but signature header was received. Signature validation failed.", extra={'endpoint': '/stripe-webhook'})
             raise HTTPException(status_code=500, detail="Webhook secret not configured for signature validation.")
         else: # ローカルテスト等でシグネチャヘッダーもシークレットもない場合
             event = stripe.Event.construct_from(
-                stripe.util.json.loads(payload_body.decode('utf-8')), stripe_config.api_key
+                json.loads(payload_body.decode('utf-8')), stripe_config.api_key
             )
-            print("Warning: Webhook signature validation skipped (no secret or signature header).")
+            logger.warning("Webhook signature validation skipped (no secret or signature header).", extra={
+                'endpoint': '/stripe-webhook', 'rate_limit_key': 'webhook_signature_skipped'
+            })
 
     except ValueError as e:
-        print(f"Webhook ValueError (Invalid payload): {str(e)}")
+        logger.warning(f"Webhook ValueError (Invalid payload): {str(e)}", extra={'endpoint': '/stripe-webhook'})
         raise HTTPException(status_code=400, detail="Invalid payload")
     except stripe.error.SignatureVerificationError as e:
-        print(f"Webhook SignatureVerificationError (Invalid signature): {str(e)}")
+        logger.warning(f"Webhook SignatureVerificationError (Invalid signature): {str(e)}", extra={'endpoint': '/stripe-webhook'})
         raise HTTPException(status_code=400, detail="Invalid signature")
     except HTTPException as e: # 内部でraiseしたHTTPExceptionをキャッチして再throw
         raise e
     except Exception as e:
-        print(f"Webhook construction/validation error: {str(e)}")
+        logger.exception(f"Webhook construction/validation error: {str(e)}", extra={'endpoint': '/stripe-webhook'})
         raise HTTPException(status_code=500, detail=f"Webhook event construction/validation error: {str(e)}")
 
     if not event:
-        print("Error: Webhook event object is None after construction attempts.")
+        logger.error("Webhook event object is None after construction attempts.", extra={'endpoint': '/stripe-webhook'})
         raise HTTPException(status_code=500, detail="Failed to construct webhook event object.")
 
+    if event.type in OPEN_SESSION_CLOSING_EVENTS:
+        # 完了・期限切れのセッションは購入の繰り返しで再利用しない
+        open_session_cache.invalidate_session(event.data.object.get('id'))
+
+    if event.type not in HANDLED_WEBHOOK_EVENTS:
+        logger.info(f"Received unhandled event type: {event.type}", extra={
+            'endpoint': '/stripe-webhook', 'rate_limit_key': 'webhook_unhandled_event'
+        })
+        return {"status": "received"}
+
     if event.type == 'checkout.session.completed':
-        session = event.data.object
-        print(f"Received checkout.session.completed event for session: {session.id}")
+        # 確認APIがStripeへ問い合わせずに済むよう、支払い済みセッションを即座にキャッシュする
+        session_cache.remember(event.data.object)
 
-        metadata = session.get('metadata', {})
-        device_id = metadata.get('device_id')
-        product_type = metadata.get('product_type')
+    # Firestoreへの反映はワーカーに任せ、イベントを永続キューに保存した時点で応答する
+    event_id = event.get('id') or f"local_{uuid.uuid4().hex}"
+    try:
+        queued = await io_executor.run(
+            webhook_queue.enqueue, event_id, event.type, payload_body.decode('utf-8')
+        )
+    except Exception as e:
+        # 保存できなかった場合は5xxを返し、Stripeに再送させる
+        logger.exception(f"Failed to queue webhook event: {str(e)}", extra={'endpoint': '/stripe-webhook', 'event_id': event_id})
+        raise HTTPException(status_code=500, detail="Failed to queue webhook event.")
 
-        if not device_id or not product_type:
-            print(f"Error: Missing device_id or product_type in webhook metadata for session {session.id}")
-            return {"status": "error", "message": "Missing metadata, event not processed further."}
+    webhook_worker.notify()
+    if not queued:
+        return {"status": "received", "message": "Duplicate event"}
+    return {"status": "received"}
 
-        db = firestore_config.get_client()
-        if not db:
-            print(f"Error: Firestore not initialized. Cannot process webhook for session {session.id}")
-            return {"status": "error", "message": "Firestore not initialized, event not processed further."}
 
-        try:
-            if product_type == "license":
-                device_ref = db.collection('devices').document(device_id)
-                
-                # 重複防止チェック
-                current_doc = device_ref.get()
-                if current_doc.exists:
-                    current_data = current_doc.to_dict()
-                    processed_tokens = current_data.get('processed_purchase_tokens', [])
-                    if session.id in processed_tokens:
-                        print(f"Webhook: License session {session.id} already processed for device {device_id}. Skipping.")
-                        return {"status": "received", "message": "Already processed"}
-                
-                doc_data = {
-                    'license_purchased': True,
-                    'license_purchase_date': datetime.now(timezone.utc),
-                    'last_successful_payment_intent': session.get('payment_intent'),
-                    'processed_purchase_tokens': firestore.ArrayUnion([session.id])
-                }
-                if current_doc.exists:
-                    device_ref.update(doc_data)
-                    print(f"Webhook: License updated for device_id: {device_id}")
-                else:
-                    device_ref.set(doc_data)
-                    print(f"Webhook: License created for device_id: {device_id}")
-
-            elif product_type == "daypass":
-                device_ref = db.collection('devices').document(device_id)
-                device_doc = device_ref.get()
-                if not device_doc.exists:
-                    print(f"Webhook Error: Device_id {device_id} not found for daypass purchase (session: {session.id})")
-                    return {"status": "error", "message": "Device not found for daypass, event not processed further."}
-                
-                current_data = device_doc.to_dict()
-                
-                # 重複防止: 同じsession_idで既に処理済みかチェック
-                processed_tokens = current_data.get('processed_purchase_tokens', [])
-                if session.id in processed_tokens:
-                    print(f"Webhook: Session {session.id} already processed for device {device_id}. Skipping.")
-                    return {"status": "received", "message": "Already processed"}
-                
-                current_unlock_count = current_data.get('unlock_count', 0) if current_data else 0
-                new_unlock_count = current_unlock_count + 1
-                today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-                update_data = {
-                    'unlock_count': new_unlock_count,
-                    'last_unlock_date': today_str,
-                    'last_successful_payment_intent': session.get('payment_intent'),
-                    'processed_purchase_tokens': firestore.ArrayUnion([session.id])
-                }
-                device_ref.update(update_data)
-                print(f"Webhook: Daypass updated for device_id: {device_id}. New unlock_count: {new_unlock_count}")
-            else:
-                print(f"Warning: Unknown product_type '{product_type}' in webhook for session {session.id}")
-        
-        except Exception as e:
-            print(f"Error processing webhook event (Firestore update failed) for session {session.id}: {str(e)}")
-            return {"status": "error", "message": "Firestore update failed during webhook processing"}
+async def _list_webhook_events(since: int) -> List[dict]:
+    """
+    指定時刻以降に作成された処理対象のWebhookイベントをStripeから取得する（WebhookReconcilerの取得関数）
 
-    else:
-        print(f"Received unhandled event type: {event.type}")
+    Args:
+        since: 対象とする作成時刻の下限（UNIX時刻）
 
-    return {"status": "received"}
+    Returns:
+        List[dict]: event_id / event_type / payload を持つ辞書のリスト
+
+    Raises:
+        stripe.error.StripeError: Stripe APIエラー
+    """
+    events = []
+    starting_after = None
+    while True:
+        page = await stripe_gateway.list_events(
+            types=sorted(HANDLED_WEBHOOK_EVENTS), created={'gte': since}, limit=100,
+            starting_after=starting_after
+        )
+        for event in page.data:
+            events.append({'event_id': event.id, 'event_type': event.type, 'payload': json.dumps(event)})
+        if not page.get('has_more') or not page.data:
+            return events
+        starting_after = page.data[-1].id
+
+
+async def process_webhook_event(queued_event: dict) -> str:
+    """
+    永続キューから取り出したWebhookイベントを処理する（WebhookWorkerのハンドラ）
+
+    Args:
+        queued_event: event_id / event_type / payload / attempts を持つ辞書
+
+    Returns:
+        str: 処理結果
+
+    Raises:
+        Exception: 再試行すべきエラー（Firestore未初期化・更新失敗など）
+    """
+    event = stripe.Event.construct_from(
+        json.loads(queued_event['payload']), stripe_config.api_key
+    )
+    if event.type == 'checkout.session.completed':
+        return await _handle_checkout_session_completed(event.data.object)
+
+    logger.info(f"Received unhandled event type: {event.type}", extra={
+        'event_id': queued_event['event_id'], 'rate_limit_key': 'webhook_unhandled_event'
+    })
+    return "ignored"
+
+
+async def _handle_checkout_session_completed(session) -> str:
+    """
+    checkout.session.completed イベントの購入内容を反映
+
+    メタデータ不足・未登録デバイスなど再試行しても解決しない場合はエラーを返さずに終了する。
+
+    Args:
+        session: stripe.checkout.Session
+
+    Returns:
+        str: 処理結果
+
+    Raises:
+        RuntimeError: Firestore未初期化
+        Exception: Firestore更新エラー
+    """
+    logger.info("Received checkout.session.completed event", extra={'session_id': session.id})
+    session_cache.remember(session)
+
+    metadata = session.get('metadata', {})
+    device_id = metadata.get('device_id')
+    product_type = metadata.get('product_type')
+
+    if not device_id or not product_type:
+        logger.error("Missing device_id or product_type in webhook metadata", extra={'session_id': session.id})
+        return "Missing metadata, event not processed further."
+
+    # 冪等性レコードの保持期間より前のセッション（古いイベントの再送など）は反映しない
+    if not within_idempotency_window(session.get('created')):
+        logger.warning("Webhook session is older than the idempotency window, skipping", extra={
+            'device_id': device_id, 'session_id': session.id, 'rate_limit_key': 'webhook_session_too_old'
+        })
+        return "Session too old, event not processed further."
+
+    # 確認APIで反映済みのセッションはFirestoreに問い合わせずにスキップ
+    if device_cache.find_processed(device_id, session.id) is not None:
+        logger.info("Webhook session already processed, skipping", extra={
+            'device_id': device_id, 'session_id': session.id, 'rate_limit_key': 'webhook_already_processed'
+        })
+        return "Already processed"
+
+    db = await io_executor.run(firestore_config.get_client)
+    if not db:
+        raise RuntimeError(f"Firestore not initialized. Cannot process webhook for session {session.id}")
+
+    try:
+        if product_type == "license":
+            result = await _apply_purchase(db, product_type, device_id, session.id, session.get('payment_intent'))
+            if not result.applied:
+                logger.info("Webhook session already processed, skipping", extra={
+                    'device_id': device_id, 'session_id': session.id, 'rate_limit_key': 'webhook_already_processed'
+                })
+                return "Already processed"
+            logger.info(f"Webhook: License {'updated' if result.device_exists else 'created'}", extra={
+                'device_id': device_id, 'session_id': session.id
+            })
+
+        elif product_type == "daypass":
+            result = await _apply_purchase(db, product_type, device_id, session.id, session.get('payment_intent'))
+            if not result.device_exists:
+                logger.error("Webhook: device_id not found for daypass purchase", extra={
+                    'device_id': device_id, 'session_id': session.id
+                })
+                return "Device not found for daypass, event not processed further."
+            if not result.applied:
+                logger.info("Webhook session already processed, skipping", extra={
+                    'device_id': device_id, 'session_id': session.id, 'rate_limit_key': 'webhook_already_processed'
+                })
+                return "Already processed"
+            logger.info("Webhook: Daypass updated", extra={
+                'device_id': device_id, 'session_id': session.id, 'unlock_count': result.unlock_count
+            })
+        else:
+            logger.warning(f"Unknown product_type '{product_type}' in webhook", extra={'session_id': session.id})
+            return "Unknown product type"
+
+    except Exception as e:
+        logger.error(f"Error processing webhook event (Firestore update failed): {str(e)}", extra={
+            'device_id': device_id, 'session_id': session.id
+        })
+        raise
+
+    return "processed"
 
 
 # アプリケーションの実行（開発用）
@@ -0,0 +1,297 @@
+"""
+Timekeeper Backend Metrics
+Prometheusテキスト形式で公開するリクエスト・依存サービス呼び出しのメトリクス
+
+記録はスレッドごとのシャードに対して行うため、計測時にロックを取らない
+（ロックを取るのは新しいスレッドが初めて記録する時と /metrics の集計時のみ）。
+"""
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# レイテンシヒストグラムのバケット境界（秒）
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# メトリクス名
+HTTP_REQUESTS_TOTAL = 'timekeeper_http_requests_total'
+HTTP_REQUEST_DURATION = 'timekeeper_http_request_duration_seconds'
+HTTP_REQUESTS_IN_FLIGHT = 'timekeeper_http_requests_in_flight'
+STRIPE_API_DURATION = 'timekeeper_stripe_api_duration_seconds'
+FIRESTORE_OPERATION_DURATION = 'timekeeper_firestore_operation_duration_seconds'
+RATE_LIMITED_TOTAL = 'timekeeper_rate_limited_requests_total'
+DEPENDENCY_REJECTED_TOTAL = 'timekeeper_dependency_rejected_total'
+HEARTBEAT_GAP_EVENTS_TOTAL = 'timekeeper_heartbeat_gap_events_total'
+
+# メトリクス名 -> (種別, 説明, ラベル名)
+METRIC_DEFINITIONS: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {
+    HTTP_REQUESTS_TOTAL: (
+        'counter', 'HTTP requests by route, method and status.', ('route', 'method', 'status')
+    ),
+    HTTP_REQUEST_DURATION: (
+        'histogram', 'HTTP request latency by route, method and status.', ('route', 'method', 'status')
+    ),
+    HTTP_REQUESTS_IN_FLIGHT: (
+        'gauge', 'HTTP requests currently being handled.', ()
+    ),
+    STRIPE_API_DURATION: (
+        'histogram', 'Stripe API call latency by method and outcome.', ('method', 'outcome')
+    ),
+    FIRESTORE_OPERATION_DURATION: (
+        'histogram', 'Firestore operation latency by operation and outcome.', ('operation', 'outcome')
+    ),
+    RATE_LIMITED_TOTAL: (
+        'counter', 'Requests rejected by the rate limiter by route and limit key.', ('route', 'key')
+    ),
+    DEPENDENCY_REJECTED_TOTAL: (
+        'counter', 'Dependency calls failed fast by circuit breakers and deadlines.', ('dependency', 'reason')
+    ),
+    HEARTBEAT_GAP_EVENTS_TOTAL: (
+        'counter', 'Heartbeat gap events emitted by the online detector by severity.', ('severity',)
+    ),
+}
+
+
+class _Shard:
+    """1スレッド分の記録値"""
+
+    __slots__ = ('values', 'histograms')
+
+    def __init__(self):
+        # (メトリクス名, ラベル値) -> カウンター・ゲージの値
+        self.values: Dict[Tuple[str, Tuple[str, ...]], float] = {}
+        # (メトリクス名, ラベル値) -> [バケットごとの件数..., 上限超過の件数, 合計秒数, 件数]
+        self.histograms: Dict[Tuple[str, Tuple[str, ...]], List[float]] = {}
+
+
+class MetricsRegistry:
+    """
+    メトリクスの記録と集計
+
+    各スレッドは自分のシャードにだけ書き込み、render() が全シャードを合算する。
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards: List[_Shard] = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> _Shard:
+        """現在のスレッドのシャードを取得（初回は作成して登録）"""
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def inc(self, name: str, labels: Tuple[str, ...] = (), amount: float = 1) -> None:
+        """
+        カウンター・ゲージを加算（ゲージの減算は負の値を渡す）
+
+        Args:
+            name: メトリクス名
+            labels: ラベル値（METRIC_DEFINITIONS のラベル名の順）
+            amount: 加算する値
+        """
+        values = self._shard().values
+        key = (name, labels)
+        values[key] = values.get(key, 0) + amount
+
+    def observe(self, name: str, labels: Tuple[str, ...], seconds: float) -> None:
+        """
+        ヒストグラムに値を記録
+
+        Args:
+            name: メトリクス名
+            labels: ラベル値（METRIC_DEFINITIONS のラベル名の順）
+            seconds: 所要時間（秒）
+        """
+        histograms = self._shard().histograms
+        key = (name, labels)
+        series = histograms.get(key)
+        if series is None:
+            series = histograms[key] = [0] * (len(self.buckets) + 3)
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-2] += seconds
+        series[-1] += 1
+
+    def timer(self, name: str, label: str) -> '_Timer':
+        """
+        with 文の所要時間をヒストグラムに記録するタイマーを作成
+        ラベルは (label, outcome) で、outcome は例外の有無により success / error となる
+
+        Args:
+            name: メトリクス名（STRIPE_API_DURATION / FIRESTORE_OPERATION_DURATION）
+            label: 呼び出し名（Stripeのメソッド名・Firestoreの操作名）
+
+        Returns:
+            _Timer: コンテキストマネージャ
+        """
+        return _Timer(self, name, label)
+
+    def timed(self, name: str, label: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        """
+        関数呼び出しの所要時間を記録するラッパーを作成（io_executor に渡す関数の計測用）
+
+        Args:
+            name: メトリクス名
+            label: 呼び出し名
+            func: 計測する関数
+
+        Returns:
+            Callable[..., Any]: func と同じ引数を受け取るラッパー
+        """
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with _Timer(self, name, label):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def render(self) -> str:
+        """
+        全シャードを合算してPrometheusテキスト形式で出力
+
+        Returns:
+            str: Prometheusテキスト形式（version 0.0.4）のメトリクス
+        """
+        with self._lock:
+            shards = list(self._shards)
+
+        values: Dict[Tuple[str, Tuple[str, ...]], float] = {}
+        histograms: Dict[Tuple[str, Tuple[str, ...]], List[float]] = {}
+        for shard in shards:
+            for key, value in list(shard.values.items()):
+                values[key] = values.get(key, 0) + value
+            for key, series in list(shard.histograms.items()):
+                merged = histograms.setdefault(key, [0] * len(series))
+                for i, v in enumerate(list(series)):
+                    merged[i] += v
+
+        lines: List[str] = []
+        for name, (metric_type, help_text, label_names) in METRIC_DEFINITIONS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            if metric_type == 'histogram':
+                for (series_name, labels), series in sorted(histograms.items()):
+                    if series_name == name:
+                        lines.extend(self._render_histogram(name, label_names, labels, series))
+            else:
+                series_values = {labels: v for (n, labels), v in values.items() if n == name}
+                if not label_names and not series_values:
+                    series_values[()] = 0
+                for labels, value in sorted(series_values.items()):
+                    lines.append(f'{name}{_format_labels(label_names, labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def _render_histogram(self, name: str, label_names: Tuple[str, ...],
+                          labels: Tuple[str, ...], series: List[float]) -> List[str]:
+        """1系列分のヒストグラムを累積バケット形式で出力"""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series):
+            cumulative += count
+            le = _format_labels(label_names + ('le',), labels + (_format_value(bound),))
+            lines.append(f'{name}_bucket{le} {_format_value(cumulative)}')
+        le = _format_labels(label_names + ('le',), labels + ('+Inf',))
+        lines.append(f'{name}_bucket{le} {_format_value(series[-1])}')
+        base = _format_labels(label_names, labels)
+        lines.append(f'{name}_sum{base} {_format_value(series[-2])}')
+        lines.append(f'{name}_count{base} {_format_value(series[-1])}')
+        return lines
+
+    def reset(self) -> None:
+        """記録値を全て破棄（テスト用）"""
+        with self._lock:
+            for shard in self._shards:
+                shard.values.clear()
+                shard.histograms.clear()
+
+
+class _Timer:
+    """所要時間をヒストグラムに記録するコンテキストマネージャ"""
+
+    __slots__ = ('_registry', '_name', '_label', '_start')
+
+    def __init__(self, registry: MetricsRegistry, name: str, label: str):
+        self._registry = registry
+        self._name = name
+        self._label = label
+        self._start = 0.0
+
+    def __enter__(self) -> '_Timer':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._registry.observe(
+            self._name,
+            (self._label, 'success' if exc_type is None else 'error'),
+            time.perf_counter() - self._start
+        )
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    """ラベルを {name="value",...} 形式に整形"""
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)) + '}'
+
+
+def _escape(value: str) -> str:
+    """ラベル値のエスケープ"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    """数値を出力形式に整形（整数値は小数点なし）"""
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsMiddleware:
+    """
+    リクエスト数・レイテンシ・処理中リクエスト数を記録するASGIミドルウェア
+
+    route ラベルには実際のパスではなくルートのパステンプレートを使い、
+    どのルートにも一致しなかったリクエストは "unmatched" にまとめる。
+    """
+
+    def __init__(self, app: ASGIApp, registry: Optional[MetricsRegistry] = None):
+        self.app = app
+        self.registry = registry or metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        registry = self.registry
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        registry.inc(HTTP_REQUESTS_IN_FLIGHT)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            registry.inc(HTTP_REQUESTS_IN_FLIGHT, amount=-1)
+            route = scope.get("route")
+            labels = (getattr(route, "path_format", None) or getattr(route, "path", None) or "unmatched",
+                      scope["method"], str(status_code))
+            registry.inc(HTTP_REQUESTS_TOTAL, labels)
+            registry.observe(HTTP_REQUEST_DURATION, labels, time.perf_counter() - start)
+
+
+# グローバルなメトリクスインスタンス
+metrics = MetricsRegistry()
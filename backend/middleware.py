@@ -2,74 +2,126 @@
 Timekeeper Backend Middleware
 共通エラーハンドリングミドルウェア
 """
-from fastapi import Request, HTTPException
+from fastapi import HTTPException
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from structured_logging import get_logger
 from validation import ValidationError
-import traceback
-import logging
+from typing import Optional
+import os
+import time
 
-# ログ設定
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+logger = get_logger(__name__)
 
 
-class ErrorHandlingMiddleware(BaseHTTPMiddleware):
-    """共通エラーハンドリングミドルウェア"""
-    
-    async def dispatch(self, request: Request, call_next):
+def error_response(exc: Exception) -> JSONResponse:
+    """
+    例外を {"error", "message"} 形式のJSONレスポンスに変換
+
+    Args:
+        exc: 発生した例外
+
+    Returns:
+        JSONResponse: エラーレスポンス
+    """
+    if isinstance(exc, ValidationError):
+        # バリデーションエラーの処理
+        logger.warning(f"Validation error: {exc.error_code} - {exc.message}", extra={'error_code': exc.error_code})
+        return JSONResponse(
+            status_code=exc.status_code,
+            content={
+                "error": exc.error_code,
+                "message": exc.message
+            }
+        )
+
+    if isinstance(exc, HTTPException):
+        # FastAPIのHTTPExceptionの処理
+        logger.warning(f"HTTP exception: {exc.status_code} - {exc.detail}")
+
+        # detailが辞書の場合はそのまま返す、文字列の場合は標準形式に変換
+        if isinstance(exc.detail, dict):
+            content = exc.detail
+        else:
+            content = {
+                "error": "http_error",
+                "message": str(exc.detail)
+            }
+
+        return JSONResponse(
+            status_code=exc.status_code,
+            content=content
+        )
+
+    # 予期しないエラーの処理（トレースバックの整形はログ出力スレッドで行う）
+    logger.error(f"Unexpected error: {str(exc)}", exc_info=exc)
+
+    return JSONResponse(
+        status_code=500,
+        content={
+            "error": "internal_server_error",
+            "message": "予期しないエラーが発生しました"
+        }
+    )
+
+
+class ErrorHandlingMiddleware:
+    """
+    共通エラーハンドリングミドルウェア（ASGIミドルウェア）
+
+    BaseHTTPMiddleware と異なり、リクエストごとのタスク生成やレスポンスの
+    バッファリングを行わず、受け取った send をそのまま下流に渡す。
+    ルートのHTTPExceptionはFastAPIの例外ハンドラが先に処理するため、
+    ここで扱うのは ValidationError と予期しない例外（および下流のミドルウェアが
+    送出したHTTPException）となる。
+    あわせて endpoint / status / latency_ms を持つアクセスログを出力する
+    （成功レスポンスは ACCESS_LOG_SAMPLE_RATE の割合で間引く）。
+    """
+
+    def __init__(self, app: ASGIApp, access_log_sample_rate: Optional[float] = None):
+        self.app = app
+        self.access_log_sample_rate: float = access_log_sample_rate if access_log_sample_rate is not None else float(
+            os.getenv('ACCESS_LOG_SAMPLE_RATE', '0.1')
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         """
         リクエスト処理とエラーハンドリング
-        
+
         Args:
-            request: HTTPリクエスト
-            call_next: 次の処理
-            
-        Returns:
-            Response: HTTPレスポンス
+            scope: ASGIスコープ
+            receive: ASGI受信関数
+            send: ASGI送信関数
         """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code: Optional[int] = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
         try:
-            response = await call_next(request)
-            return response
-            
-        except ValidationError as e:
-            # バリデーションエラーの処理
-            logger.warning(f"Validation error: {e.error_code} - {e.message}")
-            return JSONResponse(
-                status_code=e.status_code,
-                content={
-                    "error": e.error_code,
-                    "message": e.message
-                }
-            )
-            
-        except HTTPException as e:
-            # FastAPIのHTTPExceptionの処理
-            logger.warning(f"HTTP exception: {e.status_code} - {e.detail}")
-            
-            # detailが辞書の場合はそのまま返す、文字列の場合は標準形式に変換
-            if isinstance(e.detail, dict):
-                content = e.detail
-            else:
-                content = {
-                    "error": "http_error",
-                    "message": str(e.detail)
-                }
-            
-            return JSONResponse(
-                status_code=e.status_code,
-                content=content
-            )
-            
+            await self.app(scope, receive, send_wrapper)
         except Exception as e:
-            # 予期しないエラーの処理
-            logger.error(f"Unexpected error: {str(e)}")
-            logger.error(f"Traceback: {traceback.format_exc()}")
-            
-            return JSONResponse(
-                status_code=500,
-                content={
-                    "error": "internal_server_error",
-                    "message": "予期しないエラーが発生しました"
-                }
-            ) 
\ No newline at end of file
+            # レスポンス送信開始後は差し替えられないため、サーバー側のエラー処理に任せる
+            if status_code is not None:
+                raise
+            await error_response(e)(scope, receive, send_wrapper)
+        finally:
+            self._log_access(scope, status_code or 500, start)
+
+    def _log_access(self, scope: Scope, status_code: int, start: float) -> None:
+        """アクセスログを出力（エラーレスポンスは常に、成功レスポンスはサンプリングして出力）"""
+        logger.info(f"{scope['method']} {scope['path']} {status_code}", extra={
+            'endpoint': scope['path'],
+            'method': scope['method'],
+            'status': status_code,
+            'latency_ms': round((time.perf_counter() - start) * 1000, 2),
+            'sample_rate': None if status_code >= 400 else self.access_log_sample_rate,
+        })
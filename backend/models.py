@@ -3,9 +3,13 @@ Timekeeper Backend Models
 APIリクエスト・レスポンス用のPydanticモデル
 """
 from pydantic import BaseModel, Field
-from typing import Optional, Literal
+from typing import List, Optional, Literal
 from datetime import date
 
+# 購入できるデイパスの最大の購入済み回数（pricing の価格の計算式で金額が Stripe の1明細の上限に収まる最大値）
+# スキーマの読み込みを軽く保つため値を直接定義し、pricing はここから参照する
+MAX_DAYPASS_UNLOCK_COUNT = 71
+
 
 class LicenseConfirmRequest(BaseModel):
     """ライセンス確認リクエスト"""
@@ -41,8 +45,34 @@ class ErrorResponse(BaseModel):
 class CreateCheckoutSessionRequest(BaseModel):
     device_id: str = Field(..., description="デバイスID")
     product_type: Literal["license", "daypass"] = Field(..., description="購入する商品種別 (license または daypass)")
-    unlock_count: Optional[int] = Field(None, description="現在のアンロック回数 (デイパス購入時、価格計算に利用)") # デイパス価格変動のため追加
+    unlock_count: Optional[int] = Field(None, le=MAX_DAYPASS_UNLOCK_COUNT, description="現在のアンロック回数 (デイパス購入時、価格計算に利用)") # デイパス価格変動のため追加
 
 
 class CreateCheckoutSessionResponse(BaseModel):
-    checkout_url: str = Field(..., description="Stripe CheckoutページのURL") 
\ No newline at end of file
+    checkout_url: str = Field(..., description="Stripe CheckoutページのURL") 
+
+class DeviceEntitlementsResponse(BaseModel):
+    """デバイスの購入状態レスポンス"""
+    device_id: str = Field(..., description="デバイスID")
+    license_purchased: bool = Field(..., description="ライセンス購入済みかどうか")
+    unlock_count: int = Field(..., description="デイパスのアンロック回数")
+    last_unlock_date: Optional[str] = Field(None, description="最終アンロック日（YYYY-MM-DD形式、UTC）")
+    daypass_valid_today: bool = Field(..., description="今日（UTC）のデイパスが有効かどうか")
+    next_daypass_price: int = Field(..., description="次回のデイパス価格（円）")
+
+
+class HeartbeatGapModel(BaseModel):
+    """ハートビートのギャップ"""
+    start: int = Field(..., description="ギャップ直前のハートビート（エポックミリ秒）")
+    end: int = Field(..., description="ギャップ直後のハートビート（エポックミリ秒）")
+    gap_minutes: int = Field(..., description="ギャップの長さ（分）")
+    severity: Literal["SUSPICIOUS", "SECURITY_BREACH"] = Field(..., description="重大度")
+
+
+class HeartbeatBatchResponse(BaseModel):
+    """ハートビート一括アップロードレスポンス"""
+    device_id: str = Field(..., description="デバイスID")
+    accepted: int = Field(..., description="受け付けたハートビート数（重複を除く）")
+    buckets: List[str] = Field(..., description="書き込んだ日（YYYY-MM-DD形式、UTC）")
+    gaps: List[HeartbeatGapModel] = Field(..., description="検出したギャップ")
+    max_severity: Optional[Literal["SUSPICIOUS", "SECURITY_BREACH"]] = Field(None, description="最も重大なギャップの重大度")
@@ -0,0 +1,220 @@
+"""
+Timekeeper Backend Pricing
+デイパスの価格表とStripe Priceオブジェクトの管理
+
+デイパスの価格は購入済み回数（段階）ごとに決まるため、段階ごとに再利用可能なStripe Priceを
+lookup_key で引き当て（存在しない場合は作成し）、Price IDをメモリとFirestoreにキャッシュする。
+Checkoutセッションの作成はライセンスと同様に既存のPrice IDを参照するだけになり、
+セッションごとに商品・価格が作成されなくなる。
+"""
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+from config import firestore_config
+from io_executor import io_executor
+from metrics import FIRESTORE_OPERATION_DURATION, metrics
+from models import MAX_DAYPASS_UNLOCK_COUNT
+from stripe_gateway import stripe_gateway
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# デイパス価格（円）: DAYPASS_BASE_PRICE × DAYPASS_PRICE_MULTIPLIER^購入済み回数（アプリの表示価格と同じ計算）
+DAYPASS_BASE_PRICE = 200
+DAYPASS_PRICE_MULTIPLIER = 1.2
+DAYPASS_CURRENCY = 'jpy'
+# 事前計算し、Stripe Priceを作成する段階数（これを超える段階は同じ式で計算し、price_data で金額を指定する）
+DAYPASS_PRICE_TIERS = 32
+# Stripe の1明細の金額の上限（円）
+STRIPE_MAX_UNIT_AMOUNT = 99_999_999
+
+# Price IDをキャッシュするコレクション（ドキュメントIDは lookup_key）
+STRIPE_PRICES_COLLECTION = 'stripe_prices'
+
+
+def _compute_daypass_price(unlock_count: int) -> int:
+    """価格の計算式"""
+    return int(DAYPASS_BASE_PRICE * (DAYPASS_PRICE_MULTIPLIER ** unlock_count))
+
+
+def _max_unlock_count() -> int:
+    """金額が STRIPE_MAX_UNIT_AMOUNT に収まる最大の購入済み回数"""
+    count = 0
+    while _compute_daypass_price(count + 1) <= STRIPE_MAX_UNIT_AMOUNT:
+        count += 1
+    return count
+
+
+# 段階ごとのデイパス価格表
+DAYPASS_PRICE_TABLE = tuple(_compute_daypass_price(tier) for tier in range(DAYPASS_PRICE_TIERS))
+
+
+def daypass_price(unlock_count: int) -> int:
+    """
+    デイパスの価格を取得
+
+    Args:
+        unlock_count: 購入済みのアンロック回数
+
+    Returns:
+        int: 価格（円）
+
+    Raises:
+        ValueError: unlock_count が MAX_DAYPASS_UNLOCK_COUNT を超える場合
+    """
+    if 0 <= unlock_count < DAYPASS_PRICE_TIERS:
+        return DAYPASS_PRICE_TABLE[unlock_count]
+    if unlock_count > MAX_DAYPASS_UNLOCK_COUNT:
+        raise ValueError(f"unlock_count must be at most {MAX_DAYPASS_UNLOCK_COUNT}: {unlock_count}")
+    return _compute_daypass_price(max(0, unlock_count))
+
+
+def daypass_product_name(unlock_count: int) -> str:
+    """Checkoutページに表示する商品名"""
+    return f"デイパス ({unlock_count + 1}回目)"
+
+
+def daypass_lookup_key(unlock_count: int) -> str:
+    """
+    段階のStripe Price lookup_key
+
+    金額を含めるため、価格の計算式を変更した場合は新しいPriceが作成される。
+    """
+    return f"daypass_tier_{unlock_count}_{DAYPASS_CURRENCY}_{daypass_price(unlock_count)}"
+
+
+class DaypassPriceCatalog:
+    """
+    デイパスの段階ごとのStripe Price IDの解決とキャッシュ
+
+    メモリ → Firestore → Stripe（lookup_key で検索し、なければ作成）の順に引き当てる。
+    Priceを作成するのは DAYPASS_PRICE_TIERS 未満の段階だけで、キャッシュの件数もこれを上限とする。
+    同じ段階の引き当てはプロセス内で1つにまとめ、Priceの作成には lookup_key から作った
+    冪等キーを指定するため、複数インスタンスが同時に作成しても重複しない。
+    """
+
+    def __init__(self):
+        self._price_ids: Dict[str, str] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def get_price_id(self, unlock_count: int) -> str:
+        """
+        段階のPrice IDを取得
+
+        Args:
+            unlock_count: 購入済みのアンロック回数
+
+        Returns:
+            str: Stripe Price ID
+
+        Raises:
+            ValueError: 事前計算した段階の範囲外の場合
+            stripe.error.StripeError: Stripe APIエラー
+        """
+        if not 0 <= unlock_count < DAYPASS_PRICE_TIERS:
+            raise ValueError(f"No catalog price for daypass tier {unlock_count}")
+        key = daypass_lookup_key(unlock_count)
+        price_id = self._price_ids.get(key)
+        if price_id is not None:
+            return price_id
+
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            price_id = self._price_ids.get(key)
+            if price_id is None:
+                price_id = await io_executor.run(self._load, key) or await self._resolve_in_stripe(key, unlock_count)
+                self._price_ids[key] = price_id
+        return price_id
+
+    async def line_item(self, unlock_count: int) -> Dict[str, Any]:
+        """
+        デイパスのCheckout明細を作成
+
+        事前計算した段階を超える場合と、Price IDを引き当てられない場合は price_data で金額を指定する。
+
+        Args:
+            unlock_count: 購入済みのアンロック回数
+
+        Returns:
+            Dict[str, Any]: Checkout Session の line_items の要素
+
+        Raises:
+            ValueError: unlock_count が MAX_DAYPASS_UNLOCK_COUNT を超える場合
+        """
+        inline = {
+            "price_data": {
+                "currency": DAYPASS_CURRENCY,
+                "product_data": {"name": daypass_product_name(unlock_count)},
+                "unit_amount": daypass_price(unlock_count),
+            },
+            "quantity": 1,
+        }
+        if not 0 <= unlock_count < DAYPASS_PRICE_TIERS:
+            return inline
+        try:
+            return {"price": await self.get_price_id(unlock_count), "quantity": 1}
+        except Exception as e:
+            logger.warning(f"Failed to resolve daypass price, falling back to inline price_data: {str(e)}", extra={
+                'unlock_count': unlock_count, 'rate_limit_key': 'daypass_price_fallback'
+            })
+            return inline
+
+    def clear(self) -> None:
+        """メモリ上のキャッシュを破棄"""
+        self._price_ids.clear()
+        self._locks.clear()
+
+    def _load(self, key: str) -> Optional[str]:
+        """FirestoreにキャッシュされたPrice IDを取得"""
+        db = firestore_config.get_client()
+        if not db:
+            return None
+        try:
+            with metrics.timer(FIRESTORE_OPERATION_DURATION, 'get'):
+                snapshot = db.collection(STRIPE_PRICES_COLLECTION).document(key).get()
+        except Exception as e:
+            logger.warning(f"Failed to read cached Stripe price: {str(e)}", extra={'lookup_key': key})
+            return None
+        return snapshot.get('price_id') if snapshot.exists else None
+
+    def _store(self, key: str, price_id: str, unlock_count: int) -> None:
+        """Price IDをFirestoreにキャッシュ"""
+        db = firestore_config.get_client()
+        if not db:
+            return
+        try:
+            with metrics.timer(FIRESTORE_OPERATION_DURATION, 'set'):
+                db.collection(STRIPE_PRICES_COLLECTION).document(key).set({
+                    'price_id': price_id,
+                    'tier': unlock_count,
+                    'unit_amount': daypass_price(unlock_count),
+                    'currency': DAYPASS_CURRENCY,
+                    'created_at': datetime.now(timezone.utc),
+                })
+        except Exception as e:
+            # メモリにはキャッシュ済みのため、次のインスタンスが Stripe で引き当て直すだけで済む
+            logger.warning(f"Failed to cache Stripe price: {str(e)}", extra={'lookup_key': key})
+
+    async def _resolve_in_stripe(self, key: str, unlock_count: int) -> str:
+        """lookup_key でStripe Priceを検索し、なければ作成"""
+        prices = await stripe_gateway.list_prices(lookup_keys=[key], active=True, limit=1)
+        if prices.data:
+            price_id = prices.data[0].id
+        else:
+            price = await stripe_gateway.create_price(
+                currency=DAYPASS_CURRENCY,
+                unit_amount=daypass_price(unlock_count),
+                product_data={'name': daypass_product_name(unlock_count)},
+                lookup_key=key,
+                metadata={'product_type': 'daypass', 'tier': str(unlock_count)},
+                idempotency_key=f"price-{key}",
+            )
+            price_id = price.id
+            logger.info("Created Stripe price for daypass tier", extra={
+                'lookup_key': key, 'price_id': price_id, 'unlock_count': unlock_count
+            })
+        await io_executor.run(self._store, key, price_id, unlock_count)
+        return price_id
+
+
+# グローバルなデイパス価格カタログインスタンス
+daypass_price_catalog = DaypassPriceCatalog()
@@ -0,0 +1,189 @@
+"""
+Timekeeper Backend Rate Limiter
+購入系エンドポイントのトークンバケットによる流量制限
+
+同じデバイス（またはクライアントIP）からの確認APIの連打・再送の嵐は、1件ごとにStripeの問い合わせと
+Firestoreの読み書き（操作単位の課金）を発生させる。外部呼び出しの前にメモリ上のトークンバケットで判定し、
+上限を超えた要求は 429 と Retry-After で即座に返す。
+状態はインスタンスごとに保持する（Cloud Run の複数インスタンス間では共有しない）。
+"""
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from metrics import RATE_LIMITED_TOTAL, metrics
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 制限の既定値（「回数/秒数」: 秒数あたりの回数で補充し、回数までの連続した要求を許可する）
+DEFAULT_DEVICE_LIMIT = '10/60'
+DEFAULT_IP_LIMIT = '120/60'
+
+# 流量制限を行うルート（ルートごとに RATE_LIMIT_<ルート>_DEVICE / _IP で上書きできる）
+LIMITED_ROUTES = (
+    '/create-checkout-session', '/license/confirm', '/unlock/daypass', '/devices/{device_id}/heartbeats:batch'
+)
+
+
+def parse_limit(spec: Optional[str]) -> Optional[Tuple[float, float]]:
+    """
+    制限の指定（例: "10/60"）を解析
+
+    Args:
+        spec: 「回数/秒数」。空・"0"・"off" の場合は制限なし
+
+    Returns:
+        Optional[Tuple[float, float]]: (バケットの容量, 秒数)、制限なしの場合None
+
+    Raises:
+        ValueError: 形式が不正な場合
+    """
+    if spec is None or spec.strip().lower() in ('', '0', 'off'):
+        return None
+    count, _, seconds = spec.partition('/')
+    capacity, period = float(count), float(seconds or 1)
+    if capacity <= 0 or period <= 0:
+        raise ValueError(f"Invalid rate limit: {spec!r}")
+    return capacity, period
+
+
+class TokenBucket:
+    """1キー分のトークンバケット"""
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class TokenBucketLimiter:
+    """
+    キーごとのトークンバケット（サイズ上限付きLRU）
+
+    上限を超えた場合は最も長く使われていないバケットを破棄する。
+    破棄されるのは満杯まで補充済みのものがほとんどで、その場合は制限の結果は変わらない。
+    """
+
+    def __init__(self, capacity: float, period: float, max_entries: Optional[int] = None):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.max_entries: int = max_entries if max_entries is not None else int(
+            os.getenv('RATE_LIMIT_MAX_ENTRIES', '10000')
+        )
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, now: Optional[float] = None) -> float:
+        """
+        トークンを1つ消費
+
+        Args:
+            key: バケットのキー（デバイスID・クライアントIP）
+            now: 現在時刻（time.monotonic()、テスト用）
+
+        Returns:
+            float: 許可した場合0、拒否した場合は次のトークンが補充されるまでの秒数
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.capacity, now)
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_entries:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0.0
+            return (1 - bucket.tokens) / self.rate
+
+    def clear(self) -> None:
+        """全てのバケットを破棄"""
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._buckets)
+
+
+class AdmissionController:
+    """ルートごとのデバイスID・クライアントIPによる流量制限"""
+
+    def __init__(self):
+        self.enabled: bool = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() != 'false'
+        # (ルート, キー種別) -> リミッター
+        self._limiters: Dict[Tuple[str, str], TokenBucketLimiter] = {}
+        for route in LIMITED_ROUTES:
+            # 例: /devices/{device_id}/heartbeats:batch -> RATE_LIMIT_DEVICES_DEVICE_ID_HEARTBEATS_BATCH
+            env_prefix = 'RATE_LIMIT_' + re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_').upper()
+            self.configure(route, 'device', os.getenv(f'{env_prefix}_DEVICE',
+                                                      os.getenv('RATE_LIMIT_DEVICE', DEFAULT_DEVICE_LIMIT)))
+            self.configure(route, 'ip', os.getenv(f'{env_prefix}_IP', os.getenv('RATE_LIMIT_IP', DEFAULT_IP_LIMIT)))
+
+    def configure(self, route: str, key_type: str, spec: Optional[str]) -> None:
+        """
+        ルート・キー種別の制限を設定（既存のバケットは破棄される）
+
+        Args:
+            route: ルートのパス
+            key_type: キー種別（device / ip）
+            spec: 「回数/秒数」。制限しない場合は None または "off"
+        """
+        limit = parse_limit(spec)
+        if limit is None:
+            self._limiters.pop((route, key_type), None)
+        else:
+            self._limiters[(route, key_type)] = TokenBucketLimiter(*limit)
+
+    def check(self, route: str, device_id: Optional[str], client_ip: Optional[str]) -> float:
+        """
+        要求を許可するかどうかを判定（許可した場合はトークンを消費する）
+
+        Args:
+            route: ルートのパス
+            device_id: デバイスID
+            client_ip: クライアントIP
+
+        Returns:
+            float: 許可した場合0、拒否した場合は Retry-After の秒数
+        """
+        if not self.enabled:
+            return 0.0
+        for key_type, key in (('device', device_id), ('ip', client_ip)):
+            limiter = self._limiters.get((route, key_type))
+            if limiter is None or not key:
+                continue
+            retry_after = limiter.acquire(key)
+            if retry_after > 0:
+                metrics.inc(RATE_LIMITED_TOTAL, (route, key_type))
+                logger.warning("Rate limit exceeded", extra={
+                    'endpoint': route, 'limit_key': key_type, 'device_id': device_id,
+                    'retry_after_seconds': round(retry_after, 3), 'rate_limit_key': f'rate_limited_{key_type}'
+                })
+                return retry_after
+        return 0.0
+
+    def clear(self) -> None:
+        """全てのバケットを破棄（テスト用）"""
+        for limiter in self._limiters.values():
+            limiter.clear()
+
+
+def retry_after_header(seconds: float) -> str:
+    """Retry-After ヘッダーの値（秒、切り上げ）"""
+    return str(max(1, math.ceil(seconds)))
+
+
+# グローバルな流量制限インスタンス
+admission_controller = AdmissionController()
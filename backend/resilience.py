@@ -0,0 +1,184 @@
+"""
+Timekeeper Backend Resilience
+依存サービス（Stripe / Firestore）の呼び出しの期限とサーキットブレーカー
+
+応答しない依存サービスの呼び出しはリクエストを Cloud Run のタイムアウト（300秒）まで保持し、
+待機中のリクエストが積み上がってメモリ（512Mi）を使い果たす。呼び出しごとに期限を設け、
+障害が続いた依存サービスはブレーカーを開いて、回復を確認するまでの間の要求を
+503 と Retry-After で即座に返す（closed → open → half-open → closed）。
+"""
+import asyncio
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+from lazy_imports import lazy_import
+from metrics import DEPENDENCY_REJECTED_TOTAL, metrics
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 障害の判定に使う例外クラスは、例外が発生した時にだけ読み込む
+stripe = lazy_import('stripe')
+google_exceptions = lazy_import('google.api_core.exceptions')
+
+T = TypeVar('T')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class DependencyUnavailable(Exception):
+    """依存サービスが利用できない（ブレーカーが開いている・期限を超えた）"""
+
+    def __init__(self, dependency: str, retry_after: float, reason: str):
+        super().__init__(f"{dependency} is unavailable ({reason})")
+        self.dependency = dependency
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """
+    依存サービスごとのサーキットブレーカー（呼び出しの期限付き）
+
+    連続した障害が閾値に達すると open になり、reset_timeout の間は呼び出さずに
+    DependencyUnavailable を送出する。経過後は half-open として1件だけ試行を通し、
+    成功すれば closed に戻り、失敗すれば再び open になる。
+    Firestoreの呼び出しはスレッドプールで実行されるため、状態はロックで保護する。
+    """
+
+    def __init__(self, name: str, deadline: float, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 is_failure: Optional[Callable[[BaseException], bool]] = None):
+        self.name = name
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._is_failure = is_failure or (lambda exc: True)
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """現在の状態（closed / open / half_open）"""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    async def call(self, fn: Callable[[], Awaitable[T]], deadline: Optional[float] = None) -> T:
+        """
+        期限とブレーカーの判定付きで呼び出す
+
+        期限を超えた場合、スレッドプールで実行中の同期呼び出しは完了まで続く（結果は破棄される）。
+
+        Args:
+            fn: 呼び出し（コルーチンを返す関数）
+            deadline: 期限（秒）。省略時はブレーカーの既定値
+
+        Returns:
+            呼び出しの結果
+
+        Raises:
+            DependencyUnavailable: ブレーカーが開いている、または期限を超えた場合
+            Exception: 呼び出しが送出した例外
+        """
+        self._before_call()
+        try:
+            result = await asyncio.wait_for(fn(), deadline if deadline is not None else self.deadline)
+        except asyncio.TimeoutError:
+            self._record_failure()
+            metrics.inc(DEPENDENCY_REJECTED_TOTAL, (self.name, 'deadline_exceeded'))
+            raise DependencyUnavailable(self.name, self.reset_timeout, 'deadline_exceeded')
+        except asyncio.CancelledError:
+            self._release_probe()
+            raise
+        except Exception as e:
+            if self._is_failure(e):
+                self._record_failure()
+            else:
+                # 依存サービスは応答している（リクエスト側のエラー）
+                self._record_success()
+            raise
+        self._record_success()
+        return result
+
+    def reset(self) -> None:
+        """closed に戻す（テスト用）"""
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def _before_call(self) -> None:
+        """呼び出してよいかを判定（open の間、および half-open で試行中の場合は送出）"""
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+            if self._state == OPEN and remaining <= 0:
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            retry_after = remaining if remaining > 0 else 1.0
+        metrics.inc(DEPENDENCY_REJECTED_TOTAL, (self.name, 'circuit_open'))
+        raise DependencyUnavailable(self.name, retry_after, 'circuit_open')
+
+    def _record_success(self) -> None:
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info("Circuit breaker closed", extra={'dependency': self.name})
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def _record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logger.warning("Circuit breaker opened", extra={
+                        'dependency': self.name, 'failures': self._failures, 'reset_timeout': self.reset_timeout
+                    })
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def _release_probe(self) -> None:
+        with self._lock:
+            self._probe_in_flight = False
+
+
+def is_stripe_failure(exc: BaseException) -> bool:
+    """Stripeの障害（接続エラー・5xx・レート制限）かどうか"""
+    return isinstance(exc, (stripe.error.APIConnectionError, stripe.error.APIError, stripe.error.RateLimitError))
+
+
+def is_firestore_failure(exc: BaseException) -> bool:
+    """Firestoreの障害（利用不可・期限超過・内部エラー・リソース不足）かどうか"""
+    return isinstance(exc, (
+        google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError, google_exceptions.ResourceExhausted
+    ))
+
+
+def _breaker_from_env(name: str, env_prefix: str, deadline: str,
+                      is_failure: Callable[[BaseException], bool]) -> CircuitBreaker:
+    """環境変数の設定でブレーカーを作成"""
+    return CircuitBreaker(
+        name,
+        deadline=float(os.getenv(f'{env_prefix}_DEADLINE_SECONDS', deadline)),
+        failure_threshold=int(os.getenv(f'{env_prefix}_BREAKER_FAILURE_THRESHOLD', '5')),
+        reset_timeout=float(os.getenv(f'{env_prefix}_BREAKER_RESET_SECONDS', '30')),
+        is_failure=is_failure
+    )
+
+
+# グローバルな依存サービスごとのブレーカーインスタンス
+stripe_breaker = _breaker_from_env('stripe', 'STRIPE', '20', is_stripe_failure)
+firestore_breaker = _breaker_from_env('firestore', 'FIRESTORE', '10', is_firestore_failure)
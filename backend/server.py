@@ -0,0 +1,173 @@
+"""
+Timekeeper Backend Server Launcher
+本番用のuvicorn起動スクリプト
+
+コンテナに割り当てられたCPU・メモリからワーカー数を決め、uvloop・httptools が
+インストールされていれば使用する。キープアライブ・同時接続数の上限は Cloud Run の
+リクエスト同時実行数に合わせて設定し、SIGTERM 受信後は処理中のリクエストの完了を待ってから
+lifespan の終了処理（Webhookワーカーの停止・書き込みのフラッシュ）を行う。
+
+実行方法:
+    python server.py
+"""
+import importlib.util
+import math
+import os
+from typing import Any, Dict, Optional
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# ワーカー1つあたりに確保するメモリ（MB）
+DEFAULT_WORKER_MEMORY_MB = 192
+# Cloud Run のリクエスト同時実行数（デプロイ時の --concurrency と揃える）
+DEFAULT_CONCURRENCY = 80
+# Cloud Run（Google Front End）のアイドル接続タイムアウト（600秒）より長くし、
+# 再利用しようとした接続をサーバー側が先に閉じないようにする
+DEFAULT_KEEP_ALIVE_SECONDS = 620
+# SIGTERM から強制終了までの猶予（Cloud Run は10秒）のうち、処理中リクエストの完了を待つ秒数
+DEFAULT_GRACEFUL_SHUTDOWN_SECONDS = 6
+
+
+def _read_file(path: str) -> Optional[str]:
+    """ファイルの内容を取得（存在しない場合None）"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def detect_cpu_count(cgroup_root: str = '/sys/fs/cgroup') -> float:
+    """
+    利用可能なCPU数を取得（cgroupのCPUクォータを考慮）
+
+    Args:
+        cgroup_root: cgroupファイルシステムのマウント先
+
+    Returns:
+        float: 利用可能なCPU数（クォータが小数の場合は小数）
+    """
+    try:
+        cpus: float = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # cgroup v2: "<quota> <period>"（無制限の場合は "max <period>"）
+    cpu_max = _read_file(os.path.join(cgroup_root, 'cpu.max'))
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return min(cpus, int(quota) / int(period))
+        return cpus
+
+    # cgroup v1
+    quota = _read_file(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_quota_us'))
+    period = _read_file(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_period_us'))
+    if quota and period and int(quota) > 0:
+        return min(cpus, int(quota) / int(period))
+    return cpus
+
+
+def detect_memory_limit(cgroup_root: str = '/sys/fs/cgroup') -> Optional[int]:
+    """
+    利用可能なメモリ量を取得（cgroupのメモリ上限を優先）
+
+    Args:
+        cgroup_root: cgroupファイルシステムのマウント先
+
+    Returns:
+        Optional[int]: メモリ量（バイト）、取得できない場合None
+    """
+    for path in (os.path.join(cgroup_root, 'memory.max'),
+                 os.path.join(cgroup_root, 'memory', 'memory.limit_in_bytes')):
+        value = _read_file(path)
+        # cgroup v1 の無制限は非常に大きな値になるため物理メモリ量で判定する
+        if value and value != 'max' and int(value) < (1 << 60):
+            return int(value)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def compute_workers(cpus: float, memory_bytes: Optional[int],
+                    worker_memory_mb: int = DEFAULT_WORKER_MEMORY_MB) -> int:
+    """
+    ワーカー数を決定
+
+    I/O待ちはスレッドプール・イベントループで重ねるため、ワーカー数はCPU数を上限とし、
+    ワーカーごとのメモリが確保できない場合はさらに減らす。
+
+    Args:
+        cpus: 利用可能なCPU数
+        memory_bytes: 利用可能なメモリ量（バイト）
+        worker_memory_mb: ワーカー1つあたりに確保するメモリ（MB）
+
+    Returns:
+        int: ワーカー数（1以上）
+    """
+    workers = max(1, math.floor(cpus))
+    if memory_bytes:
+        workers = min(workers, max(1, memory_bytes // (worker_memory_mb * 1024 * 1024)))
+    return workers
+
+
+def build_server_options(env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    uvicorn.run() に渡す設定を作成
+
+    Args:
+        env: 環境変数（省略時は os.environ）
+
+    Returns:
+        Dict[str, Any]: uvicorn.run() のキーワード引数
+    """
+    env = os.environ if env is None else env
+
+    if env.get('WEB_CONCURRENCY'):
+        workers = max(1, int(env['WEB_CONCURRENCY']))
+    else:
+        workers = compute_workers(
+            detect_cpu_count(), detect_memory_limit(),
+            int(env.get('WORKER_MEMORY_MB', DEFAULT_WORKER_MEMORY_MB))
+        )
+
+    # Cloud Run から届く同時リクエストをワーカーで分担し、ヘルスチェック等の余裕を持たせる
+    concurrency = int(env.get('CONCURRENCY', DEFAULT_CONCURRENCY))
+    per_worker = math.ceil(concurrency / workers)
+    limit_concurrency = per_worker + max(4, per_worker // 4)
+
+    return {
+        'app': 'main:app',
+        'host': env.get('HOST', '0.0.0.0'),
+        'port': int(env.get('PORT', '8080')),
+        'workers': workers,
+        'loop': 'uvloop' if importlib.util.find_spec('uvloop') else 'asyncio',
+        'http': 'httptools' if importlib.util.find_spec('httptools') else 'h11',
+        'timeout_keep_alive': int(env.get('KEEP_ALIVE_SECONDS', DEFAULT_KEEP_ALIVE_SECONDS)),
+        'limit_concurrency': limit_concurrency,
+        'backlog': int(env.get('BACKLOG', max(2048, concurrency * 4))),
+        'timeout_graceful_shutdown': int(env.get('GRACEFUL_SHUTDOWN_SECONDS', DEFAULT_GRACEFUL_SHUTDOWN_SECONDS)),
+        # Cloud Run のプロキシ経由のため X-Forwarded-* を信頼する
+        'proxy_headers': True,
+        'forwarded_allow_ips': '*',
+        # アクセスログはアプリ側で構造化ログとして出力する
+        'access_log': False,
+        'log_level': env.get('LOG_LEVEL', 'info').lower(),
+    }
+
+
+def main() -> None:
+    """設定を作成してuvicornを起動"""
+    import uvicorn
+
+    options = build_server_options()
+    logger.info("Starting server", extra={
+        key: options[key] for key in ('workers', 'loop', 'http', 'limit_concurrency', 'timeout_keep_alive', 'backlog')
+    })
+    uvicorn.run(**options)
+
+
+if __name__ == '__main__':
+    main()
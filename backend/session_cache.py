@@ -0,0 +1,269 @@
+"""
+Timekeeper Backend Checkout Session Cache
+支払い済みStripe Checkoutセッションのキャッシュ（TTL付きLRU）と、
+購入操作の繰り返しで再利用する未完了Checkoutセッションのキャッシュ
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+class CachedSession:
+    """キャッシュされたCheckoutセッションの支払い情報"""
+
+    __slots__ = ('session_id', 'payment_status', 'metadata', 'payment_intent', 'created', 'expires_at')
+
+    def __init__(self, session_id: str, payment_status: str, metadata: Dict[str, Any],
+                 payment_intent: Optional[str], expires_at: float, created: Optional[int] = None):
+        self.session_id = session_id
+        self.payment_status = payment_status
+        self.metadata = metadata
+        self.payment_intent = payment_intent
+        # セッションの作成時刻（UNIX時刻。キャッシュヒット時もセッションの古さを判定するために保持）
+        self.created = created
+        self.expires_at = expires_at
+
+
+class CheckoutSessionCache:
+    """
+    支払い済みCheckoutセッションのTTL付きLRUキャッシュ
+
+    Webhook（checkout.session.completed）と Session.retrieve の結果から埋められ、
+    確認APIはキャッシュヒット時にStripeへの問い合わせを省略する。
+    支払い状態が変化しうる未払いセッションはキャッシュしない。
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, ttl_seconds: Optional[float] = None):
+        self.max_entries: int = max_entries if max_entries is not None else int(
+            os.getenv('SESSION_CACHE_MAX_ENTRIES', '10000')
+        )
+        self.ttl_seconds: float = ttl_seconds if ttl_seconds is not None else float(
+            os.getenv('SESSION_CACHE_TTL_SECONDS', '3600')
+        )
+        self._entries: "OrderedDict[str, CachedSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[CachedSession]:
+        """
+        セッション情報を取得
+
+        Args:
+            session_id: Checkout Session ID
+
+        Returns:
+            Optional[CachedSession]: キャッシュ済みの情報、未登録または期限切れの場合None
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.monotonic():
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return entry
+
+    def remember(self, session: Any) -> bool:
+        """
+        Stripeのセッションオブジェクトをキャッシュに登録
+
+        Args:
+            session: stripe.checkout.Session（または同等の辞書ライクなオブジェクト）
+
+        Returns:
+            bool: キャッシュに登録した場合True（支払い済みでない場合はFalse）
+        """
+        if session.get('payment_status') != 'paid':
+            return False
+        metadata = session.get('metadata') or {}
+        self.put(
+            session_id=session.get('id'),
+            payment_status='paid',
+            metadata={key: metadata.get(key) for key in ('device_id', 'product_type')},
+            payment_intent=session.get('payment_intent'),
+            created=session.get('created')
+        )
+        return True
+
+    def put(self, session_id: str, payment_status: str, metadata: Optional[Dict[str, Any]] = None,
+            payment_intent: Optional[str] = None, created: Optional[int] = None) -> None:
+        """
+        セッション情報を登録（上限を超えた場合は最も古いエントリを破棄）
+
+        Args:
+            session_id: Checkout Session ID
+            payment_status: 支払い状態
+            metadata: セッションのメタデータ
+            payment_intent: PaymentIntent ID
+            created: セッションの作成時刻（UNIX時刻）
+        """
+        if not session_id or self.max_entries <= 0:
+            return
+        entry = CachedSession(
+            session_id=session_id,
+            payment_status=payment_status,
+            metadata=metadata or {},
+            payment_intent=payment_intent,
+            expires_at=time.monotonic() + self.ttl_seconds,
+            created=created
+        )
+        with self._lock:
+            self._entries[session_id] = entry
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_id: str) -> None:
+        """
+        セッション情報を削除
+
+        Args:
+            session_id: Checkout Session ID
+        """
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def clear(self) -> None:
+        """全エントリを削除"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class OpenSession:
+    """再利用できる未完了のCheckoutセッション"""
+
+    __slots__ = ('session_id', 'url', 'expires_at')
+
+    def __init__(self, session_id: str, url: str, expires_at: float):
+        self.session_id = session_id
+        self.url = url
+        # 再利用をやめる時刻（UNIX時刻。Stripeのセッション期限より余裕を持たせる）
+        self.expires_at = expires_at
+
+
+class OpenSessionCache:
+    """
+    未完了Checkoutセッションのキャッシュ（device_id・商品種別・価格段階ごとに1件）
+
+    購入ボタンの連打や画面の行き来で同じ購入を繰り返した場合に、新しいセッションを作成せず
+    作成済みのセッションURLを返すために使用する。エントリはStripeのセッション期限の少し前
+    （または最大保持時間）で失効し、checkout.session.completed / checkout.session.expired の
+    Webhookや確認APIでの購入反映で破棄される。
+    他インスタンスで完了したセッションが残る場合があるが、デイパスは購入後に段階が変わるため
+    同じキーで引かれることはなく、ライセンスは購入後に再購入されない。
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, max_ttl_seconds: Optional[float] = None,
+                 expiry_margin_seconds: float = 300.0):
+        self.max_entries: int = max_entries if max_entries is not None else int(
+            os.getenv('OPEN_SESSION_CACHE_MAX_ENTRIES', '10000')
+        )
+        self.max_ttl_seconds: float = max_ttl_seconds if max_ttl_seconds is not None else float(
+            os.getenv('OPEN_SESSION_CACHE_TTL_SECONDS', '1800')
+        )
+        self.expiry_margin_seconds = expiry_margin_seconds
+        self._entries: "OrderedDict[Tuple[str, str, int], OpenSession]" = OrderedDict()
+        # Session ID -> キー（Webhookでの破棄用）
+        self._keys: Dict[str, Tuple[str, str, int]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, device_id: str, product_type: str, tier: int) -> Optional[OpenSession]:
+        """
+        再利用できるセッションを取得
+
+        Args:
+            device_id: デバイスID
+            product_type: 商品種別（license / daypass）
+            tier: 価格段階（デイパスは購入済み回数、ライセンスは0）
+
+        Returns:
+            Optional[OpenSession]: 再利用できるセッション、ない場合None
+        """
+        key = (device_id, product_type, tier)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                self._remove_locked(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, device_id: str, product_type: str, tier: int, session: Any) -> bool:
+        """
+        作成したセッションを登録
+
+        Args:
+            device_id: デバイスID
+            product_type: 商品種別（license / daypass）
+            tier: 価格段階
+            session: stripe.checkout.Session（または同等の辞書ライクなオブジェクト）
+
+        Returns:
+            bool: 登録した場合True（未完了でない・期限が近いなど再利用できない場合はFalse）
+        """
+        session_id, url = session.get('id'), session.get('url')
+        if self.max_entries <= 0 or not session_id or not url or session.get('status', 'open') != 'open':
+            return False
+        now = time.time()
+        expires_at = now + self.max_ttl_seconds
+        if session.get('expires_at'):
+            expires_at = min(expires_at, session.get('expires_at') - self.expiry_margin_seconds)
+        if expires_at <= now:
+            return False
+
+        key = (device_id, product_type, tier)
+        with self._lock:
+            self._remove_locked(key)
+            self._entries[key] = OpenSession(session_id, url, expires_at)
+            self._keys[session_id] = key
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove_locked(oldest)
+        return True
+
+    def invalidate_session(self, session_id: str) -> bool:
+        """
+        セッションを破棄（完了・期限切れ・購入反映時）
+
+        Args:
+            session_id: Checkout Session ID
+
+        Returns:
+            bool: 破棄した場合True
+        """
+        with self._lock:
+            key = self._keys.get(session_id)
+            if key is None:
+                return False
+            self._remove_locked(key)
+            return True
+
+    def clear(self) -> None:
+        """全エントリを削除"""
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _remove_locked(self, key: Tuple[str, str, int]) -> None:
+        """エントリを削除（ロック保持中に呼び出す）"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._keys.pop(entry.session_id, None)
+
+
+# グローバルなCheckoutセッションキャッシュインスタンス
+session_cache = CheckoutSessionCache()
+# グローバルな未完了Checkoutセッションキャッシュインスタンス
+open_session_cache = OpenSessionCache()
@@ -0,0 +1,107 @@
+"""
+Timekeeper Backend Single Flight
+同じ処理の同時実行を1つにまとめるシングルフライトと、ストライプ化した非同期ロック
+
+同じ購入は確認API・クライアントの再送・Webhookでほぼ同時に届くことが多い。
+同じキーの処理が実行中であれば新しく実行せずにその完了を待ち、全員が同じ結果（例外）を受け取る。
+"""
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class StripedLocks:
+    """
+    キーのハッシュで固定数のロックに割り当てる非同期ロック
+
+    キーごとにロックを作成・破棄せずに済み、メモリ使用量はストライプ数で一定になる。
+    異なるキーが同じロックを共有することがあるが、直列化されるだけで正しさには影響しない。
+    """
+
+    def __init__(self, stripes: Optional[int] = None):
+        self.stripes: int = max(1, stripes if stripes is not None else int(
+            os.getenv('SINGLE_FLIGHT_LOCK_STRIPES', '64')
+        ))
+        self._locks: List[asyncio.Lock] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def lock_for(self, key: Hashable) -> asyncio.Lock:
+        """
+        キーに割り当てられたロックを取得
+
+        Args:
+            key: ロックのキー（デバイスIDなど）
+
+        Returns:
+            asyncio.Lock: ロック
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # asyncio.Lock はイベントループに紐づくため、ループが作り直された場合は作成し直す
+            self._locks = [asyncio.Lock() for _ in range(self.stripes)]
+            self._loop = loop
+        return self._locks[hash(key) % self.stripes]
+
+
+class SingleFlight:
+    """
+    キーごとの処理の同時実行を1つにまとめる
+
+    処理は呼び出し元とは独立したタスクで実行するため、最初の呼び出し元がキャンセル
+    （クライアントの切断など）されても、待機している他の呼び出し元には結果が届く。
+    完了した処理の結果は保持しない（完了後の同じ要求はキャッシュ・冪等性レコードで判定する）。
+    """
+
+    def __init__(self, locks: Optional[StripedLocks] = None):
+        self.locks = locks or StripedLocks()
+        self._flights: Dict[Hashable, 'asyncio.Task[Any]'] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]], lock_key: Optional[Hashable] = None) -> T:
+        """
+        処理を実行、または実行中の同じキーの処理の完了を待つ
+
+        Args:
+            key: 処理のキー（同じキーの処理は同時に1つだけ実行される）
+            fn: 処理（コルーチンを返す関数）
+            lock_key: 指定した場合、同じロックキーの処理を直列化する（デバイスIDなど）
+
+        Returns:
+            処理の結果
+
+        Raises:
+            Exception: 処理が送出した例外（待機していた全員に送出される）
+        """
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(fn, lock_key))
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def in_flight(self, key: Hashable) -> bool:
+        """キーの処理が実行中かどうか"""
+        return key in self._flights
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def _run(self, fn: Callable[[], Awaitable[T]], lock_key: Optional[Hashable]) -> T:
+        """ロックキーが指定された場合はロックを取得して処理を実行"""
+        if lock_key is None:
+            return await fn()
+        async with self.locks.lock_for(lock_key):
+            return await fn()
+
+    def _finish(self, key: Hashable, task: 'asyncio.Task[Any]') -> None:
+        """完了した処理を登録から外す"""
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # 待機していた全員がキャンセルされた場合に「取得されなかった例外」の警告を出さない
+        if not task.cancelled():
+            task.exception()
+
+
+# 購入の確認・反映をまとめるシングルフライトインスタンス
+purchase_flights = SingleFlight()
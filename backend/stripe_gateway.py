@@ -0,0 +1,347 @@
+"""
+Timekeeper Backend Stripe Gateway
+Stripe APIを非同期HTTPクライアントで呼び出すゲートウェイ
+
+Stripe SDK（8.x）の同期HTTPクライアントはリクエストごとにスレッドプールのスレッドを占有し、
+接続の再利用も行わないため、httpx.AsyncClient の接続プール（HTTPキープアライブ）上で
+REST APIを直接呼び出す。レスポンスは StripeObject に、エラーは stripe.error の例外に変換するため、
+呼び出し側は SDK を使う場合と同じように扱える。
+"""
+import asyncio
+import os
+import random
+import uuid
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+from urllib.parse import urlencode
+from config import stripe_config
+from lazy_imports import lazy_import
+from metrics import STRIPE_API_DURATION, metrics
+from resilience import CircuitBreaker, stripe_breaker
+from structured_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 起動時間短縮のため、Stripe SDK・httpxは初回の呼び出し（または起動処理）で読み込む
+stripe = lazy_import('stripe')
+httpx = lazy_import('httpx')
+
+DEFAULT_API_BASE = 'https://api.stripe.com'
+
+# 再試行するHTTPステータス（409は冪等キーの同時使用、429はレート制限）
+RETRYABLE_STATUS_CODES = frozenset({409, 429, 500, 502, 503, 504})
+
+
+def _encode_params(params: Mapping[str, Any], prefix: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+    """
+    パラメータをStripeのフォーム形式（metadata[key]=value, line_items[0][price]=...）に展開
+
+    Args:
+        params: リクエストパラメータ
+        prefix: 入れ子の親キー
+
+    Yields:
+        Tuple[str, str]: (キー, 値)
+    """
+    for key, value in params.items():
+        name = f"{prefix}[{key}]" if prefix else key
+        if value is None:
+            continue
+        if isinstance(value, Mapping):
+            yield from _encode_params(value, name)
+        elif isinstance(value, (list, tuple)):
+            for index, item in enumerate(value):
+                if isinstance(item, Mapping):
+                    yield from _encode_params(item, f"{name}[{index}]")
+                else:
+                    yield f"{name}[{index}]", _encode_value(item)
+        else:
+            yield name, _encode_value(value)
+
+
+def _encode_value(value: Any) -> str:
+    """スカラー値をフォームの値に変換（真偽値は true / false）"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+class StripeGateway:
+    """
+    Stripe APIの非同期ゲートウェイ
+
+    接続プールはイベントループごとに1つ作成して使い回し、終了時に aclose() で閉じる。
+    接続エラー・タイムアウト・再試行可能なステータスは指数バックオフ（ジッター付き）で
+    上限回数まで再試行する。POSTには冪等キーを付与し、再試行でも同じキーを送るため、
+    Checkout Session が重複して作成されることはない。
+    """
+
+    def __init__(self, transport: Optional['httpx.AsyncBaseTransport'] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.connect_timeout: float = float(os.getenv('STRIPE_CONNECT_TIMEOUT_SECONDS', '3'))
+        self.read_timeout: float = float(os.getenv('STRIPE_READ_TIMEOUT_SECONDS', '15'))
+        self.max_retries: int = int(os.getenv('STRIPE_MAX_RETRIES', '2'))
+        self.max_connections: int = int(os.getenv('STRIPE_MAX_CONNECTIONS', '32'))
+        self.keepalive_expiry: float = float(os.getenv('STRIPE_KEEPALIVE_EXPIRY_SECONDS', '60'))
+        self.retry_base_delay: float = 0.25
+        self.retry_max_delay: float = 2.0
+        # 送信に使うトランスポート（テストで差し替える場合のみ指定）
+        self._transport = transport
+        # 再試行を含む呼び出し全体の期限と、障害が続いた場合に即座に失敗させるブレーカー
+        self.breaker = breaker or stripe_breaker
+        self._client: Optional['httpx.AsyncClient'] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def create_checkout_session(self, idempotency_key: Optional[str] = None, **params: Any) -> Any:
+        """
+        Checkout Session を作成
+
+        Args:
+            idempotency_key: 冪等キー（省略時は自動生成）
+            **params: stripe.checkout.Session.create と同じパラメータ
+
+        Returns:
+            stripe.checkout.Session: 作成したセッション
+
+        Raises:
+            stripe.error.StripeError: Stripe APIエラー
+        """
+        return await self.request(
+            'POST', '/v1/checkout/sessions', params, idempotency_key=idempotency_key, operation='Session.create'
+        )
+
+    async def retrieve_checkout_session(self, session_id: str) -> Any:
+        """
+        Checkout Session を取得
+
+        Args:
+            session_id: Checkout Session ID
+
+        Returns:
+            stripe.checkout.Session: セッション
+
+        Raises:
+            stripe.error.StripeError: Stripe APIエラー
+        """
+        return await self.request('GET', f"/v1/checkout/sessions/{session_id}", operation='Session.retrieve')
+
+    async def list_events(self, **params: Any) -> Any:
+        """
+        イベントを検索（直近30日分）
+
+        Args:
+            **params: stripe.Event.list と同じパラメータ
+
+        Returns:
+            stripe.ListObject: 検索結果（作成日時の新しい順）
+
+        Raises:
+            stripe.error.StripeError: Stripe APIエラー
+        """
+        return await self.request('GET', '/v1/events', params, operation='Event.list')
+
+    async def list_prices(self, **params: Any) -> Any:
+        """
+        Priceを検索
+
+        Args:
+            **params: stripe.Price.list と同じパラメータ
+
+        Returns:
+            stripe.ListObject: 検索結果
+
+        Raises:
+            stripe.error.StripeError: Stripe APIエラー
+        """
+        return await self.request('GET', '/v1/prices', params, operation='Price.list')
+
+    async def create_price(self, idempotency_key: Optional[str] = None, **params: Any) -> Any:
+        """
+        Priceを作成
+
+        Args:
+            idempotency_key: 冪等キー（省略時は自動生成）
+            **params: stripe.Price.create と同じパラメータ
+
+        Returns:
+            stripe.Price: 作成したPrice
+
+        Raises:
+            stripe.error.StripeError: Stripe APIエラー
+        """
+        return await self.request(
+            'POST', '/v1/prices', params, idempotency_key=idempotency_key, operation='Price.create'
+        )
+
+    async def request(self, method: str, path: str, params: Optional[Mapping[str, Any]] = None,
+                      idempotency_key: Optional[str] = None, operation: Optional[str] = None) -> Any:
+        """
+        Stripe APIを呼び出し、レスポンスを StripeObject に変換
+
+        Args:
+            method: HTTPメソッド（GET / POST / DELETE）
+            path: APIパス（/v1/...）
+            params: パラメータ（GETはクエリ、POSTはフォーム本文）
+            idempotency_key: POSTの冪等キー（省略時は自動生成）
+            operation: メトリクスの呼び出し名
+
+        Returns:
+            StripeObject: レスポンス（object の種別に応じたクラス）
+
+        Raises:
+            stripe.error.StripeError: Stripe APIエラー（再試行の上限を超えた場合を含む）
+            DependencyUnavailable: ブレーカーが開いている、または期限を超えた場合
+        """
+        encoded = list(_encode_params(params or {}))
+        headers = {}
+        if method == 'POST':
+            headers['Idempotency-Key'] = idempotency_key or str(uuid.uuid4())
+
+        async def send() -> Any:
+            with metrics.timer(STRIPE_API_DURATION, operation or f"{method} {path}"):
+                response = await self._send_with_retries(method, path, encoded, headers)
+            return self._handle_response(response)
+
+        return await self.breaker.call(send)
+
+    async def aclose(self) -> None:
+        """接続プールを閉じる（次回の呼び出しで再作成される）"""
+        client, self._client, self._loop = self._client, None, None
+        if client is not None:
+            await client.aclose()
+
+    def _get_client(self) -> 'httpx.AsyncClient':
+        """
+        接続プールを取得（未作成、または別のイベントループで作成された場合は作成）
+
+        Returns:
+            httpx.AsyncClient: Stripe API用のHTTPクライアント
+        """
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            # 別のイベントループの接続は使えないため破棄する（テストなどでループが作り直された場合）
+            self._client = httpx.AsyncClient(
+                base_url=stripe_config.api_base or DEFAULT_API_BASE,
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=self.keepalive_expiry
+                ),
+                headers={'Stripe-Version': stripe.api_version, 'User-Agent': 'timekeeper-backend'},
+                transport=self._transport
+            )
+            self._loop = loop
+        return self._client
+
+    async def _send_with_retries(self, method: str, path: str, encoded: List[Tuple[str, str]],
+                                 headers: Dict[str, str]) -> 'httpx.Response':
+        """再試行可能なエラーを上限回数まで再試行して送信"""
+        client = self._get_client()
+        headers = {**headers, 'Authorization': f"Bearer {stripe_config.api_key}"}
+        if method == 'GET':
+            request_kwargs = {'params': encoded}
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            request_kwargs = {'content': urlencode(encoded).encode('ascii')}
+
+        attempt = 0
+        while True:
+            try:
+                response = await client.request(method, path, headers=headers, **request_kwargs)
+            except httpx.TransportError as e:
+                if attempt >= self.max_retries:
+                    raise stripe.error.APIConnectionError(
+                        f"Network error communicating with Stripe: {type(e).__name__}: {str(e)}", should_retry=True
+                    ) from e
+                reason = type(e).__name__
+            else:
+                if not self._should_retry(response) or attempt >= self.max_retries:
+                    return response
+                reason = str(response.status_code)
+
+            delay = self._retry_delay(attempt)
+            attempt += 1
+            logger.warning(f"Retrying Stripe request after {reason}", extra={
+                'path': path, 'attempt': attempt, 'delay_seconds': round(delay, 3),
+                'rate_limit_key': 'stripe_retry'
+            })
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _should_retry(response: 'httpx.Response') -> bool:
+        """レスポンスが再試行可能かどうか（Stripe-Should-Retry ヘッダーを優先）"""
+        should_retry = response.headers.get('Stripe-Should-Retry')
+        if should_retry == 'true':
+            return True
+        if should_retry == 'false':
+            return False
+        return response.status_code in RETRYABLE_STATUS_CODES
+
+    def _retry_delay(self, attempt: int) -> float:
+        """再試行までの待機秒数（指数バックオフ、0.5〜1倍のジッター）"""
+        delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    @staticmethod
+    def _handle_response(response: 'httpx.Response') -> Any:
+        """
+        レスポンスを StripeObject に変換（エラーの場合は stripe.error の例外を送出）
+
+        Raises:
+            stripe.error.StripeError: Stripe APIエラー
+        """
+        body = response.text
+        try:
+            data = response.json()
+        except ValueError:
+            raise stripe.error.APIError(
+                f"Invalid response body from Stripe (HTTP {response.status_code})",
+                http_body=body, http_status=response.status_code, headers=dict(response.headers)
+            )
+
+        if response.status_code >= 400:
+            raise _error_from_response(response, body, data)
+        return stripe.convert_to_stripe_object(data, stripe_config.api_key)
+
+
+def _error_from_response(response: 'httpx.Response', body: str, data: Any) -> Exception:
+    """
+    エラーレスポンスを stripe.error の例外に変換（SDKと同じ対応付け）
+
+    Args:
+        response: HTTPレスポンス
+        body: レスポンス本文
+        data: JSONとして解析した本文
+
+    Returns:
+        stripe.error.StripeError: 例外
+    """
+    error = data.get('error') if isinstance(data, dict) else None
+    if not isinstance(error, dict):
+        return stripe.error.APIError(
+            f"Invalid response object from API: {body!r} (HTTP response code was {response.status_code})",
+            http_body=body, http_status=response.status_code, json_body=data, headers=dict(response.headers)
+        )
+
+    status = response.status_code
+    message = error.get('message')
+    code = error.get('code')
+    param = error.get('param')
+    common = {'http_body': body, 'http_status': status, 'json_body': data, 'headers': dict(response.headers)}
+    if status == 429 or (status == 400 and code == 'rate_limit'):
+        return stripe.error.RateLimitError(message, code=code, **common)
+    if status in (400, 404):
+        if error.get('type') == 'idempotency_error':
+            return stripe.error.IdempotencyError(message, code=code, **common)
+        return stripe.error.InvalidRequestError(message, param, code, **common)
+    if status == 401:
+        return stripe.error.AuthenticationError(message, code=code, **common)
+    if status == 402:
+        return stripe.error.CardError(message, param, code, **common)
+    if status == 403:
+        return stripe.error.PermissionError(message, code=code, **common)
+    return stripe.error.APIError(message, code=code, **common)
+
+
+# グローバルなStripeゲートウェイインスタンス
+stripe_gateway = StripeGateway()
@@ -0,0 +1,221 @@
+"""
+Timekeeper Backend Structured Logging
+キュー経由でバックグラウンドスレッドが書き出す構造化（JSON）ログ
+
+リクエスト処理中のログ呼び出しはレコードをキューに積むだけで、
+フォーマット（例外のトレースバック整形を含む）と標準出力への書き込みは
+専用のスレッドで行う。Cloud Run では1行1JSONの標準出力が構造化ログとして取り込まれる。
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+# LogRecord が標準で持つ属性（これ以外は extra で渡されたイベント固有のフィールドとして出力する）
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {
+    'message', 'asctime', 'taskName', 'rate_limit_key', 'sample_rate'
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """ログレコードを1行のJSONに変換するフォーマッター"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        ログレコードをJSON文字列に変換
+
+        Args:
+            record: ログレコード
+
+        Returns:
+            str: JSON文字列（severity / message / time / logger とイベント固有のフィールド）
+        """
+        entry = {
+            'severity': record.levelname,
+            'message': record.getMessage(),
+            'time': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'logger': record.name,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    頻出メッセージの出力を間引くフィルター
+
+    extra に rate_limit_key を持つレコードは、キーごとに一定時間あたりの件数を上限とし、
+    超過分は破棄して次に出力するレコードの suppressed フィールドに件数を記録する。
+    extra に sample_rate を持つレコードはその確率でのみ出力する。
+    """
+
+    def __init__(self, max_per_interval: Optional[int] = None, interval_seconds: float = 60.0):
+        super().__init__()
+        self.max_per_interval: int = max_per_interval if max_per_interval is not None else int(
+            os.getenv('LOG_RATE_LIMIT_PER_MINUTE', '20')
+        )
+        self.interval_seconds = interval_seconds
+        # キー -> [ウィンドウ開始時刻, ウィンドウ内の出力件数, 破棄した件数]
+        self._windows: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """
+        レコードを出力するかどうかを判定
+
+        Args:
+            record: ログレコード
+
+        Returns:
+            bool: 出力する場合True
+        """
+        sample_rate = getattr(record, 'sample_rate', None)
+        if sample_rate is not None and random.random() >= sample_rate:
+            return False
+
+        key = getattr(record, 'rate_limit_key', None)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval_seconds:
+                suppressed = int(window[2]) if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.max_per_interval:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    呼び出し元をブロックしないキューハンドラー
+
+    キューが満杯の場合はレコードを破棄し、破棄した件数を次に書き出すレコードに記録する。
+    フォーマットはバックグラウンドスレッドで行うため、prepare() ではメッセージの
+    展開だけを行い、例外情報はそのまま渡す。
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """引数をメッセージに展開したレコードのコピーを作成（トレースバックの整形は行わない）"""
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """キューに積む（満杯の場合は破棄）"""
+        dropped = self.dropped
+        if dropped:
+            record.dropped = dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.dropped -= dropped
+
+
+class StdoutHandler(logging.Handler):
+    """書き込み時点の標準出力に1行ずつ書き出すハンドラー"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            stream = sys.stdout
+            stream.write(self.format(record) + '\n')
+            stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class LoggingPipeline:
+    """
+    構造化ログの出力パイプライン
+
+    ルートロガーにキューハンドラーを登録し、QueueListener のスレッドが
+    JSONに整形して標準出力に書き出す。
+    """
+
+    def __init__(self, queue_size: Optional[int] = None, level: Optional[str] = None):
+        self.queue_size: int = queue_size if queue_size is not None else int(
+            os.getenv('LOG_QUEUE_SIZE', '10000')
+        )
+        self.level: str = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+        self._handler: Optional[NonBlockingQueueHandler] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """パイプラインを開始（開始済みの場合は何もしない）"""
+        with self._lock:
+            if self._listener is not None:
+                return
+            log_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+            output = StdoutHandler()
+            output.setFormatter(JsonFormatter())
+
+            self._handler = NonBlockingQueueHandler(log_queue)
+            self._handler.addFilter(RateLimitFilter())
+            self._listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+
+            root = logging.getLogger()
+            root.addHandler(self._handler)
+            root.setLevel(self.level)
+            self._listener.start()
+
+    def stop(self) -> None:
+        """キューに残っているレコードを書き出してパイプラインを停止"""
+        with self._lock:
+            if self._listener is None:
+                return
+            logging.getLogger().removeHandler(self._handler)
+            self._listener.stop()
+            self._listener = None
+            self._handler = None
+
+
+# グローバルなログパイプラインインスタンス
+logging_pipeline = LoggingPipeline()
+atexit.register(logging_pipeline.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    構造化ログのロガーを取得（初回呼び出し時にパイプラインを開始）
+
+    イベント固有のフィールドは extra で渡す。
+    例: logger.info("...", extra={'device_id': device_id, 'session_id': session_id})
+
+    Args:
+        name: ロガー名（通常は __name__）
+
+    Returns:
+        logging.Logger: ロガー
+    """
+    logging_pipeline.start()
+    return logging.getLogger(name)
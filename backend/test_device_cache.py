@@ -0,0 +1,192 @@
+"""
+デバイス状態キャッシュのテスト
+"""
+import asyncio
+import threading
+import time
+import uuid
+import pytest
+from unittest.mock import patch, MagicMock
+from fastapi.testclient import TestClient
+from device_cache import DeviceStateCache, device_cache
+from entitlements import MutationResult
+from main import app
+
+
+def make_db():
+    """on_snapshot に渡されたコールバックを記録するFirestoreクライアントのモックを作成"""
+    db = MagicMock()
+    listeners = {}
+
+    def document(device_id):
+        ref = MagicMock()
+
+        def on_snapshot(callback):
+            listeners[device_id] = callback
+            return MagicMock()
+        ref.on_snapshot.side_effect = on_snapshot
+        return ref
+    db.collection.return_value.document.side_effect = document
+    return db, listeners
+
+
+def make_snapshot(data: dict, exists: bool = True):
+    """ドキュメントスナップショットのモックを作成"""
+    snapshot = MagicMock()
+    snapshot.exists = exists
+    snapshot.to_dict.return_value = data
+    return snapshot
+
+
+@pytest.fixture
+def inline_submit():
+    """スレッドプールに渡す処理（リスナーの登録・解除）をその場で実行する"""
+    with patch('device_cache.io_executor.submit', side_effect=lambda func, *args: func(*args)) as mock_submit:
+        yield mock_submit
+
+
+@pytest.mark.usefixtures('inline_submit')
+class TestDeviceStateCache:
+    """DeviceStateCache クラスのテスト"""
+
+    def test_write_through_records_processed_session(self):
+        """購入反映の結果がキャッシュに書き込まれることをテスト"""
+        cache = DeviceStateCache(max_entries=10)
+        db, listeners = make_db()
+
+        cache.record_mutation(db, 'device', 'cs_test_a', 'daypass',
+                              MutationResult(applied=True, unlock_count=3, last_unlock_date='2026-01-01'))
+
+        entry = cache.find_processed('device', 'cs_test_a')
+        assert entry is not None
+        assert entry.unlock_count == 3
+        assert entry.last_unlock_date == '2026-01-01'
+        assert cache.find_processed('device', 'cs_test_b') is None
+        assert 'device' in listeners
+
+    def test_missing_device_not_cached(self):
+        """未登録デバイスの結果はキャッシュしないことをテスト"""
+        cache = DeviceStateCache(max_entries=10)
+        db, listeners = make_db()
+
+        cache.record_mutation(db, 'device', 'cs_test_a', 'daypass',
+                              MutationResult(applied=False, device_exists=False))
+
+        assert cache.get('device') is None
+        assert listeners == {}
+
+    def test_snapshot_from_other_instance_updates_entry(self):
+        """他インスタンスの変更がスナップショット経由で反映されることをテスト"""
+        cache = DeviceStateCache(max_entries=10)
+        db, listeners = make_db()
+        cache.record_mutation(db, 'device', 'cs_test_a', 'daypass',
+                              MutationResult(applied=True, unlock_count=1, last_unlock_date='2026-01-01'))
+
+        listeners['device']([make_snapshot({
+            'unlock_count': 2,
+            'last_unlock_date': '2026-01-02',
+            'last_session_id': 'cs_test_b'
+        })], [], None)
+
+        entry = cache.find_processed('device', 'cs_test_b')
+        assert entry is not None
+        assert entry.unlock_count == 2
+        assert entry.last_unlock_date == '2026-01-02'
+        assert cache.find_processed('device', 'cs_test_a') is not None
+
+    def test_deleted_document_disables_fast_path(self):
+        """ドキュメントが削除された場合は反映済み判定を返さないことをテスト"""
+        cache = DeviceStateCache(max_entries=10)
+        db, listeners = make_db()
+        cache.record_mutation(db, 'device', 'cs_test_a', 'license',
+                              MutationResult(applied=True, device_exists=False))
+
+        listeners['device']([make_snapshot(None, exists=False)], [], None)
+
+        assert cache.find_processed('device', 'cs_test_a') is None
+
+    def test_eviction_unsubscribes_listener(self):
+        """上限を超えて破棄されたエントリのリスナーが解除されることをテスト"""
+        cache = DeviceStateCache(max_entries=1)
+        db = MagicMock()
+        watches = []
+
+        def on_snapshot(callback):
+            watch = MagicMock()
+            watches.append(watch)
+            return watch
+        db.collection.return_value.document.return_value.on_snapshot.side_effect = on_snapshot
+
+        cache.record_mutation(db, 'device_a', 'cs_test_a', 'daypass', MutationResult(applied=True))
+        cache.record_mutation(db, 'device_b', 'cs_test_b', 'daypass', MutationResult(applied=True))
+
+        assert cache.get('device_a') is None
+        assert cache.get('device_b') is not None
+        watches[0].unsubscribe.assert_called_once()
+        watches[1].unsubscribe.assert_not_called()
+
+    def test_aclose_unsubscribes_off_event_loop(self):
+        """終了時のリスナーの解除をイベントループ外で並行して行うことをテスト"""
+        cache = DeviceStateCache(max_entries=10)
+        db = MagicMock()
+        watches = []
+        unsubscribed_on = []
+
+        def on_snapshot(callback):
+            watch = MagicMock()
+            watch.unsubscribe.side_effect = lambda: (time.sleep(0.05), unsubscribed_on.append(threading.get_ident()))
+            watches.append(watch)
+            return watch
+        db.collection.return_value.document.return_value.on_snapshot.side_effect = on_snapshot
+        for device_id in ('device_a', 'device_b', 'device_c'):
+            cache.record_mutation(db, device_id, f'cs_{device_id}', 'daypass', MutationResult(applied=True))
+
+        started = time.perf_counter()
+        asyncio.run(cache.aclose())
+
+        assert time.perf_counter() - started < 0.15
+        assert len(unsubscribed_on) == 3
+        assert threading.get_ident() not in unsubscribed_on
+        assert len(cache) == 0
+
+    def test_watch_registered_off_event_loop(self, inline_submit):
+        """リスナーの登録をスレッドプールに渡し、新規のエントリでのみ行うことをテスト"""
+        cache = DeviceStateCache(max_entries=10)
+        db, listeners = make_db()
+
+        cache.record_mutation(db, 'device', 'cs_test_a', 'daypass', MutationResult(applied=True))
+        cache.record_mutation(db, 'device', 'cs_test_b', 'daypass', MutationResult(applied=True))
+
+        assert inline_submit.call_count == 1
+        assert inline_submit.call_args[0][0] == cache._watch
+        assert list(listeners) == ['device']
+
+
+class TestDaypassRetryServedFromCache:
+    """確認APIのリトライがキャッシュから返されることのテスト"""
+
+    @pytest.fixture
+    def client(self):
+        with patch('main.stripe_config.is_initialized', return_value=True), \
+             patch('main.firestore_config.get_client', return_value=MagicMock()), \
+             patch('main.firestore_config.initialize_firestore', return_value=True):
+            with TestClient(app) as test_client:
+                yield test_client
+
+    def test_retry_skips_stripe_and_firestore(self, client):
+        """2回目のリクエストはStripe・Firestoreに問い合わせないことをテスト"""
+        device_id = str(uuid.uuid4())
+        request_data = {"device_id": device_id, "purchase_token": "cs_test_retry"}
+        result = MutationResult(applied=True, unlock_count=1, last_unlock_date='2026-01-01')
+
+        with patch('main._get_session_payment_status', return_value='paid') as mock_status, \
+             patch('main.EntitlementMutator.apply_daypass_unlock', return_value=result) as mock_apply:
+            first = client.post("/unlock/daypass", json=request_data)
+            second = client.post("/unlock/daypass", json=request_data)
+
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert second.json()["unlock_count"] == 1
+        assert mock_status.call_count == 1
+        assert mock_apply.call_count == 1
+        device_cache.invalidate(device_id)
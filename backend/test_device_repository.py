@@ -0,0 +1,166 @@
+"""
+デバイスリポジトリ（device_repository）のテスト
+"""
+from unittest.mock import MagicMock
+import pytest
+from google.cloud import firestore
+from device_repository import MUTATION_FIELDS, STATE_FIELDS, VERSION_FIELD, DeviceRepository, DeviceState
+
+
+def make_snapshot(path: str, exists: bool, data: dict = None, update_time=None):
+    """スナップショットのモックを作成"""
+    snapshot = MagicMock()
+    snapshot.reference.path = path
+    snapshot.reference.id = path.rsplit('/', 1)[-1]
+    snapshot.exists = exists
+    snapshot.to_dict.return_value = data
+    snapshot.update_time = update_time
+    return snapshot
+
+
+def make_ref(path: str):
+    """ドキュメント参照のモックを作成"""
+    ref = MagicMock()
+    ref.path = path
+    ref.id = path.rsplit('/', 1)[-1]
+    return ref
+
+
+class TestDeviceState:
+    """DeviceState のテスト"""
+
+    def test_from_snapshot(self):
+        """スナップショットの必要なフィールドだけを保持することをテスト"""
+        state = DeviceState.from_snapshot(make_snapshot('devices/d1', True, {
+            'license_purchased': True,
+            'unlock_count': 3,
+            'last_unlock_date': '2026-01-01',
+            'last_session_id': 'cs_test_1',
+            'processed_purchase_tokens': ['cs_test_0'],
+        }, update_time='t1'))
+
+        assert state.device_id == 'd1'
+        assert state.exists is True
+        assert state.license_purchased is True
+        assert state.unlock_count == 3
+        assert state.last_unlock_date == '2026-01-01'
+        assert state.last_session_id == 'cs_test_1'
+        assert 'cs_test_0' in state.legacy_session_ids
+        assert state.update_time == 't1'
+
+    def test_missing_document(self):
+        """存在しないドキュメントは既定値の状態になることをテスト"""
+        state = DeviceState.from_snapshot(make_snapshot('devices/d1', False))
+
+        assert state.exists is False
+        assert state.unlock_count == 0
+        assert state.license_purchased is False
+        assert not state.legacy_session_ids
+
+    def test_slots(self):
+        """__slots__ により属性の追加ができないことをテスト"""
+        state = DeviceState(make_ref('devices/d1'))
+        with pytest.raises(AttributeError):
+            state.extra = 1
+
+
+class TestDeviceRepository:
+    """DeviceRepository のテスト"""
+
+    def test_get_uses_field_mask(self):
+        """状態の取得でフィールドマスクを指定することをテスト"""
+        db = MagicMock()
+        ref = db.collection.return_value.document.return_value
+        ref.get.return_value = make_snapshot('devices/d1', True, {'unlock_count': 2})
+
+        state = DeviceRepository().get(db, 'd1')
+
+        db.collection.assert_called_with('devices')
+        db.collection.return_value.document.assert_called_with('d1')
+        assert ref.get.call_args.kwargs['field_paths'] == list(STATE_FIELDS)
+        assert state.unlock_count == 2
+
+    def test_get_all_single_read(self):
+        """デバイスと関連ドキュメントを1回の読み取りで取得することをテスト"""
+        db = MagicMock()
+        device_refs = [make_ref('devices/d1'), make_ref('devices/d2')]
+        extra_ref = make_ref('processed_sessions/cs_test_1')
+        db.get_all.return_value = [
+            make_snapshot('processed_sessions/cs_test_1', True, {}),
+            make_snapshot('devices/d2', False),
+            make_snapshot('devices/d1', True, {'unlock_count': 1}),
+        ]
+        transaction = MagicMock()
+
+        states, extras = DeviceRepository().get_all(db, device_refs, [extra_ref], transaction=transaction)
+
+        db.get_all.assert_called_once()
+        assert db.get_all.call_args.kwargs['field_paths'] == list(MUTATION_FIELDS)
+        assert db.get_all.call_args.kwargs['transaction'] is transaction
+        assert [state.exists for state in states] == [True, False]
+        assert states[0].unlock_count == 1
+        assert extras['processed_sessions/cs_test_1'].exists is True
+
+    def test_put_with_precondition(self):
+        """前提条件付きの書き込み（既存は update_time、新規は create）をテスト"""
+        db = MagicMock()
+        batch = MagicMock()
+        existing = DeviceState(make_ref('devices/d1'), exists=True, update_time='t1')
+        missing = DeviceState(make_ref('devices/d2'))
+
+        DeviceRepository.put(db, batch, existing, {'unlock_count': 1}, precondition=True)
+        DeviceRepository.put(db, batch, missing, {'license_purchased': True}, precondition=True)
+
+        db.write_option.assert_called_once_with(last_update_time='t1')
+        update_ref, update_data = batch.update.call_args[0]
+        assert update_ref is existing.reference
+        assert update_data['unlock_count'] == 1
+        assert batch.update.call_args.kwargs['option'] is db.write_option.return_value
+        create_ref, create_data = batch.create.call_args[0]
+        assert create_ref is missing.reference
+        assert create_data['license_purchased'] is True
+
+    def test_put_without_precondition(self):
+        """トランザクション内の書き込み（既存は update、新規は set）をテスト"""
+        db = MagicMock()
+        transaction = MagicMock()
+        existing = DeviceState(make_ref('devices/d1'), exists=True)
+        missing = DeviceState(make_ref('devices/d2'))
+
+        DeviceRepository.put(db, transaction, existing, {'unlock_count': 1})
+        DeviceRepository.put(db, transaction, missing, {'license_purchased': True})
+
+        assert transaction.update.call_args[0][0] is existing.reference
+        assert transaction.update.call_args.kwargs == {}
+        assert transaction.set.call_args[0][0] is missing.reference
+        db.write_option.assert_not_called()
+
+    def test_put_increments_version(self):
+        """全ての書き込みでバージョンをインクリメントすることをテスト"""
+        db = MagicMock()
+        writer = MagicMock()
+        data = {'unlock_count': 1}
+
+        DeviceRepository.put(db, writer, DeviceState(make_ref('devices/d1'), exists=True), data)
+
+        written = writer.update.call_args[0][1]
+        assert isinstance(written[VERSION_FIELD], firestore.Increment)
+        assert VERSION_FIELD not in data
+
+    def test_mutate_runs_in_transaction(self):
+        """mutate が読み取りと書き込みを1つのトランザクションで行うことをテスト"""
+        db = MagicMock()
+        transaction = db.transaction.return_value
+        db.get_all.return_value = [make_snapshot('devices/d1', True, {'unlock_count': 4})]
+        db.collection.return_value.document.return_value = make_ref('devices/d1')
+
+        def increment(tx, state, extras):
+            DeviceRepository.put(db, tx, state, {'unlock_count': state.unlock_count + 1})
+            return state.unlock_count + 1
+
+        result = DeviceRepository().mutate(db, 'd1', increment)
+
+        assert result == 5
+        assert db.get_all.call_args.kwargs['transaction'] is transaction
+        transaction.update.assert_called_once()
+        transaction._commit.assert_called_once()
@@ -0,0 +1,322 @@
+"""
+購入反映（entitlements）のテスト
+"""
+from unittest.mock import MagicMock
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from entitlements import (
+    IDEMPOTENCY_TTL_DAYS, LEGACY_MIGRATION_LIMIT, PROCESSED_SESSIONS_COLLECTION, PurchaseMutation,
+    _apply_in_transaction, commit_mutations, within_idempotency_window
+)
+
+
+def make_snapshot(ref, exists: bool, data: dict = None):
+    """スナップショットのモックを作成"""
+    snapshot = MagicMock()
+    snapshot.reference = ref
+    snapshot.exists = exists
+    snapshot.to_dict.return_value = data
+    return snapshot
+
+
+def make_db(exists: bool, data: dict = None, processed: bool = False):
+    """トランザクション内の読み取り結果を差し替えたFirestoreクライアントのモックを作成"""
+    db = MagicMock()
+    transaction = MagicMock()
+    db.transaction.return_value = transaction
+
+    refs = {}
+
+    def collection(name):
+        coll = MagicMock()
+
+        def document(doc_id):
+            ref = refs.setdefault(name, MagicMock())
+            ref.id = doc_id
+            ref.path = f"{name}/{doc_id}"
+            return ref
+        coll.document.side_effect = document
+        return coll
+    db.collection.side_effect = collection
+
+    def get_all(references, field_paths=None, transaction=None):
+        device_ref, idempotency_ref = references
+        return [
+            make_snapshot(idempotency_ref, processed),
+            make_snapshot(device_ref, exists, data),
+        ]
+    db.get_all.side_effect = get_all
+    return db, transaction, refs
+
+
+class TestDaypassTransaction:
+    """デイパス購入反映（個別トランザクション）のテスト"""
+
+    def test_increments_in_transaction(self):
+        """トランザクション内でサーバー側インクリメントを行い、新しい状態を返すことをテスト"""
+        db, transaction, refs = make_db(True, {'unlock_count': 2})
+
+        result = _apply_in_transaction(db, PurchaseMutation('daypass', 'device', 'cs_test_new', 'pi_1'))
+
+        assert result.applied is True
+        assert result.unlock_count == 3
+        db.get_all.assert_called_once()
+        assert db.get_all.call_args.kwargs['transaction'] is transaction
+        update_ref, update_data = transaction.update.call_args[0]
+        assert update_ref is refs['devices']
+        assert isinstance(update_data['unlock_count'], firestore.Increment)
+        assert update_data['last_successful_payment_intent'] == 'pi_1'
+        assert 'processed_purchase_tokens' not in update_data
+        transaction._commit.assert_called_once()
+
+    def test_records_idempotency_document(self):
+        """Session ID単位の冪等性レコードを作成することをテスト"""
+        db, transaction, refs = make_db(True, {'unlock_count': 0})
+
+        _apply_in_transaction(db, PurchaseMutation('daypass', 'device', 'cs_test_new'))
+
+        create_ref, record = transaction.create.call_args[0]
+        assert create_ref is refs[PROCESSED_SESSIONS_COLLECTION]
+        assert create_ref.path == f"{PROCESSED_SESSIONS_COLLECTION}/cs_test_new"
+        assert record['device_id'] == 'device'
+        assert record['product_type'] == 'daypass'
+        assert record['expires_at'] > record['processed_at']
+
+    def test_idempotency_record_detects_duplicate(self):
+        """冪等性レコードが存在する場合は処理済みとして扱うことをテスト"""
+        db, transaction, _ = make_db(True, {'unlock_count': 4, 'last_unlock_date': '2026-01-01'}, processed=True)
+
+        result = _apply_in_transaction(db, PurchaseMutation('daypass', 'device', 'cs_test_done'))
+
+        assert result.applied is False
+        assert result.unlock_count == 4
+        transaction.update.assert_not_called()
+        transaction.create.assert_not_called()
+
+    def test_legacy_processed_tokens_detect_duplicate(self):
+        """移行前の processed_purchase_tokens に残るトークンも処理済みとして扱うことをテスト"""
+        db, transaction, _ = make_db(True, {
+            'unlock_count': 5,
+            'last_unlock_date': '2026-01-01',
+            'processed_purchase_tokens': ['cs_test_done']
+        })
+
+        result = _apply_in_transaction(db, PurchaseMutation('daypass', 'device', 'cs_test_done'))
+
+        assert result.applied is False
+        assert result.unlock_count == 5
+        assert result.last_unlock_date == '2026-01-01'
+        transaction.update.assert_not_called()
+
+    def test_migrates_legacy_processed_tokens(self):
+        """書き込み時に processed_purchase_tokens を冪等性レコードに移し、フィールドを削除することをテスト"""
+        db, transaction, refs = make_db(True, {
+            'unlock_count': 1,
+            'processed_purchase_tokens': ['cs_test_old_1', 'cs_test_old_2']
+        })
+
+        result = _apply_in_transaction(db, PurchaseMutation('daypass', 'device', 'cs_test_new'))
+
+        assert result.applied is True
+        update_data = transaction.update.call_args[0][1]
+        assert update_data['processed_purchase_tokens'] is firestore.DELETE_FIELD
+        assert transaction.set.call_count == 2
+        migrated_ref, record = transaction.set.call_args[0]
+        assert migrated_ref is refs[PROCESSED_SESSIONS_COLLECTION]
+        assert record['device_id'] == 'device'
+        assert record['expires_at'] > record['processed_at']
+
+    def test_missing_device(self):
+        """未登録デバイスの場合は書き込まずに device_exists=False を返すことをテスト"""
+        db, transaction, _ = make_db(False)
+
+        result = _apply_in_transaction(db, PurchaseMutation('daypass', 'device', 'cs_test_new'))
+
+        assert result.device_exists is False
+        assert result.applied is False
+        transaction.update.assert_not_called()
+
+
+class TestLicenseTransaction:
+    """ライセンス購入反映（個別トランザクション）のテスト"""
+
+    def test_creates_missing_device(self):
+        """未登録デバイスの場合は新規作成することをテスト"""
+        db, transaction, refs = make_db(False)
+
+        result = _apply_in_transaction(db, PurchaseMutation('license', 'device', 'cs_test_new'))
+
+        assert result.applied is True
+        set_ref, set_data = transaction.set.call_args[0]
+        assert set_ref is refs['devices']
+        transaction.create.assert_called_once()
+        assert set_data['license_purchased'] is True
+        assert 'last_successful_payment_intent' not in set_data
+
+    def test_already_processed(self):
+        """処理済みトークンの場合は書き込まないことをテスト"""
+        db, transaction, _ = make_db(True, {}, processed=True)
+
+        result = _apply_in_transaction(db, PurchaseMutation('license', 'device', 'cs_test_done'))
+
+        assert result.applied is False
+        transaction.update.assert_not_called()
+        transaction.set.assert_not_called()
+
+
+def make_batch_db(devices: dict, processed: set = frozenset()):
+    """get_all の結果を差し替えたFirestoreクライアントのモックを作成（バッチ反映用）"""
+    db = MagicMock()
+
+    def collection(name):
+        coll = MagicMock()
+
+        def document(doc_id):
+            ref = MagicMock()
+            ref.id = doc_id
+            ref.path = f"{name}/{doc_id}"
+            return ref
+        coll.document.side_effect = document
+        return coll
+    db.collection.side_effect = collection
+
+    def get_all(references, field_paths=None, transaction=None):
+        for ref in references:
+            name, doc_id = ref.path.split('/')
+            if name == 'devices':
+                yield make_snapshot(ref, doc_id in devices, devices.get(doc_id))
+            else:
+                yield make_snapshot(ref, doc_id in processed)
+    db.get_all.side_effect = get_all
+    return db
+
+
+class TestCommitMutations:
+    """まとめてコミットする購入反映のテスト"""
+
+    def test_single_read_and_commit_for_many_mutations(self):
+        """複数の要求が1回の読み取りと1回のコミットで反映されることをテスト"""
+        db = make_batch_db({'device_a': {'unlock_count': 2}, 'device_b': {'unlock_count': 0}})
+        mutations = [
+            PurchaseMutation('daypass', 'device_a', 'cs_test_1'),
+            PurchaseMutation('daypass', 'device_a', 'cs_test_2'),
+            PurchaseMutation('license', 'device_b', 'cs_test_3'),
+        ]
+
+        results = commit_mutations(db, mutations)
+
+        assert [r.applied for r in results] == [True, True, True]
+        assert [r.unlock_count for r in results] == [3, 4, 0]
+        db.get_all.assert_called_once()
+        batch = db.batch.return_value
+        batch.commit.assert_called_once()
+        # デバイスごとに1件の書き込みにまとめられる
+        assert batch.update.call_count == 2
+        device_a_update = next(c for c in batch.update.call_args_list if c[0][0].id == 'device_a')
+        assert device_a_update[0][1]['unlock_count'].value == 2
+        assert 'option' in device_a_update[1]
+        # 冪等性レコードは要求ごとに作成される
+        assert batch.create.call_count == 3
+        db.transaction.assert_not_called()
+
+    def test_filters_processed_and_missing_devices(self):
+        """処理済み・未登録デバイスの要求は書き込まないことをテスト"""
+        db = make_batch_db({'device_a': {'unlock_count': 5, 'last_unlock_date': '2026-01-01'}},
+                           processed={'cs_test_done'})
+
+        results = commit_mutations(db, [
+            PurchaseMutation('daypass', 'device_a', 'cs_test_done'),
+            PurchaseMutation('daypass', 'device_missing', 'cs_test_new'),
+        ])
+
+        assert results[0].applied is False
+        assert results[0].unlock_count == 5
+        assert results[1].device_exists is False
+        db.batch.assert_not_called()
+
+    def test_duplicate_session_in_same_flush(self):
+        """同じフラッシュ内の同一セッションは1回だけ反映されることをテスト"""
+        db = make_batch_db({'device_a': {'unlock_count': 0}})
+
+        results = commit_mutations(db, [
+            PurchaseMutation('daypass', 'device_a', 'cs_test_1'),
+            PurchaseMutation('daypass', 'device_a', 'cs_test_1', 'pi_webhook'),
+        ])
+
+        assert results[0].applied is True
+        assert results[1].applied is False
+        assert results[0].unlock_count == results[1].unlock_count == 1
+        assert db.batch.return_value.create.call_count == 1
+
+    def test_migrates_legacy_tokens_in_chunks(self):
+        """上限を超える processed_purchase_tokens は一部だけ移し、残りを配列に残すことをテスト"""
+        legacy = [f'cs_test_old_{i}' for i in range(LEGACY_MIGRATION_LIMIT + 3)]
+        db = make_batch_db({'device_a': {'unlock_count': 0, 'processed_purchase_tokens': legacy}})
+
+        results = commit_mutations(db, [PurchaseMutation('daypass', 'device_a', 'cs_test_1')])
+
+        assert results[0].applied is True
+        batch = db.batch.return_value
+        assert batch.set.call_count == LEGACY_MIGRATION_LIMIT
+        assert batch.update.call_args[0][1]['processed_purchase_tokens'] == legacy[LEGACY_MIGRATION_LIMIT:]
+
+    def test_creates_missing_device_for_license(self):
+        """未登録デバイスへのライセンス購入はドキュメントを新規作成することをテスト"""
+        db = make_batch_db({})
+
+        results = commit_mutations(db, [PurchaseMutation('license', 'device_new', 'cs_test_1')])
+
+        assert results[0].applied is True
+        assert results[0].device_exists is False
+        batch = db.batch.return_value
+        created_paths = [c[0][0].path for c in batch.create.call_args_list]
+        assert created_paths == ['devices/device_new', f'{PROCESSED_SESSIONS_COLLECTION}/cs_test_1']
+
+    def test_conflict_falls_back_to_transactions(self):
+        """バッチのコミットが競合で失敗した場合は個別のトランザクションで反映することをテスト"""
+        db = make_batch_db({'device_a': {'unlock_count': 0}})
+        db.batch.return_value.commit.side_effect = google_exceptions.FailedPrecondition("update_time mismatch")
+        transaction = db.transaction.return_value
+        batch_get_all = db.get_all.side_effect
+
+        def get_all(references, field_paths=None, transaction=None):
+            if transaction is None:
+                return batch_get_all(references)
+            device_ref, idempotency_ref = references
+            return [make_snapshot(device_ref, True, {'unlock_count': 1}),
+                    make_snapshot(idempotency_ref, False)]
+        db.get_all.side_effect = get_all
+
+        results = commit_mutations(db, [PurchaseMutation('daypass', 'device_a', 'cs_test_1')])
+
+        assert results[0].applied is True
+        assert results[0].unlock_count == 2
+        transaction._commit.assert_called_once()
+
+    def test_outage_does_not_fall_back_to_transactions(self):
+        """競合以外のエラーでバッチのコミットが失敗した場合は個別に反映し直さず、全要求にエラーを返すことをテスト"""
+        db = make_batch_db({'device_a': {'unlock_count': 0}, 'device_b': {'unlock_count': 0}})
+        error = google_exceptions.ServiceUnavailable("unavailable")
+        db.batch.return_value.commit.side_effect = error
+
+        results = commit_mutations(db, [
+            PurchaseMutation('daypass', 'device_a', 'cs_test_1'),
+            PurchaseMutation('daypass', 'device_b', 'cs_test_2'),
+        ])
+
+        assert results == [error, error]
+        db.transaction.assert_not_called()
+        db.get_all.assert_called_once()
+
+
+class TestIdempotencyWindow:
+    """冪等性レコードの保持期間の判定のテスト"""
+
+    def test_rejects_sessions_older_than_ttl(self):
+        """保持期間より前に作成されたセッションのみ期間外と判定することをテスト"""
+        now = 1_800_000_000
+        ttl = IDEMPOTENCY_TTL_DAYS * 86400
+
+        assert within_idempotency_window(now - ttl + 60, now=now) is True
+        assert within_idempotency_window(now - ttl - 60, now=now) is False
+        assert within_idempotency_window(None, now=now) is True
@@ -198,6 +198,34 @@ class TestFirestoreConfig:
         assert result["status"] == "error"
         assert "Connection error" in result["message"]
 
+    def test_warm_up_reads_document(self):
+        """初期化済みの場合、ウォームアップでドキュメントを1件読み取ることをテスト"""
+        config = FirestoreConfig()
+        config._initialized = True
+        config._client = MagicMock()
+
+        config.warm_up()
+
+        config._client.collection.return_value.document.return_value.get.assert_called_once()
+
+    def test_warm_up_skipped_when_not_initialized(self):
+        """未初期化の場合はウォームアップを行わないことをテスト"""
+        config = FirestoreConfig()
+        config._client = MagicMock()
+
+        config.warm_up()
+
+        config._client.collection.assert_not_called()
+
+    def test_warm_up_failure_is_ignored(self):
+        """ウォームアップの失敗が起動処理を止めないことをテスト"""
+        config = FirestoreConfig()
+        config._initialized = True
+        config._client = MagicMock()
+        config._client.collection.return_value.document.return_value.get.side_effect = Exception("unavailable")
+
+        config.warm_up()
+
 
 class TestGlobalFirestoreConfig:
     """グローバルなfirestore_configインスタンスのテスト"""
@@ -0,0 +1,108 @@
+"""
+フリート全体のギャップ分析（gap_analytics）のテスト
+"""
+import csv
+import io
+from unittest.mock import MagicMock
+import numpy as np
+from gap_analytics import GapAnalytics, analyze_chunk, iter_device_chunks, stream_buckets
+from heartbeats import SECURITY_BREACH, SUSPICIOUS, detect_gaps
+
+MINUTE = 60 * 1000
+
+
+def fleet():
+    """デバイスごとに連続し、日ごとに分かれたバケット"""
+    return [
+        ('a', [0, MINUTE, 2 * MINUTE]),
+        ('a', [6 * MINUTE, 7 * MINUTE, 10 * MINUTE]),  # 4分（SUSPICIOUS）、3分（SUSPICIOUS）
+        ('b', [0, MINUTE]),
+        ('c', [0, 30 * MINUTE, 31 * MINUTE, 31 * MINUTE]),  # 30分（SECURITY_BREACH）、重複あり
+    ]
+
+
+def summary_rows(buckets, **kwargs):
+    output = io.StringIO()
+    report = GapAnalytics(**kwargs).run(buckets, output)
+    rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+    return report, {row['device_id']: row for row in rows}
+
+
+class TestAnalyzeChunk:
+    """チャンクの計算のテスト"""
+
+    def test_matches_gap_detector(self):
+        """ベクトル化した判定が GapDetector と同じ閾値の逐次判定と一致することをテスト"""
+        rng = np.random.default_rng(0)
+        per_device = [np.cumsum(rng.choice([MINUTE, 3 * MINUTE, 5 * MINUTE, 2 * MINUTE], size=200)) for _ in range(5)]
+        device_ids = [f'd{i}' for i in range(5)]
+        codes = np.repeat(np.arange(5), 200)
+
+        rows, histogram = analyze_chunk(device_ids, codes, np.concatenate(per_device))
+
+        for row, timestamps in zip(rows, per_device):
+            severities = [gap.severity for gap in detect_gaps(timestamps.tolist())]
+            assert row['suspicious_gaps'] == severities.count(SUSPICIOUS)
+            assert row['breach_gaps'] == severities.count(SECURITY_BREACH)
+            assert row['max_gap_ms'] == np.diff(timestamps).max()
+        assert histogram.sum() == 5 * 199
+
+    def test_gaps_do_not_cross_devices(self):
+        """デバイスの境界をまたぐ間隔はギャップにしないことをテスト"""
+        rows, histogram = analyze_chunk(['a', 'b'], np.array([0, 1]), np.array([0, 60 * MINUTE]))
+
+        assert rows['breach_gaps'].tolist() == [0, 0]
+        assert histogram.sum() == 0
+
+
+class TestGapAnalytics:
+    """GapAnalytics のテスト"""
+
+    def test_summary_table(self):
+        """デバイスごとの集計表と全体の集計をテスト"""
+        report, rows = summary_rows(fleet())
+
+        assert rows['a']['suspicious_gaps'] == '2'
+        assert rows['a']['first_heartbeat'] == '0'
+        assert rows['a']['last_heartbeat'] == str(10 * MINUTE)
+        assert rows['c']['breach_gaps'] == '1'
+        assert rows['c']['heartbeats'] == '3'
+        assert rows['c']['max_gap_ms'] == str(30 * MINUTE)
+        assert report['devices'] == 3
+        assert report['flagged_devices'] == 2
+        assert report['gap_histogram']['3-5m'] == 2
+        assert report['gap_histogram']['15-60m'] == 1
+
+    def test_chunking_does_not_change_results(self):
+        """チャンクの大きさによらず結果が同じ（デバイスの途中で区切らない）ことをテスト"""
+        assert summary_rows(fleet(), chunk_size=1) == summary_rows(fleet(), chunk_size=1_000)
+        chunks = list(iter_device_chunks(fleet(), chunk_size=1))
+        assert [device_ids for device_ids, _, _ in chunks] == [['a'], ['b'], ['c']]
+
+    def test_flagged_only(self):
+        """flagged_only の場合はギャップのあるデバイスだけを出力することをテスト"""
+        _, rows = summary_rows(fleet(), flagged_only=True)
+
+        assert set(rows) == {'a', 'c'}
+
+
+class TestStreamBuckets:
+    """Firestoreからの読み出しのテスト"""
+
+    def test_pages_until_short_page(self):
+        """ページが上限より少なくなるまで続きから読み出すことをテスト"""
+        def snapshot(doc_id, timestamps):
+            snap = MagicMock()
+            snap.id = doc_id
+            snap.to_dict.return_value = {'timestamps': timestamps}
+            return snap
+
+        first_page = [snapshot('a_2026-03-01', [1]), snapshot('a_2026-03-02', [2])]
+        second_page = [snapshot('b_2026-03-01', [3])]
+        db = MagicMock()
+        query = db.collection.return_value.select.return_value.order_by.return_value.limit.return_value
+        query.stream.return_value = iter(first_page)
+        query.start_after.return_value.stream.return_value = iter(second_page)
+
+        assert list(stream_buckets(db, page_size=2)) == [('a', [1]), ('a', [2]), ('b', [3])]
+        query.start_after.assert_called_once_with(first_page[-1])
@@ -0,0 +1,131 @@
+"""
+オンラインなギャップ検出（gap_monitor）のテスト
+"""
+import json
+import uuid
+from datetime import datetime, timezone
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+from gap_monitor import GapMonitor, gap_monitor
+from heartbeats import SECURITY_BREACH, SUSPICIOUS
+from loadtest.fake_firestore import FakeFirestoreClient
+from main import app
+from metrics import HEARTBEAT_GAP_EVENTS_TOTAL, metrics
+
+MINUTE = 60 * 1000
+
+
+class TestGapMonitor:
+    """GapMonitor のテスト"""
+
+    def test_emits_events_to_sink(self):
+        """ギャップを検出した時だけイベントをシンクに渡し、件数を数えることをテスト"""
+        events = []
+        monitor = GapMonitor(sink=events.append, idle_seconds=60, max_devices=10)
+
+        monitor.observe_batch('d1', [0, MINUTE, 2 * MINUTE], now=0.0)
+        monitor.observe_batch('d1', [5 * MINUTE, 11 * MINUTE], now=1.0)
+
+        assert [(event.start, event.end, event.severity) for event in events] == [
+            (2 * MINUTE, 5 * MINUTE, SUSPICIOUS),
+            (5 * MINUTE, 11 * MINUTE, SECURITY_BREACH),
+        ]
+        assert events[1].breaches == 1
+        state = monitor.state('d1')
+        assert (state.heartbeats, state.suspicious, state.breaches, state.max_gap) == (5, 1, 1, 6 * MINUTE)
+        assert state.mean_gap > MINUTE
+
+    def test_ignores_replayed_heartbeats(self):
+        """反映済みの時刻以前のハートビート（再送）は無視することをテスト"""
+        events = []
+        monitor = GapMonitor(sink=events.append, idle_seconds=60, max_devices=10)
+        monitor.observe_batch('d1', [0, 10 * MINUTE], now=0.0)
+
+        monitor.observe_batch('d1', [0, 10 * MINUTE], now=1.0)
+
+        assert len(events) == 1
+        assert monitor.state('d1').heartbeats == 2
+
+    def test_evicts_idle_and_oldest(self):
+        """一定時間更新のないデバイスと、上限を超えた最も古いデバイスを破棄することをテスト"""
+        monitor = GapMonitor(sink=lambda event: None, idle_seconds=60, max_devices=2)
+        monitor.observe('a', 0, now=0.0)
+        monitor.observe('b', 0, now=30.0)
+        monitor.observe('c', 0, now=40.0)
+
+        assert monitor.state('a') is None
+        assert len(monitor) == 2
+
+        monitor.evict_idle(now=95.0)
+        assert monitor.state('b') is None
+        assert monitor.state('c') is not None
+
+    def test_seeds_from_previous_after_eviction(self):
+        """破棄後のバッチは、取り込み時に求めた直前のハートビートを起点にギャップを判定することをテスト"""
+        monitor = GapMonitor(sink=lambda event: None, idle_seconds=3600, max_devices=10)
+        monitor.observe('d1', 0, now=0.0)
+        monitor.evict_idle(now=7200.0)
+        assert monitor.state('d1') is None
+
+        events = monitor.observe_batch('d1', [120 * MINUTE], now=7200.0, previous=0)
+
+        assert [(event.start, event.end, event.severity) for event in events] == [(0, 120 * MINUTE, SECURITY_BREACH)]
+
+    def test_previous_from_other_instance_advances_without_event(self):
+        """他インスタンスが受けていた間の直前のハートビートは、ギャップとして扱わずに起点を進めることをテスト"""
+        events = []
+        monitor = GapMonitor(sink=events.append, idle_seconds=3600, max_devices=10)
+        monitor.observe('d1', 0, now=0.0)
+
+        monitor.observe_batch('d1', [31 * MINUTE], now=10.0, previous=30 * MINUTE)
+
+        assert events == []
+        assert monitor.state('d1').last_seen == 31 * MINUTE
+
+    def test_sink_failure_is_contained(self):
+        """シンクの失敗で例外を送出しないことをテスト"""
+        def failing_sink(event):
+            raise RuntimeError("sink down")
+
+        monitor = GapMonitor(sink=failing_sink, idle_seconds=60, max_devices=10)
+        metrics.reset()
+
+        events = monitor.observe_batch('d1', [0, 10 * MINUTE], now=0.0)
+
+        assert len(events) == 1
+        assert f'{HEARTBEAT_GAP_EVENTS_TOTAL}{{severity="{SECURITY_BREACH}"}} 1' in metrics.render()
+
+
+class TestHeartbeatEndpointMonitor:
+    """ハートビート一括アップロードAPIからの通知のテスト"""
+
+    def test_detects_across_batches_without_reads(self):
+        """前のバッチとの間のギャップをメモリ上の状態から通知することをテスト"""
+        base = int(datetime.now(timezone.utc).timestamp() * 1000) - 60 * MINUTE
+        device_id = str(uuid.uuid4())
+        events = []
+        client = TestClient(app)
+        with patch('main.firestore_config.get_client', return_value=FakeFirestoreClient()), \
+             patch.object(gap_monitor, 'sink', events.append):
+            for batch in ([base, base + MINUTE], [base + 7 * MINUTE]):
+                response = client.post(f'/devices/{device_id}/heartbeats:batch',
+                                       content=json.dumps({'timestamps': batch}))
+                assert response.status_code == 200
+
+        assert [(event.device_id, event.severity) for event in events] == [(device_id, SECURITY_BREACH)]
+
+    def test_detects_gap_after_state_eviction(self):
+        """メモリ上の状態が破棄された後も、Firestoreの直前のハートビートからギャップを通知することをテスト"""
+        base = int(datetime.now(timezone.utc).timestamp() * 1000) - 180 * MINUTE
+        device_id = str(uuid.uuid4())
+        events = []
+        client = TestClient(app)
+        with patch('main.firestore_config.get_client', return_value=FakeFirestoreClient()), \
+             patch.object(gap_monitor, 'sink', events.append):
+            client.post(f'/devices/{device_id}/heartbeats:batch', content=json.dumps({'timestamps': [base]}))
+            gap_monitor.clear()
+            response = client.post(f'/devices/{device_id}/heartbeats:batch',
+                                   content=json.dumps({'timestamps': [base + 120 * MINUTE]}))
+
+        assert response.status_code == 200
+        assert [(event.device_id, event.gap_ms) for event in events] == [(device_id, 120 * MINUTE)]
@@ -0,0 +1,136 @@
+"""
+ハートビートのバイナリ形式（heartbeat_codec）のテスト
+"""
+import json
+import uuid
+from datetime import datetime, timezone
+from unittest.mock import patch
+import pytest
+from fastapi.testclient import TestClient
+from heartbeat_codec import (
+    BINARY_CONTENT_TYPE, FORMAT_VERSION, decode_payload, encode_payload, zigzag_decode, zigzag_encode
+)
+from heartbeats import HEARTBEAT_BUCKETS_COLLECTION, MAX_BATCH_SIZE, bucket_id, day_of
+from loadtest.fake_firestore import FakeFirestoreClient
+from main import app
+from validation import ValidationError
+
+MINUTE = 60 * 1000
+BASE = 1_772_409_000_000
+
+
+class TestZigzag:
+    """zigzag 符号化のテスト"""
+
+    def test_round_trip(self):
+        """小さい絶対値ほど小さい符号なし整数になり、元に戻せることをテスト"""
+        assert [zigzag_encode(v) for v in (0, -1, 1, -2, 2)] == [0, 1, 2, 3, 4]
+        for value in (0, 1, -1, 1440, -1440, 2 ** 40, -(2 ** 40)):
+            assert zigzag_decode(zigzag_encode(value)) == value
+
+
+class TestCodec:
+    """encode_payload / decode_payload のテスト"""
+
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_round_trip(self, compress):
+        """ハートビートと利用時間を往復できることをテスト（ハートビートは昇順・重複なしになる）"""
+        usage = {'com.example.video': 95, 'jp.example.sns': 0, 'com.example.correction': -3}
+        data = encode_payload([BASE + MINUTE, BASE, BASE + MINUTE], usage, compress=compress)
+
+        payload = decode_payload(data)
+
+        assert payload.timestamps == [BASE, BASE + MINUTE]
+        assert payload.usage == usage
+
+    def test_compact(self):
+        """1分間隔のハートビートは1件あたり3バイトで、JSON より小さいことをテスト"""
+        timestamps = [BASE + i * MINUTE for i in range(1440)]
+
+        data = encode_payload(timestamps)
+
+        assert len(data) <= 2 + 2 + 6 + 1439 * 3 + 1
+        assert len(data) * 4 < len(json.dumps({'timestamps': timestamps}))
+
+    def test_accepts_memoryview(self):
+        """bytes 以外（memoryview・bytearray）もデコードできることをテスト"""
+        data = encode_payload([BASE], {'com.example.app': 1})
+
+        assert decode_payload(memoryview(data)).usage == {'com.example.app': 1}
+        assert decode_payload(bytearray(data)).timestamps == [BASE]
+
+    @pytest.mark.parametrize('data', [
+        b'',
+        bytes((FORMAT_VERSION, 0x80)),
+        bytes((FORMAT_VERSION, 0, 2, 1)),  # 2件のうち1件で終わっている
+        bytes((FORMAT_VERSION, 0, 1, 1, 0, 0)),  # 余分なデータ
+        bytes((FORMAT_VERSION, 0, 2, 5, 0, 0)),  # 重複（差分0）
+        bytes((FORMAT_VERSION, 0)) + b'\xff' * 11,  # 長すぎる varint
+        bytes((FORMAT_VERSION, 0, 0, 1, 2, 0xff, 0xfe, 0)),  # UTF-8 でないパッケージ名
+        bytes((FORMAT_VERSION, 0x01)) + b'not zlib',
+    ])
+    def test_rejects_malformed(self, data):
+        """不正なデータはバリデーションエラーになることをテスト"""
+        with pytest.raises(ValidationError):
+            decode_payload(data)
+
+    def test_rejects_unknown_version_and_oversized(self):
+        """未対応のバージョンと上限を超える件数を拒否することをテスト"""
+        with pytest.raises(ValidationError) as exc_info:
+            decode_payload(bytes((FORMAT_VERSION + 1, 0, 0, 0)))
+        assert exc_info.value.error_code == 'unsupported_payload_version'
+
+        with pytest.raises(ValidationError) as exc_info:
+            decode_payload(encode_payload(range(MAX_BATCH_SIZE + 1)))
+        assert exc_info.value.status_code == 413
+
+
+class TestBinaryUpload:
+    """ハートビート一括アップロードAPIのバイナリ形式のテスト"""
+
+    def test_binary_upload_with_usage(self):
+        """バイナリ形式のアップロードを取り込み、利用時間を当日のバケットに記録することをテスト"""
+        db = FakeFirestoreClient()
+        device_id = str(uuid.uuid4())
+        # 日をまたがないよう、前日の正午（UTC）を基準にする
+        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        now = int(today.timestamp() * 1000) - 12 * 60 * MINUTE
+        timestamps = [now - 10 * MINUTE, now - 9 * MINUTE]
+        client = TestClient(app)
+
+        with patch('main.firestore_config.get_client', return_value=db):
+            first = client.post(f'/devices/{device_id}/heartbeats:batch', headers={
+                'Content-Type': BINARY_CONTENT_TYPE
+            }, content=encode_payload(timestamps, {'com.example.video': 30, 'com.example.game': 5}, compress=True))
+            second = client.post(f'/devices/{device_id}/heartbeats:batch', headers={
+                'Content-Type': BINARY_CONTENT_TYPE
+            }, content=encode_payload([now - 8 * MINUTE], {'com.example.video': 31}))
+
+        assert first.status_code == 200
+        assert first.json()['accepted'] == 2
+        assert second.status_code == 200
+        stored = db.collection(HEARTBEAT_BUCKETS_COLLECTION).document(
+            bucket_id(device_id, day_of(now - 8 * MINUTE))
+        ).get().to_dict()
+        assert stored['usage_minutes'] == {'com.example.video': 31, 'com.example.game': 5}
+
+    def test_invalid_binary_and_usage(self):
+        """不正なバイナリ・利用時間は400を返すことをテスト"""
+        client = TestClient(app)
+        device_id = str(uuid.uuid4())
+        now = int(datetime.now(timezone.utc).timestamp() * 1000)
+
+        with patch('main.firestore_config.get_client', return_value=FakeFirestoreClient()):
+            broken = client.post(f'/devices/{device_id}/heartbeats:batch', headers={
+                'Content-Type': BINARY_CONTENT_TYPE
+            }, content=b'\x01')
+            negative = client.post(f'/devices/{device_id}/heartbeats:batch', headers={
+                'Content-Type': BINARY_CONTENT_TYPE
+            }, content=encode_payload([now], {'com.example.video': -1}))
+            bad_package = client.post(f'/devices/{device_id}/heartbeats:batch', json={
+                'timestamps': [now], 'usage': {'not a package': 1}
+            })
+
+        assert broken.status_code == 400
+        assert negative.json()['detail']['error_code'] == 'invalid_usage_minutes'
+        assert bad_package.json()['detail']['error_code'] == 'invalid_package_name'
@@ -0,0 +1,209 @@
+"""
+ハートビートの一括取り込み（heartbeats）のテスト
+"""
+import gzip
+import json
+import uuid
+import zlib
+from datetime import datetime, timezone
+from unittest.mock import patch
+import pytest
+from fastapi.testclient import TestClient
+from loadtest.fake_firestore import FakeFirestoreClient
+from main import app
+from heartbeats import (
+    HEARTBEAT_BUCKETS_COLLECTION, HEARTBEAT_DEVICES_COLLECTION, MAX_DECOMPRESSED_BYTES, SECURITY_BREACH, SUSPICIOUS,
+    HeartbeatStore, bucket_id, decode_body, detect_gaps, normalize_timestamps
+)
+from validation import ValidationError
+
+MINUTE = 60 * 1000
+# 2026-03-01 23:50:00 UTC
+BASE = int(datetime(2026, 3, 1, 23, 50, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def bucket(db: FakeFirestoreClient, device_id: str, day: str) -> dict:
+    return db.collection(HEARTBEAT_BUCKETS_COLLECTION).document(bucket_id(device_id, day)).get().to_dict()
+
+
+class TestDetectGaps:
+    """ギャップ判定のテスト"""
+
+    def test_thresholds(self):
+        """3分以上は SUSPICIOUS、5分以上は SECURITY_BREACH と判定することをテスト"""
+        timestamps = [0, MINUTE, 2 * MINUTE, 5 * MINUTE, 10 * MINUTE, 10 * MINUTE + 2 * MINUTE]
+
+        gaps = detect_gaps(timestamps)
+
+        assert [(gap.start, gap.end, gap.severity) for gap in gaps] == [
+            (2 * MINUTE, 5 * MINUTE, SUSPICIOUS),
+            (5 * MINUTE, 10 * MINUTE, SECURITY_BREACH),
+        ]
+        assert gaps[1].gap_minutes == 5
+
+    def test_previous_heartbeat(self):
+        """バッチ直前のハートビートとの間のギャップも判定することをテスト"""
+        gaps = detect_gaps([10 * MINUTE, 11 * MINUTE], previous=4 * MINUTE)
+
+        assert len(gaps) == 1
+        assert gaps[0].start == 4 * MINUTE
+        assert gaps[0].severity == SECURITY_BREACH
+
+
+class TestDecodeBody:
+    """本文の展開のテスト"""
+
+    def test_encodings(self):
+        """無圧縮・gzip・deflate を展開できることをテスト"""
+        raw = b'{"timestamps": [1]}'
+        assert decode_body(raw, None) == raw
+        assert decode_body(gzip.compress(raw), 'gzip') == raw
+        assert decode_body(zlib.compress(raw), 'deflate') == raw
+
+    def test_rejects_oversized_and_unknown(self):
+        """展開後のサイズ超過・未対応の圧縮形式・壊れたデータを拒否することをテスト"""
+        bomb = gzip.compress(b'0' * (MAX_DECOMPRESSED_BYTES + 10))
+        with pytest.raises(ValidationError) as exc_info:
+            decode_body(bomb, 'gzip')
+        assert exc_info.value.status_code == 413
+
+        with pytest.raises(ValidationError) as exc_info:
+            decode_body(b'abc', 'br')
+        assert exc_info.value.status_code == 415
+
+        with pytest.raises(ValidationError):
+            decode_body(b'not gzip', 'gzip')
+
+
+class TestNormalizeTimestamps:
+    """ハートビートの検証のテスト"""
+
+    def test_sorts_and_dedupes(self):
+        """昇順・重複なしに整えることをテスト"""
+        assert normalize_timestamps([BASE + MINUTE, BASE, BASE + MINUTE], BASE + 2 * MINUTE) == [BASE, BASE + MINUTE]
+
+    @pytest.mark.parametrize('values', [[], ['1'], [True], [BASE + 60 * MINUTE]])
+    def test_rejects_invalid(self, values):
+        """空・整数以外・未来すぎる時刻を拒否することをテスト"""
+        with pytest.raises(ValidationError):
+            normalize_timestamps(values, BASE)
+
+
+class TestHeartbeatStore:
+    """HeartbeatStore のテスト"""
+
+    def test_splits_batch_into_day_buckets(self):
+        """日をまたぐバッチを日ごとのバケットに1回のコミットで書き込むことをテスト"""
+        db = FakeFirestoreClient()
+        device_id = str(uuid.uuid4())
+        timestamps = [BASE + i * MINUTE for i in range(5)] + [BASE + 20 * MINUTE]
+
+        result = HeartbeatStore().ingest(db, device_id, timestamps)
+
+        assert result.days == ['2026-03-01', '2026-03-02']
+        assert result.max_severity == SECURITY_BREACH
+        first = bucket(db, device_id, '2026-03-01')
+        second = bucket(db, device_id, '2026-03-02')
+        assert first['timestamps'] == timestamps[:5]
+        assert first['last_heartbeat'] == timestamps[4]
+        assert 'gaps' not in first
+        # ギャップは終了時刻の日のバケットに記録する
+        assert second['gaps'] == [{
+            'start': timestamps[4], 'end': timestamps[5], 'gap_ms': 16 * MINUTE, 'severity': SECURITY_BREACH
+        }]
+
+    def test_uses_previous_batch(self):
+        """前のバッチの最後のハートビートとの間のギャップを判定することをテスト"""
+        db = FakeFirestoreClient()
+        device_id = str(uuid.uuid4())
+        store = HeartbeatStore()
+        store.ingest(db, device_id, [BASE, BASE + MINUTE])
+
+        result = store.ingest(db, device_id, [BASE + 4 * MINUTE, BASE + 5 * MINUTE])
+
+        assert [(gap.start, gap.severity) for gap in result.gaps] == [(BASE + MINUTE, SUSPICIOUS)]
+        assert bucket(db, device_id, '2026-03-01')['first_heartbeat'] == BASE
+
+    def test_detects_gap_after_days_of_silence(self):
+        """数日間途絶えた後のバッチでも、デバイスの最後のハートビートとのギャップを判定することをテスト"""
+        db = FakeFirestoreClient()
+        device_id = str(uuid.uuid4())
+        store = HeartbeatStore()
+        store.ingest(db, device_id, [BASE, BASE + MINUTE])
+        resumed = BASE + 3 * 24 * 60 * MINUTE
+
+        result = store.ingest(db, device_id, [resumed, resumed + MINUTE])
+
+        assert [(gap.start, gap.end, gap.severity) for gap in result.gaps] == [
+            (BASE + MINUTE, resumed, SECURITY_BREACH)
+        ]
+        device = db.collection(HEARTBEAT_DEVICES_COLLECTION).document(device_id).get().to_dict()
+        assert device['last_heartbeat'] == resumed + MINUTE
+
+    def test_late_batch_falls_back_to_buckets(self):
+        """最後のハートビートより前のバッチが遅れて届いた場合は、バケットから直前のハートビートを求めることをテスト"""
+        db = FakeFirestoreClient()
+        device_id = str(uuid.uuid4())
+        store = HeartbeatStore()
+        store.ingest(db, device_id, [BASE])
+        store.ingest(db, device_id, [BASE + 10 * MINUTE])
+
+        result = store.ingest(db, device_id, [BASE + 5 * MINUTE])
+
+        assert [(gap.start, gap.severity) for gap in result.gaps] == [(BASE, SECURITY_BREACH)]
+        device = db.collection(HEARTBEAT_DEVICES_COLLECTION).document(device_id).get().to_dict()
+        assert device['last_heartbeat'] == BASE + 10 * MINUTE
+
+    def test_retry_is_idempotent(self):
+        """同じバッチの再送で記録が重複しないことをテスト"""
+        db = FakeFirestoreClient()
+        device_id = str(uuid.uuid4())
+        store = HeartbeatStore()
+        timestamps = [BASE, BASE + 6 * MINUTE]
+
+        store.ingest(db, device_id, timestamps)
+        store.ingest(db, device_id, timestamps)
+
+        stored = bucket(db, device_id, '2026-03-01')
+        assert stored['timestamps'] == timestamps
+        assert len(stored['gaps']) == 1
+
+
+class TestHeartbeatEndpoint:
+    """ハートビート一括アップロードAPIのテスト"""
+
+    @pytest.fixture
+    def db(self):
+        db = FakeFirestoreClient()
+        now = datetime.fromtimestamp((BASE + 30 * MINUTE) / 1000, tz=timezone.utc)
+        with patch('main.firestore_config.get_client', return_value=db), patch('main.datetime') as mock_datetime:
+            mock_datetime.now.return_value = now
+            yield db
+
+    def test_gzip_batch(self, db):
+        """gzip 圧縮したバッチを取り込み、ギャップを返すことをテスト"""
+        device_id = str(uuid.uuid4())
+        body = gzip.compress(json.dumps({'timestamps': [BASE, BASE + MINUTE, BASE + 4 * MINUTE]}).encode())
+
+        response = TestClient(app).post(f'/devices/{device_id}/heartbeats:batch', content=body, headers={
+            'Content-Type': 'application/json', 'Content-Encoding': 'gzip'
+        })
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data['accepted'] == 3
+        assert data['buckets'] == ['2026-03-01']
+        assert data['max_severity'] == SUSPICIOUS
+        assert data['gaps'] == [{'start': BASE + MINUTE, 'end': BASE + 4 * MINUTE, 'gap_minutes': 3,
+                                 'severity': SUSPICIOUS}]
+        assert db.document_count(HEARTBEAT_BUCKETS_COLLECTION) == 1
+
+    def test_invalid_body(self, db):
+        """不正な本文・デバイスIDは400を返すことをテスト"""
+        client = TestClient(app)
+        device_id = str(uuid.uuid4())
+
+        assert client.post(f'/devices/{device_id}/heartbeats:batch', content=b'{').status_code == 400
+        assert client.post(f'/devices/{device_id}/heartbeats:batch', json={'timestamps': 1}).status_code == 400
+        assert client.post('/devices/not-a-uuid/heartbeats:batch', json={'timestamps': [BASE]}).status_code == 400
+        assert db.document_count(HEARTBEAT_BUCKETS_COLLECTION) == 0
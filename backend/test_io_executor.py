@@ -0,0 +1,58 @@
+"""
+同期I/Oエグゼキュータのテスト
+"""
+import asyncio
+import threading
+import time
+import pytest
+from io_executor import BlockingIOExecutor
+
+
+class TestBlockingIOExecutor:
+    """BlockingIOExecutor クラスのテスト"""
+
+    def test_run_returns_result_off_loop_thread(self):
+        """同期関数がイベントループ外のスレッドで実行されることをテスト"""
+        executor = BlockingIOExecutor()
+        loop_thread = threading.get_ident()
+
+        async def run():
+            return await executor.run(lambda x, y=0: (x + y, threading.get_ident()), 1, y=2)
+
+        result, worker_thread = asyncio.run(run())
+        executor.shutdown()
+        assert result == 3
+        assert worker_thread != loop_thread
+
+    def test_run_propagates_exception(self):
+        """同期関数の例外がそのまま再送出されることをテスト"""
+        executor = BlockingIOExecutor()
+
+        def fail():
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            asyncio.run(executor.run(fail))
+        executor.shutdown()
+
+    def test_blocking_calls_run_concurrently(self):
+        """複数の同期呼び出しが並行して実行されることをテスト"""
+        executor = BlockingIOExecutor()
+        executor.max_workers = 8
+
+        async def run():
+            start = time.monotonic()
+            await asyncio.gather(*(executor.run(time.sleep, 0.1) for _ in range(8)))
+            return time.monotonic() - start
+
+        elapsed = asyncio.run(run())
+        executor.shutdown()
+        assert elapsed < 0.5
+
+    def test_shutdown_allows_reuse(self):
+        """停止後も再度実行できることをテスト"""
+        executor = BlockingIOExecutor()
+        assert asyncio.run(executor.run(lambda: 1)) == 1
+        executor.shutdown()
+        assert asyncio.run(executor.run(lambda: 2)) == 2
+        executor.shutdown()
@@ -0,0 +1,40 @@
+"""
+遅延インポートのテスト
+"""
+import subprocess
+import sys
+import pytest
+from lazy_imports import lazy_import, preload
+
+
+class TestLazyImport:
+    """lazy_import 関数のテスト"""
+
+    def test_main_import_defers_heavy_sdks(self):
+        """main の読み込み時点ではStripe・Firestore SDK・NumPyが実行されないことをテスト"""
+        code = (
+            "import sys, importlib.util, main\n"
+            "lazy = importlib.util._LazyModule\n"
+            "print(isinstance(sys.modules['stripe'], lazy),"
+            " isinstance(sys.modules['google.cloud.firestore'], lazy),"
+            " 'firebase_admin.firestore' in sys.modules,"
+            " isinstance(sys.modules['numpy'], lazy))\n"
+        )
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=60)
+        assert result.stdout.strip().splitlines()[-1] == "True True False True"
+
+    def test_loads_on_attribute_access(self):
+        """属性アクセスでモジュールが読み込まれることをテスト"""
+        module = lazy_import('json.tool')
+        assert module.main is not None
+
+    def test_returns_loaded_module(self):
+        """読み込み済みのモジュールはそのまま返すことをテスト"""
+        import json
+        assert lazy_import('json') is json
+        preload(json)
+
+    def test_missing_module(self):
+        """存在しないモジュールは ModuleNotFoundError を送出することをテスト"""
+        with pytest.raises(ModuleNotFoundError):
+            lazy_import('timekeeper_no_such_module')
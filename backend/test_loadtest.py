@@ -0,0 +1,194 @@
+"""
+負荷試験ハーネス（loadtest）のテスト
+"""
+import threading
+import pytest
+import stripe
+from google.api_core import exceptions
+from google.cloud import firestore
+from entitlements import PROCESSED_SESSIONS_COLLECTION, PurchaseMutation, _apply_in_transaction, commit_mutations
+from loadtest.app_server import device_id_for
+from loadtest.fake_firestore import FakeFirestoreClient
+from loadtest.fake_stripe import FakeStripeState
+from loadtest.run import parse_mix, percentile, sign_webhook, summarize
+
+
+class TestFakeFirestoreClient:
+    """インメモリFirestoreのテスト"""
+
+    def test_set_get_and_transforms(self):
+        """書き込み・読み取りとIncrement・SERVER_TIMESTAMPの反映"""
+        client = FakeFirestoreClient()
+        ref = client.collection('devices').document('d1')
+        ref.set({'unlock_count': 1})
+        ref.update({'unlock_count': firestore.Increment(2), 'updated_at': firestore.SERVER_TIMESTAMP})
+
+        snapshot = ref.get()
+        assert snapshot.exists is True
+        assert snapshot.get('unlock_count') == 3
+        assert snapshot.get('updated_at') == snapshot.update_time
+
+    def test_missing_document(self):
+        """存在しないドキュメントの読み取りと更新"""
+        client = FakeFirestoreClient()
+        ref = client.document('devices/missing')
+        assert ref.get().exists is False
+        with pytest.raises(exceptions.NotFound):
+            ref.update({'unlock_count': 1})
+
+    def test_batch_precondition_conflict_is_atomic(self):
+        """前提条件を満たさないバッチは一部も反映されない"""
+        client = FakeFirestoreClient()
+        client.seed('devices/d1', {'unlock_count': 0})
+        ref = client.document('devices/d1')
+        stale = ref.get().update_time
+        ref.update({'unlock_count': 1})
+
+        batch = client.batch()
+        batch.create(client.document('processed_sessions/cs_test_a'), {'device_id': 'd1'})
+        batch.update(ref, {'unlock_count': 5}, option=client.write_option(last_update_time=stale))
+        with pytest.raises(exceptions.FailedPrecondition):
+            batch.commit()
+
+        assert client.document('processed_sessions/cs_test_a').get().exists is False
+        assert ref.get().get('unlock_count') == 1
+
+    def test_create_existing_document(self):
+        """作成済みドキュメントの create は AlreadyExists"""
+        client = FakeFirestoreClient()
+        client.seed('processed_sessions/cs_test_a', {})
+        with pytest.raises(exceptions.AlreadyExists):
+            client.document('processed_sessions/cs_test_a').create({})
+
+    def test_error_injection(self):
+        """エラー率1の場合は全操作が ServiceUnavailable"""
+        client = FakeFirestoreClient(error_rate=1.0)
+        with pytest.raises(exceptions.ServiceUnavailable):
+            client.document('devices/d1').get()
+
+    def test_snapshot_listener(self):
+        """リスナーに初回と更新時のスナップショットが通知される"""
+        client = FakeFirestoreClient()
+        ref = client.document('devices/d1')
+        received = []
+        updated = threading.Event()
+
+        def on_snapshot(snapshots, changes, read_time):
+            received.append(snapshots[0].exists)
+            if len(received) >= 2:
+                updated.set()
+
+        watch = ref.on_snapshot(on_snapshot)
+        ref.set({'unlock_count': 1})
+        assert updated.wait(timeout=5)
+        watch.unsubscribe()
+
+        assert received[:2] == [False, True]
+
+
+class TestEntitlementsOnFakeFirestore:
+    """インメモリFirestore上での購入反映のテスト"""
+
+    def test_transaction_applies_once(self):
+        """トランザクションでの反映と同じセッションの再反映"""
+        client = FakeFirestoreClient()
+        client.seed('devices/d1', {'unlock_count': 0})
+
+        first = _apply_in_transaction(client, PurchaseMutation('daypass', 'd1', 'cs_test_a'))
+        second = _apply_in_transaction(client, PurchaseMutation('daypass', 'd1', 'cs_test_a'))
+
+        assert first.applied is True
+        assert second.applied is False
+        assert client.document('devices/d1').get().get('unlock_count') == 1
+        assert client.document_count(PROCESSED_SESSIONS_COLLECTION) == 1
+
+    def test_concurrent_transactions_do_not_lose_updates(self):
+        """並行するトランザクションの競合が再試行され、更新が失われない"""
+        client = FakeFirestoreClient(latency_ms=1.0)
+        client.seed('devices/d1', {'unlock_count': 0})
+        threads = [
+            threading.Thread(
+                target=_apply_in_transaction,
+                args=(client, PurchaseMutation('daypass', 'd1', f"cs_test_{i}"))
+            )
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert client.document('devices/d1').get().get('unlock_count') == 4
+
+    def test_commit_mutations(self):
+        """バッチでの反映（重複セッションは1回だけ反映）"""
+        client = FakeFirestoreClient()
+        client.seed('devices/d1', {'unlock_count': 0})
+
+        results = commit_mutations(client, [
+            PurchaseMutation('daypass', 'd1', 'cs_test_a'),
+            PurchaseMutation('daypass', 'd1', 'cs_test_b'),
+            PurchaseMutation('daypass', 'd1', 'cs_test_a'),
+            PurchaseMutation('license', 'd2', 'cs_test_c'),
+        ])
+
+        assert [result.applied for result in results] == [True, True, False, True]
+        assert client.document('devices/d1').get().get('unlock_count') == 2
+        assert client.document('devices/d2').get().get('license_purchased') is True
+
+
+class TestFakeStripeState:
+    """Stripeスタンドインのテスト"""
+
+    def test_create_and_retrieve_session(self):
+        """作成したセッションは未払い、未知のセッションは支払い済み"""
+        state = FakeStripeState()
+        session = state.create_session({'metadata[device_id]': 'd1', 'mode': 'payment'})
+
+        assert session['id'].startswith('cs_test_')
+        assert session['metadata'] == {'device_id': 'd1'}
+        assert state.get_session(session['id'])['payment_status'] == 'unpaid'
+        assert state.get_session('cs_test_unknown')['payment_status'] == 'paid'
+
+
+class TestLoadReport:
+    """負荷生成・集計のテスト"""
+
+    def test_parse_mix(self):
+        """比率の解析"""
+        assert parse_mix('create=2,webhook=1') == {'create': 2.0, 'webhook': 1.0}
+        with pytest.raises(ValueError):
+            parse_mix('refund=1')
+        with pytest.raises(ValueError):
+            parse_mix('create=0')
+
+    def test_percentile(self):
+        """最近傍順位法の百分位数"""
+        values = [float(i) for i in range(1, 101)]
+        assert percentile(values, 50) == 50.0
+        assert percentile(values, 99) == 99.0
+        assert percentile([], 50) == 0.0
+
+    def test_summarize(self):
+        """2xx以外と通信エラーをエラーとして集計"""
+        summary = summarize([(0.01, 200), (0.02, 200), (0.03, 503), (0.04, 0)], elapsed=2.0)
+
+        assert summary['requests'] == 4
+        assert summary['rps'] == 2.0
+        assert summary['errors'] == 2
+        assert summary['error_rate'] == 0.5
+        assert summary['status_codes'] == {'200': 2, '503': 1, 'transport_error': 1}
+
+    def test_webhook_signature_is_accepted_by_stripe(self):
+        """作成した署名がStripe SDKの検証を通過する"""
+        payload = b'{"id": "evt_1", "object": "event", "type": "checkout.session.completed"}'
+        header = sign_webhook(payload, 'whsec_test')
+
+        event = stripe.Webhook.construct_event(payload, header, 'whsec_test')
+        assert event.id == 'evt_1'
+
+    def test_device_ids_are_stable_uuids(self):
+        """事前登録するデバイスIDは決定的なUUID"""
+        assert device_id_for(1) == device_id_for(1)
+        assert device_id_for(1) != device_id_for(2)
+        assert len(device_id_for(0)) == 36
@@ -122,8 +122,8 @@ class TestStartupEvent:
         mock_initialize.assert_called_once()
     
     @patch('main.firestore_config.initialize_firestore')
-    @patch('builtins.print')
-    def test_startup_event_failure(self, mock_print, mock_initialize):
+    @patch('main.logger')
+    def test_startup_event_failure(self, mock_logger, mock_initialize):
         """起動時のFirestore初期化が失敗する場合のテスト"""
         mock_initialize.return_value = False
         
@@ -137,4 +137,103 @@ class TestStartupEvent:
         
         asyncio.run(test_lifespan())
         mock_initialize.assert_called_once()
-        mock_print.assert_called_with("Warning: Firestore initialization failed") 
\ No newline at end of file
+        mock_logger.warning.assert_called_with("Firestore initialization failed") 
+
+class TestDeviceEntitlementsEndpoint:
+    """購入状態取得エンドポイントのテスト"""
+
+    DEVICE_ID = '123e4567-e89b-12d3-a456-426614174000'
+
+    @pytest.fixture
+    def db(self):
+        """デバイスを登録したインメモリFirestore"""
+        from loadtest.fake_firestore import FakeFirestoreClient
+        db = FakeFirestoreClient()
+        db.seed(f"devices/{self.DEVICE_ID}", {'unlock_count': 2, 'last_unlock_date': '2026-01-01', 'version': 3})
+        return db
+
+    def test_returns_state_with_etag(self, client, db):
+        """購入状態とETagを返すことをテスト"""
+        with patch('main.firestore_config.get_client', return_value=db):
+            response = client.get(f"/devices/{self.DEVICE_ID}/entitlements")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data['license_purchased'] is False
+        assert data['unlock_count'] == 2
+        assert data['last_unlock_date'] == '2026-01-01'
+        assert data['daypass_valid_today'] is False
+        assert data['next_daypass_price'] == 288
+        assert response.headers['etag'].startswith('"v3-')
+
+    def test_not_modified(self, client, db):
+        """If-None-Match が一致する場合は304を返すことをテスト"""
+        from device_repository import device_repository
+        with patch('main.firestore_config.get_client', return_value=db):
+            etag = client.get(f"/devices/{self.DEVICE_ID}/entitlements").headers['etag']
+            with patch('main.device_repository.get', wraps=device_repository.get) as mock_get:
+                response = client.get(f"/devices/{self.DEVICE_ID}/entitlements", headers={'If-None-Match': etag})
+
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response.headers['etag'] == etag
+        # バージョンだけを読み取る
+        mock_get.assert_called_once()
+        assert list(mock_get.call_args[0][2]) == ['version']
+
+    def test_modified_after_write(self, client, db):
+        """書き込み後は古いETagで200と新しいETagを返すことをテスト"""
+        from entitlements import PurchaseMutation, commit_mutations
+        with patch('main.firestore_config.get_client', return_value=db):
+            etag = client.get(f"/devices/{self.DEVICE_ID}/entitlements").headers['etag']
+            commit_mutations(db, [PurchaseMutation('daypass', self.DEVICE_ID, 'cs_test_new')])
+            response = client.get(f"/devices/{self.DEVICE_ID}/entitlements", headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+        assert response.headers['etag'] != etag
+        assert response.json()['unlock_count'] == 3
+        assert response.json()['daypass_valid_today'] is True
+
+    def test_device_not_found(self, client, db):
+        """未登録デバイスの場合は404を返すことをテスト"""
+        with patch('main.firestore_config.get_client', return_value=db):
+            response = client.get("/devices/00000000-0000-0000-0000-000000000000/entitlements",
+                                  headers={'If-None-Match': '"v0-2026-01-01"'})
+
+        assert response.status_code == 404
+        assert response.json()['detail']['error_code'] == 'device_not_found'
+
+    def test_invalid_device_id(self, client):
+        """UUID形式でないdevice_idの場合は400を返すことをテスト"""
+        response = client.get("/devices/not-a-uuid/entitlements")
+
+        assert response.status_code == 400
+        assert response.json()['detail']['error_code'] == 'invalid_device_id_format'
+
+    def test_etag_matching(self):
+        """If-None-Match の複数指定・弱いETag・* の判定をテスト"""
+        from main import _etag_matches
+        assert _etag_matches('"a", W/"v1-2026-01-01"', '"v1-2026-01-01"')
+        assert _etag_matches('*', '"v1-2026-01-01"')
+        assert not _etag_matches('"v0-2026-01-01"', '"v1-2026-01-01"')
+
+
+class TestCreateCheckoutSessionEndpoint:
+    """Checkoutセッション作成エンドポイントのテスト"""
+
+    def test_daypass_references_catalog_price(self, client):
+        """デイパスは段階ごとのPrice IDを参照することをテスト"""
+        session = MagicMock(url='https://checkout.stripe.test/c/pay/cs_test_1')
+        with patch('main.stripe_config.is_initialized', return_value=True), \
+             patch('main.daypass_price_catalog.line_item', return_value={'price': 'price_tier_2', 'quantity': 1}) as mock_item, \
+             patch('main.stripe_gateway.create_checkout_session', return_value=session) as mock_create:
+            response = client.post("/create-checkout-session", json={
+                'device_id': '123e4567-e89b-12d3-a456-426614174000', 'product_type': 'daypass', 'unlock_count': 2
+            })
+
+        assert response.status_code == 200
+        assert response.json()['checkout_url'] == session.url
+        mock_item.assert_called_once_with(2)
+        assert mock_create.call_args.kwargs['line_items'] == [
+            {'price': 'price_tier_2', 'quantity': 1}
+        ]
@@ -0,0 +1,93 @@
+"""
+メトリクスのテスト
+"""
+import threading
+import pytest
+from fastapi.testclient import TestClient
+from metrics import (
+    MetricsRegistry, HTTP_REQUESTS_TOTAL, HTTP_REQUEST_DURATION, HTTP_REQUESTS_IN_FLIGHT,
+    STRIPE_API_DURATION, FIRESTORE_OPERATION_DURATION, metrics
+)
+from main import app
+
+
+class TestMetricsRegistry:
+    """MetricsRegistry クラスのテスト"""
+
+    def test_histogram_buckets_are_cumulative(self):
+        """ヒストグラムが累積バケットと合計・件数で出力されることをテスト"""
+        registry = MetricsRegistry(buckets=(0.1, 1.0))
+        registry.observe(STRIPE_API_DURATION, ('Session.retrieve', 'success'), 0.0625)
+        registry.observe(STRIPE_API_DURATION, ('Session.retrieve', 'success'), 0.5)
+        registry.observe(STRIPE_API_DURATION, ('Session.retrieve', 'success'), 2.0)
+
+        output = registry.render()
+        labels = 'method="Session.retrieve",outcome="success"'
+        assert f'{STRIPE_API_DURATION}_bucket{{{labels},le="0.1"}} 1' in output
+        assert f'{STRIPE_API_DURATION}_bucket{{{labels},le="1"}} 2' in output
+        assert f'{STRIPE_API_DURATION}_bucket{{{labels},le="+Inf"}} 3' in output
+        assert f'{STRIPE_API_DURATION}_sum{{{labels}}} 2.5625' in output
+        assert f'{STRIPE_API_DURATION}_count{{{labels}}} 3' in output
+        assert f'# TYPE {STRIPE_API_DURATION} histogram' in output
+
+    def test_merges_thread_shards(self):
+        """複数スレッドで記録した値が合算されることをテスト"""
+        registry = MetricsRegistry()
+
+        def record():
+            for _ in range(1000):
+                registry.inc(HTTP_REQUESTS_TOTAL, ('/health', 'GET', '200'))
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert f'{HTTP_REQUESTS_TOTAL}{{route="/health",method="GET",status="200"}} 4000' in registry.render()
+
+    def test_timer_records_outcome(self):
+        """タイマーが例外の有無で outcome ラベルを切り替えることをテスト"""
+        registry = MetricsRegistry()
+        with registry.timer(FIRESTORE_OPERATION_DURATION, 'get_all'):
+            pass
+        with pytest.raises(RuntimeError):
+            with registry.timer(FIRESTORE_OPERATION_DURATION, 'get_all'):
+                raise RuntimeError("unavailable")
+
+        output = registry.render()
+        assert f'{FIRESTORE_OPERATION_DURATION}_count{{operation="get_all",outcome="success"}} 1' in output
+        assert f'{FIRESTORE_OPERATION_DURATION}_count{{operation="get_all",outcome="error"}} 1' in output
+
+    def test_timed_wrapper(self):
+        """ラッパーが関数の戻り値を返し、所要時間を記録することをテスト"""
+        registry = MetricsRegistry()
+        wrapped = registry.timed(STRIPE_API_DURATION, 'Session.create', lambda x: x * 2)
+
+        assert wrapped(21) == 42
+        assert f'{STRIPE_API_DURATION}_count{{method="Session.create",outcome="success"}} 1' in registry.render()
+
+    def test_in_flight_gauge_defaults_to_zero(self):
+        """記録がない場合も処理中リクエスト数のゲージが0で出力されることをテスト"""
+        assert f'{HTTP_REQUESTS_IN_FLIGHT} 0' in MetricsRegistry().render()
+
+
+class TestMetricsEndpoint:
+    """/metrics エンドポイントのテスト"""
+
+    def test_records_route_template_and_status(self):
+        """リクエストがルートのパステンプレートとステータスで記録されることをテスト"""
+        metrics.reset()
+        client = TestClient(app)
+        client.get("/health")
+        client.get("/no-such-route")
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        assert f'{HTTP_REQUESTS_TOTAL}{{route="/health",method="GET",status="200"}} 1' in body
+        assert f'{HTTP_REQUESTS_TOTAL}{{route="unmatched",method="GET",status="404"}} 1' in body
+        assert f'{HTTP_REQUEST_DURATION}_count{{route="/health",method="GET",status="200"}} 1' in body
+        # /metrics 自身のリクエストは処理中として数えられる
+        assert f'{HTTP_REQUESTS_IN_FLIGHT} 1' in body
@@ -0,0 +1,54 @@
+"""
+共通エラーハンドリングミドルウェアのテスト
+"""
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from middleware import ErrorHandlingMiddleware
+from validation import ValidationError
+
+
+@pytest.fixture
+def client():
+    """例外を送出するルートを持つテスト用アプリ"""
+    app = FastAPI()
+    app.add_middleware(ErrorHandlingMiddleware)
+
+    @app.get("/ok")
+    async def ok():
+        return {"status": "ok"}
+
+    @app.get("/validation")
+    async def validation():
+        raise ValidationError("invalid_device_id_format", "device_id format is invalid")
+
+    @app.get("/unexpected")
+    async def unexpected():
+        raise RuntimeError("boom")
+
+    return TestClient(app)
+
+
+class TestErrorHandlingMiddleware:
+    """ErrorHandlingMiddleware クラスのテスト"""
+
+    def test_passes_through_response(self, client):
+        """正常なレスポンスがそのまま返されることをテスト"""
+        response = client.get("/ok")
+        assert response.status_code == 200
+        assert response.json() == {"status": "ok"}
+
+    def test_validation_error(self, client):
+        """バリデーションエラーが error / message 形式で返されることをテスト"""
+        response = client.get("/validation")
+        assert response.status_code == 400
+        assert response.json() == {
+            "error": "invalid_device_id_format",
+            "message": "device_id format is invalid"
+        }
+
+    def test_unexpected_error(self, client):
+        """予期しない例外が500の error / message 形式で返されることをテスト"""
+        response = client.get("/unexpected")
+        assert response.status_code == 500
+        assert response.json()["error"] == "internal_server_error"
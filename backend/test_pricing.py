@@ -0,0 +1,172 @@
+"""
+デイパス価格（pricing）のテスト
+"""
+import asyncio
+import uuid
+from unittest.mock import AsyncMock, MagicMock, patch
+import pytest
+from fastapi.testclient import TestClient
+from loadtest.fake_firestore import FakeFirestoreClient
+from main import app
+from models import MAX_DAYPASS_UNLOCK_COUNT
+from pricing import (
+    DAYPASS_PRICE_TABLE, DAYPASS_PRICE_TIERS, STRIPE_MAX_UNIT_AMOUNT, STRIPE_PRICES_COLLECTION,
+    DaypassPriceCatalog, _max_unlock_count, daypass_lookup_key, daypass_price
+)
+
+
+def make_gateway(existing: dict = None):
+    """list_prices / create_price を差し替えたStripeゲートウェイのモックを作成"""
+    gateway = MagicMock()
+    existing = existing or {}
+
+    async def list_prices(lookup_keys, active, limit):
+        # 同時の引き当てが重なるように、Stripeへの問い合わせ中に制御を返す
+        await asyncio.sleep(0)
+        result = MagicMock()
+        result.data = [MagicMock(id=existing[key]) for key in lookup_keys if key in existing]
+        return result
+    gateway.list_prices = AsyncMock(side_effect=list_prices)
+    gateway.create_price = AsyncMock(side_effect=lambda **kwargs: MagicMock(id=f"price_{kwargs['lookup_key']}"))
+    return gateway
+
+
+class TestDaypassPrice:
+    """価格表のテスト"""
+
+    def test_matches_app_formula(self):
+        """アプリの表示価格（200×1.2^回数）と一致することをテスト"""
+        assert DAYPASS_PRICE_TABLE[:4] == (200, 240, 288, 345)
+        assert daypass_price(3) == 345
+        # 価格表を超える段階も同じ式で計算する
+        assert daypass_price(len(DAYPASS_PRICE_TABLE)) == int(200 * (1.2 ** len(DAYPASS_PRICE_TABLE)))
+
+    def test_upper_bound(self):
+        """Stripe の金額上限を超える回数は価格を計算しないことをテスト"""
+        # models に定義した上限が価格の計算式と一致していること
+        assert MAX_DAYPASS_UNLOCK_COUNT == _max_unlock_count()
+        assert daypass_price(MAX_DAYPASS_UNLOCK_COUNT) <= STRIPE_MAX_UNIT_AMOUNT
+        with pytest.raises(ValueError):
+            daypass_price(MAX_DAYPASS_UNLOCK_COUNT + 1)
+        with pytest.raises(ValueError):
+            daypass_price(5000)
+
+    def test_lookup_key_contains_amount(self):
+        """lookup_key に段階と金額を含むことをテスト"""
+        assert daypass_lookup_key(2) == 'daypass_tier_2_jpy_288'
+
+
+class TestDaypassPriceCatalog:
+    """Price IDの引き当てのテスト"""
+
+    def test_creates_price_once_and_caches(self):
+        """未作成の段階はPriceを作成し、以降はメモリから返すことをテスト"""
+        db = FakeFirestoreClient()
+        gateway = make_gateway()
+        catalog = DaypassPriceCatalog()
+
+        with patch('pricing.stripe_gateway', gateway), \
+             patch('pricing.firestore_config.get_client', return_value=db):
+            first = asyncio.run(catalog.get_price_id(1))
+            second = asyncio.run(catalog.get_price_id(1))
+
+        assert first == second == 'price_daypass_tier_1_jpy_240'
+        gateway.create_price.assert_called_once()
+        kwargs = gateway.create_price.call_args.kwargs
+        assert kwargs['unit_amount'] == 240
+        assert kwargs['lookup_key'] == 'daypass_tier_1_jpy_240'
+        assert kwargs['idempotency_key'] == 'price-daypass_tier_1_jpy_240'
+        cached = db.document(f"{STRIPE_PRICES_COLLECTION}/daypass_tier_1_jpy_240").get()
+        assert cached.get('price_id') == first
+
+    def test_uses_existing_stripe_price(self):
+        """lookup_key に一致するPriceがある場合は作成しないことをテスト"""
+        gateway = make_gateway({'daypass_tier_0_jpy_200': 'price_existing'})
+
+        with patch('pricing.stripe_gateway', gateway), \
+             patch('pricing.firestore_config.get_client', return_value=None):
+            price_id = asyncio.run(DaypassPriceCatalog().get_price_id(0))
+
+        assert price_id == 'price_existing'
+        gateway.create_price.assert_not_called()
+
+    def test_uses_firestore_cache(self):
+        """FirestoreにキャッシュされたPrice IDはStripeに問い合わせずに使うことをテスト"""
+        db = FakeFirestoreClient()
+        db.seed(f"{STRIPE_PRICES_COLLECTION}/daypass_tier_0_jpy_200", {'price_id': 'price_cached'})
+        gateway = make_gateway()
+
+        with patch('pricing.stripe_gateway', gateway), \
+             patch('pricing.firestore_config.get_client', return_value=db):
+            price_id = asyncio.run(DaypassPriceCatalog().get_price_id(0))
+
+        assert price_id == 'price_cached'
+        gateway.list_prices.assert_not_called()
+
+    def test_concurrent_requests_resolve_once(self):
+        """同じ段階の同時の引き当ては1回にまとめられることをテスト"""
+        gateway = make_gateway()
+        catalog = DaypassPriceCatalog()
+
+        async def resolve_concurrently():
+            return await asyncio.gather(*(catalog.get_price_id(2) for _ in range(8)))
+
+        with patch('pricing.stripe_gateway', gateway), \
+             patch('pricing.firestore_config.get_client', return_value=None):
+            results = asyncio.run(resolve_concurrently())
+
+        assert len(set(results)) == 1
+        assert gateway.list_prices.call_count == 1
+
+    def test_line_item_references_price(self):
+        """明細は既存のPrice IDを参照することをテスト"""
+        with patch('pricing.stripe_gateway', make_gateway()), \
+             patch('pricing.firestore_config.get_client', return_value=None):
+            item = asyncio.run(DaypassPriceCatalog().line_item(0))
+
+        assert item == {'price': 'price_daypass_tier_0_jpy_200', 'quantity': 1}
+
+    def test_line_item_falls_back_to_price_data(self):
+        """Stripeエラー時は price_data で金額を指定することをテスト"""
+        gateway = make_gateway()
+        gateway.list_prices.side_effect = Exception("api_error")
+
+        with patch('pricing.stripe_gateway', gateway), \
+             patch('pricing.firestore_config.get_client', return_value=None):
+            item = asyncio.run(DaypassPriceCatalog().line_item(3))
+
+        assert 'price' not in item
+        assert item['price_data']['unit_amount'] == 345
+        assert item['price_data']['product_data']['name'] == 'デイパス (4回目)'
+
+    def test_tiers_beyond_catalog_use_price_data(self):
+        """事前計算した段階を超える回数はPriceを作成せず、キャッシュにも残さないことをテスト"""
+        gateway = make_gateway()
+        catalog = DaypassPriceCatalog()
+
+        with patch('pricing.stripe_gateway', gateway), \
+             patch('pricing.firestore_config.get_client', return_value=None):
+            item = asyncio.run(catalog.line_item(DAYPASS_PRICE_TIERS))
+            with pytest.raises(ValueError):
+                asyncio.run(catalog.get_price_id(DAYPASS_PRICE_TIERS))
+
+        assert item['price_data']['unit_amount'] == daypass_price(DAYPASS_PRICE_TIERS)
+        gateway.list_prices.assert_not_called()
+        gateway.create_price.assert_not_called()
+        assert not catalog._price_ids and not catalog._locks
+
+
+class TestCheckoutUnlockCountBound:
+    """Checkoutセッション作成APIの unlock_count の上限のテスト"""
+
+    @pytest.mark.parametrize('unlock_count', [MAX_DAYPASS_UNLOCK_COUNT + 1, 5000])
+    def test_rejects_unpriceable_unlock_count(self, unlock_count):
+        """上限を超える unlock_count はStripeを呼び出さずに4xxを返すことをテスト"""
+        with patch('main.stripe_config.is_initialized', return_value=True), \
+             patch('main.stripe_gateway') as mock_gateway:
+            response = TestClient(app).post('/create-checkout-session', json={
+                'device_id': str(uuid.uuid4()), 'product_type': 'daypass', 'unlock_count': unlock_count
+            })
+
+        assert 400 <= response.status_code < 500
+        mock_gateway.create_checkout_session.assert_not_called()
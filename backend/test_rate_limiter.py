@@ -0,0 +1,137 @@
+"""
+流量制限（rate_limiter）のテスト
+"""
+import uuid
+from unittest.mock import patch
+import pytest
+from fastapi.testclient import TestClient
+from main import app
+from metrics import RATE_LIMITED_TOTAL, metrics
+from rate_limiter import (
+    DEFAULT_DEVICE_LIMIT, AdmissionController, TokenBucketLimiter, admission_controller, parse_limit, retry_after_header
+)
+
+
+class TestParseLimit:
+    """制限の指定の解析のテスト"""
+
+    def test_parse(self):
+        """「回数/秒数」を (容量, 秒数) に解析することをテスト"""
+        assert parse_limit('10/60') == (10.0, 60.0)
+        assert parse_limit('5') == (5.0, 1.0)
+
+    def test_disabled(self):
+        """空・0・off は制限なしとして扱うことをテスト"""
+        assert parse_limit(None) is None
+        assert parse_limit('off') is None
+        assert parse_limit('0') is None
+
+    def test_invalid(self):
+        """不正な指定はエラーになることをテスト"""
+        with pytest.raises(ValueError):
+            parse_limit('-1/60')
+
+
+class TestTokenBucketLimiter:
+    """TokenBucketLimiter のテスト"""
+
+    def test_burst_then_reject(self):
+        """容量までは許可し、超えた要求は補充までの秒数を返すことをテスト"""
+        limiter = TokenBucketLimiter(3, 60)
+
+        assert [limiter.acquire('d1', now=0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+        assert limiter.acquire('d1', now=0.0) == pytest.approx(20.0)
+        # 他のキーには影響しない
+        assert limiter.acquire('d2', now=0.0) == 0.0
+
+    def test_refill(self):
+        """経過時間に応じてトークンが補充されることをテスト"""
+        limiter = TokenBucketLimiter(2, 10)
+        limiter.acquire('d1', now=0.0)
+        limiter.acquire('d1', now=0.0)
+
+        assert limiter.acquire('d1', now=2.0) == pytest.approx(3.0)
+        assert limiter.acquire('d1', now=5.0) == 0.0
+
+    def test_lru_bound(self):
+        """バケット数が上限を超えた場合は最も古いものを破棄することをテスト"""
+        limiter = TokenBucketLimiter(1, 60, max_entries=2)
+        limiter.acquire('a', now=0.0)
+        limiter.acquire('b', now=0.0)
+        limiter.acquire('a', now=0.0)
+        limiter.acquire('c', now=0.0)
+
+        assert len(limiter) == 2
+        # 'b' は破棄されたため満杯のバケットで再作成される
+        assert limiter.acquire('b', now=0.0) == 0.0
+
+    def test_retry_after_header(self):
+        """Retry-After は1秒以上の整数秒に切り上げることをテスト"""
+        assert retry_after_header(0.2) == '1'
+        assert retry_after_header(5.01) == '6'
+
+
+class TestAdmissionController:
+    """AdmissionController のテスト"""
+
+    def test_device_and_ip_limits(self):
+        """デバイスIDとクライアントIPのそれぞれで制限することをテスト"""
+        with patch.dict('os.environ', {'RATE_LIMIT_DEVICE': '2/60', 'RATE_LIMIT_IP': '3/60'}):
+            controller = AdmissionController()
+
+        route = '/unlock/daypass'
+        assert controller.check(route, 'd1', '10.0.0.1') == 0.0
+        assert controller.check(route, 'd1', '10.0.0.1') == 0.0
+        assert controller.check(route, 'd1', '10.0.0.1') > 0
+        # 別のデバイスでも同じIPは上限に達する
+        assert controller.check(route, 'd2', '10.0.0.1') == 0.0
+        assert controller.check(route, 'd3', '10.0.0.1') > 0
+
+    def test_route_override_and_disable(self):
+        """ルートごとの上書きと制限の無効化をテスト"""
+        with patch.dict('os.environ', {'RATE_LIMIT_LICENSE_CONFIRM_DEVICE': '1/60', 'RATE_LIMIT_IP': 'off'}):
+            controller = AdmissionController()
+
+        assert controller.check('/license/confirm', 'd1', 'ip') == 0.0
+        assert controller.check('/license/confirm', 'd1', 'ip') > 0
+        assert controller.check('/unlock/daypass', 'd1', 'ip') == 0.0
+
+        controller.enabled = False
+        assert controller.check('/license/confirm', 'd1', 'ip') == 0.0
+
+
+class TestRateLimitedEndpoint:
+    """確認APIの流量制限のテスト"""
+
+    @pytest.fixture
+    def limited(self):
+        """デイパス確認APIのデバイスごとの上限を1回にする"""
+        admission_controller.configure('/unlock/daypass', 'device', '1/60')
+        yield
+        admission_controller.configure('/unlock/daypass', 'device', DEFAULT_DEVICE_LIMIT)
+
+    def test_returns_429_before_external_calls(self, limited):
+        """上限を超えた要求はStripe・Firestoreを呼び出さずに429とRetry-Afterを返すことをテスト"""
+        metrics.reset()
+        body = {'device_id': str(uuid.uuid4()), 'purchase_token': 'cs_test_limited'}
+        with patch('main.stripe_config.is_initialized', return_value=False) as mock_initialized:
+            client = TestClient(app)
+            first = client.post('/unlock/daypass', json=body)
+            second = client.post('/unlock/daypass', json=body)
+
+        assert first.status_code == 503
+        assert second.status_code == 429
+        assert second.json()['detail']['error_code'] == 'rate_limited'
+        assert int(second.headers['Retry-After']) >= 1
+        assert mock_initialized.call_count == 1
+        assert f'{RATE_LIMITED_TOTAL}{{route="/unlock/daypass",key="device"}} 1' in metrics.render()
+
+    def test_uses_forwarded_client_ip(self, limited):
+        """X-Forwarded-For の末尾（Cloud Runが追加した接続元）をクライアントIPとして使うことをテスト"""
+        with patch('main.admission_controller.check', return_value=0.0) as mock_check, \
+             patch('main.stripe_config.is_initialized', return_value=False):
+            TestClient(app).post('/unlock/daypass', json={
+                'device_id': str(uuid.uuid4()), 'purchase_token': 'cs_test_ip'
+            }, headers={'X-Forwarded-For': '1.2.3.4, 203.0.113.7'})
+
+        assert mock_check.call_args[0][2] == '203.0.113.7'
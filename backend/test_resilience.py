@@ -0,0 +1,231 @@
+"""
+依存サービスの期限・サーキットブレーカー（resilience）のテスト
+"""
+import asyncio
+import threading
+import time
+import uuid
+from unittest.mock import MagicMock, patch
+import pytest
+import stripe
+from fastapi.testclient import TestClient
+from google.api_core import exceptions as google_exceptions
+from config import FirestoreConfig
+from main import app
+from resilience import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, DependencyUnavailable, firestore_breaker,
+    is_firestore_failure, is_stripe_failure
+)
+
+
+async def succeed():
+    return 'ok'
+
+
+async def fail():
+    raise ConnectionError("down")
+
+
+def call(breaker: CircuitBreaker, fn):
+    """ブレーカー経由で呼び出し、結果または例外を返す"""
+    async def main():
+        try:
+            return await breaker.call(fn)
+        except Exception as e:
+            return e
+    return asyncio.run(main())
+
+
+class TestCircuitBreaker:
+    """CircuitBreaker のテスト"""
+
+    def test_opens_after_threshold(self):
+        """連続した障害が閾値に達すると open になり、呼び出さずに失敗することをテスト"""
+        breaker = CircuitBreaker('dep', deadline=1, failure_threshold=2, reset_timeout=30)
+        assert isinstance(call(breaker, fail), ConnectionError)
+        assert breaker.state == CLOSED
+        assert isinstance(call(breaker, fail), ConnectionError)
+        assert breaker.state == OPEN
+
+        called = []
+
+        async def tracked():
+            called.append(1)
+
+        result = call(breaker, tracked)
+        assert isinstance(result, DependencyUnavailable)
+        assert result.reason == 'circuit_open'
+        assert 0 < result.retry_after <= 30
+        assert not called
+
+    def test_success_resets_failures(self):
+        """成功すると連続障害の数がリセットされることをテスト"""
+        breaker = CircuitBreaker('dep', deadline=1, failure_threshold=2)
+        call(breaker, fail)
+        call(breaker, succeed)
+        call(breaker, fail)
+        assert breaker.state == CLOSED
+
+    def test_half_open_probe(self):
+        """reset_timeout 経過後は1件だけ試行し、成功すれば closed に戻ることをテスト"""
+        breaker = CircuitBreaker('dep', deadline=1, failure_threshold=1, reset_timeout=0.01)
+        call(breaker, fail)
+        assert breaker.state in (OPEN, HALF_OPEN)
+
+        async def concurrent_after_reset():
+            await asyncio.sleep(0.02)
+
+            async def slow():
+                await asyncio.sleep(0.01)
+                return 'probe'
+            return await asyncio.gather(breaker.call(slow), breaker.call(succeed), return_exceptions=True)
+
+        probe, rejected = asyncio.run(concurrent_after_reset())
+        assert probe == 'probe'
+        assert isinstance(rejected, DependencyUnavailable)
+        assert breaker.state == CLOSED
+
+    def test_half_open_failure_reopens(self):
+        """試行が失敗した場合は再び open になることをテスト"""
+        breaker = CircuitBreaker('dep', deadline=1, failure_threshold=3, reset_timeout=0.01)
+        for _ in range(3):
+            call(breaker, fail)
+
+        async def probe_after_reset():
+            await asyncio.sleep(0.02)
+            try:
+                await breaker.call(fail)
+            except ConnectionError:
+                pass
+        asyncio.run(probe_after_reset())
+
+        assert breaker._state == OPEN
+
+    def test_deadline_exceeded(self):
+        """期限を超えた呼び出しは DependencyUnavailable になり、障害として数えることをテスト"""
+        breaker = CircuitBreaker('dep', deadline=0.01, failure_threshold=1)
+
+        async def hang():
+            await asyncio.sleep(1)
+
+        result = call(breaker, hang)
+        assert isinstance(result, DependencyUnavailable)
+        assert result.reason == 'deadline_exceeded'
+        assert breaker.state == OPEN
+
+    def test_client_errors_do_not_trip(self):
+        """障害と判定しない例外（リクエスト側のエラー）では open にならないことをテスト"""
+        breaker = CircuitBreaker('dep', deadline=1, failure_threshold=1, is_failure=is_stripe_failure)
+
+        async def invalid():
+            raise stripe.error.InvalidRequestError("bad", 'param')
+
+        assert isinstance(call(breaker, invalid), stripe.error.InvalidRequestError)
+        assert breaker.state == CLOSED
+
+    def test_failure_classification(self):
+        """Stripe・Firestoreの障害の判定をテスト"""
+        assert is_stripe_failure(stripe.error.APIConnectionError("down"))
+        assert is_stripe_failure(stripe.error.APIError("500"))
+        assert not is_stripe_failure(stripe.error.CardError("declined", None, 'card_declined'))
+        assert is_firestore_failure(google_exceptions.ServiceUnavailable("unavailable"))
+        assert not is_firestore_failure(google_exceptions.Aborted("contention"))
+
+
+class TestFirestoreInitBackoff:
+    """FirestoreConfig の初期化失敗のバックオフのテスト"""
+
+    def test_get_client_skips_during_backoff(self):
+        """初期化に失敗した後は再試行時刻まで初期化を試みないことをテスト"""
+        config = FirestoreConfig()
+        config.init_retry_seconds = 60
+        with patch.object(config, '_initialize_locked', return_value=False) as mock_init:
+            assert config.get_client() is None
+            assert config.get_client() is None
+            assert config.get_client() is None
+
+        mock_init.assert_called_once()
+        assert 0 < config.retry_after() <= 60
+
+    def test_concurrent_callers_make_single_attempt(self):
+        """同時に初期化を待っていた呼び出しは、失敗後に初期化を繰り返さないことをテスト"""
+        config = FirestoreConfig()
+        config.init_retry_seconds = 60
+        attempts = []
+
+        def failing_init():
+            attempts.append(1)
+            time.sleep(0.05)
+            return False
+
+        with patch.object(config, '_initialize_locked', side_effect=failing_init):
+            threads = [threading.Thread(target=config.get_client) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert len(attempts) == 1
+        assert config._init_failures == 1
+        assert 0 < config.retry_after() <= 60
+
+    def test_backoff_doubles_and_caps(self):
+        """再試行の間隔は失敗ごとに倍になり、上限で頭打ちになることをテスト"""
+        config = FirestoreConfig()
+        config.init_retry_seconds = 5
+        config.init_retry_max_seconds = 12
+        with patch.object(config, '_initialize_locked', return_value=False):
+            delays = []
+            for _ in range(3):
+                config._next_init_attempt = 0
+                config.initialize_firestore()
+                delays.append(round(config.retry_after()))
+
+        assert delays == [5, 10, 12]
+
+    def test_success_clears_backoff(self):
+        """初期化に成功するとバックオフが解除されることをテスト"""
+        config = FirestoreConfig()
+        with patch.object(config, '_initialize_locked', return_value=False):
+            config.initialize_firestore()
+        config._next_init_attempt = 0
+
+        def succeed_init():
+            config._client = MagicMock()
+            config._initialized = True
+            return True
+
+        with patch.object(config, '_initialize_locked', side_effect=succeed_init):
+            assert config.get_client() is config._client
+        assert config._init_failures == 0
+
+
+class TestFastFailEndpoints:
+    """依存サービスの障害時に即座に503を返すことのテスト"""
+
+    @pytest.fixture
+    def open_firestore_breaker(self):
+        for _ in range(firestore_breaker.failure_threshold):
+            firestore_breaker._record_failure()
+        yield
+        firestore_breaker.reset()
+
+    def test_open_breaker_returns_503(self, open_firestore_breaker):
+        """Firestoreのブレーカーが開いている間は読み取りを行わずに503とRetry-Afterを返すことをテスト"""
+        db = MagicMock()
+        with patch('main.firestore_config.get_client', return_value=db):
+            response = TestClient(app).get(f"/devices/{uuid.uuid4()}/entitlements")
+
+        assert response.status_code == 503
+        assert response.json()['detail']['error_code'] == 'dependency_unavailable'
+        assert int(response.headers['Retry-After']) >= 1
+        db.collection.assert_not_called()
+
+    def test_uninitialized_firestore_has_retry_after(self):
+        """Firestore未初期化の503にRetry-Afterを付けることをテスト"""
+        with patch('main.firestore_config.get_client', return_value=None), \
+             patch('main.firestore_config.retry_after', return_value=7.5):
+            response = TestClient(app).get(f"/devices/{uuid.uuid4()}/entitlements")
+
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '8'
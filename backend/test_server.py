@@ -0,0 +1,67 @@
+"""
+本番用サーバー起動設定のテスト
+"""
+from server import build_server_options, compute_workers, detect_cpu_count, detect_memory_limit
+
+
+class TestResourceDetection:
+    """CPU・メモリ検出のテスト"""
+
+    def test_cgroup_v2_cpu_quota(self, tmp_path):
+        """cgroup v2 のCPUクォータが反映されることをテスト"""
+        (tmp_path / 'cpu.max').write_text('50000 100000\n')
+        assert detect_cpu_count(str(tmp_path)) == 0.5
+
+    def test_cgroup_v2_unlimited_cpu(self, tmp_path):
+        """クォータが無制限の場合は割り当てCPU数を返すことをテスト"""
+        (tmp_path / 'cpu.max').write_text('max 100000\n')
+        assert detect_cpu_count(str(tmp_path)) >= 1
+
+    def test_cgroup_v1_cpu_quota(self, tmp_path):
+        """cgroup v1 のCPUクォータが反映されることをテスト"""
+        (tmp_path / 'cpu').mkdir()
+        (tmp_path / 'cpu' / 'cpu.cfs_quota_us').write_text('100000\n')
+        (tmp_path / 'cpu' / 'cpu.cfs_period_us').write_text('100000\n')
+        assert detect_cpu_count(str(tmp_path)) == 1
+
+    def test_cgroup_memory_limit(self, tmp_path):
+        """cgroup のメモリ上限が反映されることをテスト"""
+        (tmp_path / 'memory.max').write_text(str(512 * 1024 * 1024))
+        assert detect_memory_limit(str(tmp_path)) == 512 * 1024 * 1024
+
+    def test_unlimited_memory_falls_back_to_physical(self, tmp_path):
+        """メモリ上限がない場合は物理メモリ量を返すことをテスト"""
+        (tmp_path / 'memory.max').write_text('max')
+        assert detect_memory_limit(str(tmp_path)) > 0
+
+
+class TestComputeWorkers:
+    """compute_workers 関数のテスト"""
+
+    def test_limited_by_cpus(self):
+        """ワーカー数がCPU数を超えないことをテスト"""
+        assert compute_workers(4, 8 * 1024 ** 3) == 4
+
+    def test_limited_by_memory(self):
+        """メモリが足りない場合はワーカー数を減らすことをテスト"""
+        assert compute_workers(4, 512 * 1024 ** 2, worker_memory_mb=192) == 2
+
+    def test_at_least_one_worker(self):
+        """CPUが1未満でも1ワーカーで起動することをテスト"""
+        assert compute_workers(0.5, 128 * 1024 ** 2) == 1
+
+
+class TestBuildServerOptions:
+    """build_server_options 関数のテスト"""
+
+    def test_concurrency_split_across_workers(self):
+        """同時接続数の上限がワーカー数で分担されることをテスト"""
+        options = build_server_options({'WEB_CONCURRENCY': '2', 'CONCURRENCY': '80', 'PORT': '9000'})
+
+        assert options['workers'] == 2
+        assert options['port'] == 9000
+        assert options['limit_concurrency'] == 50
+        assert options['timeout_keep_alive'] > 600
+        assert options['access_log'] is False
+        assert options['loop'] in ('uvloop', 'asyncio')
+        assert options['http'] in ('httptools', 'h11')
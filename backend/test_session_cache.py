@@ -0,0 +1,238 @@
+"""
+Checkoutセッションキャッシュのテスト
+"""
+import time
+import uuid
+import pytest
+import stripe
+from unittest.mock import patch, MagicMock
+from fastapi.testclient import TestClient
+from session_cache import CheckoutSessionCache, OpenSessionCache, open_session_cache, session_cache
+from entitlements import IDEMPOTENCY_TTL_DAYS, MutationResult
+from main import app
+
+
+def make_session(session_id: str, payment_status: str = 'paid', device_id: str = 'device',
+                 age_days: float = 0) -> stripe.StripeObject:
+    """テスト用のCheckout Sessionオブジェクトを作成"""
+    return stripe.StripeObject.construct_from({
+        'id': session_id,
+        'created': int(time.time() - age_days * 86400),
+        'payment_status': payment_status,
+        'payment_intent': 'pi_test_123',
+        'metadata': {'device_id': device_id, 'product_type': 'daypass'}
+    }, 'sk_test')
+
+
+class TestCheckoutSessionCache:
+    """CheckoutSessionCache クラスのテスト"""
+
+    def test_remember_paid_session(self):
+        """支払い済みセッションが登録されることをテスト"""
+        cache = CheckoutSessionCache(max_entries=10, ttl_seconds=60)
+        assert cache.remember(make_session('cs_test_paid')) is True
+
+        entry = cache.get('cs_test_paid')
+        assert entry is not None
+        assert entry.payment_status == 'paid'
+        assert entry.metadata['device_id'] == 'device'
+        assert entry.payment_intent == 'pi_test_123'
+        assert entry.created <= time.time()
+
+    def test_unpaid_session_not_cached(self):
+        """未払いセッションはキャッシュされないことをテスト"""
+        cache = CheckoutSessionCache(max_entries=10, ttl_seconds=60)
+        assert cache.remember(make_session('cs_test_unpaid', payment_status='unpaid')) is False
+        assert cache.get('cs_test_unpaid') is None
+
+    def test_entries_expire(self):
+        """TTLを過ぎたエントリが返されないことをテスト"""
+        cache = CheckoutSessionCache(max_entries=10, ttl_seconds=0)
+        cache.put('cs_test_expired', 'paid')
+        assert cache.get('cs_test_expired') is None
+        assert len(cache) == 0
+
+    def test_lru_eviction(self):
+        """上限を超えた場合に最も古く使われたエントリが破棄されることをテスト"""
+        cache = CheckoutSessionCache(max_entries=2, ttl_seconds=60)
+        cache.put('cs_test_a', 'paid')
+        cache.put('cs_test_b', 'paid')
+        cache.get('cs_test_a')
+        cache.put('cs_test_c', 'paid')
+
+        assert cache.get('cs_test_a') is not None
+        assert cache.get('cs_test_b') is None
+        assert cache.get('cs_test_c') is not None
+
+
+class TestConfirmUsesSessionCache:
+    """確認APIがキャッシュを利用することのテスト"""
+
+    @pytest.fixture
+    def client(self):
+        session_cache.clear()
+        with patch('main.stripe_config.is_initialized', return_value=True), \
+             patch('main.firestore_config.get_client', return_value=MagicMock()), \
+             patch('main.firestore_config.initialize_firestore', return_value=True), \
+             patch('main.EntitlementMutator.apply_license_purchase', return_value=MutationResult(applied=True)):
+            with TestClient(app) as test_client:
+                yield test_client
+        session_cache.clear()
+
+    def test_cached_session_skips_stripe(self, client):
+        """キャッシュヒット時はStripeへ問い合わせないことをテスト"""
+        session_cache.put('cs_test_cached', 'paid')
+        with patch('main.stripe_gateway.retrieve_checkout_session') as mock_retrieve:
+            response = client.post("/license/confirm", json={
+                "device_id": str(uuid.uuid4()),
+                "purchase_token": "cs_test_cached"
+            })
+        assert response.status_code == 200
+        mock_retrieve.assert_not_called()
+
+    def test_cache_miss_retrieves_once(self, client):
+        """キャッシュミス時は1度だけStripeに問い合わせ、以降はキャッシュを使うことをテスト"""
+        with patch('main.stripe_gateway.retrieve_checkout_session',
+                   return_value=make_session('cs_test_miss')) as mock_retrieve:
+            for _ in range(2):
+                response = client.post("/license/confirm", json={
+                    "device_id": str(uuid.uuid4()),
+                    "purchase_token": "cs_test_miss"
+                })
+                assert response.status_code == 200
+        mock_retrieve.assert_called_once_with('cs_test_miss')
+
+    def test_unpaid_session_rejected(self, client):
+        """未払いセッションは400を返し、キャッシュされないことをテスト"""
+        with patch('main.stripe_gateway.retrieve_checkout_session',
+                   return_value=make_session('cs_test_unpaid', payment_status='unpaid')):
+            response = client.post("/license/confirm", json={
+                "device_id": str(uuid.uuid4()),
+                "purchase_token": "cs_test_unpaid"
+            })
+        assert response.status_code == 400
+        assert session_cache.get('cs_test_unpaid') is None
+
+    def test_session_older_than_idempotency_ttl_rejected(self, client):
+        """冪等性レコードの保持期間より前のセッションはキャッシュヒット時も400を返すことをテスト"""
+        with patch('main.stripe_gateway.retrieve_checkout_session',
+                   return_value=make_session('cs_test_old', age_days=IDEMPOTENCY_TTL_DAYS + 1)) as mock_retrieve:
+            responses = [
+                client.post("/license/confirm", json={
+                    "device_id": str(uuid.uuid4()),
+                    "purchase_token": "cs_test_old"
+                })
+                for _ in range(2)
+            ]
+        assert [response.status_code for response in responses] == [400, 400]
+        assert {response.json()['detail']['error_code'] for response in responses} == {'session_too_old'}
+        # 2回目はキャッシュから判定する
+        mock_retrieve.assert_called_once()
+
+
+def make_open_session(session_id: str, expires_in: float = 86400, status: str = 'open') -> stripe.StripeObject:
+    """テスト用の未完了Checkout Sessionオブジェクトを作成"""
+    return stripe.StripeObject.construct_from({
+        'id': session_id,
+        'url': f"https://checkout.stripe.test/c/pay/{session_id}",
+        'status': status,
+        'expires_at': int(time.time() + expires_in)
+    }, 'sk_test')
+
+
+class TestOpenSessionCache:
+    """OpenSessionCache クラスのテスト"""
+
+    def test_put_and_get(self):
+        """同じデバイス・商品・段階でセッションを再利用できることをテスト"""
+        cache = OpenSessionCache(max_entries=10, max_ttl_seconds=600)
+        assert cache.put('device', 'daypass', 1, make_open_session('cs_test_open')) is True
+
+        entry = cache.get('device', 'daypass', 1)
+        assert entry.session_id == 'cs_test_open'
+        assert entry.url.endswith('cs_test_open')
+        # 段階が異なる場合は再利用しない
+        assert cache.get('device', 'daypass', 2) is None
+
+    def test_expires_before_stripe_session(self):
+        """Stripeのセッション期限の手前で失効することをテスト"""
+        cache = OpenSessionCache(max_entries=10, max_ttl_seconds=3600, expiry_margin_seconds=300)
+        cache.put('device', 'license', 0, make_open_session('cs_test_open', expires_in=400))
+
+        entry = cache.get('device', 'license', 0)
+        assert entry.expires_at <= time.time() + 100
+        with patch('session_cache.time.time', return_value=time.time() + 200):
+            assert cache.get('device', 'license', 0) is None
+        assert len(cache) == 0
+
+    def test_rejects_closed_or_expiring_sessions(self):
+        """完了済み・期限間近のセッションは登録しないことをテスト"""
+        cache = OpenSessionCache(max_entries=10, max_ttl_seconds=600, expiry_margin_seconds=300)
+        assert cache.put('device', 'license', 0, make_open_session('cs_test_done', status='complete')) is False
+        assert cache.put('device', 'license', 0, make_open_session('cs_test_soon', expires_in=60)) is False
+        assert len(cache) == 0
+
+    def test_invalidate_session(self):
+        """Session IDで破棄できることをテスト"""
+        cache = OpenSessionCache(max_entries=10, max_ttl_seconds=600)
+        cache.put('device', 'daypass', 0, make_open_session('cs_test_open'))
+
+        assert cache.invalidate_session('cs_test_open') is True
+        assert cache.get('device', 'daypass', 0) is None
+        assert cache.invalidate_session('cs_test_open') is False
+
+    def test_replacing_entry_drops_old_session_index(self):
+        """同じキーへの登録で古いセッションの索引も削除されることをテスト"""
+        cache = OpenSessionCache(max_entries=1, max_ttl_seconds=600)
+        cache.put('device', 'daypass', 0, make_open_session('cs_test_old'))
+        cache.put('device', 'daypass', 0, make_open_session('cs_test_new'))
+        cache.put('other', 'daypass', 0, make_open_session('cs_test_other'))
+
+        assert cache.invalidate_session('cs_test_old') is False
+        assert cache.invalidate_session('cs_test_new') is False
+        assert cache.get('other', 'daypass', 0).session_id == 'cs_test_other'
+
+
+class TestCheckoutReusesOpenSession:
+    """Checkoutセッション作成APIでの未完了セッションの再利用のテスト"""
+
+    DEVICE_ID = '123e4567-e89b-12d3-a456-426614174000'
+
+    @pytest.fixture
+    def client(self):
+        """Stripe初期化済みとしたテストクライアント"""
+        open_session_cache.clear()
+        with patch('main.stripe_config.is_initialized', return_value=True), \
+             patch('main.daypass_price_catalog.line_item', return_value={'price': 'price_tier', 'quantity': 1}):
+            with TestClient(app) as test_client:
+                yield test_client
+        open_session_cache.clear()
+
+    def test_repeated_taps_reuse_session(self, client):
+        """同じ購入の繰り返しでは1度だけセッションを作成することをテスト"""
+        with patch('main.stripe_gateway.create_checkout_session',
+                   return_value=make_open_session('cs_test_first')) as mock_create:
+            urls = [
+                client.post("/create-checkout-session", json={
+                    'device_id': self.DEVICE_ID, 'product_type': 'daypass', 'unlock_count': 1
+                }).json()['checkout_url']
+                for _ in range(3)
+            ]
+        assert len(set(urls)) == 1
+        mock_create.assert_called_once()
+
+    def test_expired_webhook_invalidates(self, client):
+        """checkout.session.expired のWebhookで破棄され、次は新しく作成することをテスト"""
+        with patch('main.stripe_gateway.create_checkout_session',
+                   side_effect=[make_open_session('cs_test_first'), make_open_session('cs_test_second')]):
+            body = {'device_id': self.DEVICE_ID, 'product_type': 'license'}
+            first = client.post("/create-checkout-session", json=body).json()['checkout_url']
+            response = client.post("/stripe-webhook", json={
+                'id': 'evt_expired', 'object': 'event', 'type': 'checkout.session.expired',
+                'data': {'object': {'id': 'cs_test_first', 'object': 'checkout.session'}}
+            })
+            second = client.post("/create-checkout-session", json=body).json()['checkout_url']
+
+        assert response.status_code == 200
+        assert first.endswith('cs_test_first')
+        assert second.endswith('cs_test_second')
@@ -0,0 +1,173 @@
+"""
+シングルフライト（single_flight）のテスト
+"""
+import asyncio
+from unittest.mock import MagicMock, patch
+import httpx
+import stripe
+from entitlements import MutationResult
+from main import app
+from session_cache import session_cache
+from single_flight import SingleFlight, StripedLocks
+
+
+class TestStripedLocks:
+    """StripedLocks のテスト"""
+
+    def test_same_key_same_lock(self):
+        """同じキーには同じロックが割り当てられることをテスト"""
+        async def main():
+            locks = StripedLocks(stripes=4)
+            return locks.lock_for('d1') is locks.lock_for('d1'), len({id(locks.lock_for(i)) for i in range(100)})
+
+        same, distinct = asyncio.run(main())
+        assert same
+        assert distinct == 4
+
+    def test_recreated_for_new_loop(self):
+        """イベントループが変わった場合はロックを作り直すことをテスト"""
+        locks = StripedLocks(stripes=2)
+
+        async def get():
+            return locks.lock_for('d1')
+
+        assert asyncio.run(get()) is not asyncio.run(get())
+
+
+class TestSingleFlight:
+    """SingleFlight のテスト"""
+
+    def test_concurrent_calls_share_result(self):
+        """同じキーの同時の呼び出しは1回だけ実行し、同じ結果を返すことをテスト"""
+        flights = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return object()
+
+        async def main():
+            return await asyncio.gather(*(flights.do('k', work) for _ in range(5)))
+
+        results = asyncio.run(main())
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+        assert len(flights) == 0
+
+    def test_exception_shared(self):
+        """処理の例外は待機していた全員に送出されることをテスト"""
+        flights = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        async def main():
+            return await asyncio.gather(*(flights.do('k', work) for _ in range(3)), return_exceptions=True)
+
+        results = asyncio.run(main())
+        assert all(isinstance(result, ValueError) for result in results)
+
+    def test_runs_again_after_completion(self):
+        """完了後の呼び出しは新しく実行することをテスト"""
+        flights = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            return len(calls)
+
+        async def main():
+            return await flights.do('k', work), await flights.do('k', work)
+
+        assert asyncio.run(main()) == (1, 2)
+
+    def test_leader_cancellation_does_not_cancel_flight(self):
+        """最初の呼び出し元がキャンセルされても他の呼び出し元は結果を受け取ることをテスト"""
+        flights = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.02)
+            return 'done'
+
+        async def main():
+            leader = asyncio.ensure_future(flights.do('k', work))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flights.do('k', work))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower
+
+        assert asyncio.run(main()) == 'done'
+
+    def test_lock_key_serializes_different_keys(self):
+        """同じロックキーの異なる処理は直列に実行されることをテスト"""
+        flights = SingleFlight(StripedLocks(stripes=8))
+        running = []
+        overlaps = []
+
+        def make_work(name):
+            async def work():
+                running.append(name)
+                overlaps.append(len(running))
+                await asyncio.sleep(0.01)
+                running.remove(name)
+                return name
+            return work
+
+        async def main():
+            return await asyncio.gather(
+                flights.do('a', make_work('a'), lock_key='device'),
+                flights.do('b', make_work('b'), lock_key='device'),
+            )
+
+        assert asyncio.run(main()) == ['a', 'b']
+        assert max(overlaps) == 1
+
+
+class TestConcurrentConfirmations:
+    """同じ購入の同時の確認要求のテスト"""
+
+    DEVICE_ID = '123e4567-e89b-12d3-a456-426614174000'
+
+    def test_duplicate_daypass_requests_share_work(self):
+        """同時に届いた同じデイパス確認はStripe・Firestoreへの問い合わせを1回にまとめることをテスト"""
+        session_cache.clear()
+        retrieve_calls = []
+        apply_calls = []
+
+        async def retrieve(session_id):
+            retrieve_calls.append(session_id)
+            await asyncio.sleep(0.02)
+            return stripe.StripeObject.construct_from({
+                'id': session_id, 'object': 'checkout.session', 'payment_status': 'paid',
+                'metadata': {'device_id': self.DEVICE_ID, 'product_type': 'daypass'}
+            }, 'sk_test')
+
+        async def apply(db, device_id, session_id, *args):
+            apply_calls.append(session_id)
+            await asyncio.sleep(0.02)
+            return MutationResult(applied=True, unlock_count=1, last_unlock_date='2026-01-01')
+
+        async def send_concurrently():
+            async with httpx.AsyncClient(app=app, base_url='http://testserver') as client:
+                return await asyncio.gather(*(
+                    client.post('/unlock/daypass', json={
+                        'device_id': self.DEVICE_ID, 'purchase_token': 'cs_test_concurrent'
+                    })
+                    for _ in range(3)
+                ))
+
+        with patch('main.stripe_config.is_initialized', return_value=True), \
+             patch('main.firestore_config.get_client', return_value=MagicMock()), \
+             patch('main.stripe_gateway.retrieve_checkout_session', side_effect=retrieve), \
+             patch('main.EntitlementMutator.apply_daypass_unlock', side_effect=apply), \
+             patch('main.device_cache.record_mutation'):
+            responses = asyncio.run(send_concurrently())
+
+        session_cache.clear()
+        assert [response.status_code for response in responses] == [200, 200, 200]
+        assert {response.json()['unlock_count'] for response in responses} == {1}
+        assert retrieve_calls == ['cs_test_concurrent']
+        assert apply_calls == ['cs_test_concurrent']
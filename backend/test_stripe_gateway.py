@@ -0,0 +1,173 @@
+"""
+Stripeゲートウェイ（stripe_gateway）のテスト
+"""
+import asyncio
+from unittest.mock import patch
+from urllib.parse import parse_qsl
+import httpx
+import pytest
+import stripe
+from resilience import CircuitBreaker
+from stripe_gateway import StripeGateway, _encode_params
+
+
+def make_gateway(handler, max_retries: int = 2) -> StripeGateway:
+    """MockTransport で応答するゲートウェイを作成（再試行の待機なし）"""
+    gateway = StripeGateway(transport=httpx.MockTransport(handler), breaker=CircuitBreaker('stripe', deadline=5))
+    gateway.max_retries = max_retries
+    gateway.retry_base_delay = 0
+    return gateway
+
+
+def run(gateway: StripeGateway, coro_factory):
+    """ゲートウェイの呼び出しを実行し、接続プールを閉じる"""
+    async def main():
+        try:
+            return await coro_factory()
+        finally:
+            await gateway.aclose()
+    with patch('stripe_gateway.stripe_config.api_key', 'sk_test_gateway'), \
+         patch('stripe_gateway.stripe_config.api_base', 'https://stripe.test'):
+        return asyncio.run(main())
+
+
+class TestEncodeParams:
+    """フォーム形式への展開のテスト"""
+
+    def test_nested_params(self):
+        """辞書・リスト・真偽値をStripeの形式に展開することをテスト"""
+        encoded = list(_encode_params({
+            'mode': 'payment',
+            'line_items': [{'price': 'price_1', 'quantity': 1}],
+            'payment_method_types': ['card'],
+            'metadata': {'device_id': 'd1'},
+            'active': True,
+            'customer': None,
+        }))
+
+        assert encoded == [
+            ('mode', 'payment'),
+            ('line_items[0][price]', 'price_1'),
+            ('line_items[0][quantity]', '1'),
+            ('payment_method_types[0]', 'card'),
+            ('metadata[device_id]', 'd1'),
+            ('active', 'true'),
+        ]
+
+
+class TestStripeGateway:
+    """StripeGateway のテスト"""
+
+    def test_create_checkout_session(self):
+        """フォーム本文・認証・冪等キーを付けて送信し、Sessionに変換することをテスト"""
+        requests = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            return httpx.Response(200, json={
+                'id': 'cs_test_1', 'object': 'checkout.session', 'url': 'https://checkout.stripe.test/cs_test_1'
+            })
+
+        gateway = make_gateway(handler)
+        session = run(gateway, lambda: gateway.create_checkout_session(
+            mode='payment', metadata={'device_id': 'd1'}
+        ))
+
+        assert isinstance(session, stripe.checkout.Session)
+        assert session.url == 'https://checkout.stripe.test/cs_test_1'
+        request = requests[0]
+        assert str(request.url) == 'https://stripe.test/v1/checkout/sessions'
+        assert request.headers['Authorization'] == 'Bearer sk_test_gateway'
+        assert request.headers['Idempotency-Key']
+        assert dict(parse_qsl(request.content.decode())) == {'mode': 'payment', 'metadata[device_id]': 'd1'}
+
+    def test_retry_reuses_idempotency_key(self):
+        """再試行可能なエラーは同じ冪等キーで再送することをテスト"""
+        requests = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            if len(requests) == 1:
+                return httpx.Response(503, json={'error': {'type': 'api_error', 'message': 'unavailable'}})
+            return httpx.Response(200, json={'id': 'cs_test_1', 'object': 'checkout.session'})
+
+        gateway = make_gateway(handler)
+        session = run(gateway, lambda: gateway.create_checkout_session(mode='payment'))
+
+        assert session.id == 'cs_test_1'
+        assert len(requests) == 2
+        assert requests[0].headers['Idempotency-Key'] == requests[1].headers['Idempotency-Key']
+
+    def test_connection_error_retried_then_raised(self):
+        """接続エラーは上限回数まで再試行し、APIConnectionErrorを送出することをテスト"""
+        calls = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            raise httpx.ConnectError("connection refused", request=request)
+
+        gateway = make_gateway(handler, max_retries=2)
+        with pytest.raises(stripe.error.APIConnectionError):
+            run(gateway, lambda: gateway.retrieve_checkout_session('cs_test_1'))
+        assert len(calls) == 3
+
+    def test_invalid_request_not_retried(self):
+        """400エラーは再試行せず、InvalidRequestErrorに変換することをテスト"""
+        calls = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            return httpx.Response(404, json={'error': {
+                'type': 'invalid_request_error', 'message': 'No such checkout.session', 'param': 'id'
+            }})
+
+        gateway = make_gateway(handler)
+        with pytest.raises(stripe.error.InvalidRequestError) as exc_info:
+            run(gateway, lambda: gateway.retrieve_checkout_session('cs_missing'))
+
+        assert exc_info.value.http_status == 404
+        assert exc_info.value.param == 'id'
+        assert len(calls) == 1
+
+    def test_should_retry_header(self):
+        """Stripe-Should-Retry: false の場合は5xxでも再試行しないことをテスト"""
+        calls = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            return httpx.Response(500, headers={'Stripe-Should-Retry': 'false'},
+                                  json={'error': {'type': 'api_error', 'message': 'boom'}})
+
+        gateway = make_gateway(handler)
+        with pytest.raises(stripe.error.APIError):
+            run(gateway, lambda: gateway.retrieve_checkout_session('cs_test_1'))
+        assert len(calls) == 1
+
+    def test_list_prices_query(self):
+        """GETのパラメータをクエリ文字列で送信することをテスト"""
+        requests = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            return httpx.Response(200, json={'object': 'list', 'data': [{'id': 'price_1', 'object': 'price'}]})
+
+        gateway = make_gateway(handler)
+        prices = run(gateway, lambda: gateway.list_prices(lookup_keys=['tier_0'], active=True, limit=1))
+
+        assert prices.data[0].id == 'price_1'
+        assert dict(requests[0].url.params) == {'lookup_keys[0]': 'tier_0', 'active': 'true', 'limit': '1'}
+        assert 'Idempotency-Key' not in requests[0].headers
+
+    def test_connection_pool_reused(self):
+        """同じイベントループ内では同じクライアント（接続プール）を使い回すことをテスト"""
+        gateway = make_gateway(lambda request: httpx.Response(200, json={'object': 'checkout.session'}))
+
+        async def two_calls():
+            await gateway.retrieve_checkout_session('cs_1')
+            first = gateway._client
+            await gateway.retrieve_checkout_session('cs_2')
+            return first, gateway._client
+
+        first, second = run(gateway, two_calls)
+        assert first is second
+        assert gateway._client is None
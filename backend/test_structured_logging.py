@@ -0,0 +1,107 @@
+"""
+構造化ログのテスト
+"""
+import json
+import logging
+import queue
+from structured_logging import JsonFormatter, NonBlockingQueueHandler, RateLimitFilter
+
+
+def make_record(msg: str = "message", level: int = logging.INFO, **extra) -> logging.LogRecord:
+    """extra のフィールドを持つログレコードを作成"""
+    record = logging.LogRecord('test', level, __file__, 1, msg, None, None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+class TestJsonFormatter:
+    """JsonFormatter クラスのテスト"""
+
+    def test_includes_event_fields(self):
+        """extra で渡したフィールドがJSONに含まれることをテスト"""
+        record = make_record("License information updated", device_id='device', session_id='cs_test_1',
+                             rate_limit_key='license')
+
+        entry = json.loads(JsonFormatter().format(record))
+
+        assert entry['severity'] == 'INFO'
+        assert entry['message'] == "License information updated"
+        assert entry['device_id'] == 'device'
+        assert entry['session_id'] == 'cs_test_1'
+        # フィルター用の属性は出力しない
+        assert 'rate_limit_key' not in entry
+
+    def test_formats_exception(self):
+        """例外情報がトレースバックとして出力されることをテスト"""
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError as e:
+            record = make_record("failed", logging.ERROR)
+            record.exc_info = (type(e), e, e.__traceback__)
+
+        entry = json.loads(JsonFormatter().format(record))
+        assert 'RuntimeError: boom' in entry['exception']
+
+
+class TestRateLimitFilter:
+    """RateLimitFilter クラスのテスト"""
+
+    def test_limits_per_key_and_reports_suppressed(self):
+        """キーごとの上限を超えたレコードが破棄され、次のウィンドウで件数が報告されることをテスト"""
+        log_filter = RateLimitFilter(max_per_interval=2, interval_seconds=60)
+
+        passed = [log_filter.filter(make_record(rate_limit_key='hot')) for _ in range(5)]
+        assert passed == [True, True, False, False, False]
+        # 別のキーは影響を受けない
+        assert log_filter.filter(make_record(rate_limit_key='other')) is True
+        # キーのないレコードは常に出力する
+        assert log_filter.filter(make_record()) is True
+
+        log_filter.interval_seconds = 0
+        record = make_record(rate_limit_key='hot')
+        assert log_filter.filter(record) is True
+        assert record.suppressed == 3
+
+    def test_sample_rate(self):
+        """sample_rate が0のレコードは出力せず、1のレコードは出力することをテスト"""
+        log_filter = RateLimitFilter()
+        assert log_filter.filter(make_record(sample_rate=0.0)) is False
+        assert log_filter.filter(make_record(sample_rate=1.0)) is True
+
+
+class TestNonBlockingQueueHandler:
+    """NonBlockingQueueHandler クラスのテスト"""
+
+    def test_drops_when_queue_full(self):
+        """キューが満杯でもブロックせず、破棄件数を次のレコードに記録することをテスト"""
+        log_queue = queue.Queue(maxsize=1)
+        handler = NonBlockingQueueHandler(log_queue)
+
+        handler.handle(make_record("first"))
+        handler.handle(make_record("second"))
+        handler.handle(make_record("third"))
+        assert handler.dropped == 2
+
+        assert log_queue.get_nowait().getMessage() == "first"
+        handler.handle(make_record("fourth"))
+        record = log_queue.get_nowait()
+        assert record.getMessage() == "fourth"
+        assert record.dropped == 2
+
+    def test_defers_exception_formatting(self):
+        """例外のトレースバック整形を行わずにキューへ積むことをテスト"""
+        log_queue = queue.Queue()
+        handler = NonBlockingQueueHandler(log_queue)
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError as e:
+            record = make_record("failed %s", logging.ERROR)
+            record.args = ('now',)
+            record.exc_info = (type(e), e, e.__traceback__)
+
+        handler.handle(record)
+        queued = log_queue.get_nowait()
+        assert queued.getMessage() == "failed now"
+        assert queued.exc_info is not None
+        assert queued.exc_text is None
@@ -0,0 +1,226 @@
+"""
+Webhookキューとワーカーのテスト
+"""
+import asyncio
+import json
+import time
+import pytest
+from unittest.mock import patch, MagicMock
+from fastapi.testclient import TestClient
+from webhook_queue import WebhookQueue, WebhookReconciler, WebhookWorker, webhook_queue
+from entitlements import MutationResult
+from device_cache import device_cache
+import stripe
+from main import _list_webhook_events, app
+
+
+@pytest.fixture
+def queue(tmp_path):
+    """一時ファイル上のWebhookキュー"""
+    q = WebhookQueue(path=str(tmp_path / 'queue.db'), max_attempts=3,
+                     base_backoff_seconds=0.01, max_backoff_seconds=0.05)
+    yield q
+    q.close()
+
+
+class TestWebhookQueue:
+    """WebhookQueue クラスのテスト"""
+
+    def test_enqueue_and_claim(self, queue):
+        """保存したイベントを取り出せることをテスト"""
+        assert queue.enqueue('evt_1', 'checkout.session.completed', '{}') is True
+
+        events = queue.claim(10)
+        assert [e['event_id'] for e in events] == ['evt_1']
+        assert events[0]['attempts'] == 0
+        # 処理中のイベントは再度取り出されない
+        assert queue.claim(10) == []
+
+    def test_duplicate_event_ignored(self, queue):
+        """同じイベントIDの再送が1件にまとめられることをテスト"""
+        assert queue.enqueue('evt_1', 'checkout.session.completed', '{}') is True
+        assert queue.enqueue('evt_1', 'checkout.session.completed', '{}') is False
+        assert len(queue.claim(10)) == 1
+
+    def test_complete_removes_event(self, queue):
+        """完了したイベントが削除されることをテスト"""
+        queue.enqueue('evt_1', 'checkout.session.completed', '{}')
+        queue.claim(10)
+        queue.complete('evt_1')
+        assert queue.next_due_in() is None
+
+    def test_fail_retries_with_backoff_then_dead_letters(self, queue):
+        """失敗したイベントがバックオフ後に再試行され、上限でデッドレターに移ることをテスト"""
+        queue.enqueue('evt_1', 'checkout.session.completed', '{}')
+
+        for attempt in range(2):
+            assert len(queue.claim(10)) == 1
+            assert queue.fail('evt_1', 'boom') is False
+            time.sleep(0.06)
+
+        events = queue.claim(10)
+        assert events[0]['attempts'] == 2
+        assert queue.fail('evt_1', 'boom') is True
+        assert queue.claim(10) == []
+        assert queue.dead_letters()[0]['event_id'] == 'evt_1'
+        assert queue.dead_letters()[0]['last_error'] == 'boom'
+
+    def test_processing_events_recovered_after_restart(self, tmp_path):
+        """処理中に停止したイベントが再起動後に再処理されることをテスト"""
+        path = str(tmp_path / 'queue.db')
+        first = WebhookQueue(path=path)
+        first.enqueue('evt_1', 'checkout.session.completed', '{}')
+        first.claim(10)
+        first.close()
+
+        second = WebhookQueue(path=path)
+        assert [e['event_id'] for e in second.claim(10)] == ['evt_1']
+        second.close()
+
+
+class TestWebhookWorker:
+    """WebhookWorker クラスのテスト"""
+
+    def test_processes_events_with_bounded_concurrency(self, queue):
+        """同時実行数を超えずに全イベントを処理することをテスト"""
+        for i in range(6):
+            queue.enqueue(f'evt_{i}', 'checkout.session.completed', '{}')
+        worker = WebhookWorker(queue, concurrency=2, idle_poll_seconds=0.05)
+        state = {'running': 0, 'peak': 0, 'done': []}
+
+        async def handler(event):
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+            await asyncio.sleep(0.02)
+            state['running'] -= 1
+            state['done'].append(event['event_id'])
+
+        async def run():
+            worker.start(handler)
+            for _ in range(100):
+                if len(state['done']) == 6:
+                    break
+                await asyncio.sleep(0.02)
+            await worker.stop()
+
+        asyncio.run(run())
+        assert sorted(state['done']) == [f'evt_{i}' for i in range(6)]
+        assert state['peak'] <= 2
+        assert queue.next_due_in() is None
+
+    def test_failed_event_retried(self, queue):
+        """ハンドラが失敗したイベントが再試行されることをテスト"""
+        queue.enqueue('evt_1', 'checkout.session.completed', '{}')
+        worker = WebhookWorker(queue, concurrency=1, idle_poll_seconds=0.05)
+        attempts = []
+
+        async def handler(event):
+            attempts.append(event['attempts'])
+            if len(attempts) == 1:
+                raise RuntimeError("Firestore unavailable")
+
+        async def run():
+            worker.start(handler)
+            for _ in range(100):
+                if len(attempts) == 2:
+                    break
+                await asyncio.sleep(0.02)
+            await worker.stop()
+
+        asyncio.run(run())
+        assert attempts == [0, 1]
+        assert queue.next_due_in() is None
+
+
+class TestWebhookReconciler:
+    """WebhookReconciler クラスのテスト"""
+
+    def test_requeues_missing_events_with_watermark(self, queue):
+        """キューにないイベントだけを積み直し、2回目以降は前回の開始時刻からさかのぼって取得することをテスト"""
+        worker = MagicMock()
+        reconciler = WebhookReconciler(queue, worker, interval_seconds=60, lookback_seconds=3600,
+                                       overlap_seconds=300)
+        queue.enqueue('evt_known', 'checkout.session.completed', '{}')
+        calls = []
+
+        async def fetch_events(since):
+            calls.append(since)
+            return [
+                {'event_id': 'evt_known', 'event_type': 'checkout.session.completed', 'payload': '{}'},
+                {'event_id': 'evt_lost', 'event_type': 'checkout.session.completed', 'payload': '{}'},
+            ]
+        reconciler._fetch_events = fetch_events
+
+        before = time.time()
+        assert asyncio.run(reconciler.reconcile_once()) == 1
+        assert asyncio.run(reconciler.reconcile_once()) == 0
+
+        assert before - 3600 - 1 <= calls[0] <= before - 3600
+        assert before - 300 - 1 <= calls[1] <= time.time() - 300
+        assert sorted(e['event_id'] for e in queue.claim(10)) == ['evt_known', 'evt_lost']
+        worker.notify.assert_called_once()
+
+    def test_lists_events_across_pages(self):
+        """Stripeのイベント一覧をページをまたいで取得し、キューに積める形に変換することをテスト"""
+        def page(ids, has_more):
+            return stripe.StripeObject.construct_from({'object': 'list', 'has_more': has_more, 'data': [
+                {'id': event_id, 'object': 'event', 'type': 'checkout.session.completed',
+                 'data': {'object': {'id': f'cs_{event_id}', 'object': 'checkout.session'}}}
+                for event_id in ids
+            ]}, 'sk_test')
+
+        with patch('main.stripe_gateway.list_events',
+                   side_effect=[page(['evt_2', 'evt_1'], True), page(['evt_0'], False)]) as mock_list:
+            events = asyncio.run(_list_webhook_events(1_800_000_000))
+
+        assert [e['event_id'] for e in events] == ['evt_2', 'evt_1', 'evt_0']
+        assert json.loads(events[0]['payload'])['data']['object']['id'] == 'cs_evt_2'
+        assert mock_list.call_args_list[0].kwargs['created'] == {'gte': 1_800_000_000}
+        assert mock_list.call_args_list[1].kwargs['starting_after'] == 'evt_1'
+
+
+class TestStripeWebhookEndpoint:
+    """Webhookエンドポイントのテスト"""
+
+    def test_acks_and_processes_in_background(self, tmp_path):
+        """キューに保存した時点で応答し、ワーカーが購入内容を反映することをテスト"""
+        payload = {
+            'id': 'evt_test_webhook',
+            'object': 'event',
+            'type': 'checkout.session.completed',
+            'data': {'object': {
+                'id': 'cs_test_webhook',
+                'object': 'checkout.session',
+                'payment_status': 'paid',
+                'payment_intent': 'pi_test',
+                'metadata': {'device_id': 'device-webhook', 'product_type': 'license'}
+            }}
+        }
+        applied = []
+
+        def apply(db, device_id, session_id, payment_intent=None):
+            applied.append((device_id, session_id))
+            return MutationResult(applied=True)
+
+        with patch.object(webhook_queue, 'path', str(tmp_path / 'queue.db')), \
+             patch('main.stripe_config.webhook_secret', None), \
+             patch('main.firestore_config.initialize_firestore', return_value=True), \
+             patch('main.firestore_config.get_client', return_value=MagicMock()), \
+             patch('main.EntitlementMutator.apply_license_purchase', side_effect=apply):
+            with TestClient(app) as client:
+                response = client.post("/stripe-webhook", content=json.dumps(payload))
+                assert response.status_code == 200
+                assert response.json() == {"status": "received"}
+
+                for _ in range(100):
+                    if applied:
+                        break
+                    time.sleep(0.02)
+
+                # 反映済みセッションの再送はFirestoreに書き込まない
+                redelivery = client.post("/stripe-webhook", content=json.dumps(payload))
+                assert redelivery.status_code == 200
+                time.sleep(0.1)
+
+        assert applied == [('device-webhook', 'cs_test_webhook')]
+        device_cache.invalidate('device-webhook')
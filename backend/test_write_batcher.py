@@ -0,0 +1,86 @@
+"""
+書き込みコアレッサー（WriteBatcher）のテスト
+"""
+import asyncio
+import pytest
+from write_batcher import WriteBatcher
+
+
+class TestWriteBatcher:
+    """WriteBatcher クラスのテスト"""
+
+    def test_concurrent_submits_share_one_commit(self):
+        """同時に登録された要求が1回のコミットにまとめられることをテスト"""
+        commits = []
+
+        def commit(db, items):
+            commits.append(list(items))
+            return [item * 10 for item in items]
+
+        batcher = WriteBatcher(commit, flush_interval_seconds=0.01)
+
+        async def run():
+            return await asyncio.gather(*(batcher.submit('db', i) for i in range(5)))
+
+        assert asyncio.run(run()) == [0, 10, 20, 30, 40]
+        assert commits == [[0, 1, 2, 3, 4]]
+
+    def test_max_items_triggers_immediate_flush(self):
+        """上限件数に達した場合はフラッシュ間隔を待たずにコミットすることをテスト"""
+        commits = []
+
+        def commit(db, items):
+            commits.append(len(items))
+            return list(items)
+
+        batcher = WriteBatcher(commit, flush_interval_seconds=60, max_items=3)
+
+        async def run():
+            return await asyncio.wait_for(
+                asyncio.gather(*(batcher.submit('db', i) for i in range(6))), timeout=5
+            )
+
+        assert asyncio.run(run()) == [0, 1, 2, 3, 4, 5]
+        assert commits == [3, 3]
+
+    def test_per_item_exception(self):
+        """要求ごとの例外がその呼び出し元にだけ送出されることをテスト"""
+        def commit(db, items):
+            return [ValueError("conflict") if item == 'bad' else item for item in items]
+
+        batcher = WriteBatcher(commit, flush_interval_seconds=0.01)
+
+        async def run():
+            return await asyncio.gather(
+                batcher.submit('db', 'ok'), batcher.submit('db', 'bad'), return_exceptions=True
+            )
+
+        ok, bad = asyncio.run(run())
+        assert ok == 'ok'
+        assert isinstance(bad, ValueError)
+
+    def test_commit_failure_fails_all_items(self):
+        """コミット全体が失敗した場合は全ての呼び出し元に例外が送出されることをテスト"""
+        def commit(db, items):
+            raise RuntimeError("unavailable")
+
+        batcher = WriteBatcher(commit, flush_interval_seconds=0.01)
+
+        async def run():
+            return await asyncio.gather(
+                batcher.submit('db', 1), batcher.submit('db', 2), return_exceptions=True
+            )
+
+        assert all(isinstance(r, RuntimeError) for r in asyncio.run(run()))
+
+    def test_flush_commits_pending_immediately(self):
+        """flush() がためている要求を即座にコミットすることをテスト"""
+        batcher = WriteBatcher(lambda db, items: list(items), flush_interval_seconds=60)
+
+        async def run():
+            task = asyncio.ensure_future(batcher.submit('db', 'item'))
+            await asyncio.sleep(0)
+            await batcher.flush()
+            return await asyncio.wait_for(task, timeout=1)
+
+        assert asyncio.run(run()) == 'item'
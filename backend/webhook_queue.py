@@ -0,0 +1,437 @@
+"""
+Timekeeper Backend Webhook Queue
+Stripe Webhookイベントの永続キュー（SQLite）とバックグラウンド処理ワーカー
+
+キューはインスタンスのローカルディスクに置くため、永続性はインスタンスの寿命までに限られる
+（Cloud Run の /tmp はメモリ上にあり、インスタンスの停止で失われる）。Webhookは保存した時点で
+応答するため、処理前にインスタンスが停止したイベントはStripeから再送されない。
+このようなイベントは WebhookReconciler がStripeのイベント一覧から定期的に積み直して回収する。
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from io_executor import io_executor
+from structured_logging import get_logger
+
+# キューに積まれたイベントの状態
+STATUS_PENDING = 'pending'
+STATUS_PROCESSING = 'processing'
+STATUS_DEAD = 'dead'
+
+logger = get_logger(__name__)
+
+
+class WebhookQueue:
+    """
+    Webhookイベントの永続キュー
+
+    署名検証済みのイベントをSQLiteに保存し、ワーカーが取り出して処理する。
+    同じイベントIDの再送はStripe側のリトライとして1件にまとめる。
+    いずれのメソッドもブロッキングI/Oを行うため、io_executor 経由で呼び出すこと。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_attempts: Optional[int] = None,
+                 base_backoff_seconds: float = 1.0, max_backoff_seconds: float = 300.0):
+        self.path: str = path or os.getenv('WEBHOOK_QUEUE_PATH', '/tmp/timekeeper_webhook_queue.db')
+        self.max_attempts: int = max_attempts if max_attempts is not None else int(
+            os.getenv('WEBHOOK_MAX_ATTEMPTS', '8')
+        )
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """データベース接続を取得（初回はテーブル作成と中断中イベントの復旧を行う）"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.execute(
+                '''CREATE TABLE IF NOT EXISTS webhook_events (
+                    event_id TEXT PRIMARY KEY,
+                    event_type TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )'''
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_webhook_events_due '
+                'ON webhook_events (status, next_attempt_at)'
+            )
+            # 前回のプロセスが処理中に停止したイベントを再処理対象に戻す
+            conn.execute(
+                'UPDATE webhook_events SET status = ? WHERE status = ?',
+                (STATUS_PENDING, STATUS_PROCESSING)
+            )
+            self._conn = conn
+        return self._conn
+
+    def enqueue(self, event_id: str, event_type: str, payload: str) -> bool:
+        """
+        イベントを保存
+
+        Args:
+            event_id: StripeのイベントID
+            event_type: イベント種別
+            payload: イベント本文（JSON文字列）
+
+        Returns:
+            bool: 新規に保存した場合True（同じイベントIDが既に存在する場合False）
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._connect().execute(
+                'INSERT OR IGNORE INTO webhook_events '
+                '(event_id, event_type, payload, status, attempts, next_attempt_at, created_at) '
+                'VALUES (?, ?, ?, ?, 0, ?, ?)',
+                (event_id, event_type, payload, STATUS_PENDING, now, now)
+            )
+            return cursor.rowcount == 1
+
+    def claim(self, limit: int) -> List[Dict[str, Any]]:
+        """
+        処理時刻に達したイベントを取り出し、処理中にする
+
+        Args:
+            limit: 取り出す最大件数
+
+        Returns:
+            List[Dict[str, Any]]: event_id / event_type / payload / attempts を持つイベントのリスト
+        """
+        if limit <= 0:
+            return []
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    'SELECT event_id, event_type, payload, attempts FROM webhook_events '
+                    'WHERE status = ? AND next_attempt_at <= ? '
+                    'ORDER BY next_attempt_at LIMIT ?',
+                    (STATUS_PENDING, time.time(), limit)
+                ).fetchall()
+                conn.executemany(
+                    'UPDATE webhook_events SET status = ? WHERE event_id = ?',
+                    [(STATUS_PROCESSING, row[0]) for row in rows]
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return [
+            {'event_id': row[0], 'event_type': row[1], 'payload': row[2], 'attempts': row[3]}
+            for row in rows
+        ]
+
+    def complete(self, event_id: str) -> None:
+        """
+        処理が完了したイベントを削除
+
+        Args:
+            event_id: StripeのイベントID
+        """
+        with self._lock:
+            self._connect().execute('DELETE FROM webhook_events WHERE event_id = ?', (event_id,))
+
+    def fail(self, event_id: str, error: str) -> bool:
+        """
+        処理に失敗したイベントを指数バックオフ後の再試行に回す（上限回数でデッドレター化）
+
+        Args:
+            event_id: StripeのイベントID
+            error: エラー内容
+
+        Returns:
+            bool: デッドレターに移した場合True
+        """
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT attempts FROM webhook_events WHERE event_id = ?', (event_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            attempts = row[0] + 1
+            if attempts >= self.max_attempts:
+                conn.execute(
+                    'UPDATE webhook_events SET status = ?, attempts = ?, last_error = ? WHERE event_id = ?',
+                    (STATUS_DEAD, attempts, error, event_id)
+                )
+                return True
+            delay = min(self.base_backoff_seconds * (2 ** (attempts - 1)), self.max_backoff_seconds)
+            # 同時に失敗したイベントの再試行が揃わないようにジッターを加える
+            delay *= random.uniform(0.5, 1.0)
+            conn.execute(
+                'UPDATE webhook_events SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ? '
+                'WHERE event_id = ?',
+                (STATUS_PENDING, attempts, error, time.time() + delay, event_id)
+            )
+            return False
+
+    def next_due_in(self) -> Optional[float]:
+        """
+        次に処理時刻に達するイベントまでの秒数
+
+        Returns:
+            Optional[float]: 待機秒数（0以上）、待機中のイベントがない場合None
+        """
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT MIN(next_attempt_at) FROM webhook_events WHERE status = ?',
+                (STATUS_PENDING,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        デッドレターのイベントを取得
+
+        Args:
+            limit: 取得する最大件数
+
+        Returns:
+            List[Dict[str, Any]]: event_id / event_type / attempts / last_error を持つイベントのリスト
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT event_id, event_type, attempts, last_error FROM webhook_events '
+                'WHERE status = ? ORDER BY created_at LIMIT ?',
+                (STATUS_DEAD, limit)
+            ).fetchall()
+        return [
+            {'event_id': row[0], 'event_type': row[1], 'attempts': row[2], 'last_error': row[3]}
+            for row in rows
+        ]
+
+    def close(self) -> None:
+        """データベース接続を閉じる"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class WebhookWorker:
+    """
+    Webhookキューのバックグラウンド処理ワーカー
+
+    lifespan から start() で起動し、同時実行数を制限しながらイベントを処理する。
+    ハンドラが例外を送出したイベントは指数バックオフで再試行し、上限回数でデッドレターに移す。
+    """
+
+    def __init__(self, queue: WebhookQueue, concurrency: Optional[int] = None,
+                 idle_poll_seconds: float = 5.0):
+        self.queue = queue
+        self.concurrency: int = concurrency if concurrency is not None else int(
+            os.getenv('WEBHOOK_WORKER_CONCURRENCY', '8')
+        )
+        self.idle_poll_seconds = idle_poll_seconds
+        self._handler: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self._stopping = False
+
+    def start(self, handler: Callable[[Dict[str, Any]], Awaitable[Any]]) -> None:
+        """
+        ワーカーを起動
+
+        Args:
+            handler: キューから取り出したイベントを処理するコルーチン関数
+                     （引数は event_id / event_type / payload / attempts を持つ辞書）
+        """
+        if self._task is not None:
+            return
+        self._handler = handler
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def notify(self) -> None:
+        """新しいイベントが積まれたことをワーカーに通知"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """
+        新規の取り出しを止め、処理中のイベントの完了を待ってからワーカーを停止
+        時間内に完了しなかったイベントは次回起動時に再処理される
+
+        Args:
+            timeout: 処理中イベントの完了を待つ最大秒数
+        """
+        if self._task is None:
+            return
+        self._stopping = True
+        self.notify()
+        await self._task
+        if self._in_flight:
+            await asyncio.wait(self._in_flight, timeout=timeout)
+        self._task = None
+
+    async def _run(self) -> None:
+        """キューを監視し、空きスロット分のイベントを取り出して処理する"""
+        while not self._stopping:
+            self._wakeup.clear()
+            free_slots = self.concurrency - len(self._in_flight)
+            try:
+                events = await io_executor.run(self.queue.claim, free_slots)
+            except Exception as e:
+                logger.exception(f"Webhook queue error while claiming events: {str(e)}")
+                events = []
+
+            for event in events:
+                task = asyncio.create_task(self._process(event))
+                self._in_flight.add(task)
+                task.add_done_callback(self._on_task_done)
+
+            if events and len(self._in_flight) < self.concurrency:
+                continue
+            await self._wait_for_work()
+
+    async def _wait_for_work(self) -> None:
+        """次のイベントの到着、処理スロットの空き、または再試行時刻まで待機"""
+        timeout = self.idle_poll_seconds
+        if len(self._in_flight) < self.concurrency:
+            try:
+                due_in = await io_executor.run(self.queue.next_due_in)
+            except Exception:
+                due_in = None
+            if due_in is not None:
+                timeout = min(timeout, due_in)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        """処理完了時にスロットを解放し、ワーカーを起こす"""
+        self._in_flight.discard(task)
+        self.notify()
+
+    async def _process(self, event: Dict[str, Any]) -> None:
+        """1件のイベントを処理し、結果をキューに反映"""
+        try:
+            await self._handler(event)
+        except Exception as e:
+            dead = await io_executor.run(self.queue.fail, event['event_id'], str(e))
+            if dead:
+                logger.error(f"Webhook event moved to dead letter after {event['attempts'] + 1} attempts: {str(e)}", extra={
+                    'event_id': event['event_id'], 'event_type': event['event_type']
+                })
+            else:
+                logger.warning(f"Webhook event failed (attempt {event['attempts'] + 1}), will retry: {str(e)}", extra={
+                    'event_id': event['event_id'], 'event_type': event['event_type']
+                })
+            return
+        await io_executor.run(self.queue.complete, event['event_id'])
+
+
+class WebhookReconciler:
+    """
+    Stripeのイベント一覧とキューの突き合わせ（応答後に失われたイベントの回収）
+
+    直近のイベントを定期的にStripeから取得してキューに積み直す。初回は起動前の
+    lookback_seconds 秒分（他インスタンスの停止で失われたイベントを含む）、以降は前回の開始時刻から
+    overlap_seconds 秒さかのぼった時刻以降を対象とする。処理済みのイベントを積み直しても、
+    購入の反映は冪等性レコードで重複が除かれるため二重には反映されない（Firestoreの読み取りは発生する）。
+    """
+
+    def __init__(self, queue: WebhookQueue, worker: WebhookWorker, interval_seconds: Optional[float] = None,
+                 lookback_seconds: Optional[float] = None, overlap_seconds: float = 300.0):
+        self.queue = queue
+        self.worker = worker
+        self.interval_seconds: float = interval_seconds if interval_seconds is not None else float(
+            os.getenv('WEBHOOK_RECONCILE_INTERVAL_SECONDS', '900')
+        )
+        self.lookback_seconds: float = lookback_seconds if lookback_seconds is not None else float(
+            os.getenv('WEBHOOK_RECONCILE_LOOKBACK_SECONDS', '21600')
+        )
+        self.overlap_seconds = overlap_seconds
+        self._fetch_events: Optional[Callable[[int], Awaitable[List[Dict[str, Any]]]]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._last_started: Optional[float] = None
+
+    def start(self, fetch_events: Callable[[int], Awaitable[List[Dict[str, Any]]]]) -> None:
+        """
+        定期的な突き合わせを開始（interval_seconds が0以下の場合は何もしない）
+
+        Args:
+            fetch_events: 指定したUNIX時刻以降に作成されたイベントを取得するコルーチン関数
+                          （戻り値は event_id / event_type / payload を持つ辞書のリスト）
+        """
+        if self._task is not None or self.interval_seconds <= 0:
+            return
+        self._fetch_events = fetch_events
+        self._stop_event = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """突き合わせを停止（実行中の場合は中断する）"""
+        if self._task is None:
+            return
+        self._stop_event.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def reconcile_once(self) -> int:
+        """
+        直近のイベントを取得してキューに積み直す
+
+        Returns:
+            int: 新たにキューに積んだイベント数
+        """
+        started = time.time()
+        if self._last_started is None:
+            since = started - self.lookback_seconds
+        else:
+            since = self._last_started - self.overlap_seconds
+        events = await self._fetch_events(int(since))
+
+        queued = 0
+        for event in events:
+            if await io_executor.run(self.queue.enqueue, event['event_id'], event['event_type'], event['payload']):
+                queued += 1
+        self._last_started = started
+        if queued:
+            self.worker.notify()
+        logger.info(f"Webhook reconciliation queued {queued} of {len(events)} events", extra={
+            'rate_limit_key': 'webhook_reconciled'
+        })
+        return queued
+
+    async def _run(self) -> None:
+        """interval_seconds ごとに突き合わせを行う"""
+        while not self._stop_event.is_set():
+            try:
+                await self.reconcile_once()
+            except Exception as e:
+                logger.error(f"Webhook reconciliation failed: {str(e)}", extra={
+                    'rate_limit_key': 'webhook_reconcile_failed'
+                })
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self.interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+
+# グローバルなWebhookキュー・ワーカー・突き合わせインスタンス
+webhook_queue = WebhookQueue()
+webhook_worker = WebhookWorker(webhook_queue)
+webhook_reconciler = WebhookReconciler(webhook_queue, webhook_worker)
@@ -0,0 +1,92 @@
+"""
+Timekeeper Backend Write Batcher
+短いフラッシュ間隔で書き込み要求をまとめ、1回のコミットで反映するための汎用コアレッサー
+"""
+import asyncio
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from io_executor import io_executor
+
+
+class WriteBatcher:
+    """
+    書き込み要求のコアレッサー
+
+    submit() された要求をフラッシュ間隔の間ためておき、まとめて commit 関数に渡す。
+    commit 関数はブロッキングI/Oを行う同期関数で、要求と同じ順序で結果
+    （または要求ごとの例外）のリストを返す。呼び出し元は自分の要求の結果が
+    確定するまで待機するため、APIの意味は個別に書き込む場合と変わらない。
+    """
+
+    def __init__(self, commit: Callable[[Any, List[Any]], List[Any]],
+                 flush_interval_seconds: Optional[float] = None, max_items: int = 250):
+        self._commit = commit
+        self.flush_interval_seconds: float = flush_interval_seconds if flush_interval_seconds is not None else (
+            float(os.getenv('WRITE_BATCH_FLUSH_MS', '5')) / 1000.0
+        )
+        self.max_items = max_items
+        self._pending: List[Tuple[Any, Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set = set()
+
+    async def submit(self, db, item: Any) -> Any:
+        """
+        書き込み要求を登録し、コミットの完了を待つ
+
+        Args:
+            db: Firestoreクライアント
+            item: commit 関数に渡す要求
+
+        Returns:
+            Any: この要求に対する commit 関数の結果
+
+        Raises:
+            Exception: この要求（またはバッチ全体）のコミットに失敗した場合
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((db, item, future))
+
+        if len(self._pending) >= self.max_items:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval_seconds, self._start_flush)
+        return await future
+
+    async def flush(self) -> None:
+        """ためている要求を即座にコミットし、実行中のフラッシュを含めて完了を待つ"""
+        if self._pending:
+            self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def _start_flush(self) -> None:
+        """ためている要求を取り出し、コミットするタスクを開始"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        task = asyncio.ensure_future(self._flush(pending))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, pending: List[Tuple[Any, Any, asyncio.Future]]) -> None:
+        """要求をクライアントごとにまとめてコミットし、各要求の待機を解除"""
+        groups: Dict[int, Tuple[Any, List[Tuple[Any, asyncio.Future]]]] = {}
+        for db, item, future in pending:
+            groups.setdefault(id(db), (db, []))[1].append((item, future))
+
+        for db, entries in groups.values():
+            try:
+                results = await io_executor.run(self._commit, db, [item for item, _ in entries])
+            except Exception as e:
+                results = [e] * len(entries)
+            for (_, future), result in zip(entries, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)